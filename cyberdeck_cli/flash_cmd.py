@@ -5,8 +5,11 @@ from __future__ import annotations
 import glob as _glob
 import subprocess
 import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
-from typing import Optional
+from typing import List, Optional
 
 import typer
 from rich.console import Console
@@ -14,10 +17,18 @@ from rich.table import Table
 
 from cyberdeck_cli.registry import load_devices
 
+# inventory/app, so fleet flashing reuses the app's chip detection, USB hub grouping and esptool progress parsing
+_APP_DIR = Path(__file__).resolve().parent.parent / "inventory" / "app"
+
 app = typer.Typer(no_args_is_help=True)
 console = Console()
 
 
+def _inventory_app() -> None:
+    if str(_APP_DIR) not in sys.path:
+        sys.path.insert(0, str(_APP_DIR))
+
+
 def _detect_ports() -> list[str]:
     """Return available /dev/cu.usb* serial ports (macOS) or /dev/ttyUSB* (Linux)."""
     patterns = ["/dev/cu.usbmodem*", "/dev/cu.usbserial*", "/dev/ttyUSB*", "/dev/ttyACM*"]
@@ -118,3 +129,117 @@ def flash_write(
     else:
         console.print(f"\n[red]esptool exited with code {result.returncode}[/red]")
         raise typer.Exit(result.returncode)
+
+
+def _port_locations() -> dict[str, str]:
+    """Map port -> USB location (e.g. 1-1.2:1.0) from pyserial; empty if unavailable."""
+    try:
+        from serial.tools import list_ports
+    except ImportError:
+        return {}
+    return {p.device: (p.location or "") for p in list_ports.comports()}
+
+
+def _detect_chip(port: str) -> Optional[str]:
+    """Return esptool chip name (e.g. esp32s3) on port, or None (flash_ops: esptool v4 and v5 output)."""
+    _inventory_app()
+    from flash_ops import detect_chip_on_port
+
+    chip, _ = detect_chip_on_port(port, timeout=15)
+    return chip
+
+
+@app.command("fleet")
+def flash_fleet(
+    binary: str = typer.Argument(..., help="Path to .bin firmware file"),
+    port: Optional[List[str]] = typer.Option(None, "--port", help="Target port (repeat for several)"),
+    chip: Optional[str] = typer.Option(None, help="Flash every detected port with this chip (e.g. esp32s3)"),
+    device: str = typer.Option("t_beam_1w", help="Device ID for chip lookup"),
+    offset: str = typer.Option("0x0", help="Flash offset (0x0 for factory, 0x10000 for app)"),
+    max_per_hub: int = typer.Option(4, help="Max concurrent writes behind one USB hub"),
+) -> None:
+    """Write one firmware binary to many devices concurrently (one worker per port)."""
+    if not Path(binary).is_file():
+        console.print(f"[red]File not found: {binary}[/red]")
+        raise typer.Exit(1)
+
+    ports = list(port or [])
+    if not ports:
+        if not chip:
+            console.print("[red]Pass --port (repeatable) or --chip to select devices.[/red]")
+            raise typer.Exit(1)
+        candidates = _detect_ports()
+        console.print(f"Detecting chips on {len(candidates)} port(s)…")
+        with ThreadPoolExecutor(max_workers=max(1, len(candidates))) as pool:
+            chips = dict(zip(candidates, pool.map(_detect_chip, candidates)))
+        ports = [p for p, c in chips.items() if c == chip.lower()]
+        if not ports:
+            console.print(f"[red]No ports with chip {chip} detected.[/red]")
+            raise typer.Exit(1)
+
+    _inventory_app()
+    from fleet_ops import usb_hub_of
+    from flash_ops import _esptool_progress_parser, _run_streaming
+
+    devices = load_devices()
+    d = devices.get(device, {})
+    dev_chip = d.get("capability", {}).get("chip", "esp32s3")
+    locations = _port_locations()
+    hub_sems: dict[str, threading.Semaphore] = {}
+    for p in ports:
+        hub_sems.setdefault(usb_hub_of(locations.get(p, "")), threading.Semaphore(max(1, max_per_hub)))
+
+    def _flash_one(p: str) -> tuple[str, int, float, str]:
+        with hub_sems[usb_hub_of(locations.get(p, ""))]:
+            started = time.time()
+            console.print(f"  {p}: started")
+            shown = {"stage": None, "step": -1}
+
+            def progress(line, stage=None, pct=None, **_):
+                # One line per stage and per 10%, so parallel devices stay readable
+                if pct is None or (stage == shown["stage"] and int(pct // 10) <= shown["step"]):
+                    return
+                shown.update(stage=stage, step=int(pct // 10))
+                console.print(f"  {p}: {stage or 'progress'} {int(pct)}%")
+
+            cmd = [
+                sys.executable, "-m", "esptool",
+                "--chip", dev_chip,
+                "--port", p,
+                "write_flash", offset, binary,
+            ]
+            rc, out, status = _run_streaming(cmd, 600, on_line=_esptool_progress_parser(progress))
+            if status == "timeout":
+                rc, out = 1, "timeout"
+            return p, rc, time.time() - started, (out or "").strip()
+
+    console.print(f"[bold]Flashing {binary} to {len(ports)} device(s)[/bold] (max {max_per_hub} per hub)\n")
+    results = []
+    with ThreadPoolExecutor(max_workers=len(ports)) as pool:
+        futures = [pool.submit(_flash_one, p) for p in ports]
+        for fut in as_completed(futures):
+            p, rc, secs, out = fut.result()
+            results.append((p, rc, secs, out))
+            mark = "[green]ok[/green]" if rc == 0 else "[red]failed[/red]"
+            console.print(f"  {p}: {mark} ({secs:.1f}s)")
+
+    table = Table(title="Fleet Flash Results")
+    table.add_column("Port", style="cyan")
+    table.add_column("Hub")
+    table.add_column("Result")
+    table.add_column("Time")
+    table.add_column("Error")
+    for p, rc, secs, out in sorted(results):
+        table.add_row(
+            p,
+            usb_hub_of(locations.get(p, "")),
+            "[green]ok[/green]" if rc == 0 else "[red]failed[/red]",
+            f"{secs:.1f}s",
+            "" if rc == 0 else out.splitlines()[-1][:80] if out else f"exit {rc}",
+        )
+    console.print(table)
+    failed = sum(1 for r in results if r[1] != 0)
+    if failed:
+        console.print(f"\n[red]{failed} of {len(results)} device(s) failed.[/red]")
+        raise typer.Exit(1)
+    console.print(f"\n[green]All {len(results)} device(s) flashed.[/green]")
@@ -5,6 +5,7 @@ Run from repo root: python inventory/app/app.py
 Then open http://127.0.0.1:5000
 """
 import base64
+import hmac
 import json
 import os
 import re
@@ -13,7 +14,6 @@ import subprocess
 import sys
 import tempfile
 import threading
-import time
 from urllib.parse import unquote
 
 from flask import Flask, Response, jsonify, render_template, request, send_file, stream_with_context
@@ -35,16 +35,48 @@ from config import (
     save_ai_settings,
     get_path_settings,
     save_path_settings,
+    GIT_MIRROR_FETCH_INTERVAL,
+    BUILD_WORKER_TOKEN,
 )
 from updates import get_updates
+import backup_store
+from baud_tuner import delete_profile, list_profiles
+from compiler_cache import cache_stats as ccache_stats, clear as clear_ccache
+from git_mirrors import list_mirrors as list_git_mirrors, setup as setup_firmware_repo, update as update_git_mirror, update_all as update_git_mirrors
+from footprint import get as get_footprint, history as footprint_history
+from build_workers import (
+    append_log as build_worker_log,
+    claim as build_worker_claim,
+    complete as build_worker_complete,
+    heartbeat as build_worker_heartbeat,
+    list_workers as list_build_workers,
+)
+from build_stats import slowest_units as build_slowest_units, trends as build_trends
+from build_runner import list_runners as list_build_runners, recycle as recycle_build_runners
+from build_worktrees import list_worktrees as list_build_worktrees
+from build_jobs import (
+    budget_status as build_budget_status,
+    cancel_build,
+    get_build,
+    iter_build_events,
+    list_builds,
+    log_path as build_log_path,
+    submit_build,
+    wait_build,
+)
+from build_matrix import cancel_matrix, get_matrix, list_matrices, resolve_matrix_targets, start_matrix
+from flash_jobs import (
+    cancel_job,
+    get_job,
+    iter_job_events,
+    latest_backup_progress,
+    list_jobs,
+    submit_job,
+    wait_job,
+)
 from flash_ops import (
-    _kill_esptool_on_port,
-    backup_flash,
-    build_firmware,
     delete_artifact_or_backup,
     download_release_firmware,
-    flash_firmware,
-    get_alternate_port,
     get_backup_progress,
     get_build_config,
     get_flash_devices,
@@ -52,8 +84,13 @@ from flash_ops import (
     list_patches,
     list_serial_ports,
     list_serial_ports_with_detection,
-    restore_flash,
 )
+from fleet_ops import get_fleet, list_fleets, resolve_fleet_ports, start_fleet_flash
+from port_leases import list_leases
+from telemetry import recent_operations, stats as telemetry_stats
+from artifact_index import reconcile as reconcile_artifact_index
+from retention import plan as retention_plan, run_gc as run_artifact_gc
+from usb_watch import list_usb_devices, watch_mode
 from project_ops import (
     bom_csv_digikey,
     bom_csv_mouser,
@@ -81,6 +118,7 @@ from debug_ops import (
     serial_clear_buffer,
     serial_get_buffer,
     serial_is_active,
+    serial_is_paused,
     serial_start,
     serial_stop,
 )
@@ -1782,7 +1820,7 @@ def api_ai_device_context():
 def api_debug_serial():
     """Get current serial monitor buffer and active port."""
     lines, port = serial_get_buffer()
-    return jsonify({"lines": lines, "active_port": port, "active": serial_is_active()})
+    return jsonify({"lines": lines, "active_port": port, "active": serial_is_active(), "paused": serial_is_paused()})
 
 
 @app.route("/api/debug/serial/start", methods=["POST"])
@@ -1831,10 +1869,10 @@ def api_debug_tools_esptool():
 
 @app.route("/api/flash/ports")
 def api_flash_ports():
-    """List serial ports. Query ?detect=1 to auto-detect chip on each port (slower)."""
+    """List serial ports. Query ?detect=1 to auto-detect chip on each port (parallel, cached per USB device); &refresh=1 re-probes."""
     try:
         if request.args.get("detect") == "1":
-            ports = list_serial_ports_with_detection(timeout_per_port=4)
+            ports = list_serial_ports_with_detection(timeout_per_port=4, refresh=request.args.get("refresh") == "1")
         else:
             ports = list_serial_ports()
         payload = {"ports": ports}
@@ -1846,6 +1884,18 @@ def api_flash_ports():
         return jsonify({"error": str(e), "ports": []}), 500
 
 
+@app.route("/api/flash/usb")
+def api_flash_usb():
+    """Live USB serial device map from the hotplug watcher: identity (VID:PID:serial), current port, chip, MAC, connected."""
+    return jsonify({"devices": list_usb_devices(), "mode": watch_mode()})
+
+
+@app.route("/api/flash/leases")
+def api_flash_leases():
+    """Serial port leases: holder (job or serial monitor), how long it has held the port, queued waiters, paused monitor."""
+    return jsonify({"leases": list_leases()})
+
+
 @app.route("/api/flash/devices")
 def api_flash_devices():
     """List devices supported for flash/backup (esptool chip, flash_size). Reload config so list is current without restart."""
@@ -1860,14 +1910,29 @@ def api_flash_devices():
 
 @app.route("/api/flash/artifacts")
 def api_flash_artifacts():
-    """List firmware artifacts and backups (paths for flash/restore).
-    Optional ?firmware=meshtastic|meshcore|launcher to filter artifacts by target (internal, launcher-compatible)."""
+    """List firmware artifacts and backups (paths for flash/restore) from the artifact index, newest first.
+    Optional ?firmware=meshtastic|meshcore|launcher to filter artifacts by target (internal, launcher-compatible);
+    ?type=artifact|backup, ?device=, ?source=build|ota|backup|manual, ?q= (name contains), ?sort=created_at|name|size|...,
+    ?order=asc|desc, ?limit=; ?refresh=1 rescans artifacts/ first."""
     from config import FIRMWARE_TARGETS
     firmware = (request.args.get("firmware") or "").strip().lower()
     if firmware and firmware not in FIRMWARE_TARGETS:
         firmware = ""
+    limit = request.args.get("limit", type=int)
     try:
-        return jsonify({"files": list_artifacts_and_backups(firmware_filter=firmware or None)})
+        if request.args.get("refresh") in ("1", "true", "yes"):
+            reconcile_artifact_index(force=True)
+        files = list_artifacts_and_backups(
+            firmware_filter=firmware or None,
+            kind=(request.args.get("type") or "").strip().lower() or None,
+            device=(request.args.get("device") or "").strip() or None,
+            source=(request.args.get("source") or "").strip().lower() or None,
+            q=(request.args.get("q") or "").strip() or None,
+            sort=(request.args.get("sort") or "created_at").strip().lower(),
+            descending=(request.args.get("order") or "desc").strip().lower() != "asc",
+            limit=limit if limit and limit > 0 else None,
+        )
+        return jsonify({"files": files})
     except Exception as e:
         return jsonify({"error": str(e), "files": []}), 500
 
@@ -1896,8 +1961,11 @@ def api_flash_patches():
 
 @app.route("/api/flash/build", methods=["POST"])
 def api_flash_build():
-    """Build firmware. Body: device_id, firmware_id, env_name; optional: patch_paths, clean, verbose, timeout, flash_after, port. Returns { success, path?, flashed?, error? }."""
-    data = request.get_json() or request.form or {}
+    """Build firmware. Body: device_id, firmware_id, env_name; optional: patch_paths, clean, verbose, timeout, flash_after, port,
+    cache (default true; false or clean rebuilds even when an identical build exists), git_ref (tag / branch / commit to build
+    instead of the checkout's HEAD, via the shared git mirror). Returns { success, path?, cached?, flashed?, error? }. With async=true returns 202 { build_id } instead; follow
+    GET /api/flash/builds/<build_id>/events (with flash_after, result.flash_job_id is the follow-on flash job)."""
+    data = request.get_json(silent=True) or request.form or {}
     device_id = (data.get("device_id") or "").strip()
     firmware_id = (data.get("firmware_id") or "").strip()
     env_name = (data.get("env_name") or "").strip()
@@ -1916,24 +1984,352 @@ def api_flash_build():
     flash_device_id = (data.get("flash_device_id") or data.get("device_id") or "").strip()
     if not device_id or not firmware_id:
         return jsonify({"success": False, "error": "device_id and firmware_id required"}), 400
+    build_id = submit_build(
+        device_id, firmware_id, env_name, patch_paths=patch_paths, timeout=timeout, clean=clean, verbose=verbose,
+        flash_port=port if flash_after and flash_device_id else None, flash_device_id=flash_device_id,
+        use_cache=data.get("cache") not in (False, "0", "false", "no"), git_ref=(data.get("git_ref") or "").strip() or None,
+    )
+    if _wants_async(data):
+        return jsonify({"build_id": build_id}), 202
+    build = wait_build(build_id)
+    if build["status"] != "done":
+        return jsonify({"success": False, "build_id": build_id, "error": build["error"] or f"Build {build['status']}"}), 500
+    result = build["result"]
+    if result.get("flash_error"):
+        return jsonify({"success": True, "path": result["path"], "error": result["flash_error"]}), 500
+    out = {
+        "success": True, "path": result["path"], "cached": result["cached"], "ccache": result.get("ccache"),
+        "runner_saved_s": result.get("runner_saved_s"), "footprint": result.get("footprint"), "commit": result.get("commit"),
+        "worker": result.get("worker"),
+    }
+    if result.get("flash_job_id"):
+        job = wait_job(result["flash_job_id"])
+        if job is None:
+            # Finished and pruned from the job list before this request got to wait for it
+            return jsonify({**out, "flashed": None, "flash_error": "Flash job result no longer available"})
+        if job["status"] != "done":
+            return jsonify({**out, "flashed": False, "flash_error": job["error"] or job["status"]})
+        return jsonify({**out, "flashed": True})
+    return jsonify(out)
+
+
+@app.route("/api/flash/builds")
+def api_flash_builds():
+    """Recent firmware builds (newest first) and the build CPU / memory budget in use. Query: active=1 for queued/running only."""
+    active = (request.args.get("active") or "").lower() in ("1", "true", "yes")
+    return jsonify({"builds": list_builds(active_only=active), "budget": build_budget_status()})
+
+
+@app.route("/api/flash/builds/worktrees")
+def api_flash_build_worktrees():
+    """Git worktrees used by patched builds (one per firmware repo, env and patch set), least recently used first."""
+    return jsonify({"worktrees": list_build_worktrees()})
+
+
+@app.route("/api/flash/builds/stats")
+def api_flash_build_stats():
+    """Build time trends per device/firmware/env and period. Query: device_id, firmware_id, env_name, days (default 30),
+    bucket (day | week). Each period: builds, failed, cached, duration_s, queued_s, phases (mean seconds), units, ccache_hit_rate."""
+    targets, err = build_trends(
+        device_id=(request.args.get("device_id") or "").strip() or None,
+        firmware_id=(request.args.get("firmware_id") or "").strip() or None,
+        env_name=(request.args.get("env_name") or "").strip() or None,
+        since_days=request.args.get("days", default=30, type=float),
+        bucket=(request.args.get("bucket") or "day").strip().lower(),
+    )
+    if targets is None:
+        return jsonify({"error": err}), 400
+    return jsonify({"targets": targets})
+
+
+@app.route("/api/flash/builds/stats/units")
+def api_flash_build_stats_units():
+    """Slowest translation units by mean compile time. Query: device_id, firmware_id, env_name, days, limit (default 20)."""
+    units, err = build_slowest_units(
+        device_id=(request.args.get("device_id") or "").strip() or None,
+        firmware_id=(request.args.get("firmware_id") or "").strip() or None,
+        env_name=(request.args.get("env_name") or "").strip() or None,
+        since_days=request.args.get("days", type=float),
+        limit=min(request.args.get("limit", default=20, type=int), 500),
+    )
+    if units is None:
+        return jsonify({"error": err}), 400
+    return jsonify({"units": units})
+
+
+@app.route("/api/flash/git-mirrors")
+def api_flash_git_mirrors():
+    """Shared bare mirrors of firmware upstreams: url, path, last_fetch, fetch_s, ok, error, queued."""
+    return jsonify({"mirrors": list_git_mirrors(), "fetch_interval": GIT_MIRROR_FETCH_INTERVAL})
+
+
+@app.route("/api/flash/git-mirrors/update", methods=["POST"])
+def api_flash_git_mirrors_update():
+    """Queue a fetch from upstream on the mirror updater. Body: url (optional; default every mirror). Returns 202 { queued }."""
+    data = request.get_json(silent=True) or {}
+    url = (data.get("url") or "").strip()
+    if not url:
+        return jsonify({"queued": update_git_mirrors()}), 202
+    ok, err = update_git_mirror(url, wait=False)
+    if not ok:
+        return jsonify({"error": err}), 400
+    return jsonify({"queued": [url]}), 202
+
+
+@app.route("/api/flash/firmware-repos/setup", methods=["POST"])
+def api_flash_firmware_repo_setup():
+    """Set up a BUILD_CONFIG firmware checkout from its git mirror (clone borrowing the mirror's objects, or attach an
+    existing checkout). Body: device_id, firmware_id; optional url (default git_url), ref. Returns { success, path, url, commit, cloned }."""
+    data = request.get_json(silent=True) or {}
+    ok, info = setup_firmware_repo(
+        (data.get("device_id") or "").strip(), (data.get("firmware_id") or "").strip(),
+        url=(data.get("url") or "").strip() or None, ref=(data.get("ref") or "").strip() or None,
+    )
+    if not ok:
+        return jsonify({"success": False, "error": info}), 400
+    return jsonify({"success": True, **info})
+
+
+@app.route("/api/flash/builds/footprint")
+def api_flash_build_footprint():
+    """Firmware footprint. Query path (artifact dir or file): that build's full footprint.json (sections, symbols, diff).
+    Otherwise device_id and firmware_id (env_name optional, limit default 50): footprint summaries, newest first."""
+    path = (request.args.get("path") or "").strip()
+    if path:
+        fp = get_footprint(path)
+        if fp is None:
+            return jsonify({"error": "No footprint for this artifact"}), 404
+        return jsonify(fp)
+    device_id = (request.args.get("device_id") or "").strip()
+    firmware_id = (request.args.get("firmware_id") or "").strip()
+    if not device_id or not firmware_id:
+        return jsonify({"error": "path or device_id and firmware_id required"}), 400
+    return jsonify({"builds": footprint_history(
+        device_id, firmware_id, env_name=(request.args.get("env_name") or "").strip() or None,
+        limit=min(request.args.get("limit", default=50, type=int), 500),
+    )})
+
+
+def _build_worker_denied():
+    """Error response unless the request carries BUILD_WORKER_TOKEN (X-Build-Worker-Token); 403 when no token is
+    configured (remote builds off), 401 when it does not match."""
+    if not BUILD_WORKER_TOKEN:
+        return jsonify({"error": "Remote builds are off: set BUILD_WORKER_TOKEN on the inventory app"}), 403
+    if not hmac.compare_digest(request.headers.get("X-Build-Worker-Token") or "", BUILD_WORKER_TOKEN):
+        return jsonify({"error": "Invalid build worker token"}), 401
+    return None
+
+
+@app.route("/api/flash/build-workers")
+def api_flash_build_workers():
+    """Remote build workers (live first: slots, claimed, load, toolchain, warm targets, builds_done) and builds waiting for one."""
+    workers, queued = list_build_workers()
+    return jsonify({"workers": workers, "queued": queued})
+
+
+@app.route("/api/flash/build-workers/heartbeat", methods=["POST"])
+def api_flash_build_worker_heartbeat():
+    """Worker registration / keepalive. Body: worker_id, host, slots, running, load, cpus, runner, toolchain, targets."""
+    denied = _build_worker_denied()
+    if denied:
+        return denied
+    ok, err = build_worker_heartbeat(request.get_json(silent=True) or {})
+    if not ok:
+        return jsonify({"error": err}), 400
+    return jsonify({"ok": True})
+
+
+@app.route("/api/flash/build-workers/claim", methods=["POST"])
+def api_flash_build_worker_claim():
+    """Long-poll for a build. Body: worker_id, wait (seconds, max 60). Returns the job spec, or 204 when there is none."""
+    denied = _build_worker_denied()
+    if denied:
+        return denied
+    data = request.get_json(silent=True) or {}
+    worker_id = str(data.get("worker_id") or "").strip()
+    if not worker_id:
+        return jsonify({"error": "worker_id required"}), 400
     try:
-        ok, path_or_err = build_firmware(
-            device_id, firmware_id, env_name,
-            patch_paths=patch_paths, timeout=timeout, clean=clean, verbose=verbose,
-        )
-        if not ok:
-            return jsonify({"success": False, "error": path_or_err}), 500
-        if flash_after and port and flash_device_id:
-            abs_path = os.path.join(REPO_ROOT, path_or_err)
-            if not os.path.isfile(abs_path):
-                return jsonify({"success": True, "path": path_or_err, "error": "Built but flash file not found"}), 500
-            flashed_ok, flash_msg = flash_firmware(port, flash_device_id, abs_path)
-            if not flashed_ok:
-                return jsonify({"success": True, "path": path_or_err, "flashed": False, "flash_error": flash_msg})
-            return jsonify({"success": True, "path": path_or_err, "flashed": True})
-        return jsonify({"success": True, "path": path_or_err})
-    except Exception as e:
-        return jsonify({"success": False, "error": str(e)[:300]}), 500
+        wait = float(data.get("wait") or 20)
+    except (TypeError, ValueError):
+        wait = 20
+    spec = build_worker_claim(worker_id, wait=wait)
+    if spec is None:
+        return Response(status=204)
+    return jsonify(spec)
+
+
+@app.route("/api/flash/build-workers/jobs/<build_id>/log", methods=["POST"])
+def api_flash_build_worker_log(build_id):
+    """Build output from the worker. Body: worker_id, lines. Returns { cancel } (true: stop the build); 409 if no longer its build."""
+    denied = _build_worker_denied()
+    if denied:
+        return denied
+    data = request.get_json(silent=True) or {}
+    lines = data.get("lines") if isinstance(data.get("lines"), list) else []
+    ok, cancel = build_worker_log(str(data.get("worker_id") or ""), build_id, lines)
+    if not ok:
+        return jsonify({"error": cancel, "cancel": True}), 409
+    return jsonify({"cancel": cancel})
+
+
+@app.route("/api/flash/build-workers/jobs/<build_id>/result", methods=["POST"])
+def api_flash_build_worker_result(build_id):
+    """Build result upload (multipart): worker_id, ok (1/0), error, meta (JSON: toolchain, duration_s) and files
+    firmware.bin, firmware.elf, partitions.bin. 409 if the build is no longer the worker's."""
+    denied = _build_worker_denied()
+    if denied:
+        return denied
+    try:
+        meta = json.loads(request.form.get("meta") or "{}")
+    except ValueError:
+        meta = {}
+    ok, err = build_worker_complete(
+        (request.form.get("worker_id") or "").strip(), build_id, request.form.get("ok") == "1",
+        error=(request.form.get("error") or "").strip()[:400] or None, meta=meta, files=request.files,
+    )
+    if not ok:
+        return jsonify({"error": err}), 409
+    return jsonify({"ok": True})
+
+
+@app.route("/api/flash/builds/ccache")
+def api_flash_build_ccache():
+    """Shared compiler cache totals: dir, max_size, size_bytes, files, hits, misses, hit_rate, available."""
+    return jsonify(ccache_stats())
+
+
+@app.route("/api/flash/builds/ccache/clear", methods=["POST"])
+def api_flash_build_ccache_clear():
+    """Empty the shared compiler cache and zero its statistics."""
+    ok, err = clear_ccache()
+    if not ok:
+        return jsonify({"success": False, "error": err}), 400
+    return jsonify({"success": True})
+
+
+@app.route("/api/flash/builds/runners")
+def api_flash_build_runners():
+    """Warm build containers (one per toolchain): builds served, cold start they save, image current, health."""
+    runners, err = list_build_runners()
+    if err:
+        return jsonify({"error": err, "runners": []}), 503
+    return jsonify({"runners": runners})
+
+
+@app.route("/api/flash/builds/runners/recycle", methods=["POST"])
+def api_flash_build_runners_recycle():
+    """Remove the warm build container for toolchain (platformio or idf; omitted = all); the next build starts a fresh one."""
+    data = request.get_json(silent=True) or {}
+    ok, result = recycle_build_runners((data.get("toolchain") or "").strip() or None)
+    if not ok:
+        return jsonify({"success": False, "error": result}), 400
+    return jsonify({"success": True, "removed": result})
+
+
+@app.route("/api/flash/builds/<build_id>")
+def api_flash_build_status(build_id):
+    """Build status, params, result (path, flash_job_id)/error and the last log_lines lines of output."""
+    build = get_build(build_id, log_lines=int(request.args.get("log_lines") or 50))
+    if not build:
+        return jsonify({"error": "Build not found"}), 404
+    return jsonify(build)
+
+
+@app.route("/api/flash/builds/<build_id>/events")
+def api_flash_build_events(build_id):
+    """SSE stream of build snapshots, each with the new output lines in "log", until the build finishes.
+    Query: after=<n> to skip the first n lines (resume after a reconnect)."""
+    if not get_build(build_id, log_lines=0):
+        return jsonify({"error": "Build not found"}), 404
+    after = int(request.args.get("after") or 0)
+
+    def generate():
+        for snap in iter_build_events(build_id, after_line=after):
+            yield ": keepalive\n\n" if snap is None else _sse_event(snap)
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.route("/api/flash/builds/<build_id>/log")
+def api_flash_build_log(build_id):
+    """Full build output (text/plain), also for builds no longer in the recent list."""
+    if not re.fullmatch(r"[0-9a-f]{12}", build_id):
+        return jsonify({"error": "Invalid build id"}), 400
+    path = build_log_path(build_id)
+    if not os.path.isfile(path):
+        return jsonify({"error": "Build log not found"}), 404
+    return send_file(path, mimetype="text/plain")
+
+
+@app.route("/api/flash/builds/<build_id>/cancel", methods=["POST"])
+def api_flash_build_cancel(build_id):
+    """Cancel a queued or running build (the pio / lab-build.sh process tree is killed)."""
+    ok, err = cancel_build(build_id)
+    if not ok:
+        return jsonify({"success": False, "error": err}), 404 if err == "Build not found" else 409
+    return jsonify({"success": True})
+
+
+def _name_list(data, key: str):
+    """List option from JSON (list) or a comma-separated string; None when absent."""
+    val = data.get(key)
+    if isinstance(val, str):
+        val = [v.strip() for v in val.split(",") if v.strip()]
+    return [v for v in val if isinstance(v, str)] if val else None
+
+
+@app.route("/api/flash/build-matrix", methods=["POST"])
+def api_flash_build_matrix():
+    """Build devices x firmware x envs from BUILD_CONFIG concurrently. Body: devices, firmware, envs (lists; omitted = all)
+    or targets [{ device_id, firmware_id, env_name, patch_paths? }]; optional jobs (pio -j per build), clean, cache
+    (default true), prefetch (default true). Returns 202 { matrix_id, targets }; poll GET /api/flash/build-matrix/<matrix_id>."""
+    data = request.get_json(silent=True) or {}
+    targets, err = resolve_matrix_targets(
+        devices=_name_list(data, "devices"), firmware=_name_list(data, "firmware"), envs=_name_list(data, "envs"),
+        targets=data.get("targets") if isinstance(data.get("targets"), list) else None,
+    )
+    if err:
+        return jsonify({"error": err}), 400
+    try:
+        jobs = int(data.get("jobs") or 0) or None
+    except (TypeError, ValueError):
+        return jsonify({"error": "jobs must be a number"}), 400
+    matrix_id = start_matrix(
+        targets, jobs=jobs, clean=bool(data.get("clean")),
+        use_cache=data.get("cache") not in (False, "0", "false", "no"),
+        prefetch=data.get("prefetch") not in (False, "0", "false", "no"),
+    )
+    return jsonify({"matrix_id": matrix_id, "targets": [f"{t['device_id']}/{t['firmware_id']}/{t['env_name']}".rstrip("/") for t in targets]}), 202
+
+
+@app.route("/api/flash/build-matrix")
+def api_flash_build_matrix_list():
+    """Recent build matrices."""
+    return jsonify({"matrices": list_matrices()})
+
+
+@app.route("/api/flash/build-matrix/<matrix_id>")
+def api_flash_build_matrix_get(matrix_id):
+    """Matrix report: per-target status (queued, installing, waiting_budget, running, done, error, cancelled), artifact path,
+    cached, duration_s, jobs; per-project package install; summary counts, wall_s, build_s and parallelism."""
+    matrix = get_matrix(matrix_id)
+    if not matrix:
+        return jsonify({"error": "Matrix not found"}), 404
+    return jsonify(matrix)
+
+
+@app.route("/api/flash/build-matrix/<matrix_id>/cancel", methods=["POST"])
+def api_flash_build_matrix_cancel(matrix_id):
+    """Cancel a running build matrix (package installs and all of its builds)."""
+    ok, err = cancel_matrix(matrix_id)
+    if not ok:
+        return jsonify({"success": False, "error": err}), 404 if err == "Matrix not found" else 409
+    return jsonify({"success": True})
 
 
 @app.route("/api/flash/download-release", methods=["POST"])
@@ -1960,119 +2356,136 @@ def api_flash_download_release():
         return jsonify({"success": False, "error": str(e)[:300]}), 500
 
 
-def _flash_error_message(raw: str) -> str:
-    """Strip ANSI codes and return a clear message for common errors (e.g. port busy, timeout)."""
-    if not raw:
-        return "Unknown error"
-    s = re.sub(r"\x1b\[[0-9;]*m", "", raw)
-    s = s.replace("\r", " ").replace("\n", " ").strip()
-    low = s.lower()
-    if "port is busy" in low or "resource temporarily unavailable" in low or "could not exclusively lock" in low:
-        return "Port is busy or in use. Close Serial Monitor (Debug tab) and any other app using the port, then try again."
-    if "no serial data received" in low or "failed to connect" in low:
-        return "Could not connect to device. Put the board in bootloader mode (hold BOOT, press RESET, release BOOT), then try again. Also try Refresh & detect devices — the port may have changed."
-    if ("could not open" in low or "doesn't exist" in low or "no such file" in low) and "port" in low:
-        return "Port not found — device may have disconnected or the port changed after a reset. Click Refresh & detect devices and try again."
-    if s.strip().lower() == "timeout":
-        return "Backup timed out. Full flash can take 20+ minutes; try again or use a smaller backup (e.g. App partition only)."
-    return s[:400] if len(s) > 400 else s
-
-
-def _release_port(port: str, wait_longer: bool = False) -> None:
-    """Release a serial port: stop Serial Monitor if active, kill any stale esptool on it, then wait for OS release."""
-    if serial_is_active():
-        serial_stop()
-    _kill_esptool_on_port(port)
-    time.sleep(2.0 if wait_longer else 1.0)
+def _form_flag(data, key: str) -> bool:
+    """Boolean option from JSON (true) or form/query (1, true, yes)."""
+    val = data.get(key) if data else None
+    if isinstance(val, bool):
+        return val
+    return str(val or request.args.get(key) or "").strip().lower() in ("1", "true", "yes")
+
+
+def _wants_async(data) -> bool:
+    """True when the client asked for a background job (JSON async: true, or form async=1/true)."""
+    return _form_flag(data, "async")
+
+
+def _job_failed_response(job: dict):
+    """Error JSON for a finished sync job; cancelled jobs get 409."""
+    if job["status"] == "cancelled":
+        return jsonify({"success": False, "error": "Cancelled"}), 409
+    return jsonify({"success": False, "error": job["error"] or "Unknown error"}), 500
 
 
 @app.route("/api/flash/backup", methods=["POST"])
 def api_flash_backup():
-    """Backup device flash (full, app, or nvs). Optional name for the backup file. Returns .bin file download."""
-    data = request.get_json() or request.form or {}
+    """Backup device flash (full, app, nvs, or partitions with partitions: list or comma-separated names).
+    app / nvs / partitions read the partition table first and only the used part of app partitions.
+    Optional name for the backup file. Returns .bin file download.
+    With async=true returns 202 { job_id } instead; follow GET /api/flash/jobs/<job_id>/events, then download via /api/flash/backup/download."""
+    data = request.get_json(silent=True) or request.form or {}
     port = (data.get("port") or request.form.get("port") or "").strip()
     device_id = (data.get("device_id") or request.form.get("device_id") or "").strip()
     backup_type = (data.get("backup_type") or request.form.get("backup_type") or "full").strip().lower()
     backup_name = (data.get("name") or request.form.get("name") or "").strip() or None
+    names = data.get("partitions") or request.form.get("partitions") or []
+    if isinstance(names, str):
+        names = [n.strip() for n in names.split(",") if n.strip()]
     if not port or not device_id:
         return jsonify({"error": "port and device_id required"}), 400
-    _release_port(port, wait_longer=(backup_type == "full"))
-    ok, path_or_err, _ = backup_flash(port, device_id, backup_type, name=backup_name)
-    # Retry on port-busy; full backup gets extra retries and delay (OS may need more time to release).
-    for _ in range(2 if backup_type == "full" else 1):
-        if not ok and path_or_err and ("busy" in path_or_err.lower() or "temporarily unavailable" in path_or_err.lower() or "exclusively lock" in path_or_err.lower()):
-            time.sleep(2.5 if backup_type == "full" else 1.5)
-            ok, path_or_err, _ = backup_flash(port, device_id, backup_type, name=backup_name)
-        else:
-            break
-    # If still busy, try the alternate port (same device: cu <-> tty).
-    if not ok and path_or_err and ("busy" in path_or_err.lower() or "temporarily unavailable" in path_or_err.lower() or "exclusively lock" in path_or_err.lower()):
-        alt = get_alternate_port(port)
-        if alt:
-            _release_port(alt, wait_longer=(backup_type == "full"))
-            time.sleep(1.0)
-            ok, path_or_err, _ = backup_flash(alt, device_id, backup_type, name=backup_name)
-    if not ok:
-        return jsonify({"error": _flash_error_message(path_or_err)}), 500
-    if not os.path.isfile(path_or_err):
+    if backup_type == "partitions" and not names:
+        return jsonify({"error": "partitions required for backup_type partitions"}), 400
+    job_id = submit_job("backup", port, device_id, {"backup_type": backup_type, "name": backup_name, "partitions": names})
+    if _wants_async(data):
+        return jsonify({"job_id": job_id}), 202
+    job = wait_job(job_id)
+    if job["status"] != "done":
+        return _job_failed_response(job)
+    path = (job["result"] or {}).get("abs_path")
+    if not path or not os.path.isfile(path):
         return jsonify({"error": "Backup file not created"}), 500
-    return send_file(
-        path_or_err,
-        as_attachment=True,
-        download_name=os.path.basename(path_or_err),
+    return _backup_download_response(path)
+
+
+def _backup_download_response(path: str):
+    """Stream a backup image (reassembled from the chunk store for manifests) as a .bin download."""
+    return Response(
+        stream_with_context(backup_store.iter_image(path)),
         mimetype="application/octet-stream",
+        headers={
+            "Content-Disposition": f'attachment; filename="{backup_store.backup_name(path)}"',
+            "Content-Length": str(backup_store.image_size(path)),
+        },
     )
 
 
+@app.route("/api/flash/backup/download")
+def api_flash_backup_download():
+    """Download a stored backup as a raw .bin. Query: path (from /api/flash/artifacts)."""
+    path_arg = (request.args.get("path") or "").strip().lstrip("/")
+    full = os.path.realpath(os.path.join(REPO_ROOT, path_arg))
+    if not path_arg or os.path.dirname(full) != os.path.realpath(BACKUPS_DIR) or not os.path.isfile(full):
+        return jsonify({"error": "Backup not found"}), 404
+    return _backup_download_response(full)
+
+
+@app.route("/api/flash/backup/store")
+def api_flash_backup_store():
+    """Backup store usage: logical bytes of all backups vs bytes on disk after deduplication."""
+    return jsonify(backup_store.get_store_stats())
+
+
 @app.route("/api/flash/backup/progress")
 def api_flash_backup_progress():
-    """Poll backup progress during a chunked full-flash read. Returns {pct, chunk, total_chunks, status}."""
-    return jsonify(get_backup_progress())
+    """Poll progress of the latest backup job. Returns {pct, chunk, total_chunks, bytes_per_sec, status}."""
+    return jsonify(latest_backup_progress() or get_backup_progress())
+
+
+def _flash_source(path_arg: str):
+    """Resolve the image for restore/flash: path under REPO_ROOT or an uploaded .bin saved to a temp file.
+    Returns (bin_path, cleanup_or_None, error_or_None)."""
+    if path_arg:
+        bin_path = os.path.join(REPO_ROOT, path_arg.lstrip("/"))
+        if not os.path.isfile(bin_path):
+            return None, None, f"File not found: {path_arg}"
+        return bin_path, None, None
+    if "file" in request.files:
+        f = request.files["file"]
+        if not (f.filename and f.filename.endswith(".bin")):
+            return None, None, "Upload a .bin file"
+        fd, bin_path = tempfile.mkstemp(suffix=".bin")
+        os.close(fd)
+        f.save(bin_path)
+
+        def cleanup():
+            if os.path.isfile(bin_path):
+                try:
+                    os.remove(bin_path)
+                except OSError:
+                    pass
+        return bin_path, cleanup, None
+    return None, None, "Provide path or upload file"
 
 
 @app.route("/api/flash/restore", methods=["POST"])
 def api_flash_restore():
-    """Restore flash from uploaded .bin file or from path (artifacts/backups)."""
+    """Restore flash from uploaded .bin file or from path (artifacts/backups). With async=1 returns 202 { job_id }.
+    skip_unchanged=1 compares on-chip MD5 per 64 KB region and rewrites only what differs."""
     port = (request.form.get("port") or "").strip()
     device_id = (request.form.get("device_id") or "").strip()
     path_arg = (request.form.get("path") or "").strip()
     if not port or not device_id:
         return jsonify({"error": "port and device_id required"}), 400
-    _release_port(port)
-    bin_path = None
-    used_temp = False
-    if path_arg:
-        bin_path = os.path.join(REPO_ROOT, path_arg.lstrip("/"))
-        if not os.path.isfile(bin_path):
-            return jsonify({"error": f"File not found: {path_arg}"}), 400
-    elif "file" in request.files:
-        f = request.files["file"]
-        if f.filename and f.filename.endswith(".bin"):
-            fd, bin_path = tempfile.mkstemp(suffix=".bin")
-            os.close(fd)
-            f.save(bin_path)
-            used_temp = True
-        else:
-            return jsonify({"error": "Upload a .bin file"}), 400
-    else:
-        return jsonify({"error": "Provide path or upload file"}), 400
-    try:
-        ok, msg = restore_flash(port, device_id, bin_path)
-        if not ok and msg and ("busy" in msg.lower() or "temporarily unavailable" in msg.lower() or "exclusively lock" in msg.lower()):
-            alt = get_alternate_port(port)
-            if alt:
-                _release_port(alt)
-                time.sleep(1.0)
-                ok, msg = restore_flash(alt, device_id, bin_path)
-        if ok:
-            return jsonify({"success": True, "message": msg or "Restore complete"})
-        return jsonify({"success": False, "error": _flash_error_message(msg)}), 500
-    finally:
-        if used_temp and bin_path and os.path.isfile(bin_path):
-            try:
-                os.remove(bin_path)
-            except OSError:
-                pass
+    bin_path, cleanup, err = _flash_source(path_arg)
+    if err:
+        return jsonify({"error": err}), 400
+    params = {"bin_path": bin_path, "skip_unchanged": _form_flag(request.form, "skip_unchanged")}
+    job_id = submit_job("restore", port, device_id, params, cleanup=cleanup)
+    if _wants_async(request.form):
+        return jsonify({"job_id": job_id}), 202
+    job = wait_job(job_id)
+    if job["status"] == "done":
+        return jsonify({"success": True, "message": job["result"].get("message") or "Restore complete"})
+    return _job_failed_response(job)
 
 
 def _flash_addr_from_path(path_arg: str) -> str:
@@ -2091,7 +2504,8 @@ def _flash_addr_from_path(path_arg: str) -> str:
 
 @app.route("/api/flash/flash", methods=["POST"])
 def api_flash_flash():
-    """Flash firmware from path (artifacts/backups) or uploaded .bin."""
+    """Flash firmware from path (artifacts/backups) or uploaded .bin. With async=1 returns 202 { job_id }.
+    skip_unchanged=1 compares on-chip MD5 per 64 KB region and rewrites only what differs."""
     port = (request.form.get("port") or "").strip()
     device_id = (request.form.get("device_id") or "").strip()
     path_arg = (request.form.get("path") or "").strip()
@@ -2102,41 +2516,202 @@ def api_flash_flash():
         addr = "0x0"
     if not port or not device_id:
         return jsonify({"error": "port and device_id required"}), 400
-    _release_port(port)
-    bin_path = None
-    used_temp = False
-    if path_arg:
-        bin_path = os.path.join(REPO_ROOT, path_arg.lstrip("/"))
-        if not os.path.isfile(bin_path):
-            return jsonify({"error": f"File not found: {path_arg}"}), 400
-    elif "file" in request.files:
-        f = request.files["file"]
-        if f.filename and f.filename.endswith(".bin"):
-            fd, bin_path = tempfile.mkstemp(suffix=".bin")
-            os.close(fd)
-            f.save(bin_path)
-            used_temp = True
-        else:
-            return jsonify({"error": "Upload a .bin file"}), 400
-    else:
-        return jsonify({"error": "Provide path or upload file"}), 400
+    bin_path, cleanup, err = _flash_source(path_arg)
+    if err:
+        return jsonify({"error": err}), 400
+    params = {"bin_path": bin_path, "addr": addr, "skip_unchanged": _form_flag(request.form, "skip_unchanged")}
+    job_id = submit_job("flash", port, device_id, params, cleanup=cleanup)
+    if _wants_async(request.form):
+        return jsonify({"job_id": job_id}), 202
+    job = wait_job(job_id)
+    if job["status"] == "done":
+        return jsonify({"success": True, "message": job["result"].get("message") or "Flash complete"})
+    return _job_failed_response(job)
+
+
+@app.route("/api/flash/baud")
+def api_flash_baud():
+    """Tuned esptool baud profiles per (USB bridge VID:PID, chip): baud, stable rates, per-rate probe results."""
+    return jsonify({"profiles": list_profiles()})
+
+
+@app.route("/api/flash/baud/tune", methods=["POST"])
+def api_flash_baud_tune():
+    """Probe increasing baud rates on a port (short MD5-verified reads) and store the highest stable one.
+    Body: port, device_id. Returns 202 { job_id }; the job result is the profile."""
+    data = request.get_json(silent=True) or request.form or {}
+    port = (data.get("port") or "").strip()
+    device_id = (data.get("device_id") or "").strip()
+    if not port or not device_id:
+        return jsonify({"error": "port and device_id required"}), 400
+    return jsonify({"job_id": submit_job("tune", port, device_id)}), 202
+
+
+@app.route("/api/flash/baud/<path:key>", methods=["DELETE"])
+def api_flash_baud_delete(key):
+    """Forget a baud profile (transfers go back to esptool's default rate)."""
+    if not delete_profile(key):
+        return jsonify({"success": False, "error": "Profile not found"}), 404
+    return jsonify({"success": True})
+
+
+@app.route("/api/flash/telemetry")
+def api_flash_telemetry():
+    """Flash operation percentiles per group, worst first. Query: group_by (operation | device | mac | chip | port | usb),
+    kind (backup | restore | flash | tune), days. Each group: count, failure_rate, retries, duration_s and bytes_per_sec percentiles."""
+    groups, err = telemetry_stats(
+        group_by=(request.args.get("group_by") or "operation").strip().lower(),
+        kind=(request.args.get("kind") or "").strip().lower() or None,
+        since_days=request.args.get("days", type=float),
+    )
+    if groups is None:
+        return jsonify({"error": err}), 400
+    return jsonify({"groups": groups})
+
+
+@app.route("/api/flash/telemetry/recent")
+def api_flash_telemetry_recent():
+    """Latest recorded flash operations, newest first. Query: limit (default 50), runs=1 to include each esptool run."""
+    limit = min(request.args.get("limit", default=50, type=int), 500)
+    with_runs = (request.args.get("runs") or "").lower() in ("1", "true", "yes")
+    return jsonify({"operations": recent_operations(limit=limit, with_runs=with_runs)})
+
+
+def _budget_arg(value):
+    """budget_gb from a query / body value -> bytes (None = config default, 0 = no budget)."""
+    if value in (None, ""):
+        return None
+    return int(float(value) * (1 << 30))
+
+
+@app.route("/api/flash/artifacts/retention")
+def api_flash_artifacts_retention():
+    """Dry-run retention report: builds / downloads / backups the keep rules expire or the byte budget evicts (least
+    recently flashed first), duplicate files to hardlink, usage before / after. Query: budget_gb, hardlink=0, kept=1."""
     try:
-        ok, msg = flash_firmware(port, device_id, bin_path, addr)
-        if not ok and msg and ("busy" in msg.lower() or "temporarily unavailable" in msg.lower() or "exclusively lock" in msg.lower()):
-            alt = get_alternate_port(port)
-            if alt:
-                _release_port(alt)
-                time.sleep(1.0)
-                ok, msg = flash_firmware(alt, device_id, bin_path, addr)
-        if ok:
-            return jsonify({"success": True, "message": msg or "Flash complete"})
-        return jsonify({"success": False, "error": _flash_error_message(msg)}), 500
-    finally:
-        if used_temp and bin_path and os.path.isfile(bin_path):
-            try:
-                os.remove(bin_path)
-            except OSError:
-                pass
+        report = retention_plan(
+            budget_bytes=_budget_arg(request.args.get("budget_gb")),
+            hardlink=(request.args.get("hardlink") or "1").lower() not in ("0", "false", "no"),
+            include_kept=(request.args.get("kept") or "").lower() in ("1", "true", "yes"),
+        )
+    except ValueError:
+        return jsonify({"error": "budget_gb must be a number"}), 400
+    return jsonify(report)
+
+
+@app.route("/api/flash/artifacts/gc", methods=["POST"])
+def api_flash_artifacts_gc():
+    """Apply retention. Body: dry_run (default true: report only), hardlink (default true), budget_gb (overrides
+    ARTIFACT_BUDGET_GB). Returns the report; after a real run also errors, chunks_removed."""
+    data = request.get_json(silent=True) or {}
+    try:
+        budget = _budget_arg(data.get("budget_gb"))
+    except (TypeError, ValueError):
+        return jsonify({"error": "budget_gb must be a number"}), 400
+    report, err = run_artifact_gc(
+        dry_run=data.get("dry_run", True) is not False, budget_bytes=budget, hardlink=data.get("hardlink", True) is not False,
+    )
+    if report is None:
+        return jsonify({"error": err}), 409
+    return jsonify(report)
+
+
+@app.route("/api/flash/partitions")
+def api_flash_partitions():
+    """Partition table of the device on a port (read from flash at 0x8000). Query: port, device_id.
+    Returns { partitions: [{ name, type, subtype, offset, size, encrypted }] }."""
+    port = (request.args.get("port") or "").strip()
+    device_id = (request.args.get("device_id") or "").strip()
+    if not port or not device_id:
+        return jsonify({"error": "port and device_id required"}), 400
+    job = wait_job(submit_job("partitions", port, device_id))
+    if job["status"] != "done":
+        return _job_failed_response(job)
+    return jsonify(job["result"])
+
+
+@app.route("/api/flash/jobs")
+def api_flash_jobs():
+    """Recent backup/restore/flash jobs (newest first). Query: active=1 for queued/running only."""
+    active = (request.args.get("active") or "").lower() in ("1", "true", "yes")
+    return jsonify({"jobs": list_jobs(active_only=active)})
+
+
+@app.route("/api/flash/jobs/<job_id>")
+def api_flash_job(job_id):
+    """Job status, progress (pct, bytes_done, bytes_total, bytes_per_sec), result/error and recent esptool output."""
+    job = get_job(job_id, log_lines=int(request.args.get("log_lines") or 50))
+    if not job:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify(job)
+
+
+@app.route("/api/flash/jobs/<job_id>/events")
+def api_flash_job_events(job_id):
+    """SSE stream of job snapshots until the job finishes."""
+    if not get_job(job_id, log_lines=0):
+        return jsonify({"error": "Job not found"}), 404
+
+    def generate():
+        for snap in iter_job_events(job_id):
+            yield ": keepalive\n\n" if snap is None else _sse_event(snap)
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.route("/api/flash/jobs/<job_id>/cancel", methods=["POST"])
+def api_flash_job_cancel(job_id):
+    """Cancel a queued or running job (the esptool process is killed)."""
+    ok, err = cancel_job(job_id)
+    if not ok:
+        return jsonify({"success": False, "error": err}), 404 if err == "Job not found" else 409
+    return jsonify({"success": True})
+
+
+@app.route("/api/flash/fleet", methods=["POST"])
+def api_flash_fleet():
+    """Flash one artifact to many boards concurrently. Body: device_id, path, ports (list) or chip (all detected ports with that chip);
+    optional addr, max_per_hub, skip_unchanged. Returns 202 { fleet_id, devices }; poll GET /api/flash/fleet/<fleet_id>."""
+    data = request.get_json() or {}
+    device_id = (data.get("device_id") or "").strip()
+    path_arg = (data.get("path") or "").strip()
+    ports = data.get("ports") or []
+    if isinstance(ports, str):
+        ports = [p.strip() for p in ports.split(",") if p.strip()]
+    chip = (data.get("chip") or "").strip() or None
+    if not device_id or not path_arg:
+        return jsonify({"error": "device_id and path required"}), 400
+    bin_path = os.path.join(REPO_ROOT, path_arg.lstrip("/"))
+    if not os.path.isfile(bin_path):
+        return jsonify({"error": f"File not found: {path_arg}"}), 400
+    addr = (data.get("addr") or "").strip() or _flash_addr_from_path(path_arg)
+    targets, err = resolve_fleet_ports(ports=ports, chip=chip)
+    if err:
+        return jsonify({"error": err}), 400
+    fleet_id = start_fleet_flash(
+        targets, device_id, bin_path, addr=addr, max_per_hub=data.get("max_per_hub"),
+        skip_unchanged=bool(data.get("skip_unchanged")),
+    )
+    return jsonify({"fleet_id": fleet_id, "devices": [t["port"] for t in targets]}), 202
+
+
+@app.route("/api/flash/fleet")
+def api_flash_fleet_list():
+    """Recent fleet flash runs."""
+    return jsonify({"fleets": list_fleets()})
+
+
+@app.route("/api/flash/fleet/<fleet_id>")
+def api_flash_fleet_get(fleet_id):
+    """Per-device status (queued, waiting_hub, flashing, done, error) and summary of a fleet flash run."""
+    fleet = get_fleet(fleet_id)
+    if not fleet:
+        return jsonify({"error": "Fleet not found"}), 404
+    return jsonify(fleet)
 
 
 @app.route("/api/flash/file", methods=["DELETE"])
@@ -0,0 +1,364 @@
+"""
+Artifact index: every flashable file under artifacts/ (build outputs, OTA downloads, backups) in SQLite
+(artifacts/artifact_index.db) with size, SHA-256, device, firmware, version, build env, source and creation time.
+Builds, release downloads and backups call record() when they finish; reconcile() picks up everything else
+(lab-build.sh runs, files copied in by hand, deletions) with a stat-only scan that hashes only new or changed files.
+list_artifacts() is one indexed query with filters and sorting.
+"""
+import hashlib
+import os
+import re
+import sqlite3
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+import backup_store
+from build_cache import read_manifest_key
+from config import ARTIFACT_INDEX_DB_PATH, ARTIFACT_INDEX_RESCAN_INTERVAL, ARTIFACTS_DIR, BACKUPS_DIR, REPO_ROOT
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS artifacts (
+  path TEXT PRIMARY KEY,  -- relative to REPO_ROOT
+  name TEXT NOT NULL,  -- device/firmware/version/file, or the backup name
+  kind TEXT NOT NULL,  -- artifact, backup
+  source TEXT NOT NULL,  -- build, ota, backup, manual
+  device TEXT,
+  firmware TEXT,
+  version TEXT,  -- build folder, release tag, or backup type
+  build_env TEXT,
+  size INTEGER NOT NULL,  -- image bytes (a backup's reassembled size, not its manifest)
+  sha256 TEXT,
+  file_size INTEGER NOT NULL,  -- on-disk size and mtime: reconcile() rehashes only when these change
+  mtime_ns INTEGER NOT NULL,
+  created_at TEXT NOT NULL,
+  indexed_at TEXT NOT NULL,
+  last_flashed_at TEXT,  -- last successful restore / flash of this file (retention evicts least recently flashed first)
+  cache_key TEXT  -- build cache key from the build_manifest.json next to a build output (see build_cache)
+);
+CREATE INDEX IF NOT EXISTS idx_artifacts_kind_device_fw ON artifacts(kind, device, firmware);
+CREATE INDEX IF NOT EXISTS idx_artifacts_created ON artifacts(created_at);
+CREATE INDEX IF NOT EXISTS idx_artifacts_sha256 ON artifacts(sha256);
+"""
+
+# Artifact .bin files that are components only — do not offer for flash (would write partial image)
+_EXCLUDE_BIN = frozenset(("bootloader.bin", "partitions.bin"))
+SORT_COLUMNS = ("created_at", "name", "size", "device", "firmware", "version", "source", "last_flashed_at")
+# build_firmware: build_<env>_<YYYYmmdd_HHMMSS>[_<unique suffix>]
+_BUILD_DIR_RE = re.compile(r"^build_(.+)_(\d{8}_\d{6})(?:_[a-z0-9_]{8})?$")
+_DATE_DIR_RE = re.compile(r"^\d{4}-\d{2}-\d{2}$")  # lab-build.sh: <YYYY-MM-DD>
+_HASH_BLOCK = 1 << 20
+
+_db_lock = threading.Lock()
+_reconcile_lock = threading.Lock()
+_initialized = False
+_last_reconcile = 0.0
+
+
+def new_build_dir(device_id: str, firmware_id: str, env_name: str) -> str:
+    """
+    Create a fresh artifacts/<device>/<firmware>/build_<env>_<timestamp>_<suffix>/ for a build's output. The random
+    suffix keeps builds of one env that finish in the same second (other patch sets, remote workers) apart.
+    """
+    parent = os.path.join(ARTIFACTS_DIR, device_id, firmware_id)
+    os.makedirs(parent, exist_ok=True)
+    safe_env = re.sub(r"[^\w\-]", "_", env_name)
+    path = tempfile.mkdtemp(prefix=f"build_{safe_env}_{datetime.now().strftime('%Y%m%d_%H%M%S')}_", dir=parent)
+    os.chmod(path, 0o755)  # mkdtemp creates it private
+    return path
+
+
+def _connect():
+    global _initialized
+    os.makedirs(os.path.dirname(ARTIFACT_INDEX_DB_PATH), exist_ok=True)
+    conn = sqlite3.connect(ARTIFACT_INDEX_DB_PATH, timeout=10)
+    conn.row_factory = sqlite3.Row
+    if not _initialized:
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(_SCHEMA)
+        columns = {r["name"] for r in conn.execute("PRAGMA table_info(artifacts)")}
+        for column in ("last_flashed_at", "cache_key"):
+            if column not in columns:
+                conn.execute(f"ALTER TABLE artifacts ADD COLUMN {column} TEXT")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_artifacts_cache_key ON artifacts(cache_key)")
+        _initialized = True
+    return conn
+
+
+def _now() -> str:
+    return datetime.now().isoformat(timespec="seconds")
+
+
+def _sha256_file(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(_HASH_BLOCK), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _classify(abs_path: str):
+    """
+    Index fields implied by where a file lives, or None when it is not a flashable artifact:
+    artifacts/<device>/<firmware>/[<version>/]<file>.bin and artifacts/backups/<manifest or .bin>.
+    """
+    rel = os.path.relpath(abs_path, ARTIFACTS_DIR)
+    parts = rel.split(os.sep)
+    fname = parts[-1]
+    if len(parts) == 2 and parts[0] == "backups":
+        if fname.startswith(".") or not (backup_store.is_manifest(fname) or fname.endswith(".bin")):
+            return None
+        return {"kind": "backup", "source": "backup", "name": backup_store.backup_name(fname)}
+    if parts[0] in ("backups", "..") or len(parts) not in (3, 4) or not fname.endswith(".bin") or fname in _EXCLUDE_BIN:
+        return None
+    out = {"kind": "artifact", "name": "/".join(parts), "device": parts[0], "firmware": parts[1], "source": "manual"}
+    if len(parts) == 4:
+        version = parts[2]
+        out["version"] = version
+        m = _BUILD_DIR_RE.match(version)
+        if m:
+            out["source"], out["build_env"] = "build", m.group(1)
+            out["created_at"] = datetime.strptime(m.group(2), "%Y%m%d_%H%M%S").isoformat(timespec="seconds")
+        elif _DATE_DIR_RE.match(version) or version == "ci":
+            out["source"] = "build"
+        elif version == "ota":
+            out["source"] = "ota"
+    return out
+
+
+def _describe(abs_path: str, st, overrides: dict | None = None):
+    """Full index row for abs_path (hashes the file, or reads a backup manifest). None when not indexable."""
+    info = _classify(abs_path)
+    if info is None:
+        return None
+    row = {
+        "path": os.path.relpath(abs_path, REPO_ROOT), "device": None, "firmware": None, "version": None,
+        "build_env": None, "file_size": st.st_size, "mtime_ns": st.st_mtime_ns,
+        "created_at": datetime.fromtimestamp(st.st_mtime).isoformat(timespec="seconds"), **info,
+    }
+    if backup_store.is_manifest(abs_path):
+        m = backup_store.load_manifest(abs_path)
+        if not m:
+            return None
+        row.update(
+            name=m.get("name") or row["name"], size=int(m.get("size") or 0), sha256=m.get("sha256"),
+            device=m.get("device_id"), version=m.get("backup_type"), created_at=m.get("created_at") or row["created_at"],
+        )
+    else:
+        row.update(size=st.st_size, sha256=_sha256_file(abs_path))
+        if info.get("version"):
+            row["cache_key"] = read_manifest_key(abs_path)
+    row.update({k: v for k, v in (overrides or {}).items() if v})
+    return row
+
+
+_COLUMNS = ("path", "name", "kind", "source", "device", "firmware", "version", "build_env", "size", "sha256",
+            "file_size", "mtime_ns", "created_at", "cache_key")
+
+
+def _upsert(conn, row: dict, keep_labels: bool):
+    """Insert or update one row. keep_labels: a re-scan keeps source / version / build_env given by record()."""
+    if keep_labels:
+        labels = ", ".join(f"{c} = COALESCE(artifacts.{c}, excluded.{c})" for c in ("version", "build_env"))
+        labels += ", source = CASE WHEN artifacts.source = 'manual' THEN excluded.source ELSE artifacts.source END"
+    else:
+        labels = ", ".join(f"{c} = excluded.{c}" for c in ("source", "version", "build_env"))
+    updates = ", ".join(f"{c} = excluded.{c}" for c in _COLUMNS if c not in ("path", "source", "version", "build_env"))
+    conn.execute(
+        f"INSERT INTO artifacts ({', '.join(_COLUMNS)}, indexed_at) VALUES ({', '.join('?' * (len(_COLUMNS) + 1))})"
+        f" ON CONFLICT(path) DO UPDATE SET {updates}, {labels}, indexed_at = excluded.indexed_at",
+        tuple(row.get(c) for c in _COLUMNS) + (_now(),),
+    )
+
+
+def record(path: str, source: str | None = None, version: str | None = None, build_env: str | None = None) -> int:
+    """
+    Index a file, or every indexable file directly in a directory, right after a build, download or backup wrote it.
+    source / version / build_env override what the path implies (e.g. the release tag of an OTA download).
+    Returns the number of files indexed; never raises (reconcile() catches anything missed).
+    """
+    try:
+        if os.path.isdir(path):
+            paths = [e.path for e in os.scandir(path) if e.is_file()]
+        else:
+            paths = [path]
+        rows = []
+        for p in paths:
+            row = _describe(p, os.stat(p), {"source": source, "version": version, "build_env": build_env})
+            if row:
+                rows.append(row)
+        if rows:
+            with _db_lock:
+                conn = _connect()
+                try:
+                    with conn:
+                        for row in rows:
+                            _upsert(conn, row, keep_labels=False)
+                finally:
+                    conn.close()
+        return len(rows)
+    except (sqlite3.Error, OSError, ValueError):
+        return 0
+
+
+def forget(path: str) -> None:
+    """Drop a deleted file from the index (absolute or REPO_ROOT-relative path). Never raises."""
+    rel = os.path.relpath(path, REPO_ROOT) if os.path.isabs(path) else path
+    try:
+        with _db_lock:
+            conn = _connect()
+            try:
+                with conn:
+                    conn.execute("DELETE FROM artifacts WHERE path = ?", (rel,))
+            finally:
+                conn.close()
+    except (sqlite3.Error, OSError):
+        pass
+
+
+def note_flashed(path: str) -> None:
+    """Stamp last_flashed_at on an indexed file after a successful restore / flash from it. Never raises."""
+    rel = os.path.relpath(path, REPO_ROOT) if os.path.isabs(path) else path
+    try:
+        with _db_lock:
+            conn = _connect()
+            try:
+                with conn:
+                    conn.execute("UPDATE artifacts SET last_flashed_at = ? WHERE path = ?", (_now(), os.path.normpath(rel)))
+            finally:
+                conn.close()
+    except (sqlite3.Error, OSError):
+        pass
+
+
+def find_by_cache_key(cache_key: str):
+    """REPO_ROOT-relative path of the newest indexed build with this cache key that is still on disk unchanged, or None."""
+    if not cache_key:
+        return None
+    try:
+        with _db_lock:
+            conn = _connect()
+            try:
+                rows = conn.execute(
+                    "SELECT path, file_size, mtime_ns FROM artifacts WHERE cache_key = ? ORDER BY created_at DESC",
+                    (cache_key,),
+                ).fetchall()
+            finally:
+                conn.close()
+    except (sqlite3.Error, OSError):
+        return None
+    for r in rows:
+        try:
+            st = os.stat(os.path.join(REPO_ROOT, r["path"]))
+        except OSError:
+            continue
+        if (st.st_size, st.st_mtime_ns) == (r["file_size"], r["mtime_ns"]):
+            return r["path"]
+    return None
+
+
+def _scan():
+    """Yield (abs_path, stat) for every candidate file: artifacts/<device>/<firmware>/[<version>/]*.bin and backups."""
+    if os.path.isdir(BACKUPS_DIR):
+        for e in os.scandir(BACKUPS_DIR):
+            if e.is_file() and _classify(e.path):
+                yield e.path, e.stat()
+    if not os.path.isdir(ARTIFACTS_DIR):
+        return
+    for dev in os.scandir(ARTIFACTS_DIR):
+        if dev.name == "backups" or not dev.is_dir():
+            continue
+        for fw in os.scandir(dev.path):
+            if not fw.is_dir():
+                continue
+            for entry in os.scandir(fw.path):
+                if entry.is_dir():
+                    for f in os.scandir(entry.path):
+                        if f.name.endswith(".bin") and f.name not in _EXCLUDE_BIN and f.is_file():
+                            yield f.path, f.stat()
+                elif entry.name.endswith(".bin") and entry.name not in _EXCLUDE_BIN and entry.is_file():
+                    yield entry.path, entry.stat()
+
+
+def reconcile(force: bool = False):
+    """
+    Bring the index in line with the filesystem: stat every candidate file, hash only those whose size or mtime
+    changed since they were indexed, drop rows for files that are gone. Skipped when the last scan was less than
+    ARTIFACT_INDEX_RESCAN_INTERVAL seconds ago (unless force). Returns {added, updated, removed} or None if skipped.
+    """
+    global _last_reconcile
+    with _reconcile_lock:
+        if not force and time.monotonic() - _last_reconcile < ARTIFACT_INDEX_RESCAN_INTERVAL:
+            return None
+        on_disk = {os.path.relpath(p, REPO_ROOT): (p, st) for p, st in _scan()}
+        with _db_lock:
+            conn = _connect()
+            try:
+                indexed = {r["path"]: (r["file_size"], r["mtime_ns"])
+                           for r in conn.execute("SELECT path, file_size, mtime_ns FROM artifacts")}
+            finally:
+                conn.close()
+        changed = []
+        for rel, (p, st) in on_disk.items():
+            if indexed.get(rel) != (st.st_size, st.st_mtime_ns):
+                try:
+                    row = _describe(p, st)  # hashing happens here, outside the database lock
+                except (OSError, ValueError):
+                    continue
+                if row:
+                    changed.append(row)
+        removed = [rel for rel in indexed if rel not in on_disk]
+        with _db_lock:
+            conn = _connect()
+            try:
+                with conn:
+                    for row in changed:
+                        _upsert(conn, row, keep_labels=True)
+                    conn.executemany("DELETE FROM artifacts WHERE path = ?", [(rel,) for rel in removed])
+            finally:
+                conn.close()
+        _last_reconcile = time.monotonic()
+        added = sum(1 for row in changed if row["path"] not in indexed)
+        return {"added": added, "updated": len(changed) - added, "removed": len(removed)}
+
+
+def list_artifacts(kind: str | None = None, device: str | None = None, firmware: str | None = None, source: str | None = None, q: str | None = None,
+                   sort: str = "created_at", descending: bool = True, limit: int | None = None):
+    """
+    Indexed artifacts and backups (reconciled first when the last scan is stale). Filters: kind (artifact, backup),
+    device, firmware (applies to artifacts; backups are kept), source (build, ota, backup, manual), q (name contains).
+    sort: one of SORT_COLUMNS. Returns a list of row dicts; raises sqlite3.Error when the index is unavailable.
+    """
+    reconcile()
+    where, params = [], []
+    if kind:
+        where.append("kind = ?")
+        params.append(kind)
+    if device:
+        where.append("device = ?")
+        params.append(device)
+    if firmware:
+        where.append("(kind = 'backup' OR lower(firmware) = ?)")
+        params.append(firmware.lower())
+    if source:
+        where.append("source = ?")
+        params.append(source)
+    if q:
+        where.append("name LIKE ? ESCAPE '\\'")
+        params.append("%" + re.sub(r"([%_\\])", r"\\\1", q) + "%")
+    column = sort if sort in SORT_COLUMNS else "created_at"
+    sql = "SELECT * FROM artifacts"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += f" ORDER BY {column} {'DESC' if descending else 'ASC'}, path"
+    if limit:
+        sql += " LIMIT ?"
+        params.append(int(limit))
+    with _db_lock:
+        conn = _connect()
+        try:
+            rows = conn.execute(sql, params).fetchall()
+        finally:
+            conn.close()
+    return [{**dict(r), "type": r["kind"]} for r in rows]
@@ -0,0 +1,447 @@
+"""
+Content-addressed backup store: flash backups are split into fixed-size blocks keyed by SHA-256.
+Each block is stored once (zstd- or xz-compressed) under artifacts/backups/.chunks; erased (all 0xFF)
+blocks are not stored at all. Each backup is a small JSON manifest listing its blocks, the source chip,
+flash size and the non-erased regions with their hashes. Images are reassembled on demand
+(streamed to HTTP or written to temp files for esptool).
+"""
+import hashlib
+import json
+import lzma
+import os
+import tempfile
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+
+from config import BACKUP_CHUNK_SIZE, BACKUP_CHUNKS_DIR, BACKUPS_DIR
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+MANIFEST_SUFFIX = ".manifest.json"
+MANIFEST_FORMAT = "cyberlab-backup"
+# v1: every block stored raw; v2: blocks compressed, erased blocks recorded as null, regions + chip metadata
+MANIFEST_VERSION = 2
+# Chunk file suffix per codec; bare digest = uncompressed (v1 stores)
+_CODECS = ("zst", "xz", "")
+# Errors from reading or decompressing a chunk file (a truncated or corrupt blob)
+_CHUNK_ERRORS = (OSError, lzma.LZMAError) + ((zstandard.ZstdError,) if zstandard is not None else ())
+
+# Serializes manifest writes and chunk garbage collection (GC must not race a backup being stored).
+_store_lock = threading.Lock()
+
+
+def is_manifest(path: str) -> bool:
+    """True if path names a backup manifest (vs. a raw .bin image)."""
+    return bool(path) and path.endswith(MANIFEST_SUFFIX)
+
+
+def manifest_path_for(name: str) -> str:
+    """Manifest path in BACKUPS_DIR for a backup named e.g. backup_t_beam_1w_full_20260101_120000.bin."""
+    return os.path.join(BACKUPS_DIR, name + MANIFEST_SUFFIX)
+
+
+def backup_name(path: str) -> str:
+    """Display name of a backup: manifest name without suffix, or the .bin file name."""
+    base = os.path.basename(path or "")
+    return base[: -len(MANIFEST_SUFFIX)] if base.endswith(MANIFEST_SUFFIX) else base
+
+
+def scratch_dir() -> str:
+    """Directory for in-progress reads (same filesystem as the store, hidden from listings)."""
+    path = os.path.join(BACKUPS_DIR, ".tmp")
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def _chunk_path(digest: str, codec: str = "") -> str:
+    name = f"{digest}.{codec}" if codec else digest
+    return os.path.join(BACKUP_CHUNKS_DIR, digest[:2], name)
+
+
+def _find_chunk(digest: str):
+    """Return (path, codec) of a stored chunk, or (None, None)."""
+    for codec in _CODECS:
+        path = _chunk_path(digest, codec)
+        if os.path.isfile(path):
+            return path, codec
+    return None, None
+
+
+def _compress(data: bytes):
+    """Compress a block with zstd when available, else xz. Returns (blob, codec)."""
+    if zstandard is not None:
+        return zstandard.ZstdCompressor(level=10).compress(data), "zst"
+    return lzma.compress(data, preset=6), "xz"
+
+
+def _decompress(blob: bytes, codec: str) -> bytes:
+    if codec == "zst":
+        if zstandard is None:
+            raise ValueError("Backup chunk is zstd-compressed; install zstandard")
+        return zstandard.ZstdDecompressor().decompress(blob)
+    if codec == "xz":
+        return lzma.decompress(blob)
+    return blob
+
+
+def _is_erased(data: bytes) -> bool:
+    """True if the block is erased flash (all 0xFF)."""
+    return data.count(0xFF) == len(data)
+
+
+def _put_chunk(digest: str, data: bytes) -> int:
+    """Compress and write a chunk if it is not already stored. Returns bytes written to disk (0 if deduplicated)."""
+    if _find_chunk(digest)[0]:
+        return 0
+    blob, codec = _compress(data)
+    path = _chunk_path(digest, codec)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".put_")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(blob)
+        os.replace(tmp, path)
+    except OSError:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+    return len(blob)
+
+
+def store_image(src_path: str, name: str, meta: dict | None = None):
+    """
+    Split src_path into BACKUP_CHUNK_SIZE blocks, store new non-erased blocks and write a manifest for name.
+    meta: extra fields recorded in the manifest (device_id, backup_type, chip, flash_size, addr = flash offset of byte 0).
+    Returns (success, manifest_path_or_error, size_bytes).
+    """
+    if not os.path.isfile(src_path):
+        return False, f"File not found: {src_path}", 0
+    meta = dict(meta or {})
+    base = int(meta.get("addr") or 0)
+    chunks = []
+    regions = []
+    region_hash = None
+    image_hash = hashlib.sha256()
+    size = 0
+    new_bytes = 0
+    try:
+        with _store_lock, open(src_path, "rb") as f:
+            while True:
+                data = f.read(BACKUP_CHUNK_SIZE)
+                if not data:
+                    break
+                if _is_erased(data):
+                    chunks.append(None)
+                    region_hash = None
+                else:
+                    digest = hashlib.sha256(data).hexdigest()
+                    new_bytes += _put_chunk(digest, data)
+                    chunks.append(digest)
+                    if region_hash is None:
+                        regions.append({"offset": base + size, "length": 0})
+                        region_hash = hashlib.sha256()
+                    region_hash.update(data)
+                    regions[-1]["length"] += len(data)
+                    regions[-1]["sha256"] = region_hash.hexdigest()
+                image_hash.update(data)
+                size += len(data)
+            manifest = {
+                "format": MANIFEST_FORMAT,
+                "version": MANIFEST_VERSION,
+                "name": name,
+                "size": size,
+                "chunk_size": BACKUP_CHUNK_SIZE,
+                "sha256": image_hash.hexdigest(),
+                "compression": "zst" if zstandard is not None else "xz",
+                "created_at": datetime.now().isoformat(timespec="seconds"),
+                "stored_bytes": new_bytes,
+                **meta,
+                "addr": base,
+                "regions": regions,
+                "chunks": chunks,
+            }
+            path = manifest_path_for(name)
+            tmp = path + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as mf:
+                json.dump(manifest, mf, indent=1)
+            os.replace(tmp, path)
+    except OSError as e:
+        return False, str(e), 0
+    return True, path, size
+
+
+def load_manifest(path: str):
+    """Read a manifest. Returns dict or None if missing/invalid."""
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return None
+    if not isinstance(data, dict) or data.get("format") != MANIFEST_FORMAT:
+        return None
+    return data
+
+
+def image_size(path: str) -> int:
+    """Logical image size of a manifest or raw .bin."""
+    if is_manifest(path):
+        m = load_manifest(path)
+        return int(m.get("size") or 0) if m else 0
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+def iter_image(path: str, verify: bool = True):
+    """Yield the image bytes for a manifest (block by block) or a raw .bin. Raises ValueError on a missing/corrupt block."""
+    if not is_manifest(path):
+        with open(path, "rb") as f:
+            while True:
+                data = f.read(BACKUP_CHUNK_SIZE)
+                if not data:
+                    return
+                yield data
+    m = load_manifest(path)
+    if not m:
+        raise ValueError(f"Invalid backup manifest: {os.path.basename(path)}")
+    chunk_size = int(m.get("chunk_size") or BACKUP_CHUNK_SIZE)
+    size = int(m.get("size") or 0)
+    for idx, digest in enumerate(m.get("chunks") or []):
+        if digest is None:
+            yield b"\xff" * min(chunk_size, size - idx * chunk_size)
+            continue
+        yield _read_chunk(digest, verify)
+
+
+def _read_chunk(digest: str, verify: bool = True) -> bytes:
+    chunk_path, codec = _find_chunk(digest)
+    if not chunk_path:
+        raise ValueError(f"Backup chunk missing: {digest[:12]}")
+    try:
+        with open(chunk_path, "rb") as f:
+            data = _decompress(f.read(), codec)
+    except _CHUNK_ERRORS as e:
+        raise ValueError(f"Backup chunk unreadable: {digest[:12]} ({e})")
+    if verify and hashlib.sha256(data).hexdigest() != digest:
+        raise ValueError(f"Backup chunk corrupt: {digest[:12]}")
+    return data
+
+
+@contextmanager
+def materialized(path: str):
+    """Context manager yielding a plain file path for esptool: raw .bin as-is, manifests reassembled to a temp file."""
+    if not is_manifest(path):
+        yield path
+        return
+    fd, tmp = tempfile.mkstemp(dir=scratch_dir(), prefix="restore_", suffix=".bin")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            for data in iter_image(path):
+                f.write(data)
+        yield tmp
+    finally:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+
+
+def sparse_layout(path: str):
+    """
+    For a v2 manifest: (base_addr, size, regions) where regions are [{offset, length, sha256}] of non-erased data
+    (absolute flash offsets). None for raw .bin files and v1 manifests (write the whole image).
+    """
+    if not is_manifest(path):
+        return None
+    m = load_manifest(path)
+    if not m or m.get("regions") is None:
+        return None
+    return int(m.get("addr") or 0), int(m.get("size") or 0), list(m["regions"])
+
+
+def partition_layout(path: str):
+    """
+    For a partition backup: (base_addr, partitions) where partitions are [{name, type, subtype, offset, size, length}]
+    and length is the number of bytes read from the start of the partition (0 = empty, nothing to restore).
+    None for full-flash backups, raw .bin files and manifests without a partition list.
+    """
+    if not is_manifest(path):
+        return None
+    m = load_manifest(path)
+    if not m or not m.get("partitions"):
+        return None
+    return int(m.get("addr") or 0), list(m["partitions"])
+
+
+@contextmanager
+def materialized_regions(path: str):
+    """Context manager yielding [(flash_offset, temp_file_path)] for the non-erased regions of a v2 manifest."""
+    layout = sparse_layout(path)
+    if layout is None:
+        raise ValueError("Backup has no region layout")
+    base, _, regions = layout
+    m = load_manifest(path)
+    chunk_size = int(m.get("chunk_size") or BACKUP_CHUNK_SIZE)
+    chunks = m.get("chunks") or []
+    out = []
+    try:
+        for region in regions:
+            fd, tmp = tempfile.mkstemp(dir=scratch_dir(), prefix="region_", suffix=".bin")
+            out.append((region["offset"], tmp))
+            first = (region["offset"] - base) // chunk_size
+            last = first + (region["length"] + chunk_size - 1) // chunk_size
+            digest_check = hashlib.sha256()
+            with os.fdopen(fd, "wb") as f:
+                for digest in chunks[first:last]:
+                    data = _read_chunk(digest)
+                    digest_check.update(data)
+                    f.write(data)
+            if region.get("sha256") and digest_check.hexdigest() != region["sha256"]:
+                raise ValueError(f"Region 0x{region['offset']:X} hash mismatch")
+        yield out
+    finally:
+        for _, tmp in out:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+
+
+def list_backups():
+    """Return list of { path (absolute), name, size, created_at, device_id?, backup_type?, stored } for manifests and raw .bin backups."""
+    out = []
+    if not os.path.isdir(BACKUPS_DIR):
+        return out
+    for entry in os.scandir(BACKUPS_DIR):
+        if entry.name.startswith(".") or not entry.is_file():
+            continue
+        if entry.name.endswith(MANIFEST_SUFFIX):
+            m = load_manifest(entry.path)
+            if not m:
+                continue
+            out.append({
+                "path": entry.path,
+                "name": m.get("name") or backup_name(entry.path),
+                "size": int(m.get("size") or 0),
+                "created_at": m.get("created_at"),
+                "device_id": m.get("device_id"),
+                "backup_type": m.get("backup_type"),
+                "chip": m.get("chip"),
+                "flash_size": m.get("flash_size"),
+                "partitions": [p["name"] for p in m.get("partitions") or []] or None,
+                "stored": "chunked",
+            })
+        elif entry.name.endswith(".bin"):
+            out.append({
+                "path": entry.path,
+                "name": entry.name,
+                "size": entry.stat().st_size,
+                "created_at": datetime.fromtimestamp(entry.stat().st_mtime).isoformat(timespec="seconds"),
+                "device_id": None,
+                "backup_type": None,
+                "stored": "raw",
+            })
+    return out
+
+
+def _referenced_chunks() -> set:
+    refs = set()
+    if not os.path.isdir(BACKUPS_DIR):
+        return refs
+    for name in os.listdir(BACKUPS_DIR):
+        if name.endswith(MANIFEST_SUFFIX):
+            m = load_manifest(os.path.join(BACKUPS_DIR, name))
+            if m:
+                refs.update(d for d in (m.get("chunks") or []) if d)
+    return refs
+
+
+def chunk_usage(path: str) -> dict:
+    """{digest: stored bytes} for each distinct chunk a manifest references (0 when the chunk file is missing)."""
+    m = load_manifest(path)
+    out = {}
+    for digest in (m or {}).get("chunks") or []:
+        if digest and digest not in out:
+            chunk_path, _ = _find_chunk(digest)
+            try:
+                out[digest] = os.path.getsize(chunk_path) if chunk_path else 0
+            except OSError:
+                out[digest] = 0
+    return out
+
+
+def gc_chunks():
+    """Delete chunks no manifest references. Returns (chunks_removed, bytes_freed)."""
+    removed = 0
+    freed = 0
+    with _store_lock:
+        refs = _referenced_chunks()
+        if not os.path.isdir(BACKUP_CHUNKS_DIR):
+            return 0, 0
+        for sub in os.scandir(BACKUP_CHUNKS_DIR):
+            if not sub.is_dir():
+                continue
+            for entry in os.scandir(sub.path):
+                if entry.name.startswith(".") or entry.name.split(".")[0] in refs:
+                    continue
+                try:
+                    freed += entry.stat().st_size
+                    os.remove(entry.path)
+                    removed += 1
+                except OSError:
+                    pass
+    return removed, freed
+
+
+def delete_backup(path: str):
+    """Delete a manifest (then GC unreferenced chunks) or a raw .bin backup. Returns (success, error_message)."""
+    try:
+        os.remove(path)
+    except OSError as e:
+        return False, str(e)
+    if is_manifest(path):
+        gc_chunks()
+    return True, None
+
+
+def import_raw_backups():
+    """Move legacy raw .bin backups in BACKUPS_DIR into the chunk store. Returns number of backups converted."""
+    converted = 0
+    for b in list_backups():
+        if b["stored"] != "raw" or os.path.exists(manifest_path_for(b["name"])):
+            continue
+        ok, _, _ = store_image(b["path"], b["name"], meta={"imported": True})
+        if ok:
+            os.remove(b["path"])
+            converted += 1
+    return converted
+
+
+def get_store_stats() -> dict:
+    """Logical size of all backups vs bytes actually on disk (chunks + raw .bin files)."""
+    backups = list_backups()
+    logical = sum(b["size"] for b in backups)
+    physical = sum(b["size"] for b in backups if b["stored"] == "raw")
+    chunk_count = 0
+    if os.path.isdir(BACKUP_CHUNKS_DIR):
+        for sub in os.scandir(BACKUP_CHUNKS_DIR):
+            if sub.is_dir():
+                for entry in os.scandir(sub.path):
+                    if not entry.name.startswith("."):
+                        chunk_count += 1
+                        physical += entry.stat().st_size
+    return {
+        "backups": len(backups),
+        "chunks": chunk_count,
+        "logical_bytes": logical,
+        "stored_bytes": physical,
+        "dedup_ratio": round(logical / physical, 2) if physical else None,
+    }
+
@@ -0,0 +1,186 @@
+"""
+esptool baud-rate autotuner. Probes increasing rates per (USB bridge VID:PID, chip) with short MD5-verified flash reads
+and records the highest stable rate in BAUD_PROFILES_PATH. flash_ops._esptool then passes --baud automatically and
+falls back to the default rate (demoting the profile) when a transfer at the tuned rate fails.
+"""
+import json
+import os
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+from config import BAUD_CANDIDATES, BAUD_PROFILES_PATH
+from flash_ops import _esptool, _verify_regions
+from usb_watch import device_for_port
+
+_PROBE_ADDR = 0x0
+_PROBE_BYTES = 0x40000  # 256 KB: long enough to expose a marginal link, short enough to probe all rates in seconds
+_DEMOTE_AFTER = 2  # failures at the tuned rate before stepping down to the next lower stable rate
+
+_lock = threading.Lock()
+_tuning = set()  # ports being probed: no automatic --baud while tuning
+
+
+def bridge_of(port: str):
+    """
+    USB bridge type for port as VID:PID (e.g. 10c4:ea60 CP210x, 303a:1001 ESP32-S3 USB-Serial/JTAG), or None.
+    Read from the hotplug watcher's device map (usb_watch), so the per-esptool-call lookup does not rescan the ports.
+    """
+    dev = device_for_port(port)
+    if not dev or dev.get("vid") is None or dev.get("pid") is None:
+        return None
+    return f"{dev['vid']:04x}:{dev['pid']:04x}"
+
+
+def _profile_key(bridge: str, chip: str) -> str:
+    return f"{bridge}|{chip}"
+
+
+def _load() -> dict:
+    try:
+        with open(BAUD_PROFILES_PATH, encoding="utf-8") as f:
+            data = json.load(f)
+        return data if isinstance(data, dict) else {}
+    except (OSError, ValueError):
+        return {}
+
+
+def _save(profiles: dict) -> None:
+    os.makedirs(os.path.dirname(BAUD_PROFILES_PATH), exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(BAUD_PROFILES_PATH), suffix=".tmp")
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        json.dump(profiles, f, indent=2, sort_keys=True)
+    os.replace(tmp, BAUD_PROFILES_PATH)
+
+
+def list_profiles():
+    """All tuned profiles: { key, bridge, chip, baud, stable, results, tuned_at, failures }."""
+    with _lock:
+        profiles = _load()
+    return [dict(v, key=k) for k, v in sorted(profiles.items())]
+
+
+def delete_profile(key: str) -> bool:
+    """Forget a profile (back to esptool's default rate). Returns whether it existed."""
+    with _lock:
+        profiles = _load()
+        if key not in profiles:
+            return False
+        del profiles[key]
+        _save(profiles)
+    return True
+
+
+def tuned_baud(port: str, chip: str):
+    """Tuned --baud for port's bridge and chip, or None (untuned, unknown bridge, or being tuned)."""
+    if not port or not chip or port in _tuning:
+        return None
+    bridge = bridge_of(port)
+    if not bridge:
+        return None
+    with _lock:
+        profile = _load().get(_profile_key(bridge, chip))
+    return profile.get("baud") if profile else None
+
+
+def baud_failed(port: str, chip: str, baud: int) -> None:
+    """A transfer at the tuned baud failed: after _DEMOTE_AFTER failures step down to the next lower stable rate."""
+    bridge = bridge_of(port)
+    if not bridge:
+        return
+    key = _profile_key(bridge, chip)
+    with _lock:
+        profiles = _load()
+        profile = profiles.get(key)
+        if not profile or profile.get("baud") != baud:
+            return
+        profile["failures"] = profile.get("failures", 0) + 1
+        if profile["failures"] >= _DEMOTE_AFTER:
+            lower = [b for b in profile.get("stable") or [] if b < baud]
+            if lower:
+                profile["baud"] = max(lower)
+                profile["failures"] = 0
+            else:
+                del profiles[key]
+        _save(profiles)
+
+
+def baud_succeeded(port: str, chip: str, baud: int) -> None:
+    """Reset the failure count after a clean transfer at the tuned rate."""
+    bridge = bridge_of(port)
+    if not bridge:
+        return
+    with _lock:
+        profiles = _load()
+        profile = profiles.get(_profile_key(bridge, chip))
+        if profile and profile.get("baud") == baud and profile.get("failures"):
+            profile["failures"] = 0
+            _save(profiles)
+
+
+def tune_port(port: str, chip: str, progress=None, cancel=None):
+    """
+    Probe BAUD_CANDIDATES in increasing order on port: read _PROBE_BYTES at each rate, then check the read data against
+    the on-chip MD5. Stops at the first failing rate and stores the highest stable one.
+    Returns (success, profile_or_error).
+    """
+    bridge = bridge_of(port)
+    if not bridge:
+        return False, f"No USB VID/PID for {port}; cannot key a baud profile"
+    results = []
+    _tuning.add(port)
+    tmp_dir = tempfile.mkdtemp(prefix="baud_probe_")
+    try:
+        for i, baud in enumerate(BAUD_CANDIDATES):
+            if cancel is not None and cancel.is_set():
+                return False, "Cancelled"
+            if progress:
+                progress(stage="tuning", pct=round(100 * i / len(BAUD_CANDIDATES)), line=f"Probing {baud} baud")
+            probe = os.path.join(tmp_dir, f"probe_{baud}.bin")
+            started = time.monotonic()
+            ok, out = _esptool(
+                "--chip", chip, "--port", port, "--baud", str(baud),
+                "read-flash", hex(_PROBE_ADDR), str(_PROBE_BYTES), probe,
+                timeout=60, cancel=cancel,
+            )
+            elapsed = time.monotonic() - started
+            if ok and os.path.isfile(probe) and os.path.getsize(probe) == _PROBE_BYTES:
+                matched, err = _verify_regions(chip, port, [], [(_PROBE_ADDR, probe)], cancel=cancel)
+                ok = bool(matched and matched.get(_PROBE_ADDR))
+                out = err or ("MD5 mismatch" if not ok else out)
+            else:
+                ok = False
+            results.append({
+                "baud": baud,
+                "ok": ok,
+                "bytes_per_sec": round(_PROBE_BYTES / elapsed) if ok and elapsed > 0 else None,
+                **({} if ok else {"error": (out or "Read failed").strip()[-200:]}),
+            })
+            if not ok:
+                break
+    finally:
+        _tuning.discard(port)
+        for name in os.listdir(tmp_dir):
+            os.remove(os.path.join(tmp_dir, name))
+        os.rmdir(tmp_dir)
+    if cancel is not None and cancel.is_set():
+        return False, "Cancelled"
+    stable = [r["baud"] for r in results if r["ok"]]
+    if not stable:
+        return False, results[0].get("error") if results else "No baud rates probed"
+    profile = {
+        "bridge": bridge,
+        "chip": chip,
+        "baud": max(stable),
+        "stable": stable,
+        "results": results,
+        "tuned_at": datetime.now().isoformat(timespec="seconds"),
+        "failures": 0,
+    }
+    key = _profile_key(bridge, chip)
+    with _lock:
+        profiles = _load()
+        profiles[key] = profile
+        _save(profiles)
+    return True, dict(profile, key=key)
@@ -0,0 +1,191 @@
+"""
+Build result cache for PlatformIO builds. The key is a SHA-256 over everything that decides the output:
+the source tree's committed content (git tree id, plus submodule commits), uncommitted changes (unpatched builds), env, the patch set, build-flag environment
+variables and the toolchain (PlatformIO core + installed platform versions). build_firmware writes the key and
+its inputs to build_manifest.json next to firmware.bin; artifact_index indexes the key, so a repeat build of
+unchanged firmware is one query (artifact_index.find_by_cache_key) and returns the existing artifact without running pio.
+"""
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import threading
+from datetime import datetime
+
+MANIFEST_NAME = "build_manifest.json"
+_FLAG_ENV_VARS = ("PLATFORMIO_BUILD_FLAGS", "PLATFORMIO_BUILD_SRC_FLAGS", "PLATFORMIO_BUILD_UNFLAGS")
+_HASH_BLOCK = 1 << 20
+
+_toolchain_lock = threading.Lock()
+_toolchain_cache = {}  # (executable, mtime_ns, platforms dir mtime_ns) -> version dict
+
+
+def _git(args, cwd: str, timeout: int = 30):
+    """stdout of a git command (bytes), or None when it fails."""
+    try:
+        r = subprocess.run(["git"] + args, cwd=cwd, capture_output=True, timeout=timeout)
+    except (OSError, subprocess.TimeoutExpired):
+        return None
+    return r.stdout if r.returncode == 0 else None
+
+
+def _sha256_file(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(_HASH_BLOCK), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _dirty_hash(top: str, scope: str):
+    """Hash of uncommitted changes under scope (relative to top): the tracked diff against HEAD and untracked, non-ignored files."""
+    h = hashlib.sha256()
+    diff = _git(["diff", "HEAD", "--binary", "--", scope], top, timeout=60)
+    if diff is None:
+        return None
+    h.update(diff)
+    untracked = _git(["ls-files", "--others", "--exclude-standard", "-z", "--", scope], top, timeout=60)
+    if untracked is None:
+        return None
+    for rel in sorted(p for p in untracked.decode("utf-8", errors="replace").split("\0") if p):
+        if ".pio" in rel.split("/"):
+            continue
+        try:
+            digest = _sha256_file(os.path.join(top, rel))
+        except OSError:
+            continue
+        h.update(f"{rel}\0{digest}\n".encode())
+    return h.hexdigest()
+
+
+def toolchain_version(cmd: str = "pio") -> dict:
+    """PlatformIO core version and installed platforms (name@version); cached until either changes on disk."""
+    exe = shutil.which(cmd) or shutil.which("platformio")
+    if not exe:
+        return {}
+    core_dir = os.environ.get("PLATFORMIO_CORE_DIR") or os.path.join(os.path.expanduser("~"), ".platformio")
+    platforms_dir = os.path.join(core_dir, "platforms")
+    try:
+        stamp = (exe, os.stat(exe).st_mtime_ns, os.stat(platforms_dir).st_mtime_ns if os.path.isdir(platforms_dir) else 0)
+    except OSError:
+        return {}
+    with _toolchain_lock:
+        if stamp in _toolchain_cache:
+            return _toolchain_cache[stamp]
+    try:
+        r = subprocess.run([exe, "--version"], capture_output=True, text=True, timeout=60)
+        core = (r.stdout or r.stderr).strip()
+    except (OSError, subprocess.TimeoutExpired):
+        return {}
+    platforms = []
+    if os.path.isdir(platforms_dir):
+        for name in sorted(os.listdir(platforms_dir)):
+            try:
+                with open(os.path.join(platforms_dir, name, "platform.json"), encoding="utf-8") as f:
+                    platforms.append(f"{name}@{json.load(f).get('version')}")
+            except (OSError, ValueError):
+                continue
+    version = {"core": core, "platforms": platforms}
+    with _toolchain_lock:
+        _toolchain_cache[stamp] = version
+    return version
+
+
+def compute_key(work_dir: str, env_name: str, patch_files=None, source_dir: str | None = None, cmd: str = "pio", rev: str | None = None):
+    """
+    Cache key for building env_name in work_dir with patch_files (absolute paths) applied. source_dir (default
+    work_dir) is the tree the build reads; when it sits inside a larger repo, only its subtree is keyed, so
+    commits elsewhere in the repo do not invalidate it. Patched builds and rev builds (a commit) run in a clean
+    worktree (build_worktrees), so their key is the commit's tree and recorded submodule commits only; the shared
+    checkout's local changes count for unpatched builds of HEAD, which build in place.
+    Returns (key, inputs) or (None, reason) when the tree is not a git checkout (nothing to key on).
+    """
+    top = _git(["rev-parse", "--show-toplevel"], work_dir)
+    if top is None:
+        return None, "not a git checkout"
+    top = top.decode().strip()
+    scope = os.path.relpath(os.path.realpath(source_dir or work_dir), os.path.realpath(top))
+    if scope.startswith(".."):
+        scope = "."
+    commit = rev or "HEAD"
+    tree = _git(["rev-parse", f"{commit}^{{tree}}" if scope == "." else f"{commit}:{scope}"], top)
+    if tree is None:
+        return None, "no commit for the source tree"
+    if rev or patch_files:
+        # The worktree holds only the commit: the submodule commits it records, no untracked files
+        dirty = ""
+        submodules = b"".join(
+            line for line in (_git(["ls-tree", "-r", commit, "--", scope], top) or b"").splitlines(True) if b" commit " in line
+        )
+    else:
+        dirty = _dirty_hash(top, scope)
+        if dirty is None:
+            return None, "git status failed"
+        submodules = _git(["submodule", "status", "--recursive", "--", scope], top) or b""
+    patches = []
+    for p in patch_files or []:
+        try:
+            patches.append(_sha256_file(p))
+        except OSError:
+            return None, f"patch not readable: {p}"
+    inputs = {
+        "tree": tree.decode().strip(),
+        "submodules": hashlib.sha256(submodules).hexdigest(),
+        "dirty": dirty,
+        "subdir": os.path.relpath(work_dir, top),
+        "env": env_name,
+        "patches": sorted(patches),
+        "flags": {k: os.environ[k] for k in _FLAG_ENV_VARS if os.environ.get(k)},
+        "toolchain": toolchain_version(cmd),
+    }
+    return key_for(inputs), inputs
+
+
+def key_for(inputs: dict) -> str:
+    """Cache key of a set of inputs (compute_key's, or with another host's toolchain for remote builds)."""
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode()).hexdigest()
+
+
+def write_manifest(artifact_dir: str, key: str, inputs: dict, bin_name: str, device_id: str, firmware_id: str,
+                   duration: float | None = None, worker: str | None = None) -> None:
+    """Record the cache key and its inputs next to the build output (artifact_index reads it on every rescan).
+    worker: the remote build worker that built it (build_workers)."""
+    manifest = {
+        "cache_key": key,
+        "inputs": inputs,
+        "bin": bin_name,
+        "device_id": device_id,
+        "firmware_id": firmware_id,
+        "built_at": datetime.now().isoformat(timespec="seconds"),
+        "duration_s": round(duration, 1) if duration is not None else None,
+    }
+    if worker:
+        manifest["worker"] = worker
+    try:
+        with open(os.path.join(artifact_dir, MANIFEST_NAME), "w", encoding="utf-8") as f:
+            json.dump(manifest, f, indent=2)
+    except OSError:
+        pass
+
+
+def built_by_worker(bin_path: str):
+    """Remote build worker recorded in the build_manifest.json next to bin_path, or None for a local build."""
+    try:
+        with open(os.path.join(os.path.dirname(bin_path), MANIFEST_NAME), encoding="utf-8") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return manifest.get("worker") if isinstance(manifest, dict) else None
+
+
+def read_manifest_key(bin_path: str):
+    """cache_key from the build_manifest.json next to bin_path when it describes that file, else None."""
+    try:
+        with open(os.path.join(os.path.dirname(bin_path), MANIFEST_NAME), encoding="utf-8") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if manifest.get("bin") != os.path.basename(bin_path):
+        return None
+    return manifest.get("cache_key")
@@ -0,0 +1,463 @@
+"""
+Background firmware builds: a worker pool runs build_firmware (pio / lab-build.sh) off the HTTP request.
+Each build gets an ID, a status, its output streamed line by line (SSE) and saved to BUILD_LOGS_DIR/<id>.log,
+and cancellation (kills the build's process tree). Builds that share a tree run one at a time, queued FIFO per tree
+outside the worker pool so a waiting build does not hold a worker: unpatched builds
+use the shared checkout (one .pio/build/<env> per env), patched builds a worktree per (env, patch set) (see
+build_worktrees), so different envs and patch sets build in parallel, as far as the CPU / memory budget allows
+(each build reserves its pio -j cores and memory for them). PlatformIO builds go to a remote build worker instead
+when one is free (build_workers); they neither hold a local tree nor budget. flash_after chains a flash job once the
+build succeeds.
+"""
+import os
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import build_cache
+import build_stats
+import build_workers
+from config import (
+    BUILD_CONFIG,
+    BUILD_CPU_BUDGET,
+    BUILD_JOB_WORKERS,
+    BUILD_JOBS_PER_BUILD,
+    BUILD_LOGS_DIR,
+    BUILD_MEM_BUDGET_MB,
+    BUILD_MEM_PER_JOB_MB,
+    BUILD_REMOTE_MAX_BUILDS,
+    BUILD_WORKER_TOKEN,
+    REPO_ROOT,
+)
+from flash_jobs import submit_job
+from flash_ops import build_firmware
+
+_TERMINAL = ("done", "error", "cancelled")
+_LOG_LINES = 500  # in memory per build; the log file has everything
+_BUILDS_KEEP = 50
+_LOG_FILES_KEEP = 200
+
+_builds = {}  # build_id -> build dict (internal keys start with "_")
+_builds_cond = threading.Condition()
+_trees = {}  # source tree -> { busy, waiting: deque of build IDs } (waiting builds hold no pool thread)
+_pool = None
+_remote_pool = None
+_budget_cond = threading.Condition()
+_reserved = {"cpus": 0, "mem_mb": 0}
+_mem_budget = None
+
+
+def _get_pool():
+    global _pool
+    with _builds_cond:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(max_workers=BUILD_JOB_WORKERS, thread_name_prefix="build-job")
+        return _pool
+
+
+def _get_remote_pool():
+    """Threads that follow remote builds (they wait on a worker, not on local cores)."""
+    global _remote_pool
+    with _builds_cond:
+        if _remote_pool is None:
+            _remote_pool = ThreadPoolExecutor(max_workers=BUILD_REMOTE_MAX_BUILDS, thread_name_prefix="build-remote")
+        return _remote_pool
+
+
+def _tree_key(device_id: str, firmware_id: str, env_name: str, patch_paths):
+    """
+    Key of the tree a build writes to: (source path, env, patch set) for PlatformIO, the whole source path for
+    ESP-IDF (lab-build.sh has a single build dir). Shared by every device / firmware pointing at the same path.
+    """
+    cfg = ((BUILD_CONFIG or {}).get(device_id) or {}).get(firmware_id) or {}
+    key = (cfg.get("path") or "").strip().strip("/") or f"{device_id}/{firmware_id}"
+    if (cfg.get("toolchain") or "platformio") != "idf":
+        envs = cfg.get("envs") or []
+        env = env_name if env_name in envs else (envs[0] if envs else env_name)
+        key = (key, env, tuple(sorted(patch_paths or [])))
+    return key
+
+
+def _claim_tree(build: dict) -> bool:
+    """
+    Take the build's tree, or queue the build behind the one holding it and return False: the calling pool thread is
+    freed and _release_tree submits the build again once it is its turn. A build cancelled before it got the tree
+    ends here too (False).
+    """
+    with _builds_cond:
+        if build["_cancel"].is_set():
+            _update(build["id"], status="cancelled", finished_at=time.time())
+            build["_done"].set()
+            return False
+        tree = _trees.setdefault(build["_tree"], {"busy": False, "waiting": deque()})
+        if not tree["busy"]:
+            tree["busy"] = True
+            return True
+        tree["waiting"].append(build["id"])
+        _update(build["id"], status="waiting_tree")
+        return False
+
+
+def _release_tree(key) -> None:
+    """Hand the tree to the next queued build (submitted to the pool already holding it), or mark it free."""
+    with _builds_cond:
+        tree = _trees[key]
+        if not tree["waiting"]:
+            del _trees[key]
+            return
+        next_id = tree["waiting"].popleft()
+        _update(next_id, status="queued")
+    _get_pool().submit(_run_build, next_id, False, True)
+
+
+def mem_budget_mb() -> int:
+    """Memory budget for builds: BUILD_MEM_BUDGET_MB, else 75% of physical memory (0 = unknown, not enforced)."""
+    global _mem_budget
+    if BUILD_MEM_BUDGET_MB:
+        return BUILD_MEM_BUDGET_MB
+    if _mem_budget is None:
+        _mem_budget = 0
+        try:
+            with open("/proc/meminfo", encoding="ascii") as f:
+                for line in f:
+                    if line.startswith("MemTotal:"):
+                        _mem_budget = int(line.split()[1]) * 3 // 4 // 1024
+                        break
+        except (OSError, ValueError):
+            pass
+    return _mem_budget
+
+
+def default_jobs(targets: int = 1) -> int:
+    """pio -j for a build when the caller gives none: BUILD_JOBS_PER_BUILD, else the CPU budget split across targets."""
+    return max(1, BUILD_JOBS_PER_BUILD or BUILD_CPU_BUDGET // max(1, targets))
+
+
+def _reserve(cpus: int, mem_mb: int, cancel: threading.Event) -> bool:
+    """Block until cpus / mem_mb fit in the budget (or nothing else is reserved) or the build is cancelled."""
+    mem_budget = mem_budget_mb()
+    with _budget_cond:
+        while not cancel.is_set():
+            idle = not _reserved["cpus"] and not _reserved["mem_mb"]
+            fits = _reserved["cpus"] + cpus <= BUILD_CPU_BUDGET and (not mem_budget or _reserved["mem_mb"] + mem_mb <= mem_budget)
+            if idle or fits:
+                _reserved["cpus"] += cpus
+                _reserved["mem_mb"] += mem_mb
+                return True
+            _budget_cond.wait(0.5)
+    return False
+
+
+def _unreserve(cpus: int, mem_mb: int) -> None:
+    with _budget_cond:
+        _reserved["cpus"] -= cpus
+        _reserved["mem_mb"] -= mem_mb
+        _budget_cond.notify_all()
+
+
+def budget_status() -> dict:
+    """CPU / memory budget and how much running builds hold."""
+    with _budget_cond:
+        reserved = dict(_reserved)
+    return {
+        "cpu_budget": BUILD_CPU_BUDGET, "cpus_reserved": reserved["cpus"],
+        "mem_budget_mb": mem_budget_mb(), "mem_reserved_mb": reserved["mem_mb"], "mem_per_job_mb": BUILD_MEM_PER_JOB_MB,
+    }
+
+
+def log_path(build_id: str) -> str:
+    return os.path.join(BUILD_LOGS_DIR, f"{build_id}.log")
+
+
+def _update(build_id: str, line: str | None = None, **kw):
+    """Update build fields, append an output line and wake SSE listeners."""
+    with _builds_cond:
+        build = _builds.get(build_id)
+        if not build:
+            return
+        build.update(kw)
+        if line is not None:
+            build["lines"] += 1
+            build["_log"].append((build["lines"], line))
+        build["seq"] += 1
+        _builds_cond.notify_all()
+
+
+def _snapshot(build: dict, log_lines: int = 20, after_line: int | None = None) -> dict:
+    out = {k: v for k, v in build.items() if not k.startswith("_")}
+    out["params"] = dict(build["params"])
+    if after_line is not None:
+        out["log"] = [line for n, line in build["_log"] if n > after_line]
+    else:
+        out["log_tail"] = [line for _, line in build["_log"]][-log_lines:] if log_lines else []
+    return out
+
+
+def _prune_locked():
+    if len(_builds) < _BUILDS_KEEP:
+        return
+    finished = sorted((b for b in _builds.values() if b["status"] in _TERMINAL), key=lambda b: b["created_at"])
+    for b in finished[: len(_builds) - _BUILDS_KEEP + 1]:
+        _builds.pop(b["id"], None)
+
+
+def _prune_log_files():
+    """Keep the newest _LOG_FILES_KEEP build logs."""
+    try:
+        names = [n for n in os.listdir(BUILD_LOGS_DIR) if n.endswith(".log")]
+        paths = sorted((os.path.join(BUILD_LOGS_DIR, n) for n in names), key=os.path.getmtime)
+        for p in paths[: max(0, len(paths) - _LOG_FILES_KEEP)]:
+            os.remove(p)
+    except OSError:
+        pass
+
+
+def submit_build(
+    device_id: str, firmware_id: str, env_name: str = "", patch_paths=None, timeout: int = 300,
+    clean: bool = False, verbose: bool = False, flash_port: str | None = None, flash_device_id: str | None = None,
+    use_cache: bool = True, jobs: int | None = None, git_ref: str | None = None,
+) -> str:
+    """
+    Queue a build (same arguments as flash_ops.build_firmware). jobs: pio -j, default default_jobs(); the build waits
+    until that many cores (and jobs x BUILD_MEM_PER_JOB_MB) are free in the budget (a remote worker uses all of its
+    cores unless jobs is given). With flash_port, a successful build queues a flash
+    job of the new firmware.bin to that port (flash_device_id, default device_id); its ID is result.flash_job_id.
+    result.cached is true when the build cache returned an earlier artifact; result.runner_saved_s is the container
+    startup a container build skipped in a warm build container; result.ccache is the compiler cache's hits, misses
+    and hit_rate for the build; result.footprint is the firmware's memory use, its change from the env's previous
+    build and any regressions (footprint); result.commit is the commit built for git_ref (or sent to a remote
+    worker) and result.worker the remote build worker that built it. Once finished, timings holds its phase times and
+    slowest translation units, also stored for trends (build_stats). Returns build_id.
+    """
+    build_id = uuid.uuid4().hex[:12]
+    requested_jobs = max(1, int(jobs)) if jobs else None
+    jobs = requested_jobs or default_jobs()
+    with _builds_cond:
+        _prune_locked()
+        _builds[build_id] = {
+            "id": build_id,
+            "device_id": device_id,
+            "firmware_id": firmware_id,
+            "env_name": env_name,
+            "params": {
+                "patch_paths": list(patch_paths or []),
+                "clean": bool(clean),
+                "verbose": bool(verbose),
+                "use_cache": bool(use_cache),
+                "git_ref": git_ref or None,
+                "jobs": requested_jobs,
+                "timeout": timeout,
+                "flash_port": flash_port or None,
+                "flash_device_id": (flash_device_id or device_id) if flash_port else None,
+            },
+            "jobs": jobs,
+            "mem_mb": jobs * BUILD_MEM_PER_JOB_MB,
+            "status": "queued",
+            "result": None,
+            "error": None,
+            "timings": None,
+            "log_file": os.path.relpath(log_path(build_id), REPO_ROOT),
+            "lines": 0,
+            "created_at": time.time(),
+            "started_at": None,
+            "finished_at": None,
+            "seq": 0,
+            "_log": deque(maxlen=_LOG_LINES),
+            "_cancel": threading.Event(),
+            "_done": threading.Event(),
+            "_tree": _tree_key(device_id, firmware_id, env_name, patch_paths),
+        }
+    _get_pool().submit(_run_build, build_id)
+    return build_id
+
+
+def _open_log(build_id: str):
+    """(log file, on_line) for a build: each line goes to BUILD_LOGS_DIR/<id>.log and the SSE listeners."""
+    os.makedirs(BUILD_LOGS_DIR, exist_ok=True)
+    _prune_log_files()
+    log = open(log_path(build_id), "a", encoding="utf-8", buffering=1)
+
+    def on_line(line):
+        line = line.rstrip()
+        log.write(line + "\n")
+        _update(build_id, line=line)
+
+    return log, on_line
+
+
+def _finish(build: dict, ok: bool, path_or_err: str, meta: dict, on_line) -> None:
+    """Final status of a build from build_firmware's (or a remote worker's) outcome; queues flash_after."""
+    build_id, params = build["id"], build["params"]
+    if build["_cancel"].is_set():
+        _update(build_id, status="cancelled", finished_at=time.time())
+        return
+    if not ok:
+        _update(build_id, status="error", error=path_or_err, finished_at=time.time())
+        return
+    result = {
+        "path": path_or_err, "cached": bool(meta.get("cached")), "cache_key": meta.get("cache_key"), "ccache": meta.get("ccache"),
+    }
+    for key in ("runner_saved_s", "footprint", "commit", "worker"):
+        if meta.get(key) is not None:
+            result[key] = meta[key]
+    abs_path = os.path.join(REPO_ROOT, path_or_err)
+    if params["flash_port"]:
+        remote = build_cache.built_by_worker(abs_path) if not BUILD_WORKER_TOKEN else None
+        if remote:
+            result["flash_error"] = f"Built by remote worker {remote} without BUILD_WORKER_TOKEN: not flashed"
+        elif os.path.isfile(abs_path):
+            result["flash_job_id"] = submit_job("flash", params["flash_port"], params["flash_device_id"], {"bin_path": abs_path})
+            on_line(f"Queued flash job {result['flash_job_id']} to {params['flash_port']}")
+        else:
+            result["flash_error"] = "Built but flash file not found"
+    _update(build_id, status="done", result=result, finished_at=time.time())
+
+
+def _run_remote_build(build_id: str):
+    """Follow a build on a remote worker; hand it back to the local pool when no worker can take it."""
+    with _builds_cond:
+        build = _builds[build_id]
+    log = meta = None
+    handled = False
+    try:
+        log, on_line = _open_log(build_id)
+        meta = {}
+        outcome = build_workers.run(build, on_line, build["_cancel"], meta, lambda **kw: _update(build_id, **kw))
+        if outcome is None:
+            return
+        handled = True
+        _finish(build, *outcome, meta, on_line)
+    except Exception as e:
+        handled = True
+        _update(build_id, status="error", error=str(e)[:400], finished_at=time.time())
+    finally:
+        if log is not None:
+            log.close()
+        if handled:
+            _update(build_id, timings=build_stats.summarize(meta or {}))
+            build_stats.record(build, meta or {}, "ok" if build["status"] == "done" else build["status"])
+            build["_done"].set()
+        else:
+            _update(build_id, status="queued")
+            _get_pool().submit(_run_build, build_id, False)
+
+
+def _run_build(build_id: str, remote: bool = True, tree_held: bool = False):
+    """Run a build in a pool thread. tree_held: _release_tree handed it the tree it was queued for."""
+    with _builds_cond:
+        build = _builds[build_id]
+    cancel = build["_cancel"]
+    params = build["params"]
+    cfg = ((BUILD_CONFIG or {}).get(build["device_id"]) or {}).get(build["firmware_id"]) or {}
+    if remote and not cancel.is_set() and build_workers.accepting(cfg.get("toolchain")):
+        _get_remote_pool().submit(_run_remote_build, build_id)
+        return
+    if not tree_held and not _claim_tree(build):
+        return
+    reserved = False
+    log = meta = None
+    try:
+        if not cancel.is_set():
+            _update(build_id, status="waiting_budget")
+            reserved = _reserve(build["jobs"], build["mem_mb"], cancel)
+        if cancel.is_set():
+            _update(build_id, status="cancelled", finished_at=time.time())
+            return
+        log, on_line = _open_log(build_id)
+        _update(build_id, status="running", started_at=time.time())
+        meta = {}
+        ok, path_or_err = build_firmware(
+            build["device_id"], build["firmware_id"], build["env_name"],
+            patch_paths=params["patch_paths"], timeout=params["timeout"], clean=params["clean"],
+            verbose=params["verbose"], on_line=on_line, cancel=cancel, use_cache=params["use_cache"], meta=meta,
+            jobs=build["jobs"], git_ref=params["git_ref"],
+        )
+        _finish(build, ok, path_or_err, meta, on_line)
+    except Exception as e:
+        _update(build_id, status="error", error=str(e)[:400], finished_at=time.time())
+    finally:
+        if meta is not None:
+            _update(build_id, timings=build_stats.summarize(meta))
+            build_stats.record(build, meta, "ok" if build["status"] == "done" else build["status"])
+        if log is not None:
+            log.close()
+        if reserved:
+            _unreserve(build["jobs"], build["mem_mb"])
+        _release_tree(build["_tree"])
+        build["_done"].set()
+
+
+def get_build(build_id: str, log_lines: int = 20):
+    """Snapshot of a build (status, params, result, error, log_tail), or None."""
+    with _builds_cond:
+        build = _builds.get(build_id)
+        return _snapshot(build, log_lines) if build else None
+
+
+def list_builds(active_only: bool = False):
+    """Recent builds, newest first."""
+    with _builds_cond:
+        builds = [_snapshot(b, 0) for b in _builds.values() if not active_only or b["status"] not in _TERMINAL]
+    return sorted(builds, key=lambda b: b["created_at"], reverse=True)
+
+
+def cancel_build(build_id: str):
+    """Request cancellation (kills the build's process tree). Returns (success, error_message)."""
+    with _builds_cond:
+        build = _builds.get(build_id)
+        if not build:
+            return False, "Build not found"
+        if build["status"] in _TERMINAL:
+            return False, f"Build already {build['status']}"
+        build["_cancel"].set()
+        waiting = (_trees.get(build["_tree"]) or {}).get("waiting") or ()
+        if build_id in waiting:
+            # Queued for its tree: no thread runs it, so it ends here
+            waiting.remove(build_id)
+            _update(build_id, status="cancelled", finished_at=time.time())
+            build["_done"].set()
+    _update(build_id, line="Cancellation requested")
+    return True, None
+
+
+def wait_build(build_id: str, timeout: float | None = None):
+    """
+    Block until the build finishes (or timeout). Returns its snapshot, or None if unknown. The snapshot is taken from
+    the build held here, so it is returned even when the build was pruned from the list while waiting.
+    """
+    with _builds_cond:
+        build = _builds.get(build_id)
+    if not build:
+        return None
+    build["_done"].wait(timeout)
+    with _builds_cond:
+        return _snapshot(build)
+
+
+def iter_build_events(build_id: str, after_line: int = 0, keepalive: float = 15.0):
+    """
+    Yield build snapshots whenever the build changes (None on idle keepalive); each carries "log", the output lines
+    since the previous event (starting after line after_line). Ends after a terminal state.
+    """
+    last_seq = -1
+    while True:
+        with _builds_cond:
+            build = _builds.get(build_id)
+            if not build:
+                return
+            if build["seq"] == last_seq:
+                _builds_cond.wait(keepalive)
+                build = _builds.get(build_id)
+                if not build:
+                    return
+            if build["seq"] == last_seq:
+                snap = None
+            else:
+                last_seq = build["seq"]
+                snap = _snapshot(build, after_line=after_line)
+                after_line = build["lines"]
+        yield snap
+        if snap is not None and snap["status"] in _TERMINAL:
+            return
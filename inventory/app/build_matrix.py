@@ -0,0 +1,229 @@
+"""
+Build matrix: build devices x firmware x envs from BUILD_CONFIG in one operation (e.g. every MeshCore role plus
+Meshtastic for one board). Each target becomes a build job (see build_jobs), so independent envs run concurrently
+within the CPU / memory budget, each with its share of cores as pio -j. Work shared by the envs of one project
+(platforms, toolchains, library downloads) runs once, as one pio pkg install per project, before its envs start.
+get_matrix() is the report: per-target status, artifact, cache hit and duration, plus wall-clock vs summed build time.
+"""
+import threading
+import time
+import uuid
+from collections import deque
+
+from build_jobs import cancel_build, default_jobs, get_build, submit_build, wait_build
+from config import BUILD_CONFIG
+from flash_ops import install_build_packages
+
+_matrices_lock = threading.Lock()
+_matrices = {}  # matrix_id -> { id, status, targets: [...], projects: { "dev/fw": {...} }, ... }
+_MATRICES_KEEP = 20
+_TERMINAL = ("done", "error", "cancelled")
+
+
+def resolve_matrix_targets(devices=None, firmware=None, envs=None, targets=None):
+    """
+    Expand the matrix: explicit targets [{ device_id, firmware_id, env_name?, patch_paths? }], or every
+    BUILD_CONFIG entry matching devices x firmware (None = all) with envs (None = all of each firmware's envs).
+    ESP-IDF firmware has no envs and builds once. Returns (list of targets, error_or_None).
+    """
+    out = []
+    if targets:
+        for t in targets:
+            device_id, firmware_id = (t.get("device_id") or "").strip(), (t.get("firmware_id") or "").strip()
+            cfg = ((BUILD_CONFIG or {}).get(device_id) or {}).get(firmware_id)
+            if not cfg:
+                return [], f"Unknown device or firmware: {device_id}/{firmware_id}"
+            env = (t.get("env_name") or "").strip()
+            if cfg.get("toolchain") != "idf" and env not in (cfg.get("envs") or []):
+                return [], f"Unknown env for {device_id}/{firmware_id}: {env or '(none)'}"
+            out.append({"device_id": device_id, "firmware_id": firmware_id, "env_name": env,
+                        "patch_paths": [p for p in (t.get("patch_paths") or []) if isinstance(p, str) and p.strip()]})
+        return out, None if out else "No targets"
+    for device_id, firmwares in (BUILD_CONFIG or {}).items():
+        if devices and device_id not in devices:
+            continue
+        for firmware_id, cfg in firmwares.items():
+            if firmware and firmware_id not in firmware:
+                continue
+            if cfg.get("toolchain") == "idf":
+                out.append({"device_id": device_id, "firmware_id": firmware_id, "env_name": "", "patch_paths": []})
+                continue
+            for env in cfg.get("envs") or []:
+                if not envs or env in envs:
+                    out.append({"device_id": device_id, "firmware_id": firmware_id, "env_name": env, "patch_paths": []})
+    if not out:
+        return [], "No BUILD_CONFIG entries match"
+    return out, None
+
+
+def _run_project(matrix_id: str, project: str, rows: list, cancel: threading.Event, opts: dict):
+    """Install the project's packages once for all its envs, then queue one build per target."""
+    device_id, firmware_id = project.split("/", 1)
+    if opts["prefetch"] and not cancel.is_set():
+        _set_project(matrix_id, project, status="installing", started_at=time.time())
+        tail = deque(maxlen=20)
+        ok, msg = install_build_packages(
+            device_id, firmware_id, [r["env_name"] for r in rows if r["env_name"]], on_line=tail.append, cancel=cancel,
+        )
+        # A failed install is reported but not fatal: each build installs what it still lacks
+        _set_project(matrix_id, project, status="installed" if ok else "install_failed", message=msg,
+                     log_tail=[] if ok else list(tail), finished_at=time.time())
+    if cancel.is_set():
+        return
+    for row in rows:
+        row["build_id"] = submit_build(
+            row["device_id"], row["firmware_id"], row["env_name"], patch_paths=row["patch_paths"],
+            clean=opts["clean"], use_cache=opts["use_cache"], jobs=opts["jobs"],
+        )
+        watcher = threading.Thread(target=_record_build, args=(matrix_id, row), daemon=True)
+        watcher.start()
+        with _matrices_lock:
+            _matrices[matrix_id]["_watchers"].append(watcher)
+
+
+def _record_build(matrix_id: str, row: dict):
+    """Wait for the row's build and keep its outcome in the row: the build itself is pruned after 50 later builds."""
+    build = wait_build(row["build_id"])
+    if build:
+        with _matrices_lock:
+            row.update(_build_fields(build))
+
+
+def _set_project(matrix_id: str, project: str, **kw):
+    with _matrices_lock:
+        _matrices[matrix_id]["projects"][project].update(kw)
+
+
+def _run_matrix(matrix_id: str):
+    with _matrices_lock:
+        matrix = _matrices[matrix_id]
+    cancel = matrix["_cancel"]
+    try:
+        by_project = {}
+        for row in matrix["targets"]:
+            by_project.setdefault(f"{row['device_id']}/{row['firmware_id']}", []).append(row)
+        threads = [
+            threading.Thread(target=_run_project, args=(matrix_id, project, rows, cancel, matrix["options"]), daemon=True)
+            for project, rows in by_project.items()
+        ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        if cancel.is_set():
+            for row in matrix["targets"]:
+                if row.get("build_id"):
+                    cancel_build(row["build_id"])
+        with _matrices_lock:
+            watchers = list(matrix["_watchers"])
+        for t in watchers:
+            t.join()
+        status = "cancelled" if cancel.is_set() else "done"
+    except Exception as e:
+        status = "error"
+        with _matrices_lock:
+            matrix["error"] = str(e)[:300]
+    with _matrices_lock:
+        matrix["status"] = status
+        matrix["finished_at"] = time.time()
+
+
+def start_matrix(targets: list, jobs: int | None = None, clean: bool = False, use_cache: bool = True, prefetch: bool = True):
+    """
+    Build every target (from resolve_matrix_targets) in the background. jobs: pio -j per build, default the CPU
+    budget split across the targets. prefetch: one pio pkg install per project first. Returns matrix_id.
+    """
+    matrix_id = uuid.uuid4().hex[:12]
+    jobs = max(1, int(jobs or default_jobs(len(targets))))
+    with _matrices_lock:
+        if len(_matrices) >= _MATRICES_KEEP:
+            finished = sorted((m for m in _matrices.values() if m["status"] in _TERMINAL), key=lambda m: m["created_at"])
+            for m in finished[: len(_matrices) - _MATRICES_KEEP + 1]:
+                _matrices.pop(m["id"], None)
+        _matrices[matrix_id] = {
+            "id": matrix_id,
+            "status": "running",
+            "options": {"jobs": jobs, "clean": bool(clean), "use_cache": bool(use_cache), "prefetch": bool(prefetch)},
+            "created_at": time.time(),
+            "finished_at": None,
+            "error": None,
+            "targets": [dict(t, build_id=None) for t in targets],
+            "projects": {f"{t['device_id']}/{t['firmware_id']}": {"status": "queued"} for t in targets},
+            "_cancel": threading.Event(),
+            "_watchers": [],
+        }
+    threading.Thread(target=_run_matrix, args=(matrix_id,), daemon=True).start()
+    return matrix_id
+
+
+def _build_fields(build: dict) -> dict:
+    """Row fields from a build snapshot: status, artifact, cache hit, error, jobs and duration."""
+    result = build["result"] or {}
+    out = {"status": build["status"], "path": result.get("path"), "cached": result.get("cached"), "error": build["error"], "jobs": build["jobs"]}
+    if build["started_at"]:
+        out["duration_s"] = round((build["finished_at"] or time.time()) - build["started_at"], 1)
+    return out
+
+
+def _target_status(row: dict, project: dict) -> dict:
+    """
+    Merge the target's build (status, artifact, cache hit, duration, error) into its matrix row: live while the build
+    is listed, else the outcome _record_build stored in the row.
+    """
+    out = {k: v for k, v in row.items() if k != "patch_paths"} | {"patches": len(row["patch_paths"])}
+    build = get_build(row["build_id"], log_lines=0) if row.get("build_id") else None
+    if build:
+        out.update(_build_fields(build))
+    elif "status" not in row:
+        out["status"] = "installing" if project.get("status") == "installing" else "queued"
+    return out
+
+
+def get_matrix(matrix_id: str):
+    """Matrix report: per-target rows, per-project package install, status counts and timings, or None."""
+    with _matrices_lock:
+        matrix = _matrices.get(matrix_id)
+        if not matrix:
+            return None
+        out = {k: v for k, v in matrix.items() if not k.startswith("_")}
+        rows = [dict(r) for r in matrix["targets"]]
+        out["projects"] = {k: dict(v) for k, v in matrix["projects"].items()}
+    out["targets"] = [_target_status(r, out["projects"][f"{r['device_id']}/{r['firmware_id']}"]) for r in rows]
+    counts = {}
+    for r in out["targets"]:
+        counts[r["status"]] = counts.get(r["status"], 0) + 1
+    build_s = sum(r.get("duration_s") or 0 for r in out["targets"])
+    wall_s = (out["finished_at"] or time.time()) - out["created_at"]
+    out["summary"] = dict(
+        counts, total=len(rows), cached=sum(1 for r in out["targets"] if r.get("cached")),
+        wall_s=round(wall_s, 1), build_s=round(build_s, 1), parallelism=round(build_s / wall_s, 2) if wall_s > 0 else None,
+    )
+    if out["status"] == "done" and any(r["status"] != "done" for r in out["targets"]):
+        out["status"] = "error"
+    return out
+
+
+def list_matrices():
+    """Recent build matrices (newest first) without per-target detail."""
+    with _matrices_lock:
+        matrices = [
+            {k: v for k, v in m.items() if k not in ("targets", "projects") and not k.startswith("_")}
+            | {"target_count": len(m["targets"])}
+            for m in _matrices.values()
+        ]
+    return sorted(matrices, key=lambda m: m["created_at"], reverse=True)
+
+
+def cancel_matrix(matrix_id: str):
+    """Cancel a running matrix: pending package installs stop and every queued or running build is cancelled."""
+    with _matrices_lock:
+        matrix = _matrices.get(matrix_id)
+        if not matrix:
+            return False, "Matrix not found"
+        if matrix["status"] in _TERMINAL:
+            return False, f"Matrix already {matrix['status']}"
+        matrix["_cancel"].set()
+        build_ids = [r["build_id"] for r in matrix["targets"] if r.get("build_id")]
+    for build_id in build_ids:
+        cancel_build(build_id)
+    return True, None
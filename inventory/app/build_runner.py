@@ -0,0 +1,97 @@
+"""
+Warm build containers. scripts/lab-exec.sh runs each container build (scripts/lab-build.sh, the ESP-IDF path of
+build_firmware) with docker exec in a long-lived container per toolchain (lab-build-platformio, lab-build-idf)
+instead of a fresh docker run, with named volumes for PlatformIO packages and ccache. The script starts the
+container on first use, health-checks it before each build and recycles it when its image changes or after
+LAB_MAX_BUILDS builds; this module reports on those containers and recycles them on request.
+A warm build logs "lab-exec: ... saved_s=<seconds>", the container's measured cold start; saved_seconds() reads it.
+"""
+import re
+import subprocess
+
+from config import BUILD_RUNNER_MAX_BUILDS
+
+_LABEL = "cyber-lab.build-runner"
+_TOOLCHAINS = ("platformio", "idf")
+_SAVED_RE = re.compile(r"^lab-exec: warm .*saved_s=([\d.]+)", re.M)
+
+
+def _docker(args, timeout: int = 15):
+    """(ok, stdout or error) of a docker command."""
+    try:
+        r = subprocess.run(["docker"] + args, capture_output=True, text=True, timeout=timeout)
+    except FileNotFoundError:
+        return False, "Docker CLI not available"
+    except subprocess.TimeoutExpired:
+        return False, f"docker {args[0]} timed out"
+    return r.returncode == 0, (r.stdout if r.returncode == 0 else (r.stderr or r.stdout)).strip()
+
+
+def saved_seconds(output: str):
+    """Seconds of container startup a build skipped by running in a warm container (from lab-exec output), else None."""
+    m = _SAVED_RE.search(output or "")
+    return float(m.group(1)) if m else None
+
+
+def _read(name: str, path: str):
+    ok, out = _docker(["exec", name, "cat", path], timeout=10)
+    return out if ok else None
+
+
+def list_runners():
+    """
+    Warm build containers: name, toolchain, image, state, started_at, builds, max_builds, cold_start_s,
+    image_current (False when the image was rebuilt since; the next build recycles it), healthy.
+    Returns (runners, error_or_None).
+    """
+    ok, out = _docker(["ps", "-a", "-q", "--filter", f"label={_LABEL}"])
+    if not ok:
+        return [], out
+    runners = []
+    for cid in out.split():
+        ok, info = _docker([
+            "inspect", "-f",
+            "{{.Name}}\t{{index .Config.Labels \"" + _LABEL + "\"}}\t{{index .Config.Labels \"cyber-lab.image\"}}"
+            "\t{{.Image}}\t{{.State.Status}}\t{{.State.StartedAt}}",
+            cid,
+        ])
+        if not ok:
+            continue
+        parts = info.split("\t")
+        if len(parts) < 6:
+            continue
+        name, toolchain, image, image_id, state, started_at = parts[0].lstrip("/"), *parts[1:6]
+        ok, current_id = _docker(["image", "inspect", "-f", "{{.Id}}", image]) if image else (False, "")
+        running = state == "running"
+        builds, cold = (_read(name, "/tmp/.lab-builds"), _read(name, "/tmp/.lab-cold-start-s")) if running else (None, None)
+        runners.append({
+            "name": name,
+            "toolchain": toolchain,
+            "image": image,
+            "state": state,
+            "started_at": started_at,
+            "builds": int(builds) if builds and builds.isdigit() else None,
+            "max_builds": BUILD_RUNNER_MAX_BUILDS,
+            "cold_start_s": float(cold) if cold and re.fullmatch(r"[\d.]+", cold) else None,
+            "image_current": ok and current_id == image_id,
+            "healthy": running and _read(name, "/tmp/.lab-env") is not None,
+        })
+    return runners, None
+
+
+def recycle(toolchain: str | None = None):
+    """Remove the warm container for toolchain (None = all); the next build starts a fresh one. Returns (ok, removed or error)."""
+    if toolchain and toolchain not in _TOOLCHAINS:
+        return False, f"Unknown toolchain: {toolchain}"
+    runners, err = list_runners()
+    if err:
+        return False, err
+    removed = []
+    for r in runners:
+        if toolchain and r["toolchain"] != toolchain:
+            continue
+        ok, out = _docker(["rm", "-f", r["name"]], timeout=60)
+        if not ok:
+            return False, out[:300]
+        removed.append(r["name"])
+    return True, removed
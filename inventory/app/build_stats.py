@@ -0,0 +1,322 @@
+"""
+Build performance history: every firmware build (build_jobs) is recorded in SQLite (artifacts/build_stats.db) with
+its phase timings (cache lookup, patch, clean, deps, compile, link, copy), queue wait, cache / ccache outcome and
+per-translation-unit compile times, so trends() shows where build time goes per device / firmware / env over time
+and slowest_units() which sources dominate compilation.
+
+Phase boundaries come from the build output (PhaseTimer). Translation-unit times are measured, not inferred from
+output order (with pio -j the "Compiling" lines only mark starts): PlatformIO builds wrap each compile command with
+scripts/time_unit.py (installed by the pre: extra script scripts/pio_unit_times.py) which appends
+"<seconds>\\t<object>" to BUILD_UNIT_LOG; ESP-IDF builds read ninja's .ninja_log. Recording never raises.
+"""
+import json
+import os
+import re
+import sqlite3
+import sys
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+from config import BUILD_STATS_DB_PATH, BUILD_STATS_UNIT_BUILDS, BUILD_UNIT_TIMES, REPO_ROOT
+
+PHASES = ("fetch", "cache", "patch", "clean", "deps", "compile", "link", "copy")
+PIO_SCRIPT = os.path.join(REPO_ROOT, "scripts", "pio_unit_times.py")
+_WRAPPER = os.path.join(REPO_ROOT, "scripts", "time_unit.py")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS builds (
+  build_id TEXT PRIMARY KEY,
+  device_id TEXT NOT NULL,
+  firmware_id TEXT NOT NULL,
+  env_name TEXT,
+  patches INTEGER NOT NULL DEFAULT 0,
+  jobs INTEGER,
+  outcome TEXT NOT NULL,  -- ok, error, cancelled
+  cached INTEGER NOT NULL DEFAULT 0,
+  queued_s REAL,
+  duration_s REAL,
+  phases TEXT,  -- JSON { phase: seconds }
+  units INTEGER NOT NULL DEFAULT 0,
+  unit_s REAL,  -- summed compile time of all units (CPU-side view; duration_s is wall clock)
+  ccache_hits INTEGER,
+  ccache_misses INTEGER,
+  created_at TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS build_units (
+  build_id TEXT NOT NULL REFERENCES builds(build_id),
+  unit TEXT NOT NULL,
+  seconds REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_builds_target ON builds(device_id, firmware_id, env_name, created_at);
+CREATE INDEX IF NOT EXISTS idx_build_units_build ON build_units(build_id);
+"""
+_COMPILE_LINE = re.compile(r"^(Compiling |Archiving |\[\d+/\d+\] Building (C|CXX|ASM) object )")
+_LINK_LINE = re.compile(r"^(Linking \S+\.elf$|\[\d+/\d+\] Linking CX* executable )")
+_UNIT_PREFIX = re.compile(r"^.*?\.pio/build/[^/]+/")
+_UNITS_IN_RESULT = 10
+
+_db_lock = threading.Lock()
+_initialized = False
+
+
+def _connect():
+    global _initialized
+    os.makedirs(os.path.dirname(BUILD_STATS_DB_PATH), exist_ok=True)
+    conn = sqlite3.connect(BUILD_STATS_DB_PATH, timeout=10)
+    conn.row_factory = sqlite3.Row
+    if not _initialized:
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(_SCHEMA)
+        _initialized = True
+    return conn
+
+
+class PhaseTimer:
+    """
+    Splits one pio run / idf.py build into deps (packages, dependency finder, configure), compile and link by
+    watching its output: feed() each line as it arrives, finish() when the process exits.
+    """
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.first_compile = None
+        self.first_link = None
+
+    def feed(self, line: str) -> None:
+        if self.first_compile is None and _COMPILE_LINE.match(line):
+            self.first_compile = time.monotonic()
+        elif self.first_link is None and _LINK_LINE.match(line):
+            self.first_link = time.monotonic()
+
+    def finish(self, phases: dict) -> None:
+        end = time.monotonic()
+        link = self.first_link or end
+        compile_start = min(self.first_compile or link, link)
+        phases["deps"] = round(phases.get("deps", 0) + compile_start - self.started, 3)
+        phases["compile"] = round(phases.get("compile", 0) + link - compile_start, 3)
+        phases["link"] = round(phases.get("link", 0) + end - link, 3)
+
+
+@contextmanager
+def phase(meta: dict, name: str):
+    """with phase(meta, "clean"): ... adds the block's wall time to meta["phases"]["clean"]."""
+    phases = meta.setdefault("phases", {})
+    started = time.monotonic()
+    try:
+        yield
+    finally:
+        phases[name] = round(phases.get(name, 0) + time.monotonic() - started, 3)
+
+
+def new_unit_log() -> str:
+    """Path for one build's BUILD_UNIT_LOG (under the repo, like compiler_cache stats logs)."""
+    log_dir = os.path.join(REPO_ROOT, ".build_stats")
+    os.makedirs(log_dir, exist_ok=True)
+    return os.path.join(log_dir, uuid.uuid4().hex[:12] + ".units")
+
+
+def pio_env(unit_log: str, env: dict | None = None):
+    """
+    env (default os.environ) with per-unit timing added for pio run, or env unchanged when BUILD_UNIT_TIMES is off.
+    Goes after compiler_cache.pio_env: the timing wrapper must be outermost, around ccache.
+    """
+    if not BUILD_UNIT_TIMES or not os.path.isfile(PIO_SCRIPT) or not os.path.isfile(_WRAPPER):
+        return env
+    env = dict(env if env is not None else os.environ)
+    scripts = [s for s in (env.get("PLATFORMIO_EXTRA_SCRIPTS") or "").split("\n") if s.strip()]
+    env["PLATFORMIO_EXTRA_SCRIPTS"] = "\n".join(scripts + [f"pre:{PIO_SCRIPT}"])
+    env["BUILD_UNIT_LOG"] = unit_log
+    env["BUILD_UNIT_PYTHON"] = sys.executable
+    env["BUILD_UNIT_WRAPPER"] = _WRAPPER
+    return env
+
+
+def read_unit_log(unit_log: str) -> list:
+    """[(unit, seconds)] from a BUILD_UNIT_LOG (removed afterwards), slowest first; unit is the object path below .pio/build/<env>/."""
+    units = []
+    try:
+        with open(unit_log, encoding="utf-8", errors="replace") as f:
+            lines = f.read().splitlines()
+        os.remove(unit_log)
+    except OSError:
+        return units
+    for line in lines:
+        seconds, _, target = line.partition("\t")
+        try:
+            units.append((re.sub(r"\.o$", "", _UNIT_PREFIX.sub("", target.strip())), float(seconds)))
+        except ValueError:
+            continue
+    return sorted(units, key=lambda u: -u[1])
+
+
+def read_ninja_log(build_dir: str, since: float) -> list:
+    """[(unit, seconds)] for objects ninja built in build_dir since (wall clock), from .ninja_log, slowest first."""
+    units = []
+    try:
+        with open(os.path.join(build_dir, ".ninja_log"), encoding="utf-8", errors="replace") as f:
+            lines = f.read().splitlines()
+    except OSError:
+        return units
+    latest = {}
+    for line in lines[1:]:  # "# ninja log v5", then start_ms end_ms mtime target hash
+        parts = line.split("\t")
+        if len(parts) >= 4 and parts[3].endswith((".obj", ".o")) and parts[0].isdigit() and parts[1].isdigit():
+            latest[parts[3]] = (int(parts[1]) - int(parts[0])) / 1000
+    for target, seconds in latest.items():
+        try:
+            if os.path.getmtime(os.path.join(build_dir, target)) < since - 1:
+                continue  # built by an earlier run
+        except OSError:
+            continue
+        units.append((re.sub(r"\.(obj|o)$", "", target), seconds))
+    return sorted(units, key=lambda u: -u[1])
+
+
+def summarize(meta: dict) -> dict:
+    """Timings for the build record: phases, unit count, summed unit time and the slowest units."""
+    units = meta.get("units") or []
+    return {
+        "phases": meta.get("phases") or {},
+        "units": len(units),
+        "unit_s": round(sum(s for _, s in units), 3),
+        "slowest_units": [{"unit": u, "seconds": round(s, 3)} for u, s in units[:_UNITS_IN_RESULT]],
+    }
+
+
+def record(build: dict, meta: dict, outcome: str) -> None:
+    """Store a finished build (build_jobs build dict) with its timings from meta (phases, units, cached, ccache)."""
+    units = meta.get("units") or []
+    ccache = meta.get("ccache") or {}
+    started, finished = build.get("started_at"), build.get("finished_at") or time.time()
+    try:
+        with _db_lock:
+            conn = _connect()
+            try:
+                with conn:
+                    conn.execute(
+                        "INSERT OR REPLACE INTO builds (build_id, device_id, firmware_id, env_name, patches, jobs, outcome,"
+                        " cached, queued_s, duration_s, phases, units, unit_s, ccache_hits, ccache_misses, created_at)"
+                        " VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)",
+                        (build["id"], build["device_id"], build["firmware_id"], build.get("env_name") or "",
+                         len(build["params"]["patch_paths"]), build.get("jobs"), outcome, 1 if meta.get("cached") else 0,
+                         round(started - build["created_at"], 3) if started else None,
+                         round(finished - started, 3) if started else None,
+                         json.dumps(meta.get("phases") or {}), len(units), round(sum(s for _, s in units), 3),
+                         ccache.get("hits"), ccache.get("misses"),
+                         datetime.fromtimestamp(build["created_at"]).isoformat(timespec="seconds")),
+                    )
+                    conn.executemany(
+                        "INSERT INTO build_units (build_id, unit, seconds) VALUES (?,?,?)",
+                        [(build["id"], u, round(s, 3)) for u, s in units],
+                    )
+                    if units:
+                        # Unit rows dominate the database: keep them for the latest BUILD_STATS_UNIT_BUILDS builds only
+                        conn.execute(
+                            "DELETE FROM build_units WHERE build_id NOT IN (SELECT build_id FROM builds WHERE units > 0"
+                            " ORDER BY created_at DESC LIMIT ?)", (BUILD_STATS_UNIT_BUILDS,),
+                        )
+            finally:
+                conn.close()
+    except (sqlite3.Error, OSError, KeyError):
+        pass
+
+
+def _filters(device_id=None, firmware_id=None, env_name=None, since_days=None, prefix=""):
+    where, params = [], []
+    for column, value in (("device_id", device_id), ("firmware_id", firmware_id), ("env_name", env_name)):
+        if value:
+            where.append(f"{prefix}{column} = ?")
+            params.append(value)
+    if since_days:
+        where.append(f"{prefix}created_at >= ?")
+        params.append((datetime.now() - timedelta(days=float(since_days))).isoformat(timespec="seconds"))
+    return where, params
+
+
+def _query(sql: str, params: list):
+    with _db_lock:
+        conn = _connect()
+        try:
+            return conn.execute(sql, params).fetchall()
+        finally:
+            conn.close()
+
+
+def _mean(values):
+    values = [v for v in values if v is not None]
+    return round(sum(values) / len(values), 2) if values else None
+
+
+def trends(device_id: str | None = None, firmware_id: str | None = None, env_name: str | None = None, since_days: float = 30,
+           bucket: str = "day"):
+    """
+    Build time per target (device/firmware/env) and period (bucket: day or week): builds, failures, cache hits,
+    mean wall / queue time, mean time per phase, mean units compiled and ccache hit rate. Cached and failed builds
+    are counted but only successful, uncached builds go into the timings. Returns (targets_or_None, error).
+    """
+    if bucket not in ("day", "week"):
+        return None, "bucket must be day or week"
+    where, params = _filters(device_id, firmware_id, env_name, since_days)
+    sql = "SELECT * FROM builds" + (" WHERE " + " AND ".join(where) if where else "") + " ORDER BY created_at"
+    try:
+        rows = _query(sql, params)
+    except (sqlite3.Error, OSError) as e:
+        return None, str(e)
+    targets = {}
+    for r in rows:
+        day = datetime.fromisoformat(r["created_at"]).date()
+        period = (day - timedelta(days=day.weekday()) if bucket == "week" else day).isoformat()
+        key = (r["device_id"], r["firmware_id"], r["env_name"])
+        targets.setdefault(key, {}).setdefault(period, []).append(r)
+    out = []
+    for (device, firmware, env), periods in targets.items():
+        series = []
+        for period, items in periods.items():
+            timed = [r for r in items if r["outcome"] == "ok" and not r["cached"]]
+            phases = [json.loads(r["phases"] or "{}") for r in timed]
+            hits = sum(r["ccache_hits"] or 0 for r in timed)
+            misses = sum(r["ccache_misses"] or 0 for r in timed)
+            series.append({
+                "period": period,
+                "builds": len(items),
+                "failed": sum(1 for r in items if r["outcome"] == "error"),
+                "cached": sum(1 for r in items if r["cached"]),
+                "duration_s": _mean(r["duration_s"] for r in timed),
+                "queued_s": _mean(r["queued_s"] for r in items),
+                "phases": {p: _mean(ph.get(p) for ph in phases) for p in PHASES if any(p in ph for ph in phases)},
+                "units": _mean(r["units"] for r in timed if r["units"]),
+                "unit_s": _mean(r["unit_s"] for r in timed if r["units"]),
+                "ccache_hit_rate": round(hits / (hits + misses), 3) if hits + misses else None,
+            })
+        out.append({"device_id": device, "firmware_id": firmware, "env_name": env, "series": series})
+    return out, None
+
+
+def slowest_units(device_id: str | None = None, firmware_id: str | None = None, env_name: str | None = None, since_days: float | None = None,
+                  limit: int = 20):
+    """
+    Translation units by mean compile time across recorded builds: unit, builds, mean_s, max_s, last_s, total_s.
+    Returns (units_or_None, error).
+    """
+    where, params = _filters(device_id, firmware_id, env_name, since_days, prefix="b.")
+    sql = (
+        "SELECT u.unit, b.device_id, b.firmware_id, b.env_name, COUNT(*) AS builds, AVG(u.seconds) AS mean_s,"
+        " MAX(u.seconds) AS max_s, SUM(u.seconds) AS total_s,"
+        " (SELECT u2.seconds FROM build_units u2 JOIN builds b2 ON b2.build_id = u2.build_id"
+        "  WHERE u2.unit = u.unit AND b2.device_id = b.device_id AND b2.firmware_id = b.firmware_id"
+        "  AND b2.env_name = b.env_name ORDER BY b2.created_at DESC LIMIT 1) AS last_s"
+        " FROM build_units u JOIN builds b ON b.build_id = u.build_id"
+        + (" WHERE " + " AND ".join(where) if where else "")
+        + " GROUP BY u.unit, b.device_id, b.firmware_id, b.env_name ORDER BY mean_s DESC LIMIT ?"
+    )
+    try:
+        rows = _query(sql, params + [int(limit)])
+    except (sqlite3.Error, OSError) as e:
+        return None, str(e)
+    return [
+        {k: round(r[k], 3) if isinstance(r[k], float) else r[k] for k in r.keys()}
+        for r in rows
+    ], None
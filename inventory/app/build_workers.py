@@ -0,0 +1,361 @@
+"""
+Remote build workers. scripts/build_worker.py runs on any lab host with Docker (or a local PlatformIO), sends a
+heartbeat (slots, running builds, load, toolchain, the repo / env / commit of its warm build trees) and pulls builds
+over HTTP. build_jobs hands a PlatformIO build here when BUILD_REMOTE allows it and a live worker has a free slot;
+the build is described by git revision (upstream URL, commit, project subdir, patch contents), so only clean trees
+at commits upstream has (HEAD, or a git_ref through git_mirrors) go remote.
+A queued build is offered to the best worker: warm tree for the same repo and env (and commit) first, then least
+loaded. After BUILD_WORKER_AFFINITY_WAIT seconds any free worker may take it; unclaimed after
+BUILD_WORKER_CLAIM_TIMEOUT it builds locally (BUILD_REMOTE=auto). The worker streams its output back and uploads
+firmware.bin (plus firmware.elf / partitions.bin for the footprint); the artifact is stored and indexed like a
+local build, with a build manifest keyed on the worker's toolchain (and naming the worker) so the build cache finds
+it again. Nothing goes remote unless BUILD_WORKER_TOKEN is set: workers authenticate with it.
+"""
+import base64
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from collections import deque
+
+import artifact_index
+import build_cache
+import build_stats
+import footprint
+import git_mirrors
+from config import (
+    BUILD_CONFIG, BUILD_REMOTE, BUILD_WORKER_AFFINITY_WAIT, BUILD_WORKER_CLAIM_TIMEOUT,
+    BUILD_WORKER_TIMEOUT, BUILD_WORKER_TOKEN, REPO_ROOT,
+)
+
+_UPLOAD_FILES = ("firmware.bin", "firmware.elf", "partitions.bin")
+_TARGETS_KEEP = 20
+
+_cond = threading.Condition()
+_workers = {}  # worker_id -> heartbeat fields + last_seen, builds_done
+_jobs = {}  # build_id -> remote job (spec, status, worker, lines, cancel, result)
+_queue = []  # build_ids waiting for a worker, oldest first
+
+
+def _git(args, cwd: str, timeout: int = 60):
+    """(ok, output) of a git command; output is stderr (or stdout) on failure."""
+    try:
+        r = subprocess.run(["git"] + args, cwd=cwd, capture_output=True, text=True, timeout=timeout)
+    except subprocess.TimeoutExpired:
+        return False, f"git {args[0]} timed out"
+    except OSError as e:
+        return False, str(e)
+    return r.returncode == 0, (r.stdout if r.returncode == 0 else (r.stderr or r.stdout)).strip()
+
+
+def _live_locked():
+    now = time.time()
+    return [w for w in _workers.values() if now - w["last_seen"] <= BUILD_WORKER_TIMEOUT]
+
+
+def _busy_locked(worker_id: str) -> int:
+    """Builds the worker holds: claimed here and not finished (its heartbeat may lag behind)."""
+    return sum(1 for j in _jobs.values() if j["worker"] == worker_id and j["status"] == "claimed")
+
+
+def heartbeat(data: dict):
+    """Register or refresh a worker. data: worker_id, host, slots, running, load, cpus, runner, toolchain, targets."""
+    worker_id = str(data.get("worker_id") or "").strip()[:100]
+    if not worker_id:
+        return False, "worker_id required"
+    with _cond:
+        w = _workers.setdefault(worker_id, {"id": worker_id, "first_seen": time.time(), "builds_done": 0})
+        w.update(
+            host=str(data.get("host") or "")[:200],
+            slots=max(1, int(data.get("slots") or 1)),
+            running=int(data.get("running") or 0),
+            load=float(data.get("load") or 0),
+            cpus=max(1, int(data.get("cpus") or 1)),
+            runner=str(data.get("runner") or "")[:20],
+            toolchain=data.get("toolchain") if isinstance(data.get("toolchain"), dict) else {},
+            targets=[t for t in (data.get("targets") or []) if isinstance(t, dict)][:_TARGETS_KEEP],
+            last_seen=time.time(),
+        )
+        _cond.notify_all()
+    return True, None
+
+
+def accepting(toolchain: str) -> bool:
+    """True when a build of this toolchain should try the remote path: PlatformIO, BUILD_REMOTE not off,
+    BUILD_WORKER_TOKEN set, and a live worker with a free slot (BUILD_REMOTE=only: any live worker)."""
+    if BUILD_REMOTE == "off" or not BUILD_WORKER_TOKEN or (toolchain or "platformio") != "platformio":
+        return False
+    with _cond:
+        live = _live_locked()
+        if BUILD_REMOTE == "only":
+            return bool(live)
+        return any(_busy_locked(w["id"]) < w["slots"] for w in live)
+
+
+def _score(worker: dict, job: dict) -> float:
+    """Higher is better: a warm tree for the job's repo and env (same commit best), minus the worker's load."""
+    spec = job["spec"]
+    affinity = 0.0
+    for t in worker.get("targets") or []:
+        if t.get("repo_url") == spec["repo_url"] and t.get("env") == spec["env_name"]:
+            affinity = max(affinity, 2.0 if t.get("commit") == spec["commit"] else 1.0)
+    load = (_busy_locked(worker["id"]) / worker["slots"]) + (worker.get("load") or 0) / worker["cpus"]
+    return affinity - load
+
+
+def _pick_locked(worker_id: str):
+    """Queued build for this worker: one it is the best free worker for, or any that has waited out the affinity window."""
+    worker = _workers.get(worker_id)
+    if not worker or _busy_locked(worker_id) >= worker["slots"]:
+        return None
+    free = [w for w in _live_locked() if _busy_locked(w["id"]) < w["slots"]]
+    now = time.time()
+    for build_id in _queue:
+        job = _jobs[build_id]
+        best = max(free, key=lambda w: (_score(w, job), w["id"] == worker_id))
+        if best["id"] == worker_id or now - job["queued_at"] >= BUILD_WORKER_AFFINITY_WAIT:
+            return job
+    return None
+
+
+def claim(worker_id: str, wait: float = 20):
+    """Next build for the worker (its job spec), waiting up to wait seconds; None when there is none."""
+    deadline = time.time() + max(0.0, min(wait, 60))
+    with _cond:
+        if worker_id in _workers:
+            _workers[worker_id]["last_seen"] = time.time()
+        while True:
+            job = _pick_locked(worker_id)
+            if job:
+                _queue.remove(job["id"])
+                job.update(status="claimed", worker=worker_id, claimed_at=time.time())
+                _cond.notify_all()
+                return job["spec"]
+            remaining = deadline - time.time()
+            if remaining <= 0 or worker_id not in _workers:
+                return None
+            _cond.wait(min(remaining, 1.0))
+
+
+def append_log(worker_id: str, build_id: str, lines):
+    """Output lines from the worker running build_id. Returns (ok, cancel_requested) or (False, error)."""
+    with _cond:
+        job = _jobs.get(build_id)
+        if not job or job["worker"] != worker_id or job["status"] != "claimed":
+            return False, "Unknown or reassigned build"
+        if worker_id in _workers:
+            _workers[worker_id]["last_seen"] = time.time()
+        job["lines"].extend(str(line)[:2000] for line in (lines or [])[:1000])
+        _cond.notify_all()
+        return True, job["cancel"]
+
+
+def complete(worker_id: str, build_id: str, ok: bool, error: str | None = None, meta: dict | None = None, files=None):
+    """
+    Result upload from the worker: ok / error, meta (toolchain, duration_s), files {name: file object with .save()}
+    among firmware.bin, firmware.elf, partitions.bin. Returns (ok, error).
+    """
+    with _cond:
+        job = _jobs.get(build_id)
+        if not job or job["worker"] != worker_id or job["status"] != "claimed":
+            return False, "Unknown or reassigned build"
+    upload_dir = tempfile.mkdtemp(prefix=f"build-{build_id}-")
+    saved = {}
+    for name in _UPLOAD_FILES:
+        f = (files or {}).get(name)
+        if f is not None:
+            f.save(os.path.join(upload_dir, name))
+            saved[name] = os.path.join(upload_dir, name)
+    with _cond:
+        if _jobs.get(build_id) is not job or job["status"] != "claimed":
+            shutil.rmtree(upload_dir, ignore_errors=True)
+            return False, "Unknown or reassigned build"
+        job.update(status="finished", result={
+            "ok": bool(ok) and "firmware.bin" in saved, "error": error or (None if "firmware.bin" in saved else "No firmware.bin uploaded"),
+            "meta": meta if isinstance(meta, dict) else {}, "dir": upload_dir, "files": saved,
+        })
+        if worker_id in _workers:
+            _workers[worker_id]["builds_done"] += 1
+        _cond.notify_all()
+    return True, None
+
+
+def _spec(build: dict, on_line):
+    """
+    (spec, cache inputs) describing the build by git revision, or (None, reason) when it cannot be built remotely:
+    not PlatformIO, no own git checkout with an upstream URL, local changes, or a commit upstream does not have.
+    """
+    cfg = ((BUILD_CONFIG or {}).get(build["device_id"]) or {}).get(build["firmware_id"]) or {}
+    params = build["params"]
+    envs = cfg.get("envs") or []
+    env_name = build["env_name"] if build["env_name"] in envs else (envs[0] if envs else "")
+    if (cfg.get("toolchain") or "platformio") != "platformio" or not env_name:
+        return None, "not a PlatformIO build"
+    repo_dir = os.path.join(REPO_ROOT, (cfg.get("path") or "").strip())
+    work_dir = os.path.join(repo_dir, cfg["build_subdir"].strip("/")) if cfg.get("build_subdir") else repo_dir
+    ok, top = _git(["rev-parse", "--show-toplevel"], work_dir)
+    if not ok or os.path.realpath(top) == os.path.realpath(REPO_ROOT):
+        return None, "firmware is not in its own git checkout"
+    ok, url = _git(["config", "--get", "remote.origin.url"], top)
+    if not ok or git_mirrors.mirror_path(url) is None:
+        return None, "no upstream URL to fetch the source from"
+    if params.get("git_ref"):
+        ok, commit = git_mirrors.resolve(work_dir, params["git_ref"], on_line=on_line)
+        if not ok:
+            return None, commit
+    else:
+        ok, status = _git(["status", "--porcelain"], top)
+        if not ok or status:
+            return None, "checkout has local changes"
+        ok, commit = _git(["rev-parse", "HEAD"], top)
+        mirror = git_mirrors.existing_mirror(url)
+        ok_remote, branches = _git(["branch", "-r", "--contains", commit], top)
+        in_mirror = mirror and _git(["cat-file", "-e", f"{commit}^{{commit}}"], mirror)[0]
+        if not ok or not (in_mirror or (ok_remote and branches)):
+            return None, f"commit {commit[:12]} is not on upstream"
+    patches = []
+    for rel in params.get("patch_paths") or []:
+        try:
+            with open(os.path.join(repo_dir, rel), "rb") as f:
+                patches.append({"name": os.path.basename(rel), "data": base64.b64encode(f.read()).decode("ascii")})
+        except OSError:
+            return None, f"Patch not found: {rel}"
+    key, inputs = build_cache.compute_key(
+        work_dir, env_name, [os.path.join(repo_dir, rel) for rel in params.get("patch_paths") or []],
+        source_dir=repo_dir, rev=commit,
+    )
+    spec = {
+        "build_id": build["id"], "device_id": build["device_id"], "firmware_id": build["firmware_id"],
+        "env_name": env_name, "repo_url": url, "commit": commit,
+        "subdir": os.path.relpath(os.path.realpath(work_dir), os.path.realpath(top)),
+        "patches": patches, "clean": params.get("clean"), "verbose": params.get("verbose"),
+        "jobs": params.get("jobs"), "timeout": params.get("timeout") or 300,
+    }
+    return spec, (inputs if key else None)
+
+
+def _store(spec: dict, result: dict, inputs, meta: dict, on_line):
+    """Move an uploaded build into artifacts/<device>/<firmware>/build_<env>_<ts>_<suffix>/ with manifest, index and footprint."""
+    files = result["files"]
+    artifact_subdir = artifact_index.new_build_dir(spec["device_id"], spec["firmware_id"], spec["env_name"])
+    dest = os.path.join(artifact_subdir, "firmware.bin")
+    shutil.move(files["firmware.bin"], dest)
+    toolchain = (result["meta"] or {}).get("toolchain")
+    if inputs and isinstance(toolchain, dict):
+        inputs = {**inputs, "toolchain": toolchain}
+        key = build_cache.key_for(inputs)
+        build_cache.write_manifest(
+            artifact_subdir, key, inputs, "firmware.bin", spec["device_id"], spec["firmware_id"],
+            (result["meta"] or {}).get("duration_s"), worker=meta.get("worker"),
+        )
+        meta["cache_key"] = key
+    artifact_index.record(dest, source="build", build_env=spec["env_name"])
+    if "firmware.elf" in files:
+        meta["footprint"] = footprint.record(
+            artifact_subdir, files["firmware.elf"], spec["device_id"], spec["firmware_id"], spec["env_name"],
+            bin_path=dest, partitions_bin=files.get("partitions.bin"),
+        )
+        on_line(footprint.describe(meta["footprint"]))
+    return os.path.relpath(dest, REPO_ROOT)
+
+
+def run(build: dict, on_line, cancel: threading.Event, meta: dict, on_status):
+    """
+    Build on a remote worker (called by build_jobs). meta receives commit, worker, cache_key, cached, phases and
+    footprint; on_status(**fields) updates the build record. Returns (ok, path_or_error), or None when the build
+    should run locally instead (not remotely buildable, or no worker took it in time).
+    """
+    spec, inputs = _spec(build, on_line)
+    if spec is None:
+        on_line(f"Building locally: {inputs}")
+        return None
+    meta.update(commit=spec["commit"], cached=False)
+    params = build["params"]
+    if params.get("use_cache") and not params.get("clean") and inputs:
+        # Remote artifacts are keyed on the toolchain of the worker that built them: try each live worker's toolchain
+        with build_stats.phase(meta, "cache"):
+            with _cond:
+                toolchains = {repr(w["toolchain"]): w["toolchain"] for w in _live_locked() if w.get("toolchain")}
+            hit = None
+            for toolchain in toolchains.values():
+                key = build_cache.key_for({**inputs, "toolchain": toolchain})
+                hit = artifact_index.find_by_cache_key(key)
+                if hit:
+                    break
+        if hit:
+            meta.update(cache_key=key, cached=True)
+            on_line(f"Build cache hit ({key[:12]}): {hit}")
+            return True, hit
+    job = {
+        "id": build["id"], "spec": spec, "status": "queued", "worker": None, "queued_at": time.time(),
+        "claimed_at": None, "lines": deque(), "cancel": False, "result": None,
+    }
+    with _cond:
+        _jobs[job["id"]] = job
+        _queue.append(job["id"])
+        _cond.notify_all()
+    on_status(status="waiting_worker")
+    on_line(f"Queued for a build worker ({spec['repo_url']} @ {spec['commit'][:12]})")
+    try:
+        with _cond:
+            while job["status"] == "queued":
+                if cancel.is_set():
+                    return False, "Build cancelled"
+                if BUILD_REMOTE != "only" and time.time() - job["queued_at"] > BUILD_WORKER_CLAIM_TIMEOUT:
+                    on_line("No build worker took the build in time")
+                    return None
+                _cond.wait(0.5)
+            meta["worker"] = job["worker"]
+        timer = build_stats.PhaseTimer()
+        on_status(status="running", started_at=time.time())
+        on_line(f"Building on worker {job['worker']}")
+        while True:
+            with _cond:
+                lines = list(job["lines"])
+                job["lines"].clear()
+                finished = job["status"] == "finished"
+                worker = _workers.get(job["worker"])
+                lost = worker is None or time.time() - worker["last_seen"] > BUILD_WORKER_TIMEOUT
+                if cancel.is_set():
+                    # The worker learns it from its next log post and kills the build; nothing more to wait for
+                    job["cancel"] = True
+                    return False, "Build cancelled"
+                if not lines and not finished and not lost:
+                    _cond.wait(1.0)
+                    continue
+            for line in lines:
+                timer.feed(line)
+                on_line(line)
+            if finished:
+                break
+            if lost:
+                on_line(f"Lost build worker {job['worker']}")
+                return None if BUILD_REMOTE != "only" else (False, f"Build worker {job['worker']} lost")
+        timer.finish(meta.setdefault("phases", {}))
+        result = job["result"]
+        if cancel.is_set():
+            return False, "Build cancelled"
+        if not result["ok"]:
+            return False, result["error"] or "Remote build failed"
+        with build_stats.phase(meta, "copy"):
+            return True, _store(spec, result, inputs, meta, on_line)
+    finally:
+        with _cond:
+            if job["id"] in _queue:
+                _queue.remove(job["id"])
+            _jobs.pop(job["id"], None)
+            _cond.notify_all()
+        if job["result"]:
+            shutil.rmtree(job["result"]["dir"], ignore_errors=True)
+
+
+def list_workers():
+    """Known workers (live first): id, host, slots, running, load, cpus, runner, toolchain, targets, live, builds_done, last_seen."""
+    with _cond:
+        live = {w["id"] for w in _live_locked()}
+        out = [{**w, "live": w["id"] in live, "claimed": _busy_locked(w["id"])} for w in _workers.values()]
+        queued = [{"build_id": b, "queued_at": _jobs[b]["queued_at"], "env_name": _jobs[b]["spec"]["env_name"]} for b in _queue]
+    return sorted(out, key=lambda w: (not w["live"], w["id"])), queued
+
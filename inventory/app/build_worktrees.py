@@ -0,0 +1,225 @@
+"""
+Git worktrees for patched firmware builds. Instead of resetting and patching the shared checkout under
+devices/<dev>/firmware/<fw>/repo, each (firmware repo, env, patch set) gets its own worktree under
+BUILD_WORKTREES_DIR with HEAD checked out and the patches applied. Worktrees are reused: when HEAD and the
+patches have not changed, nothing is touched, so the .pio/ build state (incremental compiles) survives, and
+builds for different envs or patch sets run side by side. The least recently used worktrees beyond
+BUILD_WORKTREES_MAX are removed.
+"""
+import hashlib
+import json
+import os
+import re
+import shutil
+import subprocess
+import threading
+import time
+
+import git_mirrors
+from config import BUILD_WORKTREES_DIR, BUILD_WORKTREES_MAX, REPO_ROOT
+
+_STATE_SUFFIX = ".json"  # <worktree>.json: repo, env, patches, head, diff hash after patching
+
+_lock = threading.Lock()
+_in_use = set()
+
+
+def _git(args, cwd: str, timeout: int = 300, stdin=None):
+    """(ok, output) of a git command; output is stderr (or stdout) on failure."""
+    try:
+        r = subprocess.run(["git"] + args, cwd=cwd, stdin=stdin, capture_output=True, text=True, timeout=timeout)
+    except subprocess.TimeoutExpired:
+        return False, f"git {args[0]} timed out"
+    except OSError as e:
+        return False, str(e)
+    return r.returncode == 0, (r.stdout if r.returncode == 0 else (r.stderr or r.stdout)).strip()
+
+
+def _sha256_file(path: str) -> str:
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def _load_state(wt: str):
+    try:
+        with open(wt + _STATE_SUFFIX, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _save_state(wt: str, state) -> None:
+    path = wt + _STATE_SUFFIX
+    try:
+        if state is None:
+            os.remove(path)
+            return
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(state, f, indent=2)
+    except OSError:
+        pass
+
+
+def _diff_hash(wt: str):
+    ok, out = _git(["diff", "HEAD", "--binary"], wt)
+    return hashlib.sha256(out.encode()).hexdigest() if ok else None
+
+
+def _update_submodules(top: str, wt: str, on_line=None, clone_mirrors: bool = False):
+    """
+    Check out submodules in the worktree from their git_mirrors mirrors (every upstream commit, no network when
+    current), else from the shared checkout's copies. clone_mirrors: clone missing mirrors first (builds of
+    another ref, whose submodule commits the shared checkout may lack).
+    """
+    if not os.path.isfile(os.path.join(wt, ".gitmodules")):
+        return True, ""
+    # URL overrides go on the command line: worktrees share the repo's config with the checkout they came from
+    overrides = ["-c", "protocol.file.allow=always"]
+    mirrors = git_mirrors.submodule_mirrors(wt, "HEAD", on_line, create=clone_mirrors)
+    for name, (sub_path, _) in git_mirrors.submodule_urls(wt).items():
+        local = os.path.join(top, sub_path)
+        if name in mirrors:
+            overrides += ["-c", f"submodule.{name}.url={mirrors[name]}"]
+        elif os.path.exists(os.path.join(local, ".git")):
+            overrides += ["-c", f"submodule.{name}.url={local}"]
+    return _git(overrides + ["submodule", "update", "--init", "--recursive", "--force"], wt, timeout=1800)
+
+
+def _remove(wt: str, top: str | None = None) -> None:
+    if top:
+        _git(["worktree", "remove", "--force", wt], top)
+    if os.path.isdir(wt):
+        shutil.rmtree(wt, ignore_errors=True)
+    if top:
+        _git(["worktree", "prune"], top)
+    _save_state(wt, None)
+
+
+def _all_worktrees():
+    """[(worktree path, state)] for every worktree under BUILD_WORKTREES_DIR."""
+    out = []
+    if not os.path.isdir(BUILD_WORKTREES_DIR):
+        return out
+    for repo in os.scandir(BUILD_WORKTREES_DIR):
+        if not repo.is_dir():
+            continue
+        for entry in os.scandir(repo.path):
+            if entry.is_dir():
+                out.append((entry.path, _load_state(entry.path) or {}))
+    return out
+
+
+def _evict(keep: str) -> None:
+    """Remove least recently used worktrees (not in use) beyond BUILD_WORKTREES_MAX."""
+    with _lock:
+        busy = set(_in_use) | {keep}
+    trees = sorted(_all_worktrees(), key=lambda t: t[1].get("last_used") or 0)
+    excess = len(trees) - BUILD_WORKTREES_MAX
+    for wt, state in trees:
+        if excess <= 0:
+            break
+        if wt not in busy:
+            _remove(wt, state.get("repo"))
+            excess -= 1
+
+
+def prepare(work_dir: str, env_name: str, patch_files, on_line=None, rev: str | None = None):
+    """
+    Worktree for building env_name in work_dir with patch_files (absolute paths, applied in order with -p1 from
+    work_dir's counterpart). Creates or reuses it and brings it to the shared checkout's HEAD (or commit rev, e.g.
+    from git_mirrors.resolve) with exactly these patches applied. Returns (ok, dir_or_error): the directory to build in. Call release(dir) when the build ends.
+    """
+    def log(msg):
+        if on_line:
+            on_line(msg)
+
+    ok, top = _git(["rev-parse", "--show-toplevel"], work_dir)
+    if not ok:
+        return False, f"Patched builds need a git checkout: {top[:200]}"
+    ok, head = _git(["rev-parse", "--verify", f"{rev or 'HEAD'}^{{commit}}"], top)
+    if not ok:
+        return False, f"git rev-parse {rev or 'HEAD'} failed: {head[:200]}"
+    sub = os.path.relpath(os.path.realpath(work_dir), os.path.realpath(top))
+    patch_set = hashlib.sha256("\n".join(sorted(os.path.realpath(p) for p in patch_files)).encode()).hexdigest()[:10]
+    repo_slug = re.sub(r"[^\w\-]+", "_", os.path.relpath(top, REPO_ROOT)).strip("_") or "repo"
+    safe_env = re.sub(r"[^\w\-]", "_", env_name)
+    wt = os.path.join(BUILD_WORKTREES_DIR, repo_slug, f"{safe_env}-{patch_set}")
+    with _lock:
+        if wt in _in_use:
+            return False, f"Worktree busy: {os.path.relpath(wt, REPO_ROOT)}"
+        _in_use.add(wt)
+    try:
+        hashes = [_sha256_file(p) for p in patch_files]
+    except OSError as e:
+        release(wt)
+        return False, f"Patch not readable: {e}"
+    try:
+        state = _load_state(wt)
+        if not os.path.exists(os.path.join(wt, ".git")):
+            log(f"Creating worktree {os.path.relpath(wt, REPO_ROOT)}")
+            _remove(wt, top)
+            os.makedirs(os.path.dirname(wt), exist_ok=True)
+            ok, out = _git(["worktree", "add", "--detach", "--force", wt, head], top)
+            if not ok:
+                return _fail(wt, f"git worktree add failed: {out[:300]}")
+            state = None
+            _evict(wt)
+        elif state and state.get("head") == head and state.get("patches") == hashes and state.get("diff") == _diff_hash(wt):
+            log(f"Reusing worktree {os.path.relpath(wt, REPO_ROOT)} (HEAD and patches unchanged)")
+            _save_state(wt, {**state, "last_used": time.time()})
+            return True, os.path.join(wt, sub)
+        log(f"Resetting worktree to {head[:12]} and applying {len(patch_files)} patch(es)")
+        ok, out = _git(["checkout", "--force", "--detach", head], wt)
+        if not ok:
+            return _fail(wt, f"git checkout failed: {out[:300]}")
+        _git(["clean", "-fdq"], wt)  # files added by earlier patches; ignored files (.pio/) stay
+        ok, out = _update_submodules(top, wt, on_line, clone_mirrors=rev is not None)
+        if not ok:
+            return _fail(wt, f"git submodule update failed: {out[:300]}")
+        build_dir = os.path.join(wt, sub)
+        for p in patch_files:
+            with open(p, "rb") as f:
+                ok, out = _git(["apply", "-p1", "--verbose"], build_dir, stdin=f, timeout=60)
+            if not ok:
+                return _fail(wt, f"Patch {os.path.basename(p)} failed: {out[:300]}")
+            log(f"Applied patch {os.path.basename(p)}")
+        _save_state(wt, {
+            "repo": top, "env": env_name, "patch_files": [os.path.relpath(p, REPO_ROOT) for p in patch_files],
+            "patches": hashes, "head": head, "diff": _diff_hash(wt), "last_used": time.time(),
+        })
+        return True, build_dir
+    except Exception as e:
+        return _fail(wt, str(e)[:300])
+
+
+def _fail(wt: str, error: str):
+    """Forget the worktree's state (next build resets it) and release it."""
+    _save_state(wt, None)
+    release(wt)
+    return False, error
+
+
+def release(path: str) -> None:
+    """Mark the worktree containing path (as returned by prepare) free for the next build."""
+    with _lock:
+        for wt in list(_in_use):
+            if path == wt or path.startswith(wt + os.sep):
+                _in_use.discard(wt)
+
+
+def list_worktrees():
+    """Build worktrees: path, repo, env, patch_files, head, last_used, in_use (least recently used first)."""
+    with _lock:
+        busy = set(_in_use)
+    out = []
+    for wt, state in sorted(_all_worktrees(), key=lambda t: t[1].get("last_used") or 0):
+        out.append({
+            "path": os.path.relpath(wt, REPO_ROOT),
+            "repo": os.path.relpath(state["repo"], REPO_ROOT) if state.get("repo") else None,
+            "env": state.get("env"),
+            "patch_files": state.get("patch_files") or [],
+            "head": state.get("head"),
+            "last_used": state.get("last_used"),
+            "in_use": wt in busy,
+        })
+    return out
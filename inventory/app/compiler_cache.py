@@ -0,0 +1,127 @@
+"""
+Shared compiler cache (ccache) for firmware builds. PlatformIO builds on this host compile through ccache via
+scripts/pio_ccache.py (a pre: extra script passed in PLATFORMIO_EXTRA_SCRIPTS, so firmware repos are not touched),
+with one cache in BUILD_CCACHE_DIR for every firmware, env, patch set and worktree (CCACHE_BASEDIR makes paths
+under the repo relative, so a worktree hits on the shared checkout's objects). Container builds share the
+lab-ccache volume (scripts/lab-exec.sh). ccache keeps each cache under BUILD_CCACHE_MAX_SIZE.
+Each build gets its own CCACHE_STATSLOG; read_stats() turns it into the build's hits / misses / hit rate.
+"""
+import os
+import shutil
+import subprocess
+import uuid
+
+from config import BUILD_CCACHE, BUILD_CCACHE_DIR, BUILD_CCACHE_MAX_SIZE, REPO_ROOT
+
+PIO_SCRIPT = os.path.join(REPO_ROOT, "scripts", "pio_ccache.py")
+_HIT_COUNTERS = ("direct_cache_hit", "preprocessed_cache_hit")
+
+
+def available() -> bool:
+    """True when builds should use ccache: enabled in config and ccache installed."""
+    return BUILD_CCACHE and shutil.which("ccache") is not None
+
+
+def _ccache(args, timeout: int = 60):
+    """stdout of a ccache command against BUILD_CCACHE_DIR, or None when it fails."""
+    try:
+        r = subprocess.run(["ccache"] + args, capture_output=True, text=True, timeout=timeout, env=_cache_env())
+    except (OSError, subprocess.TimeoutExpired):
+        return None
+    return r.stdout if r.returncode == 0 else None
+
+
+def _cache_env(stats_log: str | None = None) -> dict:
+    env = dict(os.environ)
+    env.update(CCACHE_DIR=BUILD_CCACHE_DIR, CCACHE_MAXSIZE=BUILD_CCACHE_MAX_SIZE, CCACHE_BASEDIR=REPO_ROOT, CCACHE_NOHASHDIR="1")
+    if stats_log:
+        env["CCACHE_STATSLOG"] = stats_log
+    return env
+
+
+def new_stats_log() -> str:
+    """Path for one build's CCACHE_STATSLOG (under BUILD_CCACHE_DIR, inside the repo, so lab containers can write it)."""
+    stats_dir = os.path.join(BUILD_CCACHE_DIR, "stats")
+    os.makedirs(stats_dir, exist_ok=True)
+    return os.path.join(stats_dir, uuid.uuid4().hex[:12] + ".log")
+
+
+def pio_env(stats_log: str):
+    """Environment for pio run compiling through the shared cache, or None when ccache is not available."""
+    if not available() or not os.path.isfile(PIO_SCRIPT):
+        return None
+    env = _cache_env(stats_log)
+    scripts = [s for s in (env.get("PLATFORMIO_EXTRA_SCRIPTS") or "").split("\n") if s.strip()]
+    env["PLATFORMIO_EXTRA_SCRIPTS"] = "\n".join(scripts + [f"pre:{PIO_SCRIPT}"])
+    return env
+
+
+def read_stats(stats_log: str):
+    """
+    Per-build cache stats from a CCACHE_STATSLOG (removed afterwards): hits, misses, uncacheable (links,
+    unsupported flags), hit_rate (hits / (hits + misses), None without compiles). None when nothing was logged.
+    """
+    try:
+        with open(stats_log, encoding="utf-8", errors="replace") as f:
+            lines = f.read().splitlines()
+        os.remove(stats_log)
+    except OSError:
+        return None
+    # One block per compiler call: "# <source>" then the counters it bumped
+    blocks, block = [], None
+    for line in lines:
+        line = line.strip()
+        if line.startswith("#"):
+            block = set()
+            blocks.append(block)
+        elif line and block is not None:
+            block.add(line)
+    if not blocks:
+        return None
+    hits = sum(1 for b in blocks if any(c in b for c in _HIT_COUNTERS))
+    misses = sum(1 for b in blocks if "cache_miss" in b)
+    return {
+        "hits": hits,
+        "misses": misses,
+        "uncacheable": len(blocks) - hits - misses,
+        "hit_rate": round(hits / (hits + misses), 3) if hits + misses else None,
+    }
+
+
+def describe(stats) -> str:
+    """One-line summary for build logs."""
+    if not stats:
+        return "ccache: no compiler calls logged"
+    rate = f", {stats['hit_rate']:.0%} hit rate" if stats["hit_rate"] is not None else ""
+    return f"ccache: {stats['hits']} hits, {stats['misses']} misses{rate}"
+
+
+def cache_stats():
+    """Whole-cache totals for BUILD_CCACHE_DIR: dir, max_size, size_bytes, files, hits, misses, hit_rate, available."""
+    out = {"dir": os.path.relpath(BUILD_CCACHE_DIR, REPO_ROOT), "max_size": BUILD_CCACHE_MAX_SIZE, "available": available()}
+    if not out["available"]:
+        return out
+    counters = {}
+    for line in (_ccache(["--print-stats"]) or "").splitlines():
+        key, _, value = line.partition("\t")
+        if value.strip().isdigit():
+            counters[key.strip()] = int(value)
+    hits = sum(counters.get(c, 0) for c in _HIT_COUNTERS)
+    misses = counters.get("cache_miss", 0)
+    out.update(
+        size_bytes=counters["cache_size_kibibyte"] * 1024 if "cache_size_kibibyte" in counters else None,
+        files=counters.get("files_in_cache"),
+        hits=hits,
+        misses=misses,
+        hit_rate=round(hits / (hits + misses), 3) if hits + misses else None,
+    )
+    return out
+
+
+def clear():
+    """Empty the shared cache and zero its statistics. Returns (ok, error_or_None)."""
+    if not available():
+        return False, "ccache not installed or disabled (BUILD_CCACHE=0)"
+    if _ccache(["--clear"], timeout=300) is None or _ccache(["--zero-stats"]) is None:
+        return False, "ccache --clear failed"
+    return True, None
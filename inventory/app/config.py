@@ -183,8 +183,106 @@ FLASH_DEVICES = {
     },
 }
 
+# Fleet flashing: max concurrent esptool writes behind one USB hub (shared upstream link and bus power)
+FLEET_MAX_PER_HUB = 4
+
+# USB hotplug watcher: port-list poll interval in seconds (udev events wake it early when pyudev is installed)
+USB_WATCH_INTERVAL = 1.0
+
+# Port leases: max seconds to poll for a serial port to be released (node present, no process holding it)
+PORT_READY_TIMEOUT = 5.0
+
+# Async backup/restore/flash jobs: worker threads (jobs on the same port still run one at a time)
+FLASH_JOB_WORKERS = int(os.environ.get("FLASH_JOB_WORKERS", "16"))
+
 # Backups stored here (relative to REPO_ROOT); create if missing
 BACKUPS_DIR = os.path.join(REPO_ROOT, "artifacts", "backups")
+# Backups are deduplicated: fixed-size blocks keyed by SHA-256 under BACKUP_CHUNKS_DIR, one manifest per backup
+BACKUP_CHUNKS_DIR = os.path.join(BACKUPS_DIR, ".chunks")
+BACKUP_CHUNK_SIZE = 64 * 1024
+
+# esptool baud autotuner: highest stable rate per (USB bridge VID:PID, chip), probed in this order
+BAUD_PROFILES_PATH = os.path.join(ARTIFACTS_DIR, "baud_profiles.json")
+BAUD_CANDIDATES = (460800, 921600, 1500000, 2000000)
+
+# esptool reset sequence (--before / --after); empty = esptool's defaults. Set both to no_reset for ports without
+# DTR/RTS reset lines (scripts/esp_emulator.py ptys, RFC 2217 / TCP serial bridges)
+ESPTOOL_BEFORE = os.environ.get("ESPTOOL_BEFORE", "").strip()
+ESPTOOL_AFTER = os.environ.get("ESPTOOL_AFTER", "").strip()
+
+# Artifact index: path, size, SHA-256, device / firmware / version, source per flashable file (listing = one query);
+# a stat-only rescan of artifacts/ catches files added or removed outside the app, at most every N seconds
+ARTIFACT_INDEX_DB_PATH = os.path.join(ARTIFACTS_DIR, "artifact_index.db")
+ARTIFACT_INDEX_RESCAN_INTERVAL = 30.0
+
+# Artifact retention (GET /api/flash/artifacts/retention = dry run, POST /api/flash/artifacts/gc; never runs on its own).
+# "default" applies everywhere; "<device>" and "<device>/<firmware>" entries override single keys.
+ARTIFACT_RETENTION = {
+    "default": {
+        "keep_builds": 5,  # newest builds per device / firmware / build env (the newest one is never removed)
+        "keep_releases": True,  # release downloads (artifacts/<device>/<firmware>/ota/)
+        "keep_backups_days": 90,  # backups newer than this (a device's newest backup is never removed); 0 = all
+        "keep_flashed_days": 30,  # anything restored / flashed from within this many days
+        "keep_manual": True,  # .bin files copied into artifacts/ by hand
+    },
+}
+# Byte budget for artifacts/ (builds, downloads, backups): over it, kept items go least recently flashed first. 0 = none
+ARTIFACT_BUDGET_BYTES = int(float(os.environ.get("ARTIFACT_BUDGET_GB", "0")) * (1 << 30))
+
+# Flash telemetry: every esptool run and backup/restore/flash operation (duration, bytes/sec, retries, outcome)
+TELEMETRY_DB_PATH = os.path.join(ARTIFACTS_DIR, "telemetry.db")
+
+# Background firmware builds (POST /api/flash/build, /api/flash/build-matrix): worker threads; concurrency is bounded
+# by the CPU / memory budget below, and builds sharing a tree (same firmware, env and patch set) run one at a time.
+# Full pio / lab-build.sh output per build is written to BUILD_LOGS_DIR/<build_id>.log
+BUILD_JOB_WORKERS = int(os.environ.get("BUILD_JOB_WORKERS", "8"))
+# Build scheduling: a build reserves its pio -j cores and -j x BUILD_MEM_PER_JOB_MB of memory, and waits until both fit
+# in the budget (a build larger than the whole budget runs alone). BUILD_MEM_BUDGET_MB 0 = 75% of physical memory.
+# BUILD_JOBS_PER_BUILD 0 = the whole CPU budget for a single build; a build matrix splits it across its targets.
+BUILD_CPU_BUDGET = int(os.environ.get("BUILD_CPU_BUDGET") or os.cpu_count() or 2)
+BUILD_MEM_BUDGET_MB = int(os.environ.get("BUILD_MEM_BUDGET_MB", "0"))
+BUILD_MEM_PER_JOB_MB = int(os.environ.get("BUILD_MEM_PER_JOB_MB", "400"))
+BUILD_JOBS_PER_BUILD = int(os.environ.get("BUILD_JOBS_PER_BUILD", "0"))
+BUILD_LOGS_DIR = os.path.join(ARTIFACTS_DIR, "build_logs")
+# Patched builds run in git worktrees, one per (firmware repo, env, patch set), reused so .pio/ incremental state
+# survives; the least recently used beyond BUILD_WORKTREES_MAX are removed
+BUILD_WORKTREES_DIR = os.environ.get("BUILD_WORKTREES_DIR") or os.path.join(REPO_ROOT, ".build_worktrees")
+BUILD_WORKTREES_MAX = int(os.environ.get("BUILD_WORKTREES_MAX", "6"))
+# Shared bare mirrors of firmware upstreams (git_mirrors): device checkouts borrow their objects and fetch from them.
+# A background updater fetches every mirror from upstream each GIT_MIRROR_FETCH_INTERVAL seconds (0 = on demand only).
+GIT_MIRRORS_DIR = os.environ.get("GIT_MIRRORS_DIR") or os.path.join(REPO_ROOT, ".git_mirrors")
+GIT_MIRROR_FETCH_INTERVAL = int(os.environ.get("GIT_MIRROR_FETCH_INTERVAL", "3600"))
+# Remote build workers (scripts/build_worker.py on other lab hosts, pulling builds over HTTP). BUILD_REMOTE: auto (clean
+# PlatformIO builds of upstream commits go to a live worker with a free slot), only (they wait for a worker), off.
+# A worker without a heartbeat for BUILD_WORKER_TIMEOUT seconds is gone; a queued build waits BUILD_WORKER_AFFINITY_WAIT
+# seconds for the worker with the warmest tree, and builds locally when unclaimed after BUILD_WORKER_CLAIM_TIMEOUT.
+# Workers must send BUILD_WORKER_TOKEN (X-Build-Worker-Token): without a token configured the worker routes refuse
+# every call, no build goes remote and artifacts uploaded by workers are not used as cache hits.
+BUILD_REMOTE = os.environ.get("BUILD_REMOTE", "auto").strip().lower()
+BUILD_REMOTE_MAX_BUILDS = int(os.environ.get("BUILD_REMOTE_MAX_BUILDS", "16"))
+BUILD_WORKER_TIMEOUT = int(os.environ.get("BUILD_WORKER_TIMEOUT", "30"))
+BUILD_WORKER_AFFINITY_WAIT = float(os.environ.get("BUILD_WORKER_AFFINITY_WAIT", "10"))
+BUILD_WORKER_CLAIM_TIMEOUT = float(os.environ.get("BUILD_WORKER_CLAIM_TIMEOUT", "60"))
+BUILD_WORKER_TOKEN = os.environ.get("BUILD_WORKER_TOKEN", "")
+# Container builds (scripts/lab-build.sh, ESP-IDF) run in warm per-toolchain containers via scripts/lab-exec.sh,
+# recycled after LAB_MAX_BUILDS builds or when their image changes (LAB_WARM=0: a fresh container per build)
+BUILD_RUNNER_MAX_BUILDS = int(os.environ.get("LAB_MAX_BUILDS", "50"))
+# Shared compiler cache: PlatformIO builds compile through ccache in BUILD_CCACHE_DIR (shared across firmware, envs,
+# patch sets and worktrees), kept under BUILD_CCACHE_MAX_SIZE (ccache size syntax, e.g. 5G). BUILD_CCACHE=0 disables it.
+BUILD_CCACHE = os.environ.get("BUILD_CCACHE", "1") != "0"
+BUILD_CCACHE_DIR = os.environ.get("BUILD_CCACHE_DIR") or os.path.join(REPO_ROOT, ".ccache")
+BUILD_CCACHE_MAX_SIZE = os.environ.get("BUILD_CCACHE_MAX_SIZE", "5G")
+# Build performance history (phase timings, per-translation-unit compile times) for GET /api/flash/builds/stats.
+# BUILD_UNIT_TIMES=0 skips timing each compile command; unit rows are kept for the latest BUILD_STATS_UNIT_BUILDS builds.
+BUILD_STATS_DB_PATH = os.path.join(ARTIFACTS_DIR, "build_stats.db")
+BUILD_UNIT_TIMES = os.environ.get("BUILD_UNIT_TIMES", "1") != "0"
+BUILD_STATS_UNIT_BUILDS = int(os.environ.get("BUILD_STATS_UNIT_BUILDS", "200"))
+# Firmware footprint (footprint.json per build): growth of a memory region or the image over the previous build of
+# the same env by FOOTPRINT_REGRESSION_PCT percent or FOOTPRINT_REGRESSION_BYTES bytes is a regression, as is an
+# image filling FOOTPRINT_PARTITION_WARN_PCT percent of its app partition.
+FOOTPRINT_REGRESSION_PCT = float(os.environ.get("FOOTPRINT_REGRESSION_PCT", "1.0"))
+FOOTPRINT_REGRESSION_BYTES = int(os.environ.get("FOOTPRINT_REGRESSION_BYTES", "8192"))
+FOOTPRINT_PARTITION_WARN_PCT = float(os.environ.get("FOOTPRINT_PARTITION_WARN_PCT", "90"))
 
 # Firmware targets for flash UI: filter artifacts by Meshtastic / MeshCore / Launcher / Bruce / Ghost / Marauder / Flipper (folder names under artifacts/<device>/)
 FIRMWARE_TARGETS = ["meshtastic", "meshcore", "launcher", "bruce", "ghost", "marauder", "flipper_firmware", "unleashed", "roguemaster"]
@@ -192,24 +290,30 @@ FIRMWARE_TARGETS = ["meshtastic", "meshcore", "launcher", "bruce", "ghost", "mar
 # Project proposals (saved in container mount under REPO_ROOT)
 PROJECT_PROPOSALS_DIR = os.path.join(REPO_ROOT, "artifacts", "project_proposals")
 
-# Build config: device_id -> firmware_id -> { path, envs, optional build_subdir for PlatformIO project }
+# Build config: device_id -> firmware_id -> { path, envs, optional build_subdir for PlatformIO project,
+# git_url (upstream, for git_mirrors setup and git_ref builds), git_dir when the git checkout is below path }
 BUILD_CONFIG = {
     "t_beam_1w": {
         "meshcore": {
             "path": "devices/t_beam_1w/firmware/meshcore/repo",
+            "git_url": "https://github.com/meshcore-dev/MeshCore.git",
             "envs": ["T_Beam_1W_SX1262_repeater", "T_Beam_1W_SX1262_room_server", "T_Beam_1W_SX1262_companion_radio_ble"],
         },
         "meshtastic": {
             "path": "devices/t_beam_1w/firmware/meshtastic/repo",
             "envs": ["tbeam-1w"],
             "build_subdir": "firmware",  # PlatformIO project is in repo/firmware
+            "git_url": "https://github.com/meshtastic/firmware.git",
+            "git_dir": "firmware",  # submodule checkout of the upstream
         },
     },
     "lumari_watch": {
         "lumari_watch": {
             "path": "devices/lumari_watch/firmware/lumari_watch/repo",
+            "git_url": "https://github.com/athompson36/lumari_watch.git",
             "toolchain": "idf",
             "idf_target": "esp32s3",
         },
     },
 }
+
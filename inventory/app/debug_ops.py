@@ -10,15 +10,21 @@ from collections import deque
 from datetime import datetime, timezone
 
 from flash_ops import detect_chip_on_port, list_serial_ports
+from port_leases import acquire_monitor, release, wait_port_ready
+from usb_watch import current_port, identity_for_port, wait_for_device
 
 # Serial monitor: one port at a time, ring buffer of last N lines
 SERIAL_BUFFER_MAX_LINES = 500
+SERIAL_RECONNECT_TIMEOUT = 30.0  # seconds to wait for a board that dropped off USB (reset / re-enumeration)
 _serial_buffer = deque(maxlen=SERIAL_BUFFER_MAX_LINES)
 _serial_lock = threading.Lock()
 _serial_stop = threading.Event()
 _serial_thread = None
 _serial_port = None
 _serial_reader = None
+_serial_lease = None
+_serial_paused = threading.Event()  # set while a flash job holds the port lease
+_serial_idle = threading.Event()  # reader thread has closed the port and is parked
 
 # Persistent device logs (historical) for AI and troubleshooting
 _historical_log_max_lines = 500
@@ -65,55 +71,126 @@ def get_historical_log(max_lines: int = 150) -> str:
     return "\n".join(tail) if tail else ""
 
 
+def _open_serial(port: str, baud: int, wait: float = 0.0):
+    """Open port; after a re-enumeration the node can exist briefly before it is usable, so retry for up to wait seconds."""
+    import serial
+    deadline = time.monotonic() + wait
+    while True:
+        try:
+            return serial.Serial(port, baud, timeout=0.5)
+        except Exception:
+            if time.monotonic() >= deadline or _serial_stop.is_set():
+                raise
+            time.sleep(0.2)
+
+
 def _serial_read_loop(port: str, baud: int = 115200):
-    """Background thread: read from serial port and append lines to buffer and persistent log."""
-    global _serial_reader
-    try:
-        import serial
-        _serial_reader = serial.Serial(port, baud, timeout=0.5)
-    except Exception as e:
-        with _serial_lock:
-            _serial_buffer.append(f"[Serial open error] {port}: {e}")
-        _append_to_persistent_log(port, f"[Serial open error] {e}")
-        return
-    line_buf = ""
-    try:
-        while not _serial_stop.is_set():
-            try:
-                chunk = _serial_reader.read(_serial_reader.in_waiting or 1)
-                if chunk:
-                    line_buf += chunk.decode("utf-8", errors="replace")
-                    while "\n" in line_buf or "\r" in line_buf:
-                        line = line_buf.split("\n")[0].split("\r")[0]
-                        line_buf = line_buf[line_buf.index("\n") + 1:] if "\n" in line_buf else line_buf[line_buf.index("\r") + 1:]
-                        line = line.strip()
-                        if line:
+    """Background thread: read from serial port and append lines to buffer and persistent log.
+    Parks (port closed) while a flash job holds the port lease. If the board drops off USB (reset, re-enumeration),
+    wait for the same device and reopen it on its current port."""
+    global _serial_reader, _serial_port
+    identity = identity_for_port(port)
+    reconnecting = False
+    while not _serial_stop.is_set():
+        if _serial_paused.is_set():
+            with _serial_lock:
+                _serial_buffer.append(f"[Paused] {port} in use by a flash job")
+            _serial_idle.set()
+            while _serial_paused.is_set() and not _serial_stop.wait(0.1):
+                pass
+            _serial_idle.clear()
+            if _serial_stop.is_set():
+                return
+            # The job may have reset the board onto another port; reopen wherever the device is now.
+            port = current_port(identity) or wait_for_device(identity, timeout=SERIAL_RECONNECT_TIMEOUT, cancel=_serial_stop) or port
+            _serial_port = port
+            wait_port_ready(port, cancel=_serial_stop)
+            reconnecting = True
+            continue
+        try:
+            _serial_reader = _open_serial(port, baud, wait=3.0 if reconnecting else 0.0)
+        except Exception as e:
+            with _serial_lock:
+                _serial_buffer.append(f"[Serial open error] {port}: {e}")
+            _append_to_persistent_log(port, f"[Serial open error] {e}")
+            return
+        if reconnecting:
+            with _serial_lock:
+                _serial_buffer.append(f"[Reconnected] {port}")
+            _append_to_persistent_log(port, f"[Reconnected] {port}")
+        line_buf = ""
+        try:
+            while not _serial_stop.is_set() and not _serial_paused.is_set():
+                try:
+                    chunk = _serial_reader.read(_serial_reader.in_waiting or 1)
+                    if chunk:
+                        line_buf += chunk.decode("utf-8", errors="replace")
+                        while "\n" in line_buf or "\r" in line_buf:
+                            line = line_buf.split("\n")[0].split("\r")[0]
+                            line_buf = line_buf[line_buf.index("\n") + 1:] if "\n" in line_buf else line_buf[line_buf.index("\r") + 1:]
+                            line = line.strip()
+                            if line:
+                                with _serial_lock:
+                                    _serial_buffer.append(line)
+                                _append_to_persistent_log(port, line)
+                    else:
+                        if line_buf.strip():
                             with _serial_lock:
-                                _serial_buffer.append(line)
-                            _append_to_persistent_log(port, line)
-                else:
-                    if line_buf.strip():
+                                _serial_buffer.append(line_buf.strip())
+                            _append_to_persistent_log(port, line_buf.strip())
+                            line_buf = ""
+                        time.sleep(0.05)
+                except Exception as e:
+                    if not _serial_stop.is_set() and not _serial_paused.is_set():
                         with _serial_lock:
-                            _serial_buffer.append(line_buf.strip())
-                        _append_to_persistent_log(port, line_buf.strip())
-                        line_buf = ""
-                    time.sleep(0.05)
-            except Exception as e:
-                with _serial_lock:
-                    _serial_buffer.append(f"[Read error] {e}")
-                _append_to_persistent_log(port, f"[Read error] {e}")
-                break
-    finally:
+                            _serial_buffer.append(f"[Read error] {e}")
+                        _append_to_persistent_log(port, f"[Read error] {e}")
+                    break
+        finally:
+            try:
+                _serial_reader.close()
+            except Exception:
+                pass
+            _serial_reader = None
+        if _serial_paused.is_set():
+            continue
+        if _serial_stop.is_set() or not identity:
+            return
+        with _serial_lock:
+            _serial_buffer.append("[Disconnected] waiting for the device to come back…")
+        new_port = wait_for_device(identity, timeout=SERIAL_RECONNECT_TIMEOUT, cancel=_serial_stop)
+        if not new_port:
+            with _serial_lock:
+                _serial_buffer.append("[Disconnected] device did not come back; monitor stopped")
+            return
+        port = new_port
+        _serial_port = port
+        reconnecting = True
+
+
+def _monitor_pause() -> None:
+    """Lease preempted by a flash job: close the port and wait until the reader thread has parked."""
+    _serial_idle.clear()
+    _serial_paused.set()
+    reader = _serial_reader
+    if reader is not None:
         try:
-            _serial_reader.close()
+            reader.close()
         except Exception:
             pass
-        _serial_reader = None
+    if _serial_thread and _serial_thread.is_alive():
+        _serial_idle.wait(2.0)
+
+
+def _monitor_resume() -> None:
+    """Lease handed back after the flash job: the reader thread reopens the port."""
+    _serial_paused.clear()
 
 
 def serial_start(port: str, baud: int = 115200) -> tuple[bool, str]:
-    """Start serial monitor on port. Returns (success, message)."""
-    global _serial_thread, _serial_port, _serial_stop
+    """Start serial monitor on port. If a flash job holds the port, the monitor starts paused and resumes after it.
+    Returns (success, message)."""
+    global _serial_thread, _serial_port, _serial_stop, _serial_lease
     serial_stop()
     _serial_stop.clear()
     if not port or not port.strip():
@@ -123,17 +200,25 @@ def serial_start(port: str, baud: int = 115200) -> tuple[bool, str]:
         _serial_buffer.clear()
     _serial_port = port
     _serial_stop.clear()
+    _serial_paused.clear()
+    _serial_lease, active = acquire_monitor(port, "serial-monitor", _monitor_pause, _monitor_resume)
+    if not active:
+        _serial_paused.set()
     try:
         _serial_thread = threading.Thread(target=_serial_read_loop, args=(port, baud), daemon=True)
         _serial_thread.start()
+        if not active:
+            return True, f"{port} is in use by a flash job; monitor starts when it finishes"
         return True, f"Listening on {port}"
     except Exception as e:
+        release(_serial_lease)
+        _serial_lease = None
         return False, str(e)
 
 
 def serial_stop() -> None:
     """Stop serial monitor and clear buffer. Closes the port from this thread so it is released immediately."""
-    global _serial_thread, _serial_port, _serial_reader
+    global _serial_thread, _serial_port, _serial_reader, _serial_lease
     _serial_stop.set()
     # Close the serial port from here so the OS releases it immediately (thread may be blocked in read())
     reader = _serial_reader
@@ -147,6 +232,8 @@ def serial_stop() -> None:
         _serial_thread.join(timeout=2.0)
     _serial_thread = None
     _serial_port = None
+    release(_serial_lease)
+    _serial_lease = None
 
 
 def serial_get_buffer() -> tuple[list[str], str | None]:
@@ -160,6 +247,11 @@ def serial_is_active() -> bool:
     return _serial_port is not None and _serial_thread is not None and _serial_thread.is_alive()
 
 
+def serial_is_paused() -> bool:
+    """True while the monitor is running but parked because a flash job holds the port."""
+    return serial_is_active() and _serial_paused.is_set()
+
+
 def serial_clear_buffer() -> None:
     """Clear the in-memory serial buffer (display and AI). Does not stop the monitor."""
     with _serial_lock:
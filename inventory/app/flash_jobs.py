@@ -0,0 +1,328 @@
+"""
+Asynchronous backup / restore / flash jobs: a worker pool; each job holds a lease on its serial port (see port_leases).
+Each job gets an ID, its own progress (percent, bytes/sec parsed from esptool output), a log tail,
+an SSE event stream and cancellation, so HTTP requests no longer hold the connection for the whole esptool run.
+"""
+import os
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import artifact_index
+import telemetry
+from baud_tuner import tune_port
+from config import FLASH_DEVICES, FLASH_JOB_WORKERS, REPO_ROOT
+from flash_ops import (
+    backup_flash,
+    cached_detection,
+    flash_error_message,
+    flash_firmware,
+    get_alternate_port,
+    get_partition_table,
+    is_port_busy_error,
+    is_port_gone_error,
+    restore_flash,
+)
+from port_leases import acquire, free_port, release
+from usb_watch import current_port, device_generation, identity_for_port, wait_for_device
+
+JOB_KINDS = ("backup", "restore", "flash", "tune", "partitions")
+_TERMINAL = ("done", "error", "cancelled")
+_LOG_LINES = 200
+_JOBS_KEEP = 100
+_REENUMERATE_TIMEOUT = 10.0  # seconds to wait for a board that dropped off USB mid-operation to come back
+
+_jobs = {}  # job_id -> job dict (internal keys start with "_")
+_jobs_cond = threading.Condition()
+_pool = None
+
+
+def _get_pool():
+    global _pool
+    with _jobs_cond:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(max_workers=FLASH_JOB_WORKERS, thread_name_prefix="flash-job")
+        return _pool
+
+
+def _update(job_id: str, progress: dict | None = None, line: str | None = None, **kw):
+    """Update job fields / progress, append a log line and wake SSE listeners."""
+    with _jobs_cond:
+        job = _jobs.get(job_id)
+        if not job:
+            return
+        job.update(kw)
+        if progress:
+            job["progress"].update(progress)
+        if line:
+            job["_log"].append(line)
+        job["seq"] += 1
+        _jobs_cond.notify_all()
+
+
+def _snapshot(job: dict, log_lines: int = 20) -> dict:
+    out = {k: v for k, v in job.items() if not k.startswith("_")}
+    out["progress"] = dict(job["progress"])
+    out["log_tail"] = list(job["_log"])[-log_lines:] if log_lines else []
+    return out
+
+
+def _prune_locked():
+    if len(_jobs) < _JOBS_KEEP:
+        return
+    finished = sorted((j for j in _jobs.values() if j["status"] in _TERMINAL), key=lambda j: j["created_at"])
+    for j in finished[: len(_jobs) - _JOBS_KEEP + 1]:
+        _jobs.pop(j["id"], None)
+
+
+def submit_job(kind: str, port: str, device_id: str, params: dict | None = None, gate=None, cleanup=None) -> str:
+    """
+    Queue a job. kind: backup (params: backup_type, name, partitions), restore (params: bin_path, skip_unchanged),
+    flash (params: bin_path, addr, skip_unchanged), tune (baud autotune; no params), partitions (read the table; no params).
+    gate: optional semaphore held while the job runs (e.g. per-USB-hub limit); cleanup: called when the job ends.
+    Returns job_id.
+    """
+    if kind not in JOB_KINDS:
+        raise ValueError(f"Unknown job kind: {kind}")
+    job_id = uuid.uuid4().hex[:12]
+    with _jobs_cond:
+        _prune_locked()
+        _jobs[job_id] = {
+            "id": job_id,
+            "kind": kind,
+            "port": port,
+            "identity": identity_for_port(port),
+            "device_id": device_id,
+            "params": {k: v for k, v in (params or {}).items() if k != "bin_path"},
+            "status": "queued",
+            "progress": {},
+            "result": None,
+            "error": None,
+            "created_at": time.time(),
+            "started_at": None,
+            "finished_at": None,
+            "seq": 0,
+            "_params": dict(params or {}),
+            "_log": deque(maxlen=_LOG_LINES),
+            "_cancel": threading.Event(),
+            "_gate": gate,
+            "_cleanup": cleanup,
+            "_done": threading.Event(),
+        }
+    _get_pool().submit(_run_job, job_id)
+    return job_id
+
+
+def _acquire(gate, cancel: threading.Event) -> bool:
+    """Block on gate (Semaphore) until acquired or the job is cancelled."""
+    while not cancel.is_set():
+        if gate.acquire(timeout=0.5):
+            return True
+    return False
+
+
+def _ready(job_id: str, port: str, cancel: threading.Event) -> None:
+    """Wait for port to be released by whoever had it (paused monitor, orphaned esptool); logged when it never is."""
+    if not free_port(port, cancel=cancel):
+        _update(job_id, line=f"{port} still held by another process; trying anyway")
+
+
+def _dispatch(job: dict, port: str, progress, cancel):
+    """Run the esptool operation for job on port. Returns (ok, result_dict_or_error)."""
+    params = job["_params"]
+    if job["kind"] == "tune":
+        dev = FLASH_DEVICES.get(job["device_id"])
+        if not dev:
+            return False, f"Unknown device: {job['device_id']}"
+        return tune_port(port, dev["chip"], progress=progress, cancel=cancel)
+    if job["kind"] == "partitions":
+        ok, table_or_err = get_partition_table(port, job["device_id"], cancel=cancel)
+        return (True, {"partitions": table_or_err}) if ok else (False, table_or_err)
+    if job["kind"] == "backup":
+        ok, path_or_err, size = backup_flash(
+            port, job["device_id"], params.get("backup_type") or "full", name=params.get("name"),
+            progress=progress, cancel=cancel, partition_names=params.get("partitions"),
+        )
+        if not ok:
+            return False, path_or_err
+        return True, {"path": os.path.relpath(path_or_err, REPO_ROOT), "abs_path": path_or_err, "size": size}
+    skip = bool(params.get("skip_unchanged"))
+    if job["kind"] == "restore":
+        ok, msg = restore_flash(port, job["device_id"], params["bin_path"], progress=progress, cancel=cancel, skip_unchanged=skip)
+    else:
+        ok, msg = flash_firmware(
+            port, job["device_id"], params["bin_path"], params.get("addr") or "0x0",
+            progress=progress, cancel=cancel, skip_unchanged=skip,
+        )
+    return (True, {"message": msg}) if ok else (False, msg)
+
+
+def _run_job(job_id: str):
+    with _jobs_cond:
+        job = _jobs[job_id]
+    cancel = job["_cancel"]
+    gate = job["_gate"]
+    port = job["port"]
+    identity = job["identity"]
+    gate_held = False
+    lease = None
+    try:
+        if gate is not None:
+            _update(job_id, status="waiting_gate")
+            gate_held = _acquire(gate, cancel)
+        if not cancel.is_set():
+            _update(job_id, status="waiting_port")
+            lease = acquire(port, f"job:{job_id}", cancel=cancel)
+        if cancel.is_set():
+            _update(job_id, status="cancelled", finished_at=time.time())
+            return
+        moved = current_port(identity)
+        if moved and moved != port:
+            port = moved
+            _update(job_id, port=port, line=f"Device is now on {port}")
+        _update(job_id, status="running", started_at=time.time())
+        _ready(job_id, port, cancel)
+
+        def progress(line=None, **kw):
+            _update(job_id, progress=kw, line=line)
+
+        with telemetry.operation(
+            job["kind"], device_id=job["device_id"], port=port,
+            chip=(FLASH_DEVICES.get(job["device_id"]) or {}).get("chip"),
+            mac=(cached_detection(identity) or {}).get("mac"), usb_identity=identity,
+        ) as op:
+            generation = device_generation(identity)
+            ok, result = _dispatch(job, port, progress, cancel)
+            # The board dropped off USB mid-operation (e.g. native USB re-enumerating after reset): follow it to its new port.
+            if not ok and not cancel.is_set() and identity and is_port_gone_error(result):
+                _update(job_id, line="Port went away; waiting for the device to come back")
+                new_port = wait_for_device(identity, timeout=_REENUMERATE_TIMEOUT, cancel=cancel, after_generation=generation)
+                if new_port:
+                    port = op["port"] = new_port
+                    _update(job_id, port=port, line=f"Device is back on {port}; retrying")
+                    _ready(job_id, port, cancel)
+                    telemetry.note_retry()
+                    ok, result = _dispatch(job, port, progress, cancel)
+            # Busy despite the lease: another program has the port open. Free it (kills orphaned esptool) and retry once,
+            # then try the alternate port (same device: cu <-> tty).
+            if not ok and not cancel.is_set() and is_port_busy_error(result):
+                _update(job_id, line="Port busy; waiting for it to be released")
+                _ready(job_id, port, cancel)
+                telemetry.note_retry()
+                ok, result = _dispatch(job, port, progress, cancel)
+            if not ok and not cancel.is_set() and is_port_busy_error(result):
+                alt = get_alternate_port(port)
+                if alt:
+                    _update(job_id, line=f"Port busy; trying alternate port {alt}")
+                    _ready(job_id, alt, cancel)
+                    telemetry.note_retry()
+                    ok, result = _dispatch(job, alt, progress, cancel)
+            op["outcome"] = "cancelled" if cancel.is_set() else "ok" if ok else "error"
+            op["error"] = None if ok else str(result)
+        if ok and job["kind"] in ("restore", "flash"):
+            artifact_index.note_flashed(job["_params"]["bin_path"])  # retention keeps recently flashed artifacts
+        if cancel.is_set():
+            _update(job_id, status="cancelled", finished_at=time.time())
+        elif ok:
+            _update(job_id, status="done", result=result, finished_at=time.time(), progress={"pct": 100})
+        else:
+            _update(job_id, status="error", error=flash_error_message(result), finished_at=time.time())
+    except Exception as e:
+        _update(job_id, status="error", error=str(e)[:400], finished_at=time.time())
+    finally:
+        release(lease)
+        if gate_held:
+            gate.release()
+        if job["_cleanup"]:
+            try:
+                job["_cleanup"]()
+            except Exception:
+                pass
+        job["_done"].set()
+
+
+def get_job(job_id: str, log_lines: int = 20):
+    """Snapshot of a job (status, progress, result, error, log_tail), or None."""
+    with _jobs_cond:
+        job = _jobs.get(job_id)
+        return _snapshot(job, log_lines) if job else None
+
+
+def list_jobs(active_only: bool = False):
+    """Recent jobs, newest first."""
+    with _jobs_cond:
+        jobs = [_snapshot(j, 0) for j in _jobs.values() if not active_only or j["status"] not in _TERMINAL]
+    return sorted(jobs, key=lambda j: j["created_at"], reverse=True)
+
+
+def cancel_job(job_id: str):
+    """Request cancellation (kills the running esptool). Returns (success, error_message)."""
+    with _jobs_cond:
+        job = _jobs.get(job_id)
+        if not job:
+            return False, "Job not found"
+        if job["status"] in _TERMINAL:
+            return False, f"Job already {job['status']}"
+        job["_cancel"].set()
+    _update(job_id, line="Cancellation requested")
+    return True, None
+
+
+def wait_job(job_id: str, timeout: float | None = None):
+    """
+    Block until the job finishes (or timeout). Returns its snapshot, or None if unknown. The snapshot is taken from
+    the job held here, so it is returned even when the job was pruned from the list while waiting.
+    """
+    with _jobs_cond:
+        job = _jobs.get(job_id)
+    if not job:
+        return None
+    job["_done"].wait(timeout)
+    with _jobs_cond:
+        return _snapshot(job)
+
+
+def iter_job_events(job_id: str, keepalive: float = 15.0):
+    """Yield job snapshots whenever the job changes (None on idle keepalive); ends after a terminal state."""
+    last_seq = -1
+    while True:
+        with _jobs_cond:
+            job = _jobs.get(job_id)
+            if not job:
+                return
+            if job["seq"] == last_seq:
+                _jobs_cond.wait(keepalive)
+                job = _jobs.get(job_id)
+                if not job:
+                    return
+                if job["seq"] == last_seq:
+                    snap = None
+                else:
+                    last_seq = job["seq"]
+                    snap = _snapshot(job, 5)
+            else:
+                last_seq = job["seq"]
+                snap = _snapshot(job, 5)
+        yield snap
+        if snap is not None and snap["status"] in _TERMINAL:
+            return
+
+
+def latest_backup_progress():
+    """Progress of the most recent backup job in the legacy {pct, chunk, total_chunks, status} shape, or None."""
+    with _jobs_cond:
+        backups = [j for j in _jobs.values() if j["kind"] == "backup"]
+        if not backups:
+            return None
+        job = max(backups, key=lambda j: j["created_at"])
+        prog = dict(job["progress"])
+    if job["status"] in ("queued", "waiting_gate", "waiting_port"):
+        prog["status"] = "waiting"
+    elif job["status"] == "done":
+        prog["status"] = "done"
+    elif job["status"] in ("error", "cancelled"):
+        prog["status"] = "error"
+        prog["error"] = job["error"] or job["status"]
+    return prog
@@ -2,18 +2,39 @@
 Backup, restore, and flash for ESP32-family devices via esptool.
 Run from host (USB); when app runs in Docker, USB must be passed through or use host helper.
 """
+import glob
 import os
 import re
 import shutil
+import signal
 import subprocess
 import tempfile
 import threading
 import time as _time
 import urllib.error
 import urllib.request
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
-from config import ARTIFACTS_DIR, BACKUPS_DIR, BUILD_CONFIG, FLASH_DEVICES, FIRMWARE_TARGETS, REPO_ROOT
+import artifact_index
+import backup_store
+import build_cache
+import build_runner
+import build_stats
+import build_worktrees
+import compiler_cache
+import footprint
+import git_mirrors
+import partitions
+import telemetry
+from config import (
+    ARTIFACTS_DIR, BACKUPS_DIR, BUILD_CONFIG, BUILD_WORKER_TOKEN, ESPTOOL_AFTER, ESPTOOL_BEFORE, FLASH_DEVICES, FIRMWARE_TARGETS, REPO_ROOT,
+)
+
+try:
+    import esptool as esptool_lib  # in-process chip detection: one serial connection per port, no subprocess startup
+except ImportError:
+    esptool_lib = None
 
 
 # Backup progress: shared state so UI can poll during long chunked reads.
@@ -71,10 +92,6 @@ def get_alternate_port(port: str) -> str | None:
         return None
     return alt if os.path.exists(alt) else None
 
-# Artifact .bin files that are components only — do not offer for flash (would write partial image)
-_FLASH_EXCLUDE_BIN = frozenset(("bootloader.bin", "partitions.bin"))
-
-
 def _is_excluded_port(port_path: str, description: str = "") -> bool:
     """True if this port should be excluded from backup/flash/health (e.g. debug-console)."""
     combined = ((port_path or "") + " " + (description or "")).lower()
@@ -82,14 +99,22 @@ def _is_excluded_port(port_path: str, description: str = "") -> bool:
 
 
 def list_serial_ports():
-    """Return list of { port, description }. Excludes virtual/debug ports (e.g. cu.debug-console)."""
+    """Return list of { port, description, location?, vid?, pid?, serial_number? }. Excludes virtual/debug ports (e.g. cu.debug-console).
+    location is the USB path (e.g. 1-1.2:1.0); ports sharing everything but the last hop hang off the same hub."""
     seen = {}
     try:
         import serial.tools.list_ports
         for p in serial.tools.list_ports.comports():
             path = getattr(p, "device", None) or getattr(p, "path", None)
             if path and path not in seen and not _is_excluded_port(path, p.description or ""):
-                seen[path] = {"port": path, "description": (p.description or path)}
+                seen[path] = {
+                    "port": path,
+                    "description": (p.description or path),
+                    "location": getattr(p, "location", None),
+                    "vid": getattr(p, "vid", None),
+                    "pid": getattr(p, "pid", None),
+                    "serial_number": getattr(p, "serial_number", None),
+                }
     except ImportError:
         pass
     if not seen:
@@ -105,15 +130,11 @@ def get_flash_devices():
     return [{"id": did, **dict(d)} for did, d in FLASH_DEVICES.items()]
 
 
-def _chip_from_esptool_output(text):
-    """Parse 'Chip is ESP32-S3 (revision 0)' or similar from esptool stdout/stderr. Returns lowercase chip name e.g. esp32s3."""
-    if not text:
-        return None
-    import re
-    m = re.search(r"Chip is (ESP32[^\s\(]*(?:\s*\([^)]*\))?)", text, re.IGNORECASE)
-    if not m:
+def _normalize_chip(name):
+    """Map an esptool chip name ('ESP32-S3', 'esp32s3 (revision 0)') to the --chip value, e.g. esp32s3."""
+    chip = (name or "").strip().split("(")[0].strip().lower().replace("-", "")
+    if not chip:
         return None
-    chip = m.group(1).strip().split("(")[0].strip().lower().replace("-", "")
     # Normalize to esptool --chip values
     if chip.startswith("esp32s3"):
         return "esp32s3"
@@ -126,9 +147,29 @@ def _chip_from_esptool_output(text):
     return chip
 
 
+def _chip_from_esptool_output(text):
+    """Parse 'Chip is ESP32-S3 (revision 0)' or similar from esptool stdout/stderr. Returns lowercase chip name e.g. esp32s3."""
+    if not text:
+        return None
+    m = re.search(r"Chip is (ESP32[^\s\(]*(?:\s*\([^)]*\))?)", text, re.IGNORECASE)
+    if not m:
+        return None
+    return _normalize_chip(m.group(1))
+
+
+def _reset_args() -> list:
+    """--before / --after from config (ESPTOOL_BEFORE / ESPTOOL_AFTER); empty when esptool's defaults apply."""
+    args = []
+    if ESPTOOL_BEFORE:
+        args += ["--before", ESPTOOL_BEFORE]
+    if ESPTOOL_AFTER:
+        args += ["--after", ESPTOOL_AFTER]
+    return args
+
+
 def _run_esptool_read_mac(cmd, port, chip=None, timeout=5):
     """Run esptool read-mac; optional --chip. Returns (combined_stdout_stderr, returncode)."""
-    args = [cmd, "--port", port]
+    args = [cmd] + _reset_args() + ["--port", port]
     if chip:
         args.extend(["--chip", chip])
     args.append("read-mac")
@@ -136,12 +177,38 @@ def _run_esptool_read_mac(cmd, port, chip=None, timeout=5):
     return (out.stdout or "") + (out.stderr or ""), out.returncode
 
 
-def detect_chip_on_port(port, timeout=5):
+def _probe_port_inprocess(port, connect_attempts=2):
     """
-    Run esptool read_mac on port to detect chip type. Returns (chip, error_message).
-    chip is lowercase e.g. esp32s3, or None if detection failed.
-    Tries auto-detect first, then --chip esp32s3 (T-Beam 1W, T-Deck Plus), then --chip esp32.
+    One in-process esptool connection: auto-detect the chip, read the base MAC, then hard-reset back into the app.
+    Returns (chip, mac_or_None); raises on connect failure.
     """
+    kwargs = {}
+    if ESPTOOL_BEFORE:
+        # esptool v5 spells reset modes with hyphens (no-reset), v4 with underscores (no_reset)
+        v5 = int(str(getattr(esptool_lib, "__version__", "4")).split(".")[0]) >= 5
+        kwargs["connect_mode"] = ESPTOOL_BEFORE.replace("_", "-") if v5 else ESPTOOL_BEFORE.replace("-", "_")
+    esp = esptool_lib.cmds.detect_chip(port=port, connect_attempts=connect_attempts, **kwargs)
+    try:
+        chip = _normalize_chip(esp.CHIP_NAME)
+        try:
+            mac = ":".join(f"{b:02x}" for b in esp.read_mac())
+        except Exception:
+            mac = None
+        if ESPTOOL_AFTER.replace("-", "_") != "no_reset":
+            try:
+                esp.hard_reset()
+            except Exception:
+                pass
+    finally:
+        try:
+            esp._port.close()
+        except Exception:
+            pass
+    return chip, mac
+
+
+def _detect_chip_subprocess(port, timeout=5):
+    """detect_chip_on_port via esptool subprocesses (used when the esptool package is not importable)."""
     for cmd in ("esptool", "esptool.py"):
         try:
             last_error = None
@@ -174,79 +241,398 @@ def detect_chip_on_port(port, timeout=5):
     return None, "esptool not found"
 
 
-def list_serial_ports_with_detection(timeout_per_port=4):
+_probing_lock = threading.Lock()
+_probing = {}  # port -> in-process probe thread that outlived its timeout (still holds the port)
+
+
+def _detect_port(port, timeout=5):
+    """Detect chip (and MAC, in-process only) on port within timeout seconds. Returns (chip, mac, error_message)."""
+    if esptool_lib is None:
+        chip, err = _detect_chip_subprocess(port, timeout=timeout)
+        return chip, None, err
+    # esptool's connect loop has no overall deadline: probe in a daemon thread and stop waiting after timeout.
+    # A timed-out probe keeps the port until its connect attempts run out; later probes of that port wait for it.
+    with _probing_lock:
+        stale = _probing.get(port)
+        if stale is not None and stale.is_alive():
+            return None, None, "Timeout (previous detection still running)"
+        outcome = {}
+
+        def probe():
+            try:
+                outcome["res"] = _probe_port_inprocess(port)
+            except Exception as e:
+                outcome["err"] = (str(e).strip() or type(e).__name__)[:200]
+
+        t = threading.Thread(target=probe, name=f"detect-{os.path.basename(port)}", daemon=True)
+        _probing[port] = t
+        t.start()
+    t.join(timeout)
+    if t.is_alive():
+        return None, None, "Timeout"
+    with _probing_lock:
+        if _probing.get(port) is t:
+            del _probing[port]
+    if "err" in outcome:
+        return None, None, outcome["err"]
+    chip, mac = outcome["res"]
+    return chip, mac, None if chip else "Could not detect chip"
+
+
+def detect_chip_on_port(port, timeout=5):
+    """
+    Detect the chip type on port. Returns (chip, error_message).
+    chip is lowercase e.g. esp32s3, or None if detection failed.
+    Uses one in-process esptool connection when the esptool package is importable; otherwise runs esptool
+    read-mac (auto-detect, then --chip esp32s3 for T-Beam 1W / T-Deck Plus, then --chip esp32).
+    """
+    chip, _, err = _detect_port(port, timeout=timeout)
+    return chip, err
+
+
+# Detection cache: USB identity -> { chip, mac }. Entries survive port renumbering and are dropped when the
+# device disappears from the port list (hotplug) or via invalidate_detection.
+_detect_cache_lock = threading.Lock()
+_detect_cache = {}
+
+
+def port_identity(p: dict) -> str:
+    """Stable key for a USB serial device: VID:PID:serial when the bridge reports a serial number, else VID:PID@location/port."""
+    vid, pid = p.get("vid"), p.get("pid")
+    ids = f"{vid:04x}:{pid:04x}" if vid is not None and pid is not None else "-"
+    if p.get("serial_number"):
+        return f"{ids}:{p['serial_number']}"
+    return f"{ids}@{p.get('location') or p.get('port')}"
+
+
+def cached_detection(identity: str):
+    """Cached { chip, mac } for a USB identity, or None."""
+    with _detect_cache_lock:
+        hit = _detect_cache.get(identity)
+        return dict(hit) if hit else None
+
+
+def invalidate_detection(identity: str | None = None) -> None:
+    """Forget cached detection for one USB identity (hotplug), or for all devices."""
+    with _detect_cache_lock:
+        if identity is None:
+            _detect_cache.clear()
+        else:
+            _detect_cache.pop(identity, None)
+
+
+def list_serial_ports_with_detection(timeout_per_port=4, refresh=False):
     """
     List ports and, for each, try to detect connected chip. Returns list of
-    { port, description, chip, suggested_device_ids }.
+    { port, description, location, vid, pid, serial_number, chip, mac, cached, busy, detection_error, suggested_device_ids }.
     suggested_device_ids: list of device_id from FLASH_DEVICES that use this chip (user can pick).
+    Uncached ports are probed in parallel, at most timeout_per_port seconds each; refresh=True ignores the cache.
+    Ports leased by a job or the serial monitor (port_leases) are never probed, since probing resets the chip:
+    busy names the lease owner and chip/mac come from the cache when known.
     """
-    ports = list_serial_ports()
+    from port_leases import lease_holder
+    ports = [p for p in list_serial_ports() if p.get("port") or p.get("description")]
     chip_to_devices = {}
     for device_id, dev in FLASH_DEVICES.items():
         c = (dev.get("chip") or "").lower()
         if c:
             chip_to_devices.setdefault(c, []).append(device_id)
 
+    identities = {p.get("port") or p.get("description"): port_identity(p) for p in ports}
+    busy = {port: holder for port, holder in ((port, lease_holder(port)) for port in identities) if holder}
+    with _detect_cache_lock:
+        for key in [k for k in _detect_cache if k not in identities.values()]:
+            del _detect_cache[key]  # unplugged since last listing
+        cached = {
+            port: dict(_detect_cache[ident])
+            for port, ident in identities.items()
+            if ident in _detect_cache and (port in busy or not refresh)
+        }
+
+    probe = [port for port in identities if port not in cached and port not in busy]
+    probed = {}
+    if probe:
+        with ThreadPoolExecutor(max_workers=len(probe), thread_name_prefix="detect") as pool:
+            for port, res in zip(probe, pool.map(lambda port: _detect_port(port, timeout=timeout_per_port), probe)):
+                probed[port] = res
+        with _detect_cache_lock:
+            for port, (chip, mac, _) in probed.items():
+                if chip:
+                    _detect_cache[identities[port]] = {"chip": chip, "mac": mac}
+
     result = []
     for p in ports:
-        port = p.get("port") or p.get("description") or ""
-        if not port:
-            continue
-        desc = p.get("description") or port
-        chip, err = detect_chip_on_port(port, timeout=timeout_per_port)
-        suggested = list(chip_to_devices.get(chip, [])) if chip else []
+        port = p.get("port") or p.get("description")
+        if port in cached:
+            chip, mac, err = cached[port]["chip"], cached[port]["mac"], None
+        elif port in busy:
+            chip, mac, err = None, None, f"Port busy ({busy[port]['owner']})"
+        else:
+            chip, mac, err = probed[port]
         result.append({
+            **p,
             "port": port,
-            "description": desc,
+            "description": p.get("description") or port,
             "chip": chip,
+            "mac": mac,
+            "cached": port in cached,
+            "busy": busy[port]["owner"] if port in busy else None,
             "detection_error": err if not chip else None,
-            "suggested_device_ids": suggested,
+            "suggested_device_ids": list(chip_to_devices.get(chip, [])) if chip else [],
         })
     return result
 
 
-def _kill_esptool_on_port(port: str) -> None:
-    """Kill any running esptool process that is using this port (stale from a previous timed-out request)."""
-    if not port:
-        return
+_PROGRESS_PCT_RE = re.compile(r"(\d+(?:\.\d+)?)\s*%")
+_PROGRESS_BYTES_RE = re.compile(r"(\d+)\s*/\s*(\d+)\s*bytes")  # esptool v5 progress bar
+_PROGRESS_READ_V4_RE = re.compile(r"^(\d+)\s+\(\s*\d+\s*%\)")  # esptool v4 read-flash: "262144 (25 %)"
+_PROGRESS_RATE_RE = re.compile(r"\((?:effective\s+)?([\d.]+)\s*kbit/s\)")
+_PROGRESS_STAGES = (("erasing", "erasing"), ("writing", "writing"), ("reading", "reading"), ("verif", "verifying"), ("hash of data", "verifying"))
+
+
+def _esptool_progress_parser(progress, total_bytes: int = 0):
+    """
+    Return an on_line callback that parses esptool output (v4 and v5 formats) and calls
+    progress(line=..., stage?, pct?, bytes_done?, bytes_total?, bytes_per_sec?).
+    total_bytes: size of the transfer, used to derive bytes from percent-only lines.
+    """
+    state = {"t": None, "bytes": 0, "rate": None}
+
+    def on_line(line):
+        kw = {"line": line}
+        low = line.lower()
+        for key, stage in _PROGRESS_STAGES:
+            if key in low:
+                kw["stage"] = stage
+                break
+        done = total = None
+        m = _PROGRESS_BYTES_RE.search(line)
+        if m:
+            done, total = int(m.group(1)), int(m.group(2))
+        else:
+            m = _PROGRESS_READ_V4_RE.match(line.strip())
+            if m:
+                done, total = int(m.group(1)), total_bytes or None
+        m = _PROGRESS_PCT_RE.search(line)
+        if m:
+            kw["pct"] = min(100.0, float(m.group(1)))
+            if done is None and total_bytes:
+                done, total = int(total_bytes * kw["pct"] / 100), total_bytes
+        elif done is not None and total:
+            kw["pct"] = round(100.0 * done / total, 1)
+        if done is not None:
+            now = _time.monotonic()
+            if state["t"] is not None and done > state["bytes"] and now > state["t"]:
+                inst = (done - state["bytes"]) / (now - state["t"])
+                state["rate"] = inst if state["rate"] is None else 0.7 * state["rate"] + 0.3 * inst
+            if state["t"] is None or done != state["bytes"]:
+                state["t"], state["bytes"] = now, done
+            kw["bytes_done"] = done
+            kw["bytes_total"] = total
+        m = _PROGRESS_RATE_RE.search(line)
+        if m:
+            state["rate"] = float(m.group(1)) * 1000 / 8
+        if state["rate"] is not None:
+            kw["bytes_per_sec"] = round(state["rate"])
+        progress(**kw)
+
+    return on_line
+
+
+def _run_streaming(args, timeout, on_line=None, cancel=None, cwd=None, env=None, start_new_session=False):
+    """
+    Run a process, feeding each output line (split on \\n and \\r, stderr merged) to on_line while it runs.
+    Kills the process on timeout or when cancel (threading.Event) is set.
+    Returns (returncode_or_None, output, status) with status ok | timeout | cancelled. Raises FileNotFoundError.
+    """
+    proc = subprocess.Popen(
+        args,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        cwd=cwd,
+        env=env,
+        start_new_session=start_new_session,
+    )
+    chunks = []
+    done = threading.Event()
+
+    def _reader():
+        pending = ""
+        try:
+            while True:
+                data = os.read(proc.stdout.fileno(), 4096)
+                if not data:
+                    break
+                text = data.decode("utf-8", errors="replace")
+                chunks.append(text)
+                if on_line:
+                    pending += text
+                    parts = re.split(r"[\r\n]", pending)
+                    pending = parts.pop()
+                    for part in parts:
+                        if part.strip():
+                            on_line(part)
+            if on_line and pending.strip():
+                on_line(pending)
+        except Exception:
+            pass
+        finally:
+            done.set()
+
+    threading.Thread(target=_reader, daemon=True).start()
+    deadline = _time.monotonic() + timeout if timeout else None
+    status = "ok"
+    while not done.wait(0.2):
+        if cancel is not None and cancel.is_set():
+            status = "cancelled"
+        elif deadline is not None and _time.monotonic() > deadline:
+            status = "timeout"
+        if status != "ok":
+            _kill_process_tree(proc, start_new_session)
+            done.wait(5)
+            break
     try:
-        out = subprocess.run(
-            ["pgrep", "-af", "esptool"],
-            capture_output=True, text=True, timeout=5,
-        )
-        for line in (out.stdout or "").splitlines():
-            if port in line or (get_alternate_port(port) or "") in line:
-                pid_str = line.strip().split()[0]
-                try:
-                    os.kill(int(pid_str), 9)
-                except (ValueError, ProcessLookupError, PermissionError):
-                    pass
-    except Exception:
+        proc.wait(timeout=5)
+    except subprocess.TimeoutExpired:
+        _kill_process_tree(proc, start_new_session)
+    proc.stdout.close()
+    return (proc.returncode if status == "ok" else None), "".join(chunks), status
+
+
+_KILL_GRACE_S = 15  # SIGTERM -> SIGKILL for process groups: lab-exec.sh stops the build inside its container meanwhile
+
+
+def _kill_process_tree(proc, own_session: bool) -> None:
+    """
+    Kill proc. When started in its own session, its process group gets SIGTERM first and SIGKILL once it has not
+    exited within _KILL_GRACE_S, so scripts can clean up (lab-exec.sh stops the build running in the container).
+    """
+    try:
+        if not own_session:
+            proc.kill()
+            return
+        os.killpg(proc.pid, signal.SIGTERM)
+        deadline = _time.monotonic() + _KILL_GRACE_S
+        while _time.monotonic() < deadline:
+            proc.poll()  # reap the leader so an empty group reads as gone
+            try:
+                os.killpg(proc.pid, 0)
+            except ProcessLookupError:
+                return
+            _time.sleep(0.1)
+        os.killpg(proc.pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError, OSError):
         pass
 
 
-def _esptool(*args, timeout=120):
-    """Run esptool with explicit kill on timeout (prefer 'esptool'; esptool.py is deprecated in v5+)."""
+def _run_esptool_cmd(args, timeout, progress=None, cancel=None, total_bytes=0):
+    """Run esptool (prefer 'esptool'; esptool.py is deprecated in v5+) once. Returns (success, output)."""
+    on_line = _esptool_progress_parser(progress, total_bytes) if progress else None
     for cmd in ("esptool", "esptool.py"):
+        started = _time.monotonic()
         try:
-            proc = subprocess.Popen(
-                [cmd] + list(args),
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                text=True,
-            )
-            try:
-                stdout, stderr = proc.communicate(timeout=timeout)
-                return proc.returncode == 0, (stdout or "") + (stderr or "")
-            except subprocess.TimeoutExpired:
-                proc.kill()
-                proc.wait(timeout=5)
-                return False, "Timeout"
+            rc, output, status = _run_streaming([cmd] + _reset_args() + list(args), timeout, on_line=on_line, cancel=cancel)
         except FileNotFoundError:
             continue
+        if status == "timeout":
+            ok, output = False, "Timeout"
+        elif status == "cancelled":
+            ok, output = False, "Cancelled"
+        else:
+            ok = rc == 0
+        telemetry.record_run(args, _run_outcome(ok, output), output, _time.monotonic() - started, total_bytes)
+        return ok, output
     return False, "esptool not found (pip install esptool)"
 
 
+def _run_outcome(ok: bool, output: str) -> str:
+    """Telemetry outcome of one esptool run: ok, cancelled, timeout, busy, gone or error."""
+    if ok:
+        return "ok"
+    if output in ("Cancelled", "Timeout"):
+        return output.lower()
+    if is_port_busy_error(output):
+        return "busy"
+    if is_port_gone_error(output):
+        return "gone"
+    return "error"
+
+
+def _esptool(*args, timeout=120, progress=None, cancel=None, total_bytes=0):
+    """
+    Run esptool with explicit kill on timeout.
+    progress: optional callable(**kw) fed parsed output (pct, bytes_done, bytes_per_sec, stage, line).
+    cancel: optional threading.Event; setting it kills esptool and returns (False, "Cancelled").
+    When the port's USB bridge + chip has a tuned baud profile (baud_tuner) and no --baud is given, the tuned rate is
+    used; if that run fails (other than cancel / busy / unplugged), it is retried once at esptool's default rate.
+    """
+    baud = None
+    if "--baud" not in args and "--chip" in args and "--port" in args:
+        from baud_tuner import tuned_baud
+        chip = args[args.index("--chip") + 1]
+        port = args[args.index("--port") + 1]
+        baud = tuned_baud(port, chip)
+    if not baud:
+        return _run_esptool_cmd(args, timeout, progress=progress, cancel=cancel, total_bytes=total_bytes)
+    ok, output = _run_esptool_cmd(("--baud", str(baud)) + args, timeout, progress=progress, cancel=cancel, total_bytes=total_bytes)
+    from baud_tuner import baud_failed, baud_succeeded
+    if ok:
+        baud_succeeded(port, chip, baud)
+        return ok, output
+    low = (output or "").lower()
+    if (
+        output == "Cancelled" or (cancel is not None and cancel.is_set())
+        or is_port_busy_error(output) or is_port_gone_error(output)
+        or "failed to connect" in low or "no serial data received" in low  # connect runs at ROM baud: not a rate problem
+    ):
+        return ok, output
+    baud_failed(port, chip, baud)
+    telemetry.note_retry()
+    if progress:
+        progress(line=f"Failed at {baud} baud; retrying at the default rate")
+    return _run_esptool_cmd(args, timeout, progress=progress, cancel=cancel, total_bytes=total_bytes)
+
+
+def flash_error_message(raw: str) -> str:
+    """Strip ANSI codes and return a clear message for common errors (e.g. port busy, timeout)."""
+    if not raw:
+        return "Unknown error"
+    s = re.sub(r"\x1b\[[0-9;]*m", "", raw)
+    s = s.replace("\r", " ").replace("\n", " ").strip()
+    low = s.lower()
+    if "port is busy" in low or "resource temporarily unavailable" in low or "could not exclusively lock" in low:
+        return "Port is busy or in use. Close Serial Monitor (Debug tab) and any other app using the port, then try again."
+    if "no serial data received" in low or "failed to connect" in low:
+        return "Could not connect to device. Put the board in bootloader mode (hold BOOT, press RESET, release BOOT), then try again. Also try Refresh & detect devices — the port may have changed."
+    if ("could not open" in low or "doesn't exist" in low or "no such file" in low) and "port" in low:
+        return "Port not found — device may have disconnected or the port changed after a reset. Click Refresh & detect devices and try again."
+    if s.strip().lower() == "timeout":
+        return "Backup timed out. Full flash can take 20+ minutes; try again or use a smaller backup (e.g. App partition only)."
+    return s[:400] if len(s) > 400 else s
+
+
+def is_port_busy_error(msg: str) -> bool:
+    """True if esptool output says the port is held by another process."""
+    low = (msg or "").lower()
+    return "busy" in low or "temporarily unavailable" in low or "exclusively lock" in low
+
+
+def is_port_gone_error(msg: str) -> bool:
+    """True if esptool output says the port vanished or never existed (unplugged, or renumbered after a reset)."""
+    low = (msg or "").lower()
+    return (
+        "could not open" in low or "no such file" in low or "doesn't exist" in low
+        or "device disconnected" in low or "device not configured" in low
+        or "returned no data" in low or "input/output error" in low
+    )
+
+
+def _flash_size_bytes(flash_size: str) -> int:
+    """Bytes for a FLASH_DEVICES flash_size string (4MB, 8MB, 16MB); defaults to 8 MB."""
+    size_map = {"4MB": 4 * 1024 * 1024, "8MB": 8 * 1024 * 1024, "16MB": 16 * 1024 * 1024}
+    return size_map.get(flash_size, 8 * 1024 * 1024)
+
+
 def _sanitize_backup_name(name: str) -> str:
     """Make a safe filename for backup: alphanumeric, dash, underscore; ensure .bin."""
     if not name or not name.strip():
@@ -258,112 +644,334 @@ def _sanitize_backup_name(name: str) -> str:
     return s + ".bin" if not s.lower().endswith(".bin") else s
 
 
-def backup_flash(port: str, device_id: str, backup_type: str = "full", name: str = None):
+_LEGACY_BACKUP_REGIONS = {"app": (0x10000, 0x180000), "nvs": (0x9000, 0x6000)}  # used when there is no partition table
+_READ_BLOCK = 0x1000  # flash sector; small reads (table, image headers) are rounded to it
+_HEADER_WINDOW = 0x10000  # first read of an app image: header and the segment headers near its start in one esptool call
+
+
+def _read_flash_bytes(chip: str, port: str, addr: int, size: int, cancel=None):
+    """One small read-flash into memory. Returns (data_or_None, error_message)."""
+    fd, tmp = tempfile.mkstemp(prefix="flash_read_", suffix=".bin")
+    os.close(fd)
+    try:
+        ok, msg = _esptool("--chip", chip, "--port", port, "read-flash", str(addr), str(size), tmp,
+                           timeout=60, cancel=cancel, total_bytes=size)
+        if not ok or os.path.getsize(tmp) != size:
+            return None, msg or "Read failed"
+        with open(tmp, "rb") as f:
+            return f.read(), None
+    finally:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+
+
+def _read_partition_table(chip: str, port: str, dev: dict, cancel=None):
+    """Read and parse the partition table. Returns (partitions_or_None, error_message)."""
+    offset = int(dev.get("partition_table_offset") or partitions.PARTITION_TABLE_OFFSET)
+    data, err = _read_flash_bytes(chip, port, offset, partitions.PARTITION_TABLE_SIZE, cancel=cancel)
+    if data is None:
+        return None, err
+    table = partitions.parse_partition_table(data)
+    if table is None:
+        return None, f"No partition table at 0x{offset:X}"
+    return table, None
+
+
+def get_partition_table(port: str, device_id: str, cancel=None):
+    """Partition table of the device on port. Returns (success, partitions_or_error)."""
+    dev = FLASH_DEVICES.get(device_id)
+    if not dev:
+        return False, f"Unknown device: {device_id}"
+    if dev.get("flash_method") == "uf2":
+        return False, "This device uses UF2 flashing; it has no ESP partition table."
+    table, err = _read_partition_table(dev["chip"], port, dev, cancel=cancel)
+    return (True, table) if table is not None else (False, err)
+
+
+def _app_read_length(chip: str, port: str, part: dict, cancel=None) -> int:
+    """Bytes of an app partition worth reading: the image length from its header (rounded up to a sector), the whole
+    partition when the header is invalid, 0 when it is erased. The first _HEADER_WINDOW bytes are read in one call;
+    segment headers beyond them are fetched a sector at a time."""
+    blocks = {}
+
+    def read(offset, size):
+        if not blocks:
+            window = min(_HEADER_WINDOW, part["size"]) // _READ_BLOCK * _READ_BLOCK
+            data, _ = _read_flash_bytes(chip, port, part["offset"], window, cancel=cancel)
+            if data is None:
+                return b""
+            for i in range(window // _READ_BLOCK):
+                blocks[i] = data[i * _READ_BLOCK:(i + 1) * _READ_BLOCK]
+        first, last = offset // _READ_BLOCK, (offset + size - 1) // _READ_BLOCK
+        if any(b not in blocks for b in range(first, last + 1)):
+            data, _ = _read_flash_bytes(chip, port, part["offset"] + first * _READ_BLOCK,
+                                        (last - first + 1) * _READ_BLOCK, cancel=cancel)
+            if data is None:
+                return b""
+            for i in range(last - first + 1):
+                blocks[first + i] = data[i * _READ_BLOCK:(i + 1) * _READ_BLOCK]
+        buf = b"".join(blocks[b] for b in range(first, last + 1))
+        return buf[offset - first * _READ_BLOCK:][:size]
+
+    length = partitions.app_image_length(read, part["size"])
+    if length is None:
+        return part["size"]
+    return min(part["size"], -(-length // _READ_BLOCK) * _READ_BLOCK)
+
+
+def _select_backup_partitions(chip: str, port: str, table: list, backup_type: str, names, cancel=None):
+    """Partitions to back up for backup_type app (boot app), nvs, or partitions (names). Returns (list, error)."""
+    if backup_type == "partitions":
+        selected = []
+        for name in names or []:
+            part = partitions.find_partition(table, name=name)
+            if part is None:
+                return None, f"No partition named {name!r} (have: {', '.join(p['name'] for p in table)})"
+            if part not in selected:
+                selected.append(part)
+        return (selected, None) if selected else (None, "No partitions selected")
+    if backup_type == "nvs":
+        part = partitions.find_partition(table, ptype="data", subtype="nvs")
+        return ([part], None) if part else (None, "Partition table has no nvs partition")
+    otadata = None
+    ota = partitions.find_partition(table, ptype="data", subtype="ota")
+    if ota:
+        otadata, _ = _read_flash_bytes(chip, port, ota["offset"], min(ota["size"], 0x2000), cancel=cancel)
+    part = partitions.boot_app_partition(table, otadata)
+    return ([part], None) if part else (None, "Partition table has no app partition")
+
+
+def backup_flash(port: str, device_id: str, backup_type: str = "full", name: str | None = None, progress=None, cancel=None,
+                 partition_names=None):
     """
-    Read flash to a file. backup_type: full, app (0x10000 for 0x10000 size ~1MB default), nvs.
-    name: optional custom filename (saved under BACKUPS_DIR); must be safe (alphanumeric, dash, underscore).
-    Returns (success, path_or_error, size_bytes).
+    Read flash into the backup store. backup_type: full (whole chip), app (the partition that boots), nvs, or
+    partitions (partition_names, e.g. ["nvs", "app0", "spiffs"]). Non-full backups read the partition table at 0x8000
+    first and read app partitions only up to the end of their image; the manifest lists the partitions it holds.
+    app / nvs fall back to 0x10000 (1.5 MB) / 0x9000 (24 KB) when there is no readable partition table.
+    name: optional custom backup name (manifest under BACKUPS_DIR); must be safe (alphanumeric, dash, underscore).
+    progress / cancel: optional callable(**kw) and threading.Event (see _esptool); without progress, the
+    global backup progress is updated.
+    Returns (success, manifest_path_or_error, size_bytes).
     """
     dev = FLASH_DEVICES.get(device_id)
     if not dev:
         return False, f"Unknown device: {device_id}", 0
     if dev.get("flash_method") == "uf2":
         return False, "This device uses UF2 flashing. Use the magnetic pogo cable and copy a UF2 file to the HT-n5262 drive. See device notes (e.g. devices/ht_mesh_pocket_10000/notes/FLASHING_UF2.md).", 0
+    if backup_type not in ("full", "app", "nvs", "partitions"):
+        return False, f"Unknown backup_type: {backup_type}", 0
     chip = dev["chip"]
     flash_size = dev.get("flash_size", "8MB")
-    size_map = {"4MB": 4 * 1024 * 1024, "8MB": 8 * 1024 * 1024, "16MB": 16 * 1024 * 1024}
-    total_size = size_map.get(flash_size, 8 * 1024 * 1024)
+    total_size = _flash_size_bytes(flash_size)
+    report = progress or _set_backup_progress
 
     os.makedirs(BACKUPS_DIR, exist_ok=True)
     stamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    if backup_type == "full":
-        size = total_size
-        fname = f"backup_{device_id}_full_{stamp}.bin"
-    elif backup_type == "app":
-        # Common: app at 0x10000, up to ~1.5MB
-        size = 0x180000  # 1.5MB
-        fname = f"backup_{device_id}_app_{stamp}.bin"
-    elif backup_type == "nvs":
-        # NVS often at 0x9000, 24KB
-        size = 0x6000
-        fname = f"backup_{device_id}_nvs_{stamp}.bin"
-    else:
-        return False, f"Unknown backup_type: {backup_type}", 0
-
     custom = _sanitize_backup_name(name) if name else ""
-    if custom:
-        fname = custom
-
-    if backup_type == "app":
-        addr = 0x10000
-    elif backup_type == "nvs":
-        addr = 0x9000
-    else:
-        addr = 0
-
-    path = os.path.join(BACKUPS_DIR, fname)
+    fname = custom or f"backup_{device_id}_{backup_type}_{stamp}.bin"
 
+    # Byte ranges to read: [(addr, length, partition_or_None)]
+    selected = None
     if backup_type == "full":
-        # Chunked read: ESP32-S3 USB-Serial/JTAG drops data on long reads.
-        # Read in 1MB chunks, retry each chunk up to 3 times, then concatenate.
-        ok, err = _chunked_read_flash(chip, port, addr, size, path)
-        if ok:
-            return True, path, size
-        return False, err, 0
-
-    ok, msg = _esptool("--chip", chip, "--port", port,
-                        "read-flash", str(addr), str(size), path,
-                        timeout=300)
-    if ok and os.path.isfile(path):
-        return True, path, size
-    return False, msg or "Read failed", 0
-
-
-_CHUNK_SIZE = 0x100000  # 1 MB per chunk
-_CHUNK_RETRIES = 3
-
-
-def _chunked_read_flash(chip: str, port: str, start_addr: int, total_size: int, out_path: str):
-    """Read flash in 1MB chunks to avoid USB-Serial/JTAG corruption on long reads.
-    Updates _backup_progress so the UI can poll. Returns (success, error_message_or_None)."""
-    total_chunks = (total_size + _CHUNK_SIZE - 1) // _CHUNK_SIZE
-    _set_backup_progress(pct=0, chunk=0, total_chunks=total_chunks, status="reading", error=None)
+        ranges = [(0, total_size, None)]
+    else:
+        report(pct=0, status="reading", error=None, line="Reading partition table")
+        table, err = _read_partition_table(chip, port, dev, cancel=cancel)
+        if cancel is not None and cancel.is_set():
+            return False, "Cancelled", 0
+        if table is None:
+            if backup_type == "partitions":
+                return False, err, 0
+            ranges = [(*_LEGACY_BACKUP_REGIONS[backup_type], None)]
+        else:
+            selected, err = _select_backup_partitions(chip, port, table, backup_type, partition_names, cancel=cancel)
+            if selected is None:
+                return False, err, 0
+            ranges = []
+            for part in selected:
+                length = _app_read_length(chip, port, part, cancel=cancel) if part["type"] == "app" else part["size"]
+                ranges.append((part["offset"], length, part))
+            report(line="Reading " + ", ".join(
+                f"{p['name']} ({length // 1024} of {p['size'] // 1024} KB)" for _, length, p in ranges))
+    if cancel is not None and cancel.is_set():
+        return False, "Cancelled", 0
+
+    base = min(addr for addr, _, _ in ranges)
+    image_end = max(addr + length for addr, length, _ in ranges) if any(length for _, length, _ in ranges) else base
+    to_read = sum(length for _, length, _ in ranges)
+
+    # Read into a scratch image (unread gaps between partitions stay 0xFF, so they cost nothing in the store),
+    # then split it into the content-addressed store (only new blocks hit the disk).
+    fd, raw_path = tempfile.mkstemp(dir=backup_store.scratch_dir(), prefix="read_", suffix=".bin")
+    os.close(fd)
+    single = len(ranges) == 1
+    part_path = raw_path if single else raw_path + ".part"
+    try:
+        if not single:
+            with open(raw_path, "wb") as f:
+                gap = b"\xff" * 0x10000
+                remaining = image_end - base
+                while remaining > 0:
+                    f.write(gap[:remaining])
+                    remaining -= min(remaining, len(gap))
+        done = 0
+        for addr, length, _ in ranges:
+            if not length:
+                continue
+            before = done
+
+            def _part_progress(pct=None, status=None, **kw):
+                # Scale per-range progress to the whole backup; the final assembling/done is reported below.
+                if pct is not None:
+                    kw["pct"] = round(100 * (before + length * pct / 100) / to_read, 1)
+                if status not in ("assembling", "done"):
+                    report(**kw, **({"status": status} if status else {}))
+
+            # Chunked read: ESP32-S3 USB-Serial/JTAG drops data on long reads.
+            # Chunk size adapts to the link (see _chunked_read_flash), then chunks are concatenated.
+            ok, err = _chunked_read_flash(chip, port, addr, length, part_path, progress=_part_progress, cancel=cancel)
+            if not ok:
+                return False, err, 0
+            if not single:
+                with open(raw_path, "r+b") as f, open(part_path, "rb") as pf:
+                    f.seek(addr - base)
+                    shutil.copyfileobj(pf, f)
+            done += length
+        meta = {
+            "device_id": device_id,
+            "backup_type": backup_type,
+            "chip": chip,
+            "flash_size": flash_size,
+            "addr": base,
+        }
+        if selected is not None:
+            meta["partitions"] = [
+                {**{k: p[k] for k in ("name", "type", "subtype", "offset", "size")}, "length": length}
+                for _, length, p in ranges
+            ]
+        report(pct=100, status="assembling")
+        ok, path_or_err, stored_size = backup_store.store_image(raw_path, fname, meta=meta)
+        if not ok:
+            report(status="error", error=path_or_err)
+            return False, path_or_err, 0
+        artifact_index.record(path_or_err, source="backup")
+        report(status="done")
+        return True, path_or_err, stored_size
+    finally:
+        for path in {raw_path, part_path}:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+# Adaptive chunked reads: start at 1 MB, double after clean reads (while throughput holds), halve after a failure.
+_CHUNK_SIZE = 0x100000
+_CHUNK_MIN = 0x10000
+_CHUNK_MAX = 0x400000
+_CHUNK_GROW_AFTER = 2  # consecutive clean reads before doubling
+_CHUNK_CEILING_CLEAR = 8  # clean reads before trying a size that failed earlier in this read
+_CHUNK_RETRIES = 3  # consecutive failures at the minimum size before giving up
+_chunk_sizes_lock = threading.Lock()
+_chunk_sizes = {}  # port -> last good chunk size, so the next backup on that port starts there
+
+
+def _chunked_read_flash(chip: str, port: str, start_addr: int, total_size: int, out_path: str, progress=None, cancel=None):
+    """Read flash in chunks to avoid USB-Serial/JTAG corruption on long reads.
+    Chunk size adapts per port: doubles after clean reads (up to 4 MB) unless throughput drops, halves after a
+    failure (down to 64 KB), so a retry only re-reads a sub-range as large as the new chunk. A size that failed is
+    not tried again until 8 clean reads later; the size in use at the end is remembered for the port's next read.
+    Reports pct/chunk/total_chunks (estimated)/chunk_size/throughput/errors/status to progress, or to the global
+    backup progress so the UI can poll. Returns (success, error_message_or_None)."""
+    from port_leases import wait_port_ready
+
+    report = progress or _set_backup_progress
+    with _chunk_sizes_lock:
+        chunk_size = _chunk_sizes.get(port, _CHUNK_SIZE)
+    report(pct=0, chunk=0, total_chunks=-(-total_size // chunk_size), chunk_size=chunk_size,
+           status="reading", error=None, errors=0)
     tmp_dir = tempfile.mkdtemp(prefix="flash_chunks_")
     try:
         offset = start_addr
+        end = start_addr + total_size
         chunk_paths = []
-        remaining = total_size
         chunk_idx = 0
-        while remaining > 0:
-            chunk_size = min(_CHUNK_SIZE, remaining)
+        clean_streak = 0
+        ceiling = _CHUNK_MAX  # largest size not known to fail on this link
+        ceiling_streak = 0
+        failures_at_min = 0
+        errors = 0
+        throughput_avg = None
+        last_err = ""
+        while offset < end:
+            size = min(chunk_size, end - offset)
             chunk_file = os.path.join(tmp_dir, f"chunk_{offset:08x}.bin")
-            ok = False
-            last_err = ""
-            for attempt in range(_CHUNK_RETRIES):
-                ok, msg = _esptool(
-                    "--chip", chip, "--port", port,
-                    "read-flash", str(offset), str(chunk_size), chunk_file,
-                    timeout=180,
-                )
-                if ok and os.path.isfile(chunk_file) and os.path.getsize(chunk_file) == chunk_size:
-                    break
-                last_err = msg or "Read failed"
-                _time.sleep(2)
+            done_before = offset - start_addr
+
+            def _chunk_progress(bytes_done=None, bytes_per_sec=None, **_):
+                if bytes_done is None:
+                    return
+                overall = done_before + min(bytes_done, size)
+                report(pct=round(100 * overall / total_size, 1), bytes_done=overall, bytes_total=total_size,
+                       **({"bytes_per_sec": bytes_per_sec} if bytes_per_sec else {}))
+
+            started = _time.monotonic()
+            ok, msg = _esptool(
+                "--chip", chip, "--port", port,
+                "read-flash", str(offset), str(size), chunk_file,
+                timeout=max(60, size // 0x1800), progress=_chunk_progress, cancel=cancel, total_bytes=size,
+            )
+            ok = ok and os.path.isfile(chunk_file) and os.path.getsize(chunk_file) == size
             if not ok:
-                _set_backup_progress(status="error", error=f"Failed at 0x{offset:X}")
-                return False, last_err or f"Read failed at offset 0x{offset:X}"
+                if cancel is not None and cancel.is_set():
+                    return False, "Cancelled"
+                errors += 1
+                telemetry.note_retry()
+                last_err = msg or "Read failed"
+                if chunk_size == _CHUNK_MIN:
+                    failures_at_min += 1
+                    if failures_at_min >= _CHUNK_RETRIES:
+                        report(status="error", error=f"Failed at 0x{offset:X}", errors=errors)
+                        return False, last_err or f"Read failed at offset 0x{offset:X}"
+                chunk_size = max(_CHUNK_MIN, chunk_size // 2)
+                ceiling = chunk_size
+                clean_streak = ceiling_streak = 0
+                report(chunk_size=chunk_size, errors=errors, line=f"Read failed at 0x{offset:X}; retrying with {chunk_size // 1024} KB chunks")
+                wait_port_ready(port, timeout=2.0, cancel=cancel)
+                continue
+
+            throughput = size / max(_time.monotonic() - started, 1e-3)
             chunk_paths.append(chunk_file)
-            offset += chunk_size
-            remaining -= chunk_size
+            offset += size
             chunk_idx += 1
-            _set_backup_progress(pct=round(100 * chunk_idx / total_chunks), chunk=chunk_idx)
+            failures_at_min = 0
+            clean_streak += 1
+            ceiling_streak += 1
+            if ceiling < _CHUNK_MAX and ceiling_streak >= _CHUNK_CEILING_CLEAR:
+                ceiling = min(_CHUNK_MAX, ceiling * 2)
+                ceiling_streak = 0
+            # Grow only while throughput holds up; a drop means the link is at its limit (or a read barely made it).
+            holding = throughput_avg is None or throughput >= 0.75 * throughput_avg
+            throughput_avg = throughput if throughput_avg is None else 0.7 * throughput_avg + 0.3 * throughput
+            if clean_streak >= _CHUNK_GROW_AFTER and holding and chunk_size < ceiling:
+                chunk_size = min(ceiling, chunk_size * 2)
+                clean_streak = 0
+            report(
+                pct=round(100 * (offset - start_addr) / total_size), chunk=chunk_idx,
+                total_chunks=chunk_idx + -(-(end - offset) // chunk_size),
+                chunk_size=chunk_size, throughput=round(throughput_avg), errors=errors,
+            )
 
-        _set_backup_progress(pct=100, status="assembling")
+        with _chunk_sizes_lock:
+            _chunk_sizes[port] = chunk_size
+        report(pct=100, status="assembling")
         with open(out_path, "wb") as out_f:
             for cp in chunk_paths:
                 with open(cp, "rb") as cf:
                     shutil.copyfileobj(cf, out_f)
-        _set_backup_progress(status="done")
+        report(status="done")
         return True, None
     finally:
         shutil.rmtree(tmp_dir, ignore_errors=True)
@@ -379,8 +987,14 @@ def _write_flash_args(dev: dict):
     return args
 
 
-def restore_flash(port: str, device_id: str, bin_path: str):
-    """Write bin_path to flash at 0x0. Returns (success, message)."""
+def restore_flash(port: str, device_id: str, bin_path: str, progress=None, cancel=None, skip_unchanged: bool = False):
+    """
+    Write bin_path (raw .bin or backup manifest) to flash. Raw images go to 0x0; manifests to their recorded address.
+    Sparse (v2) full-flash backups write only the non-erased regions after a chip erase; partition backups write
+    only the partition data they hold.
+    skip_unchanged: instead compare on-chip MD5 per 64 KB region and rewrite only what differs (no chip erase), then MD5-verify.
+    progress / cancel: see _esptool. Returns (success, message).
+    """
     dev = FLASH_DEVICES.get(device_id)
     if not dev:
         return False, f"Unknown device: {device_id}"
@@ -390,17 +1004,200 @@ def restore_flash(port: str, device_id: str, bin_path: str):
         return False, f"File not found: {bin_path}"
     chip = dev["chip"]
     extra = _write_flash_args(dev)
-    ok, msg = _esptool(
-        "--chip", chip,
-        "--port", port,
-        "write-flash", *extra, "0x0", bin_path,
-        timeout=300,
-    )
+    parts = backup_store.partition_layout(bin_path)
+    if parts is not None:
+        return _restore_partitions(chip, port, extra, bin_path, *parts, progress=progress, cancel=cancel, skip_unchanged=skip_unchanged)
+    layout = backup_store.sparse_layout(bin_path)
+    try:
+        if layout is not None:
+            base, size, regions = layout
+            if not skip_unchanged and base == 0 and size == _flash_size_bytes(dev.get("flash_size", "8MB")):
+                return _restore_sparse(chip, port, extra, bin_path, regions, progress=progress, cancel=cancel)
+        addr = hex(layout[0]) if layout is not None else "0x0"
+        with backup_store.materialized(bin_path) as image_path:
+            if skip_unchanged:
+                return _flash_changed_regions(chip, port, extra, image_path, int(addr, 16), progress=progress, cancel=cancel)
+            ok, msg = _esptool(
+                "--chip", chip,
+                "--port", port,
+                "write-flash", *extra, addr, image_path,
+                timeout=300, progress=progress, cancel=cancel, total_bytes=os.path.getsize(image_path),
+            )
+    except ValueError as e:
+        return False, str(e)
+    return ok, msg
+
+
+def _restore_partitions(chip: str, port: str, extra: list, manifest_path: str, base: int, parts: list, progress=None,
+                        cancel=None, skip_unchanged: bool = False):
+    """Restore a partition backup: write back exactly the bytes read from each partition; the rest of flash is untouched."""
+    parts = [p for p in parts if p.get("length")]
+    if not parts:
+        return True, "Backup holds no partition data (all selected partitions were empty); nothing written."
+    tmp_dir = tempfile.mkdtemp(prefix="flash_parts_")
+    try:
+        files = []
+        with backup_store.materialized(manifest_path) as image_path, open(image_path, "rb") as f:
+            for p in parts:
+                path = os.path.join(tmp_dir, f"{p['offset']:08x}.bin")
+                f.seek(p["offset"] - base)
+                with open(path, "wb") as out:
+                    out.write(f.read(p["length"]))
+                files.append((p, path))
+        names = ", ".join(p["name"] for p in parts)
+        if skip_unchanged:
+            messages = []
+            for p, path in files:
+                ok, msg = _flash_changed_regions(chip, port, extra, path, p["offset"], progress=progress, cancel=cancel)
+                if not ok:
+                    return False, msg
+                messages.append(f"{p['name']}: {msg}")
+            return True, "\n".join(messages)
+        pairs = []
+        for p, path in files:
+            pairs.extend((hex(p["offset"]), path))
+        ok, msg = _esptool(
+            "--chip", chip,
+            "--port", port,
+            "write-flash", *extra, *pairs,
+            timeout=300, progress=progress, cancel=cancel, total_bytes=sum(p["length"] for p in parts),
+        )
+        if ok:
+            msg = (msg or "") + f"\nRestored partition(s) {names}."
+        return ok, msg
+    except ValueError as e:
+        return False, str(e)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def _restore_sparse(chip: str, port: str, extra: list, manifest_path: str, regions: list, progress=None, cancel=None):
+    """Full-flash restore of a sparse backup: erase the chip, then write only the non-erased regions in one esptool run."""
+    if not regions:
+        return _esptool("--chip", chip, "--port", port, "erase-flash", timeout=300, progress=progress, cancel=cancel)
+    with backup_store.materialized_regions(manifest_path) as parts:
+        pairs = []
+        for offset, part_path in parts:
+            pairs.extend((hex(offset), part_path))
+        ok, msg = _esptool(
+            "--chip", chip,
+            "--port", port,
+            "write-flash", *extra, "--erase-all", *pairs,
+            timeout=600, progress=progress, cancel=cancel,
+        )
+    if ok:
+        written = sum(r["length"] for r in regions)
+        msg = (msg or "") + f"\nRestored {len(regions)} region(s), {written} bytes written; erased areas skipped."
     return ok, msg
 
 
-def flash_firmware(port: str, device_id: str, bin_path: str, addr: str = "0x0"):
-    """Write firmware.bin to flash at addr. Returns (success, message)."""
+_DIFF_REGION_SIZE = 0x10000  # compare/write granularity for skip-unchanged writes (one 64 KB flash block)
+_VERIFY_AT_RE = re.compile(r"(?:@|bytes at) 0x([0-9a-fA-F]+)")  # v4: "... @ 0x00010000 in flash", v5: "... bytes at 0x00010000 in flash"
+
+
+def _verify_regions(chip: str, port: str, extra: list, regions: list, progress=None, cancel=None):
+    """
+    One esptool verify-flash run over regions [(addr, path)]: the stub computes each region's MD5 on-chip, nothing is read back.
+    Returns ({addr: matched}, error_or_None); the dict is None when esptool reported no per-region results (e.g. connect failure).
+    """
+    pairs = []
+    for addr, path in regions:
+        pairs.extend((hex(addr), path))
+    _, out = _esptool(
+        "--chip", chip, "--port", port,
+        "verify-flash", *extra, *pairs,
+        timeout=300, progress=progress, cancel=cancel,
+    )
+    results = {}
+    current = None
+    for line in (out or "").splitlines():
+        low = line.lower()
+        m = _VERIFY_AT_RE.search(line)
+        if m and low.lstrip().startswith("verifying"):
+            current = int(m.group(1), 16)
+        elif current is not None and ("-- verify" in low or low.lstrip().startswith("verification")):
+            # v4: "-- verify OK (digest matched)"; v5: "Verification successful (digest matched)."
+            results[current] = "verify ok" in low or "verification successful" in low
+            current = None
+    if not results:
+        return None, out or "verify-flash failed"
+    return results, None
+
+
+def _flash_changed_regions(chip: str, port: str, extra: list, image_path: str, base_addr: int, progress=None, cancel=None):
+    """
+    Skip-unchanged write of image_path at base_addr: compare on-chip MD5 per 64 KB region, write only the runs
+    that differ (one write-flash run), then MD5-verify the written runs. Returns (success, message).
+    """
+    size = os.path.getsize(image_path)
+    tmp_dir = tempfile.mkdtemp(prefix="flash_diff_")
+    try:
+        regions = []  # (addr, path, bytes)
+        with open(image_path, "rb") as f:
+            while True:
+                data = f.read(_DIFF_REGION_SIZE)
+                if not data:
+                    break
+                addr = base_addr + len(regions) * _DIFF_REGION_SIZE
+                part = os.path.join(tmp_dir, f"region_{addr:08x}.bin")
+                with open(part, "wb") as out:
+                    out.write(data)
+                regions.append((addr, part, len(data)))
+        if progress:
+            progress(stage="comparing", line=f"Comparing {len(regions)} region(s) by on-chip MD5")
+        matched, err = _verify_regions(chip, port, extra, [(a, p) for a, p, _ in regions], progress=progress, cancel=cancel)
+        if matched is None:
+            return False, err
+        dirty = [r for r in regions if not matched.get(r[0])]
+        if not dirty:
+            return True, f"Device already matches image ({len(regions)} region(s), {size} bytes); nothing written. Verified by MD5."
+
+        # Merge adjacent differing regions so each run is one write.
+        runs = []  # [addr, [paths], length]
+        for addr, part, length in dirty:
+            if runs and runs[-1][0] + runs[-1][2] == addr:
+                runs[-1][1].append(part)
+                runs[-1][2] += length
+            else:
+                runs.append([addr, [part], length])
+        pairs = []
+        run_files = []
+        for addr, parts, _ in runs:
+            run_path = os.path.join(tmp_dir, f"run_{addr:08x}.bin")
+            with open(run_path, "wb") as out:
+                for part in parts:
+                    with open(part, "rb") as pf:
+                        shutil.copyfileobj(pf, out)
+            pairs.extend((hex(addr), run_path))
+            run_files.append((addr, run_path))
+        written = sum(length for _, _, length in runs)
+        ok, msg = _esptool(
+            "--chip", chip, "--port", port,
+            "write-flash", *extra, *pairs,
+            timeout=300, progress=progress, cancel=cancel, total_bytes=written,
+        )
+        if not ok:
+            return False, msg
+
+        if progress:
+            progress(stage="verifying", line=f"Verifying {len(runs)} written run(s) by on-chip MD5")
+        verified, err = _verify_regions(chip, port, extra, run_files, progress=progress, cancel=cancel)
+        if verified is None:
+            return False, err
+        bad = [a for a, _ in run_files if not verified.get(a)]
+        if bad:
+            return False, "Verify failed (MD5 mismatch) at " + ", ".join(f"0x{a:X}" for a in bad)
+        return True, (
+            f"Wrote {len(dirty)} of {len(regions)} region(s) ({written} of {size} bytes); "
+            f"{len(regions) - len(dirty)} unchanged region(s) skipped. Verified by MD5."
+        )
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def flash_firmware(port: str, device_id: str, bin_path: str, addr: str = "0x0", progress=None, cancel=None, skip_unchanged: bool = False):
+    """Write firmware.bin (or a backup manifest) to flash at addr. progress / cancel: see _esptool.
+    skip_unchanged: write only 64 KB regions whose on-chip MD5 differs, then MD5-verify. Returns (success, message)."""
     dev = FLASH_DEVICES.get(device_id)
     if not dev:
         return False, f"Unknown device: {device_id}"
@@ -410,12 +1207,18 @@ def flash_firmware(port: str, device_id: str, bin_path: str, addr: str = "0x0"):
         return False, f"File not found: {bin_path}"
     chip = dev["chip"]
     extra = _write_flash_args(dev)
-    ok, msg = _esptool(
-        "--chip", chip,
-        "--port", port,
-        "write-flash", *extra, addr, bin_path,
-        timeout=300,
-    )
+    try:
+        with backup_store.materialized(bin_path) as image_path:
+            if skip_unchanged:
+                return _flash_changed_regions(chip, port, extra, image_path, int(addr, 0), progress=progress, cancel=cancel)
+            ok, msg = _esptool(
+                "--chip", chip,
+                "--port", port,
+                "write-flash", *extra, addr, image_path,
+                timeout=300, progress=progress, cancel=cancel, total_bytes=os.path.getsize(image_path),
+            )
+    except ValueError as e:
+        return False, str(e)
     return ok, msg
 
 
@@ -462,12 +1265,61 @@ def list_patches(device_id: str, firmware_id: str):
     return result
 
 
-def build_firmware(device_id: str, firmware_id: str, env_name: str, patch_paths=None, timeout: int = 300, clean: bool = False, verbose: bool = False):
+def _build_failure(output: str, status: str, default: str) -> str:
+    """Error message for a failed build step: the tail of its output (where compilers put the error)."""
+    if status == "timeout":
+        return "Build timed out"
+    if status == "cancelled":
+        return "Build cancelled"
+    tail = (output or "").strip()[-500:]
+    return tail or default
+
+
+def _timed_lines(timer, on_line):
+    """on_line that also feeds each build output line to a build_stats.PhaseTimer."""
+    def feed(line):
+        timer.feed(line)
+        if on_line:
+            on_line(line)
+    return feed
+
+
+def _record_footprint(meta: dict, on_line, artifact_dir: str, elf_path: str, device_id: str, firmware_id: str,
+                      env_name: str, bin_path: str | None = None, partitions_bin: str | None = None):
+    """Write footprint.json for a finished build into meta["footprint"] and the build log (see footprint)."""
+    if not os.path.isfile(elf_path):
+        meta["footprint"] = {"error": f"{os.path.basename(elf_path)} not found"}
+    else:
+        meta["footprint"] = footprint.record(
+            artifact_dir, elf_path, device_id, firmware_id, env_name, bin_path=bin_path, partitions_bin=partitions_bin,
+        )
+    if on_line:
+        on_line(footprint.describe(meta["footprint"]))
+
+
+def build_firmware(
+    device_id: str, firmware_id: str, env_name: str, patch_paths=None, timeout: int = 300, clean: bool = False,
+    verbose: bool = False, on_line=None, cancel=None, use_cache: bool = True, meta: dict | None = None,
+    jobs: int | None = None, git_ref: str | None = None,
+):
     """
     Run build for the given device/firmware. For PlatformIO: env required, pio run -e <env>, copy to artifacts.
-    For ESP-IDF (toolchain idf): run scripts/lab-build.sh; no env. Optionally apply patch_paths; if clean, run clean first.
-    Returns (ok: bool, path_or_error: str). path is relative to REPO_ROOT (artifact dir or firmware.bin).
+    For ESP-IDF (toolchain idf): run scripts/lab-build.sh; no env. With patch_paths the build runs in a git worktree
+    per (env, patch set) with the patches applied (build_worktrees); if clean, run clean first.
+    on_line: called with each line of build output as it is produced; cancel: threading.Event that kills the
+    build's process tree when set. PlatformIO builds are cached (build_cache): an earlier artifact built from the same
+    revision, changes, env, patches, flags and toolchain is returned without running pio, unless use_cache is False or
+    clean is set. meta (dict) receives cache_key and cached, ccache (compiler cache hits / misses / hit_rate for this
+    build, see compiler_cache), and for container builds runner_saved_s (startup seconds skipped by running in a warm
+    build container, see build_runner), phases ({phase: seconds}: fetch, cache, patch, clean, deps, compile, link, copy)
+    and units ([(translation unit, compile seconds)], slowest first; see build_stats), and for fresh builds footprint
+    (memory regions, app partition use, diff against the env's previous build and regressions; see footprint).
+    git_ref (tag, branch or commit) builds that ref instead of the checkout's HEAD, fetched through the shared
+    mirror (git_mirrors) in a worktree (build_worktrees), for ESP-IDF too; meta["commit"] is its commit. jobs: pio
+    run -j (default: PlatformIO's, one per core). Returns (ok: bool, path_or_error: str). path is relative to
+    REPO_ROOT (artifact dir or firmware.bin).
     """
+    meta = meta if meta is not None else {}
     if not BUILD_CONFIG or device_id not in BUILD_CONFIG or firmware_id not in BUILD_CONFIG[device_id]:
         return False, "Unknown device or firmware"
     cfg = BUILD_CONFIG[device_id][firmware_id]
@@ -480,27 +1332,60 @@ def build_firmware(device_id: str, firmware_id: str, env_name: str, patch_paths=
         script = os.path.join(REPO_ROOT, "scripts", "lab-build.sh")
         if not os.path.isfile(script):
             return False, "scripts/lab-build.sh not found"
+        project_dir = os.path.join(REPO_ROOT, path)
+        script_env = dict(os.environ)
+        worktree = None
         try:
-            r = subprocess.run(
-                [script, device_id, firmware_id, ""],
-                cwd=REPO_ROOT,
-                capture_output=True,
-                text=True,
-                timeout=timeout,
+            if git_ref:
+                # Another ref builds in a worktree (lab-build.sh LAB_BUILD_WORK_DIR); the shared checkout is never modified
+                with build_stats.phase(meta, "fetch"):
+                    ok, commit = git_mirrors.resolve(project_dir, git_ref, on_line=on_line)
+                if not ok:
+                    return False, commit
+                meta["commit"] = commit
+                with build_stats.phase(meta, "patch"):
+                    ok, dir_or_err = build_worktrees.prepare(project_dir, "idf", [], on_line=on_line, rev=commit)
+                if not ok:
+                    return False, dir_or_err
+                project_dir = worktree = dir_or_err
+                script_env["LAB_BUILD_WORK_DIR"] = worktree
+            stats_log = compiler_cache.new_stats_log()
+            timer, started_wall = build_stats.PhaseTimer(), _time.time()
+            # lab-exec.sh maps CCACHE_STATSLOG into the container; idf.py compiles through the lab-ccache volume
+            rc, output, status = _run_streaming(
+                [script, device_id, firmware_id, ""], timeout, on_line=_timed_lines(timer, on_line), cancel=cancel,
+                cwd=REPO_ROOT, env=dict(script_env, CCACHE_STATSLOG=stats_log), start_new_session=True,
             )
-            if r.returncode != 0:
-                return False, (r.stderr or r.stdout or "IDF build failed")[:500]
+            # lab-build.sh copies the artifacts itself: its tail after linking counts as link
+            timer.finish(meta.setdefault("phases", {}))
+            meta["units"] = build_stats.read_ninja_log(os.path.join(project_dir, "build"), started_wall)
+            meta["runner_saved_s"] = build_runner.saved_seconds(output)
+            meta["ccache"] = compiler_cache.read_stats(stats_log)
+            if meta["ccache"] and on_line:
+                on_line(compiler_cache.describe(meta["ccache"]))
+            if status != "ok" or rc != 0:
+                return False, _build_failure(output, status, "IDF build failed")
             # Script writes to artifacts/<device>/<firmware>/<date>/
             version = datetime.now().strftime("%Y-%m-%d")
             artifact_dir = os.path.join(ARTIFACTS_DIR, device_id, firmware_id, version)
             if os.path.isdir(artifact_dir):
+                artifact_index.record(artifact_dir, source="build")
                 fw_bin = os.path.join(artifact_dir, "firmware.bin")
+                idf_build = os.path.join(project_dir, "build")
+                elfs = sorted(glob.glob(os.path.join(idf_build, "*.elf")), key=os.path.getsize, reverse=True)
+                if elfs:
+                    _record_footprint(
+                        meta, on_line, artifact_dir, elfs[0], device_id, firmware_id, "idf",
+                        fw_bin if os.path.isfile(fw_bin) else None,
+                        os.path.join(idf_build, "partition_table", "partition-table.bin"),
+                    )
                 return True, os.path.relpath(fw_bin, REPO_ROOT) if os.path.isfile(fw_bin) else os.path.relpath(artifact_dir, REPO_ROOT)
             return True, os.path.relpath(os.path.join(ARTIFACTS_DIR, device_id, firmware_id), REPO_ROOT)
-        except subprocess.TimeoutExpired:
-            return False, "Build timed out"
         except Exception as e:
             return False, str(e)[:300]
+        finally:
+            if worktree:
+                build_worktrees.release(worktree)
 
     # PlatformIO path
     if env_name not in envs:
@@ -515,95 +1400,146 @@ def build_firmware(device_id: str, firmware_id: str, env_name: str, patch_paths=
     if not os.path.isdir(work_dir):
         return False, f"Build dir not found: {work_dir}"
     patch_paths = [p for p in (patch_paths or []) if p and isinstance(p, str)]
-    applied = False
+    for rel in patch_paths:
+        if not os.path.isfile(os.path.join(REPO_ROOT, path, rel)):
+            return False, f"Patch not found: {rel}"
+    commit = None
+    if git_ref:
+        with build_stats.phase(meta, "fetch"):
+            ok, commit = git_mirrors.resolve(work_dir, git_ref, on_line=on_line)
+        if not ok:
+            return False, commit
+        meta["commit"] = commit
+    with build_stats.phase(meta, "cache"):
+        cache_key, cache_inputs = build_cache.compute_key(
+            work_dir, env_name, [os.path.join(REPO_ROOT, path, rel) for rel in patch_paths], source_dir=repo_dir, rev=commit,
+        )
+        hit = artifact_index.find_by_cache_key(cache_key) if cache_key and use_cache and not clean else None
+        remote = build_cache.built_by_worker(os.path.join(REPO_ROOT, hit)) if hit and not BUILD_WORKER_TOKEN else None
+        if remote:
+            # Uploaded by a remote worker, and workers are not authenticated now: never hand it out (or to flash_after)
+            if on_line:
+                on_line(f"Ignoring cached build from remote worker {remote} (BUILD_WORKER_TOKEN not set)")
+            hit = None
+    meta.update(cache_key=cache_key, cached=False)
+    if hit:
+        meta["cached"] = True
+        if on_line:
+            on_line(f"Build cache hit ({cache_key[:12]}): {hit}")
+        return True, hit
+    if on_line:
+        on_line(f"Build cache miss ({cache_key[:12]})" if cache_key else f"Build cache off: {cache_inputs}")
+    started = _time.monotonic()
+    worktree = None
     try:
-        if patch_paths:
-            # Reset work tree so we apply only the selected patches
-            r = subprocess.run(
-                ["git", "checkout", "-f", "."],
-                cwd=work_dir,
-                capture_output=True,
-                text=True,
-                timeout=30,
-            )
-            if r.returncode != 0:
-                return False, (r.stderr or r.stdout or "git checkout failed")[:300]
-            for rel in patch_paths:
-                # Patch file is at repo_dir/rel; we apply from work_dir with -p1
-                patch_abs = os.path.join(REPO_ROOT, path, rel)
-                if not os.path.isfile(patch_abs):
-                    return False, f"Patch not found: {rel}"
-                with open(patch_abs, "rb") as f:
-                    r = subprocess.run(
-                        ["git", "apply", "-p1", "--verbose"],
-                        cwd=work_dir,
-                        stdin=f,
-                        capture_output=True,
-                        text=True,
-                        timeout=30,
-                    )
-                if r.returncode != 0:
-                    return False, f"Patch {rel} failed: {(r.stderr or r.stdout or '')[:300]}"
-            applied = True
+        if patch_paths or commit:
+            # Patched builds and builds of another ref run in their own worktree per (env, patch set); the shared
+            # checkout is never modified
+            with build_stats.phase(meta, "patch"):
+                ok, dir_or_err = build_worktrees.prepare(
+                    work_dir, env_name, [os.path.join(REPO_ROOT, path, rel) for rel in patch_paths], on_line=on_line,
+                    rev=commit,
+                )
+            if not ok:
+                return False, dir_or_err
+            work_dir = worktree = dir_or_err
         # Optional: clean before build
         if clean:
-            for cmd in ("pio", "platformio"):
-                try:
-                    subprocess.run(
-                        [cmd, "run", "-t", "clean", "-e", env_name],
-                        cwd=work_dir,
-                        capture_output=True,
-                        text=True,
-                        timeout=120,
-                    )
-                    break
-                except FileNotFoundError:
-                    continue
+            with build_stats.phase(meta, "clean"):
+                for cmd in ("pio", "platformio"):
+                    try:
+                        _run_streaming(
+                            [cmd, "run", "-t", "clean", "-e", env_name], 120, on_line=on_line, cancel=cancel,
+                            cwd=work_dir, start_new_session=True,
+                        )
+                        break
+                    except FileNotFoundError:
+                        continue
+            if cancel is not None and cancel.is_set():
+                return False, "Build cancelled"
         # PlatformIO output: .pio/build/<env>/firmware.bin (env name as-is, e.g. tbeam-1w)
         pio_build_dir = os.path.join(work_dir, ".pio", "build", env_name)
         bin_name = "firmware.bin"
         out_bin = os.path.join(pio_build_dir, bin_name)
+        stats_log, unit_log = compiler_cache.new_stats_log(), build_stats.new_unit_log()
+        pio_env = build_stats.pio_env(unit_log, compiler_cache.pio_env(stats_log))
         for cmd in ("pio", "platformio"):
             try:
-                r = subprocess.run(
-                    [cmd, "run", "-e", env_name] + (["-v"] if verbose else []),
-                    cwd=work_dir,
-                    capture_output=True,
-                    text=True,
-                    timeout=timeout,
+                timer = build_stats.PhaseTimer()
+                rc, output, status = _run_streaming(
+                    [cmd, "run", "-e", env_name] + (["-j", str(jobs)] if jobs else []) + (["-v"] if verbose else []),
+                    timeout, on_line=_timed_lines(timer, on_line), cancel=cancel,
+                    cwd=work_dir, env=pio_env, start_new_session=True,
                 )
-                if r.returncode != 0:
-                    if applied:
-                        subprocess.run(["git", "checkout", "-f", "."], cwd=work_dir, capture_output=True, timeout=10)
-                    return False, (r.stderr or r.stdout or "Build failed")[:500]
+                timer.finish(meta.setdefault("phases", {}))
+                meta["units"] = build_stats.read_unit_log(unit_log)
+                if pio_env and pio_env.get("CCACHE_STATSLOG"):
+                    meta["ccache"] = compiler_cache.read_stats(stats_log)
+                    if on_line:
+                        on_line(compiler_cache.describe(meta["ccache"]))
+                if status != "ok" or rc != 0:
+                    return False, _build_failure(output, status, "Build failed")
                 if not os.path.isfile(out_bin):
-                    if applied:
-                        subprocess.run(["git", "checkout", "-f", "."], cwd=work_dir, capture_output=True, timeout=10)
                     return False, f"Build succeeded but {bin_name} not found in .pio/build/{env_name}"
                 break
             except FileNotFoundError:
                 continue
-            except subprocess.TimeoutExpired:
-                if applied:
-                    subprocess.run(["git", "checkout", "-f", "."], cwd=work_dir, capture_output=True, timeout=10)
-                return False, "Build timed out"
             except Exception as e:
-                if applied:
-                    subprocess.run(["git", "checkout", "-f", "."], cwd=work_dir, capture_output=True, timeout=10)
                 return False, str(e)[:300]
         else:
             return False, "PlatformIO not found (pip install platformio)"
-        # Copy to artifacts/<device_id>/<firmware_id>/build_<env>_<timestamp>/
-        ts = datetime.now().strftime("%Y%m%d_%H%M%S")
-        safe_env = re.sub(r"[^\w\-]", "_", env_name)
-        artifact_subdir = os.path.join(ARTIFACTS_DIR, device_id, firmware_id, f"build_{safe_env}_{ts}")
-        os.makedirs(artifact_subdir, exist_ok=True)
-        dest = os.path.join(artifact_subdir, bin_name)
-        shutil.copy2(out_bin, dest)
+        # Copy to artifacts/<device_id>/<firmware_id>/build_<env>_<timestamp>_<suffix>/
+        with build_stats.phase(meta, "copy"):
+            artifact_subdir = artifact_index.new_build_dir(device_id, firmware_id, env_name)
+            dest = os.path.join(artifact_subdir, bin_name)
+            shutil.copy2(out_bin, dest)
+            if cache_key:
+                build_cache.write_manifest(
+                    artifact_subdir, cache_key, cache_inputs, bin_name, device_id, firmware_id, _time.monotonic() - started,
+                )
+            artifact_index.record(dest, source="build", build_env=env_name)
+        partitions_bin = os.path.join(pio_build_dir, "partitions.bin")
+        _record_footprint(
+            meta, on_line, artifact_subdir, os.path.join(pio_build_dir, "firmware.elf"), device_id, firmware_id, env_name,
+            dest, partitions_bin if os.path.isfile(partitions_bin) else None,
+        )
         return True, os.path.relpath(dest, REPO_ROOT)
     finally:
-        if applied:
-            subprocess.run(["git", "checkout", "-f", "."], cwd=work_dir, capture_output=True, timeout=10)
+        if worktree:
+            build_worktrees.release(worktree)
+
+
+def install_build_packages(device_id: str, firmware_id: str, env_names, on_line=None, cancel=None, timeout: int = 1800):
+    """
+    Install the platforms, toolchains and libraries of several envs of one PlatformIO project in one
+    pio pkg install run, so builds of those envs started afterwards in parallel neither download them again nor
+    race each other installing them. ESP-IDF projects have nothing to install. Returns (ok, message).
+    """
+    cfg = ((BUILD_CONFIG or {}).get(device_id) or {}).get(firmware_id)
+    if not cfg:
+        return False, "Unknown device or firmware"
+    if (cfg.get("toolchain") or "platformio") == "idf":
+        return True, "Nothing to install (ESP-IDF)"
+    work_dir = os.path.join(REPO_ROOT, (cfg.get("path") or "").strip())
+    if cfg.get("build_subdir"):
+        work_dir = os.path.join(work_dir, cfg["build_subdir"].strip("/"))
+    if not os.path.isdir(work_dir):
+        return False, f"Build dir not found: {work_dir}"
+    env_args = []
+    for env in env_names or []:
+        env_args += ["-e", env]
+    for cmd in ("pio", "platformio"):
+        try:
+            rc, output, status = _run_streaming(
+                [cmd, "pkg", "install"] + env_args, timeout, on_line=on_line, cancel=cancel,
+                cwd=work_dir, start_new_session=True,
+            )
+        except FileNotFoundError:
+            continue
+        if status != "ok" or rc != 0:
+            return False, _build_failure(output, status, "pio pkg install failed")
+        return True, f"Packages installed for {len(env_names or [])} env(s)"
+    return False, "PlatformIO not found (pip install platformio)"
 
 
 def download_release_firmware(
@@ -655,79 +1591,32 @@ def download_release_firmware(
         return False, str(e)[:300]
     if not os.path.isfile(dest_path):
         return False, "Download failed"
+    artifact_index.record(dest_path, source="ota", version=release_tag or None)
     return True, os.path.relpath(dest_path, REPO_ROOT)
 
 
-def list_artifacts_and_backups(firmware_filter=None):
-    """Return list of { path, name, type: artifact|backup, device?, firmware?, size }.
+def list_artifacts_and_backups(firmware_filter=None, **filters):
+    """Return list of { path, name, type: artifact|backup, device?, firmware?, size, sha256, source, version?, build_env?,
+    created_at } from the artifact index, newest first.
     firmware_filter: if set (meshtastic|meshcore|launcher), only include artifacts under that firmware folder.
-    Backups are always included (no firmware filter)."""
-    results = []
+    Backups are always included (no firmware filter). filters: kind, device, source, q, sort, descending, limit
+    (artifact_index.list_artifacts)."""
     fw_filter = (firmware_filter or "").strip().lower()
     if fw_filter and fw_filter not in FIRMWARE_TARGETS:
         fw_filter = ""
-    # Artifacts: artifacts/<device>/<firmware>/...
-    if os.path.isdir(ARTIFACTS_DIR):
-        for dev in os.listdir(ARTIFACTS_DIR):
-            dev_path = os.path.join(ARTIFACTS_DIR, dev)
-            if dev == "backups" or not os.path.isdir(dev_path):
-                continue
-            for fw in os.listdir(dev_path):
-                fw_path = os.path.join(dev_path, fw)
-                if not os.path.isdir(fw_path):
-                    continue
-                if fw_filter and fw.lower() != fw_filter:
-                    continue
-                for name in os.listdir(fw_path):
-                    full = os.path.join(fw_path, name)
-                    if os.path.isdir(full):
-                        for f in os.listdir(full):
-                            if f.endswith(".bin") and f not in _FLASH_EXCLUDE_BIN:
-                                p = os.path.join(full, f)
-                                results.append({
-                                    "path": os.path.relpath(p, REPO_ROOT),
-                                    "name": f"{dev}/{fw}/{name}/{f}",
-                                    "type": "artifact",
-                                    "device": dev,
-                                    "firmware": fw,
-                                    "size": os.path.getsize(p) if os.path.isfile(p) else 0,
-                                })
-                    elif name.endswith(".bin") and name not in _FLASH_EXCLUDE_BIN:
-                        results.append({
-                            "path": os.path.relpath(full, REPO_ROOT),
-                            "name": f"{dev}/{fw}/{name}",
-                            "type": "artifact",
-                            "device": dev,
-                            "firmware": fw,
-                            "size": os.path.getsize(full) if os.path.isfile(full) else 0,
-                        })
-    # Backups
-    if os.path.isdir(BACKUPS_DIR):
-        for name in os.listdir(BACKUPS_DIR):
-            if not name.endswith(".bin"):
-                continue
-            full = os.path.join(BACKUPS_DIR, name)
-            if os.path.isfile(full):
-                results.append({
-                    "path": os.path.relpath(full, REPO_ROOT),
-                    "name": name,
-                    "type": "backup",
-                    "device": None,
-                    "size": os.path.getsize(full),
-                })
-    return results
+    return artifact_index.list_artifacts(firmware=fw_filter or None, **filters)
 
 
 def delete_artifact_or_backup(rel_path: str):
     """
-    Delete a backup or artifact .bin file. rel_path is relative to REPO_ROOT (e.g. from list_artifacts_and_backups).
+    Delete a backup (manifest or .bin) or artifact .bin file. rel_path is relative to REPO_ROOT (e.g. from list_artifacts_and_backups).
     Returns (success, error_message).
     """
     if not rel_path or not rel_path.strip():
         return False, "Path required"
     rel_path = rel_path.strip().lstrip("/")
-    if not rel_path.lower().endswith(".bin"):
-        return False, "Only .bin files under artifacts can be deleted"
+    if not rel_path.lower().endswith(".bin") and not backup_store.is_manifest(rel_path):
+        return False, "Only .bin files or backup manifests under artifacts can be deleted"
     full = os.path.normpath(os.path.join(REPO_ROOT, rel_path))
     try:
         full = os.path.realpath(full)
@@ -738,8 +1627,14 @@ def delete_artifact_or_backup(rel_path: str):
         return False, "Path must be under artifacts"
     if not os.path.isfile(full):
         return False, "File not found"
+    if os.path.dirname(full) == os.path.realpath(BACKUPS_DIR):
+        ok, err = backup_store.delete_backup(full)
+        if ok:
+            artifact_index.forget(os.path.normpath(rel_path))
+        return ok, err
     try:
         os.remove(full)
+        artifact_index.forget(os.path.normpath(rel_path))
         return True, None
     except OSError as e:
         return False, str(e)
@@ -0,0 +1,151 @@
+"""
+Fleet flashing: write one artifact to many ESP32 boards at once (field deployments).
+Each port gets its own flash job (see flash_jobs); concurrency is additionally bounded per USB hub because
+hubs share one upstream link and bus-powered hubs brown out when every board draws write current at once.
+"""
+import threading
+import time
+import uuid
+
+import artifact_index
+import backup_store
+from config import FLEET_MAX_PER_HUB
+from flash_jobs import get_job, submit_job, wait_job
+from flash_ops import list_serial_ports, list_serial_ports_with_detection
+
+_fleets_lock = threading.Lock()
+_fleets = {}  # fleet_id -> { id, device_id, path, addr, status, created_at, devices: { port: {...} } }
+_FLEETS_KEEP = 20
+
+
+def usb_hub_of(location: str) -> str:
+    """Hub key from a pyserial USB location ('1-1.2:1.0' -> '1-1'). Ports without location share one 'unknown' hub."""
+    if not location:
+        return "unknown"
+    path = location.split(":")[0]
+    if "." in path:
+        return path.rsplit(".", 1)[0]
+    return path.rsplit("-", 1)[0] if "-" in path else path
+
+
+def resolve_fleet_ports(ports=None, chip: str | None = None):
+    """
+    Resolve the target port list: explicit ports, or every detected port whose chip matches chip.
+    Returns (list of { port, location, chip? }, error_or_None).
+    """
+    if ports:
+        known = {p["port"]: p for p in list_serial_ports()}
+        return [{"port": p, "location": (known.get(p) or {}).get("location")} for p in ports], None
+    if not chip:
+        return [], "ports or chip required"
+    detected = list_serial_ports_with_detection()
+    matched = [{"port": p["port"], "location": p.get("location"), "chip": p["chip"]} for p in detected if p.get("chip") == chip.lower()]
+    if not matched:
+        return [], f"No detected ports with chip {chip}"
+    return matched, None
+
+
+def _run_fleet(fleet_id: str, targets: list, device_id: str, bin_path: str, addr: str, max_per_hub: int, skip_unchanged: bool):
+    hub_sems = {}
+    for t in targets:
+        hub_sems.setdefault(usb_hub_of(t.get("location")), threading.Semaphore(max_per_hub))
+    try:
+        # Reassemble a backup manifest once, not once per board
+        with backup_store.materialized(bin_path) as image_path:
+            job_ids = {}
+            for t in targets:
+                job_ids[t["port"]] = submit_job(
+                    "flash", t["port"], device_id, {"bin_path": image_path, "addr": addr, "skip_unchanged": skip_unchanged},
+                    gate=hub_sems[usb_hub_of(t.get("location"))],
+                )
+            with _fleets_lock:
+                for port, job_id in job_ids.items():
+                    _fleets[fleet_id]["devices"][port]["job_id"] = job_id
+            for job_id in job_ids.values():
+                wait_job(job_id)
+        # Jobs flashed a reassembled temp copy of a backup manifest; credit the manifest itself
+        if any((get_job(j, log_lines=0) or {}).get("status") == "done" for j in job_ids.values()):
+            artifact_index.note_flashed(bin_path)
+        status = "done"
+    except Exception as e:
+        status = "error"
+        with _fleets_lock:
+            _fleets[fleet_id]["error"] = str(e)[:300]
+    with _fleets_lock:
+        _fleets[fleet_id]["status"] = status
+        _fleets[fleet_id]["finished_at"] = time.time()
+
+
+def start_fleet_flash(targets: list, device_id: str, bin_path: str, addr: str = "0x0", max_per_hub: int | None = None, skip_unchanged: bool = False):
+    """
+    Start flashing bin_path to every target port in the background. targets: from resolve_fleet_ports.
+    skip_unchanged: boards that already hold the image (e.g. a retried run) only get an MD5 compare.
+    Returns fleet_id; poll get_fleet(fleet_id) for per-device status.
+    """
+    max_per_hub = max(1, int(max_per_hub or FLEET_MAX_PER_HUB))
+    fleet_id = uuid.uuid4().hex[:12]
+    with _fleets_lock:
+        if len(_fleets) >= _FLEETS_KEEP:
+            finished = sorted((f for f in _fleets.values() if f["status"] != "running"), key=lambda f: f["created_at"])
+            for f in finished[: len(_fleets) - _FLEETS_KEEP + 1]:
+                _fleets.pop(f["id"], None)
+        _fleets[fleet_id] = {
+            "id": fleet_id,
+            "device_id": device_id,
+            "path": bin_path,
+            "addr": addr,
+            "max_per_hub": max_per_hub,
+            "skip_unchanged": skip_unchanged,
+            "status": "running",
+            "created_at": time.time(),
+            "devices": {
+                t["port"]: {"port": t["port"], "hub": usb_hub_of(t.get("location")), "status": "queued"}
+                for t in targets
+            },
+        }
+    threading.Thread(
+        target=_run_fleet,
+        args=(fleet_id, targets, device_id, bin_path, addr, max_per_hub, skip_unchanged),
+        daemon=True,
+    ).start()
+    return fleet_id
+
+
+def _device_status(device: dict) -> dict:
+    """Merge the device's flash job (status, progress, error, duration) into its fleet entry."""
+    job = get_job(device["job_id"], log_lines=0) if device.get("job_id") else None
+    if not job:
+        return device
+    status = {"waiting_gate": "waiting_hub", "waiting_port": "waiting_hub", "running": "flashing"}.get(job["status"], job["status"])
+    out = dict(device, status=status, progress=job["progress"], error=job["error"])
+    if job["started_at"]:
+        out["duration_s"] = round((job["finished_at"] or time.time()) - job["started_at"], 1)
+    return out
+
+
+def get_fleet(fleet_id: str):
+    """Snapshot of a fleet run with per-device status and a summary, or None."""
+    with _fleets_lock:
+        fleet = _fleets.get(fleet_id)
+        if not fleet:
+            return None
+        out = dict(fleet)
+        devices = [dict(d) for d in fleet["devices"].values()]
+    out["devices"] = [_device_status(d) for d in devices]
+    counts = {}
+    for d in out["devices"]:
+        counts[d["status"]] = counts.get(d["status"], 0) + 1
+    out["summary"] = counts
+    if out["status"] == "done" and any(d["status"] != "done" for d in out["devices"]):
+        out["status"] = "error"
+    return out
+
+
+def list_fleets():
+    """Recent fleet runs (newest first) without per-device detail."""
+    with _fleets_lock:
+        fleets = [
+            {k: v for k, v in f.items() if k != "devices"} | {"device_count": len(f["devices"])}
+            for f in _fleets.values()
+        ]
+    return sorted(fleets, key=lambda f: f["created_at"], reverse=True)
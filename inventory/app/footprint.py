@@ -0,0 +1,270 @@
+"""
+Firmware footprint: memory use of each build from its ELF (.pio/build/<env>/firmware.elf, or the ESP-IDF project
+ELF) without a toolchain: section sizes summed into regions (flash, IRAM, DRAM, PSRAM, RTC) by the ESP-IDF linker
+section names (generic rules for other targets), the largest symbols, and the image size against the app partition
+from the build's partitions.bin. build_firmware writes it to footprint.json next to the artifact, diffed against
+the previous footprint of the same device / firmware / env; growth above FOOTPRINT_REGRESSION_PCT or
+FOOTPRINT_REGRESSION_BYTES, or an image filling more than FOOTPRINT_PARTITION_WARN_PCT of its partition, is
+flagged as a regression.
+"""
+import json
+import os
+import struct
+from datetime import datetime
+
+import partitions
+from config import (
+    ARTIFACTS_DIR, FOOTPRINT_PARTITION_WARN_PCT, FOOTPRINT_REGRESSION_BYTES, FOOTPRINT_REGRESSION_PCT, REPO_ROOT,
+)
+
+FOOTPRINT_NAME = "footprint.json"
+REGIONS = ("flash", "iram", "dram", "psram", "rtc")
+_SYMBOLS_KEEP = 1000  # largest symbols stored per build (for symbol diffs)
+_SYMBOLS_SHOWN = 10
+# ESP-IDF linker output sections by prefix, most specific first
+_SECTION_REGIONS = (
+    (".ext_ram", "psram"),
+    (".rtc", "rtc"),
+    (".iram", "iram"),
+    (".dram", "dram"),
+    (".noinit", "dram"),
+    (".flash", "flash"),
+)
+_SHT_SYMTAB, _SHT_NOBITS = 2, 8
+_SHF_WRITE, _SHF_ALLOC, _SHF_EXECINSTR = 0x1, 0x2, 0x4
+_STT_OBJECT, _STT_FUNC = 1, 2
+
+
+def _read_elf(path: str):
+    """(sections, symbols) of an ELF file: [{name, type, flags, size}], [{name, size, shndx, kind}]. Raises ValueError."""
+    with open(path, "rb") as f:
+        data = f.read()
+    if data[:4] != b"\x7fELF":
+        raise ValueError("not an ELF file")
+    is64, endian = data[4] == 2, "<" if data[5] == 1 else ">"
+    if is64:
+        shoff, = struct.unpack_from(endian + "Q", data, 0x28)
+        shentsize, shnum, shstrndx = struct.unpack_from(endian + "HHH", data, 0x3A)
+        sh_fmt, sym_fmt = endian + "IIQQQQIIQQ", endian + "IBBHQQ"
+    else:
+        shoff, = struct.unpack_from(endian + "I", data, 0x20)
+        shentsize, shnum, shstrndx = struct.unpack_from(endian + "HHH", data, 0x2E)
+        sh_fmt, sym_fmt = endian + "IIIIIIIIII", endian + "IIIBBH"
+    headers = [struct.unpack_from(sh_fmt, data, shoff + i * shentsize) for i in range(shnum)]
+
+    def c_string(table_offset, index):
+        end = data.index(b"\0", table_offset + index)
+        return data[table_offset + index:end].decode("utf-8", errors="replace")
+
+    names_offset = headers[shstrndx][4] if shstrndx < shnum else None
+    sections, symbols = [], []
+    for h in headers:
+        # (name, type, flags, addr, offset, size, link, info, addralign, entsize) in both layouts
+        sections.append({
+            "name": c_string(names_offset, h[0]) if names_offset is not None else "",
+            "type": h[1], "flags": h[2], "size": h[5], "offset": h[4], "link": h[6], "entsize": h[9],
+        })
+    for sec in sections:
+        if sec["type"] != _SHT_SYMTAB or not sec["entsize"]:
+            continue
+        strtab = sections[sec["link"]]["offset"]
+        for pos in range(sec["offset"], sec["offset"] + sec["size"], sec["entsize"]):
+            if is64:
+                name, info, _, shndx, _, size = struct.unpack_from(sym_fmt, data, pos)
+            else:
+                name, _, size, info, _, shndx = struct.unpack_from(sym_fmt, data, pos)
+            kind = info & 0xF
+            if size and kind in (_STT_OBJECT, _STT_FUNC) and 0 < shndx < len(sections):
+                symbols.append({"name": c_string(strtab, name), "size": size, "shndx": shndx,
+                                "kind": "func" if kind == _STT_FUNC else "object"})
+    return sections, symbols
+
+
+def _regions_of(section: dict):
+    """Regions a section occupies: ESP-IDF sections by name; otherwise code / read-only data in flash,
+    writable data in RAM (initialised data also in flash, where its load image lives)."""
+    if not section["flags"] & _SHF_ALLOC or not section["size"]:
+        return ()
+    for prefix, region in _SECTION_REGIONS:
+        if section["name"].startswith(prefix):
+            # NOBITS placeholders in flash (e.g. .flash_rodata_dummy) reserve address space, not image bytes
+            return () if region == "flash" and section["type"] == _SHT_NOBITS else (region,)
+    if not section["flags"] & _SHF_WRITE:
+        return ("flash",)
+    return ("dram",) if section["type"] == _SHT_NOBITS else ("dram", "flash")
+
+
+def _app_partition_size(partitions_bin: str):
+    """Size of the largest app partition in a partitions.bin (the slot the image must fit), or None."""
+    try:
+        with open(partitions_bin, "rb") as f:
+            table = partitions.parse_partition_table(f.read())
+    except OSError:
+        return None
+    apps = [p["size"] for p in table or [] if p["type"] == "app"]
+    return max(apps) if apps else None
+
+
+def compute(elf_path: str, bin_path: str | None = None, partitions_bin: str | None = None) -> dict:
+    """Footprint of one build: regions, sections, symbols (largest first), bin_size, app_partition_size, app_partition_pct."""
+    sections, symbols = _read_elf(elf_path)
+    regions = dict.fromkeys(REGIONS, 0)
+    section_rows = []
+    for sec in sections:
+        where = _regions_of(sec)
+        for region in where:
+            regions[region] += sec["size"]
+        if where:
+            section_rows.append({"name": sec["name"], "size": sec["size"], "region": where[0]})
+    for sym in symbols:
+        where = _regions_of(sections[sym["shndx"]])
+        sym["region"] = where[0] if where else None
+        del sym["shndx"]
+    symbols.sort(key=lambda s: -s["size"])
+    bin_size = os.path.getsize(bin_path) if bin_path and os.path.isfile(bin_path) else None
+    app_size = _app_partition_size(partitions_bin) if partitions_bin else None
+    return {
+        "elf": os.path.relpath(elf_path, REPO_ROOT),
+        "regions": regions,
+        "sections": sorted(section_rows, key=lambda s: -s["size"]),
+        "symbols": symbols[:_SYMBOLS_KEEP],
+        "bin_size": bin_size,
+        "app_partition_size": app_size,
+        "app_partition_pct": round(100 * bin_size / app_size, 1) if bin_size and app_size else None,
+    }
+
+
+def _load(path: str):
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def previous(artifact_dir: str, device_id: str, firmware_id: str, env_name: str):
+    """Latest earlier footprint of the same device / firmware / env among the firmware's artifact dirs, or None."""
+    root = os.path.join(ARTIFACTS_DIR, device_id, firmware_id)
+    best = None
+    try:
+        entries = list(os.scandir(root))
+    except OSError:
+        return None
+    for entry in entries:
+        if not entry.is_dir() or os.path.realpath(entry.path) == os.path.realpath(artifact_dir):
+            continue
+        fp = _load(os.path.join(entry.path, FOOTPRINT_NAME))
+        if fp and fp.get("env_name") == env_name and (best is None or fp.get("built_at", "") > best.get("built_at", "")):
+            best = fp
+    return best
+
+
+def diff(old: dict, new: dict) -> dict:
+    """
+    Change from old to new: per region and bin_size {old, new, delta, pct}, the symbols that grew most
+    (new symbols count from 0) and regressions: [{what, delta, pct, reason}].
+    """
+    out, regressions = {"against": old.get("artifact"), "regions": {}, "symbols": []}, []
+    rows = [(r, (old.get("regions") or {}).get(r, 0), new["regions"].get(r, 0)) for r in REGIONS]
+    rows.append(("bin", old.get("bin_size"), new.get("bin_size")))
+    for what, before, after in rows:
+        if before is None or after is None or (not before and not after):
+            continue
+        delta = after - before
+        pct = round(100 * delta / before, 2) if before else None
+        out["regions"][what] = {"old": before, "new": after, "delta": delta, "pct": pct}
+        if delta > 0 and (delta >= FOOTPRINT_REGRESSION_BYTES or (pct is not None and pct >= FOOTPRINT_REGRESSION_PCT)):
+            regressions.append({"what": what, "delta": delta, "pct": pct, "reason": "growth"})
+    old_symbols = {s["name"]: s["size"] for s in old.get("symbols") or []}
+    grown = []
+    for s in new.get("symbols") or []:
+        delta = s["size"] - old_symbols.get(s["name"], 0)
+        if delta > 0:
+            grown.append({"name": s["name"], "region": s["region"], "old": old_symbols.get(s["name"]), "new": s["size"], "delta": delta})
+    out["symbols"] = sorted(grown, key=lambda s: -s["delta"])[:_SYMBOLS_SHOWN]
+    out["regressions"] = regressions
+    return out
+
+
+def record(artifact_dir: str, elf_path: str, device_id: str, firmware_id: str, env_name: str, bin_path: str | None = None,
+           partitions_bin: str | None = None):
+    """
+    Compute the footprint of a finished build, diff it against the previous build of the same env and write
+    footprint.json into artifact_dir. Returns the summary (regions, bin_size, app_partition_pct, diff, regressions)
+    ({"error": ...} when the ELF cannot be read).
+    """
+    try:
+        fp = compute(elf_path, bin_path, partitions_bin)
+    except (OSError, ValueError, struct.error, IndexError) as e:
+        return {"error": f"ELF not readable: {str(e)[:200]}"}
+    fp.update(
+        device_id=device_id, firmware_id=firmware_id, env_name=env_name,
+        artifact=os.path.relpath(artifact_dir, REPO_ROOT), built_at=datetime.now().isoformat(timespec="seconds"),
+    )
+    prev = previous(artifact_dir, device_id, firmware_id, env_name)
+    fp["diff"] = diff(prev, fp) if prev else None
+    regressions = list(fp["diff"]["regressions"]) if fp["diff"] else []
+    if fp["app_partition_pct"] is not None and fp["app_partition_pct"] >= FOOTPRINT_PARTITION_WARN_PCT:
+        regressions.append({"what": "app_partition", "delta": None, "pct": fp["app_partition_pct"], "reason": "headroom"})
+    fp["regressions"] = regressions
+    try:
+        with open(os.path.join(artifact_dir, FOOTPRINT_NAME), "w", encoding="utf-8") as f:
+            json.dump(fp, f, indent=2)
+    except OSError:
+        pass
+    return summary(fp)
+
+
+def summary(fp: dict) -> dict:
+    """Footprint without the per-section and per-symbol lists (what build results and history carry)."""
+    out = {k: v for k, v in fp.items() if k not in ("sections", "symbols", "diff")}
+    if fp.get("diff"):
+        out["diff"] = {"against": fp["diff"]["against"], "regions": fp["diff"]["regions"], "symbols": fp["diff"]["symbols"]}
+    return out
+
+
+def describe(fp: dict) -> str:
+    """One-line summary for build logs."""
+    if not fp or fp.get("error"):
+        return f"Footprint: {(fp or {}).get('error') or 'not available'}"
+    deltas = (fp.get("diff") or {}).get("regions") or {}
+    parts = []
+    for region in REGIONS:
+        size = fp["regions"].get(region)
+        if size:
+            delta = deltas.get(region, {}).get("delta")
+            parts.append(f"{region} {size}" + (f" ({delta:+d})" if delta else ""))
+    line = "Footprint: " + ", ".join(parts)
+    if fp.get("app_partition_pct") is not None:
+        line += f"; image {fp['app_partition_pct']}% of app partition"
+    for r in fp.get("regressions") or []:
+        line += f"; REGRESSION {r['what']}" + (f" +{r['delta']} bytes" if r["delta"] else "") + (f" ({r['pct']}%)" if r["pct"] is not None else "")
+    return line
+
+
+def get(path: str):
+    """Full footprint.json for an artifact (dir or a file in it, relative to REPO_ROOT), or None."""
+    abs_path = os.path.realpath(os.path.join(REPO_ROOT, path))
+    if not abs_path.startswith(os.path.realpath(ARTIFACTS_DIR) + os.sep):
+        return None
+    if not os.path.isdir(abs_path):
+        abs_path = os.path.dirname(abs_path)
+    return _load(os.path.join(abs_path, FOOTPRINT_NAME))
+
+
+def history(device_id: str, firmware_id: str, env_name: str | None = None, limit: int = 50) -> list:
+    """Footprint summaries of a firmware's builds (optionally one env), newest first."""
+    root = os.path.realpath(os.path.join(ARTIFACTS_DIR, device_id, firmware_id))
+    out = []
+    if not root.startswith(os.path.realpath(ARTIFACTS_DIR) + os.sep):
+        return out
+    try:
+        entries = list(os.scandir(root))
+    except OSError:
+        return out
+    for entry in entries:
+        fp = _load(os.path.join(entry.path, FOOTPRINT_NAME)) if entry.is_dir() else None
+        if fp and (not env_name or fp.get("env_name") == env_name):
+            out.append(summary(fp))
+    out.sort(key=lambda fp: fp.get("built_at") or "", reverse=True)
+    return out[:limit]
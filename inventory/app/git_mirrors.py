@@ -0,0 +1,386 @@
+"""
+Shared bare-mirror cache for firmware source repos. Every upstream (meshtastic/firmware, meshcore-dev/MeshCore, their
+submodules) gets one `git clone --mirror` under GIT_MIRRORS_DIR, however many devices build it. Device checkouts
+borrow the mirror's objects (objects/info/alternates, as a relative path so the link also holds inside lab containers)
+and fetch refs from it locally, so setting up a new firmware tree or building another tag takes seconds instead of a
+clone. All network traffic goes through one background updater thread: mirrors are cloned on first use, refreshed
+every GIT_MIRROR_FETCH_INTERVAL seconds, and on demand when a ref is not in the mirror yet.
+Mirrors never prune objects (gc.pruneExpire=never): checkouts borrowing from them may still need commits that
+upstream has since dropped. Do not delete a mirror while checkouts borrow from it.
+"""
+import json
+import os
+import re
+import shutil
+import subprocess
+import threading
+import time
+
+from config import BUILD_CONFIG, GIT_MIRROR_FETCH_INTERVAL, GIT_MIRRORS_DIR, REPO_ROOT
+
+_STATE_SUFFIX = ".json"  # <mirror>.git.json: url, last_fetch, fetch_s, ok, error
+_CLONE_TIMEOUT = 3600
+_URL_RE = re.compile(r"^(?:[a-z][a-z0-9+.-]*://)?(?:[^@/]+@)?([^/:]+)[:/]+(.+?)(?:\.git)?/*$", re.I)
+
+_cond = threading.Condition()
+_queue = []  # urls waiting for the updater, in order
+_waiters = {}  # url -> Event set when the queued refresh of url finishes
+_results = {}  # url -> (ok, error) of its last refresh
+_thread = None
+
+
+def _git(args, cwd: str, timeout: int = 300):
+    """(ok, output) of a git command; output is stderr (or stdout) on failure."""
+    try:
+        r = subprocess.run(["git"] + args, cwd=cwd, capture_output=True, text=True, timeout=timeout)
+    except subprocess.TimeoutExpired:
+        return False, f"git {args[0]} timed out"
+    except OSError as e:
+        return False, str(e)
+    return r.returncode == 0, (r.stdout if r.returncode == 0 else (r.stderr or r.stdout)).strip()
+
+
+def mirror_path(url: str):
+    """Mirror directory for a remote URL (GIT_MIRRORS_DIR/<host>/<owner>/<repo>.git), or None for local paths."""
+    url = (url or "").strip()
+    if not url or url.startswith(("/", ".", "file:")):
+        return None
+    m = _URL_RE.match(url)
+    if not m:
+        return None
+    host, repo = m.group(1).lower(), m.group(2).strip("/")
+    if ".." in repo.split("/"):
+        return None
+    return os.path.join(GIT_MIRRORS_DIR, host, repo + ".git")
+
+
+def existing_mirror(url: str):
+    """Mirror directory for url when the mirror has been cloned, else None."""
+    path = mirror_path(url)
+    return path if path and os.path.isfile(os.path.join(path, "HEAD")) else None
+
+
+def _load_state(path: str):
+    try:
+        with open(path + _STATE_SUFFIX, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _save_state(path: str, state: dict) -> None:
+    try:
+        with open(path + _STATE_SUFFIX, "w", encoding="utf-8") as f:
+            json.dump(state, f, indent=2)
+    except OSError:
+        pass
+
+
+def _refresh(url: str):
+    """Clone the mirror of url, or fetch it when it exists. Runs on the updater thread only. Returns (ok, error)."""
+    path = mirror_path(url)
+    if path is None:
+        return False, f"Not a mirrorable URL: {url}"
+    started = time.monotonic()
+    if existing_mirror(url):
+        ok, out = _git(["fetch", "--prune", "--quiet", "origin"], path, timeout=_CLONE_TIMEOUT)
+    else:
+        tmp = path + ".tmp"
+        shutil.rmtree(tmp, ignore_errors=True)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        ok, out = _git(["clone", "--mirror", "--quiet", url, tmp], os.path.dirname(path), timeout=_CLONE_TIMEOUT)
+        if ok:
+            _git(["config", "gc.pruneExpire", "never"], tmp)
+            shutil.rmtree(path, ignore_errors=True)
+            os.rename(tmp, path)
+        else:
+            shutil.rmtree(tmp, ignore_errors=True)
+    if not ok and not existing_mirror(url):
+        return False, out[:300]
+    state = _load_state(path) or {}
+    state.update(url=url, ok=ok, error=None if ok else out[:300], fetch_s=round(time.monotonic() - started, 1))
+    if ok:
+        state["last_fetch"] = time.time()
+    _save_state(path, state)
+    return ok, None if ok else out[:300]
+
+
+def _all_mirrors():
+    """[(mirror path, state)] for every mirror under GIT_MIRRORS_DIR."""
+    out = []
+    for root, dirs, files in os.walk(GIT_MIRRORS_DIR):
+        for name in files:
+            if name.endswith(".git" + _STATE_SUFFIX):
+                path = os.path.join(root, name[:-len(_STATE_SUFFIX)])
+                out.append((path, _load_state(path) or {}))
+        dirs[:] = [d for d in dirs if not d.endswith((".git", ".tmp"))]
+    return out
+
+
+def _enqueue_due() -> None:
+    """Queue every mirror not fetched for GIT_MIRROR_FETCH_INTERVAL seconds (caller holds _cond)."""
+    now = time.time()
+    for _, state in _all_mirrors():
+        url = state.get("url")
+        if url and url not in _queue and now - (state.get("last_fetch") or 0) >= GIT_MIRROR_FETCH_INTERVAL:
+            _queue.append(url)
+
+
+def _updater_loop() -> None:
+    while True:
+        with _cond:
+            if not _queue:
+                _cond.wait(timeout=min(GIT_MIRROR_FETCH_INTERVAL, 300) if GIT_MIRROR_FETCH_INTERVAL > 0 else None)
+                if not _queue and GIT_MIRROR_FETCH_INTERVAL > 0:
+                    _enqueue_due()
+            if not _queue:
+                continue
+            url = _queue.pop(0)
+            done = _waiters.pop(url, None)
+        try:
+            result = _refresh(url)
+        except Exception as e:
+            result = (False, str(e)[:300])
+        with _cond:
+            _results[url] = result
+        if done:
+            done.set()
+
+
+def start_updater() -> None:
+    """Start the mirror updater thread (idempotent)."""
+    global _thread
+    with _cond:
+        if _thread is not None:
+            return
+        _thread = threading.Thread(target=_updater_loop, name="git-mirrors", daemon=True)
+    _thread.start()
+
+
+def update(url: str, wait: bool = True, timeout: float = _CLONE_TIMEOUT):
+    """
+    Queue a clone / fetch of url's mirror on the updater. With wait, block until it has run: returns (ok, error).
+    Without wait, returns (True, None) once queued.
+    """
+    if mirror_path(url) is None:
+        return False, f"Not a mirrorable URL: {url}"
+    start_updater()
+    with _cond:
+        done = _waiters.setdefault(url, threading.Event())
+        if url not in _queue:
+            _queue.append(url)
+        _cond.notify_all()
+    if not wait:
+        return True, None
+    if not done.wait(timeout):
+        return False, f"Mirror update of {url} timed out"
+    with _cond:
+        return _results.get(url) or (False, "Mirror update failed")
+
+
+def update_all():
+    """Queue a fetch of every mirror. Returns the queued URLs."""
+    urls = [s["url"] for _, s in _all_mirrors() if s.get("url")]
+    for url in urls:
+        update(url, wait=False)
+    return urls
+
+
+def _has_commit(git_dir: str, rev: str):
+    """Commit id of rev in git_dir, or None."""
+    ok, out = _git(["rev-parse", "--verify", "--quiet", f"{rev}^{{commit}}"], git_dir, timeout=30)
+    return out if ok and out else None
+
+
+def _ensure_commit(url: str, rev: str, on_line=None):
+    """(ok, commit_or_error): rev resolved in url's mirror, cloning / fetching the mirror first when it lacks rev."""
+    mirror = existing_mirror(url)
+    commit = _has_commit(mirror, rev) if mirror else None
+    if commit:
+        return True, commit
+    if on_line:
+        on_line(f"{'Fetching' if mirror else 'Cloning'} mirror of {url}")
+    ok, err = update(url)
+    if not ok:
+        return False, f"Mirror of {url}: {err}"
+    commit = _has_commit(mirror_path(url), rev)
+    return (True, commit) if commit else (False, f"Unknown ref {rev} in {url}")
+
+
+def attach(top: str, url: str) -> bool:
+    """Let the checkout at top borrow objects from url's mirror (relative alternates entry). True when attached."""
+    mirror = existing_mirror(url)
+    ok, objects = _git(["rev-parse", "--git-path", "objects"], top, timeout=30)
+    if not mirror or not ok:
+        return False
+    objects = os.path.realpath(os.path.join(top, objects))
+    alternates = os.path.join(objects, "info", "alternates")
+    entry = os.path.relpath(os.path.join(os.path.realpath(mirror), "objects"), objects)
+    try:
+        with open(alternates, encoding="utf-8") as f:
+            lines = [line.strip() for line in f if line.strip()]
+    except OSError:
+        lines = []
+    known = {os.path.realpath(os.path.join(objects, line)) for line in lines}
+    if os.path.realpath(os.path.join(objects, entry)) not in known:
+        os.makedirs(os.path.dirname(alternates), exist_ok=True)
+        with open(alternates, "w", encoding="utf-8") as f:
+            f.write("\n".join(lines + [entry]) + "\n")
+    return True
+
+
+def submodule_urls(top: str, rev: str = "HEAD"):
+    """{submodule name: (path, url)} from .gitmodules at rev in the checkout at top."""
+    ok, out = _git(["config", "--blob", f"{rev}:.gitmodules", "--get-regexp", r"^submodule\..*\.(path|url)$"], top, timeout=30)
+    subs = {}
+    for line in (out.splitlines() if ok else []):
+        key, _, value = line.partition(" ")
+        name, _, field = key[len("submodule."):].rpartition(".")
+        subs.setdefault(name, {})[field] = value
+    return {name: (s["path"], s["url"]) for name, s in subs.items() if s.get("path") and s.get("url")}
+
+
+def submodule_mirrors(top: str, rev: str = "HEAD", on_line=None, create: bool = True):
+    """
+    {submodule name: mirror dir} for the submodules at rev, fetching a mirror that lacks the commit rev records for
+    it (and cloning missing mirrors unless create is False). Submodules with local or relative URLs, or whose
+    mirror cannot be updated, are left out.
+    """
+    mirrors = {}
+    for name, (sub_path, url) in submodule_urls(top, rev).items():
+        if mirror_path(url) is None or not (create or existing_mirror(url)):
+            continue
+        ok, line = _git(["ls-tree", rev, "--", sub_path], top, timeout=30)
+        want = line.split()[2] if ok and line.count(" ") >= 2 else None
+        ok, _ = _ensure_commit(url, want, on_line) if want else (existing_mirror(url) is not None, None)
+        if ok:
+            mirrors[name] = mirror_path(url)
+    return mirrors
+
+
+def _submodule_overrides(top: str, rev: str, on_line=None):
+    """git -c options cloning the submodules at rev from their mirrors."""
+    overrides = []
+    for name, mirror in submodule_mirrors(top, rev, on_line).items():
+        overrides += ["-c", f"submodule.{name}.url={mirror}"]
+    return (["-c", "protocol.file.allow=always"] + overrides) if overrides else []
+
+
+def _origin_url(top: str):
+    ok, url = _git(["config", "--get", "remote.origin.url"], top, timeout=30)
+    return url if ok and url else None
+
+
+def resolve(work_dir: str, ref: str, on_line=None):
+    """
+    Make ref of work_dir's firmware repo available in its checkout through the mirror: fetch the mirror when it
+    lacks ref, attach the checkout to it and fetch branches and tags from it (local, no network).
+    Returns (ok, commit_or_error).
+    """
+    ok, top = _git(["rev-parse", "--show-toplevel"], work_dir, timeout=30)
+    if not ok or os.path.realpath(top) == os.path.realpath(REPO_ROOT):
+        return False, "Building a git ref needs the firmware in its own git checkout"
+    url = _origin_url(top)
+    if mirror_path(url) is None:
+        return False, f"No mirrorable origin URL for {os.path.relpath(top, REPO_ROOT)}"
+    ok, commit = _ensure_commit(url, ref, on_line)
+    if not ok:
+        return False, commit
+    attach(top, url)
+    if not _has_commit(top, commit):
+        ok, out = _git(["fetch", "--quiet", mirror_path(url), "+refs/heads/*:refs/remotes/origin/*", "+refs/tags/*:refs/tags/*"], top)
+        if not ok:
+            return False, f"git fetch from mirror failed: {out[:300]}"
+    if on_line:
+        on_line(f"Resolved {ref} to {commit[:12]} via mirror of {url}")
+    return True, commit
+
+
+def checkout(work_dir: str, ref: str, on_line=None):
+    """Check out ref (detached) in work_dir's own checkout with submodules from the mirrors. Returns (ok, commit_or_error)."""
+    ok, commit = resolve(work_dir, ref, on_line)
+    if not ok:
+        return False, commit
+    ok, top = _git(["rev-parse", "--show-toplevel"], work_dir, timeout=30)
+    ok, out = _git(["checkout", "--quiet", "--detach", commit], top)
+    if not ok:
+        return False, f"git checkout failed: {out[:300]}"
+    ok, out = _git(_submodule_overrides(top, commit, on_line) + ["submodule", "update", "--init", "--recursive", "--force"], top, timeout=1800)
+    if not ok:
+        return False, f"git submodule update failed: {out[:300]}"
+    return True, commit
+
+
+def _checkout_dir(cfg: dict) -> str:
+    """Git checkout of a BUILD_CONFIG entry: path, or path/git_dir when the repo sits below it (e.g. a submodule)."""
+    base = os.path.join(REPO_ROOT, (cfg.get("path") or "").strip())
+    return os.path.join(base, cfg["git_dir"].strip("/")) if cfg.get("git_dir") else base
+
+
+def setup(device_id: str, firmware_id: str, url: str | None = None, ref: str | None = None, on_line=None):
+    """
+    Set up the firmware checkout of a BUILD_CONFIG entry from the mirror of url (default: its git_url): a new
+    checkout is cloned from the mirror borrowing its objects, an existing one is attached to the mirror. With ref,
+    that ref is checked out. Returns (ok, {path, url, commit, cloned}) or (False, error).
+    """
+    cfg = ((BUILD_CONFIG or {}).get(device_id) or {}).get(firmware_id)
+    if not cfg:
+        return False, "Unknown device or firmware"
+    dest = _checkout_dir(cfg)
+    existing = os.path.exists(os.path.join(dest, ".git"))
+    url = (url or (_origin_url(dest) if existing else None) or cfg.get("git_url") or "").strip()
+    if mirror_path(url) is None:
+        return False, "git url required (remote URL of the firmware repo)"
+    info = {"path": os.path.relpath(dest, REPO_ROOT), "url": url, "cloned": not existing}
+    if existing:
+        ok, err = update(url) if not existing_mirror(url) else (True, None)
+        if not ok:
+            return False, f"Mirror of {url}: {err}"
+        attach(dest, url)
+        ok, commit = checkout(dest, ref, on_line) if ref else (True, _has_commit(dest, "HEAD"))
+        return (True, {**info, "commit": commit}) if ok else (False, commit)
+    if os.path.isdir(dest) and os.listdir(dest):
+        return False, f"{info['path']} exists and is not a git checkout"
+    ok, commit = _ensure_commit(url, ref or "HEAD", on_line)
+    if not ok:
+        return False, commit
+    mirror = mirror_path(url)
+    if on_line:
+        on_line(f"Cloning {info['path']} from mirror of {url}")
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    ok, out = _git(["clone", "--quiet", "--shared", "--no-checkout", mirror, dest], os.path.dirname(dest))
+    if not ok:
+        return False, f"git clone from mirror failed: {out[:300]}"
+    # --shared writes an absolute alternates path; attach() replaces it with a relative one
+    try:
+        os.remove(os.path.join(dest, ".git", "objects", "info", "alternates"))
+    except OSError:
+        pass
+    attach(dest, url)
+    _git(["remote", "set-url", "origin", url], dest)
+    # Cloned with --no-checkout: reset --hard populates the default branch
+    ok, out = _git(["checkout", "--quiet", "--detach", commit] if ref else ["reset", "--hard", "--quiet"], dest)
+    if not ok:
+        return False, f"git checkout failed: {out[:300]}"
+    ok, out = _git(_submodule_overrides(dest, commit, on_line) + ["submodule", "update", "--init", "--recursive"], dest, timeout=1800)
+    if not ok:
+        return False, f"git submodule update failed: {out[:300]}"
+    return True, {**info, "commit": commit}
+
+
+def list_mirrors():
+    """Mirrors: url, path, last_fetch, fetch_s, ok, error, queued (waiting for the updater), newest fetch first."""
+    with _cond:
+        queued = set(_queue)
+    out = []
+    for path, state in _all_mirrors():
+        out.append({
+            "url": state.get("url"),
+            "path": os.path.relpath(path, REPO_ROOT),
+            "last_fetch": state.get("last_fetch"),
+            "fetch_s": state.get("fetch_s"),
+            "ok": state.get("ok"),
+            "error": state.get("error"),
+            "queued": state.get("url") in queued,
+        })
+    return sorted(out, key=lambda m: -(m["last_fetch"] or 0))
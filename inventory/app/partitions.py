@@ -0,0 +1,120 @@
+"""
+ESP-IDF partition table and app image parsing (no I/O): the binary partition table (0x8000 by default),
+otadata (which OTA slot boots) and app image headers, whose segment list gives the image's real length so a
+backup only has to read the occupied part of an app partition.
+"""
+import struct
+
+PARTITION_TABLE_OFFSET = 0x8000
+PARTITION_TABLE_SIZE = 0xC00  # 3 KB: up to 95 entries + MD5 entry
+_ENTRY = struct.Struct("<2sBBII16sI")
+_ENTRY_MAGIC = b"\xaa\x50"
+_MD5_MAGIC = b"\xeb\xeb"
+
+_APP_SUBTYPES = {0x00: "factory", 0x20: "test"}
+_DATA_SUBTYPES = {
+    0x00: "ota", 0x01: "phy", 0x02: "nvs", 0x03: "coredump", 0x04: "nvs_keys", 0x05: "efuse",
+    0x80: "esphttpd", 0x81: "fat", 0x82: "spiffs", 0x83: "littlefs",
+}
+
+IMAGE_MAGIC = 0xE9
+IMAGE_HEADER_SIZE = 24  # 8-byte common header + 16-byte extended header
+SEGMENT_HEADER_SIZE = 8
+_MAX_SEGMENTS = 16
+_OTADATA_ENTRY = struct.Struct("<I20sII")
+_OTA_STATE_INVALID = (3, 4)  # ESP_OTA_IMG_INVALID, ESP_OTA_IMG_ABORTED
+
+
+def _subtype_name(ptype: int, subtype: int) -> str:
+    if ptype == 0:
+        if 0x10 <= subtype < 0x20:
+            return f"ota_{subtype - 0x10}"
+        return _APP_SUBTYPES.get(subtype, f"0x{subtype:02x}")
+    if ptype == 1:
+        return _DATA_SUBTYPES.get(subtype, f"0x{subtype:02x}")
+    return f"0x{subtype:02x}"
+
+
+def parse_partition_table(data: bytes):
+    """
+    Parse a binary partition table. Returns a list of {name, type, subtype, offset, size, encrypted} (type 'app',
+    'data' or hex; subtype e.g. 'ota_0', 'nvs', 'spiffs'), or None when data holds no valid table.
+    """
+    out = []
+    for pos in range(0, len(data) - _ENTRY.size + 1, _ENTRY.size):
+        magic, ptype, subtype, offset, size, label, flags = _ENTRY.unpack_from(data, pos)
+        if magic != _ENTRY_MAGIC:
+            if magic not in (_MD5_MAGIC, b"\xff\xff"):
+                return None
+            break
+        out.append({
+            "name": label.split(b"\0", 1)[0].decode("ascii", errors="replace"),
+            "type": {0: "app", 1: "data"}.get(ptype, f"0x{ptype:02x}"),
+            "subtype": _subtype_name(ptype, subtype),
+            "offset": offset,
+            "size": size,
+            "encrypted": bool(flags & 1),
+        })
+    return out or None
+
+
+def find_partition(partitions: list, name: str | None = None, ptype: str | None = None, subtype: str | None = None):
+    """First partition matching name (case-insensitive) or type/subtype, or None."""
+    for p in partitions or []:
+        if name is not None and p["name"].lower() == name.lower():
+            return p
+        if name is None and (ptype is None or p["type"] == ptype) and (subtype is None or p["subtype"] == subtype):
+            return p
+    return None
+
+
+def boot_app_partition(partitions: list, otadata: bytes | None = None):
+    """
+    The app partition the bootloader would start: the OTA slot selected by otadata (highest valid sequence),
+    else factory, else the first app partition. otadata: the otadata partition contents (first two sectors), if read.
+    """
+    apps = [p for p in partitions or [] if p["type"] == "app"]
+    ota_slots = sorted((p for p in apps if p["subtype"].startswith("ota_")), key=lambda p: int(p["subtype"][4:]))
+    if otadata and ota_slots:
+        best = None
+        for sector in (0, 0x1000):
+            if len(otadata) < sector + _OTADATA_ENTRY.size:
+                continue
+            seq, _, state, _ = _OTADATA_ENTRY.unpack_from(otadata, sector)
+            if seq in (0, 0xFFFFFFFF) or state in _OTA_STATE_INVALID:
+                continue
+            best = seq if best is None else max(best, seq)
+        if best is not None:
+            return ota_slots[(best - 1) % len(ota_slots)]
+    return find_partition(apps, subtype="factory") or (ota_slots[0] if ota_slots else None) or (apps[0] if apps else None)
+
+
+def app_image_length(read, limit: int):
+    """
+    Length of the app image at the start of a partition, walking its segment headers.
+    read(offset, size) -> bytes returns partition-relative data (may fetch from flash on demand); limit is the
+    partition size. Returns the image length (segments + checksum + appended SHA-256), 0 for an erased partition,
+    or None when there is no valid image header (read the whole partition instead).
+    Secure Boot signature blocks after the image are not included.
+    """
+    header = read(0, IMAGE_HEADER_SIZE)
+    if len(header) < IMAGE_HEADER_SIZE:
+        return None
+    if header.count(0xFF) == len(header):
+        return 0
+    if header[0] != IMAGE_MAGIC or not 0 < header[1] <= _MAX_SEGMENTS:
+        return None
+    hash_appended = header[23] == 1
+    pos = IMAGE_HEADER_SIZE
+    for _ in range(header[1]):
+        seg = read(pos, SEGMENT_HEADER_SIZE)
+        if len(seg) < SEGMENT_HEADER_SIZE:
+            return None
+        _, seg_len = struct.unpack("<II", seg)
+        pos += SEGMENT_HEADER_SIZE + seg_len
+        if pos > limit:
+            return None
+    pos += 16 - pos % 16  # zero padding, checksum byte in the last byte of the 16-byte block
+    if hash_appended:
+        pos += 32
+    return pos if pos <= limit else None
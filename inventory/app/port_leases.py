@@ -0,0 +1,225 @@
+"""
+Serial port leases: one exclusive holder per physical device (flash/backup jobs, the serial monitor).
+The serial monitor holds a preemptible lease: when a job needs the port the monitor is paused (port closed) and
+resumed when the job releases it. Port readiness is polled (device node present, no process holding it open)
+instead of waited out with fixed sleeps. list_leases() shows holders and waiters for the API.
+"""
+import os
+import subprocess
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+from config import PORT_READY_TIMEOUT
+from flash_ops import get_alternate_port
+from usb_watch import current_port, identity_for_port
+
+_POLL_S = 0.05
+
+_cond = threading.Condition()
+_holders = {}  # key -> lease
+_parked = {}  # key -> preempted (paused) monitor lease, resumed when the port is free again
+_waiters = {}  # key -> deque of tickets (FIFO)
+
+
+def lease_key(port: str) -> str:
+    """Device key for port: USB identity when known (cu/tty alternates and renumbered ports share it), else the port path."""
+    alt = get_alternate_port(port)
+    return identity_for_port(port) or (identity_for_port(alt) if alt else None) or port
+
+
+def _new_lease(port: str, owner: str, kind: str, on_preempt=None, on_resume=None) -> dict:
+    return {
+        "key": lease_key(port),
+        "port": port,
+        "owner": owner,
+        "kind": kind,
+        "since": time.time(),
+        "on_preempt": on_preempt,
+        "on_resume": on_resume,
+    }
+
+
+def acquire(port: str, owner: str, cancel: threading.Event | None = None, timeout: float | None = None):
+    """
+    Take an exclusive lease on port's device, queueing FIFO behind other jobs. A serial monitor holding the port is
+    paused first. Returns the lease, or None on cancel / timeout. Port readiness is not checked; see wait_port_ready.
+    """
+    lease = _new_lease(port, owner, "job")
+    key = lease["key"]
+    ticket = object()
+    deadline = time.monotonic() + timeout if timeout is not None else None
+    with _cond:
+        _waiters.setdefault(key, deque()).append(ticket)
+        try:
+            while True:
+                if cancel is not None and cancel.is_set():
+                    return None
+                holder = _holders.get(key)
+                if _waiters[key][0] is ticket and (holder is None or holder["kind"] == "monitor"):
+                    break
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return None
+                _cond.wait(0.5 if remaining is None else min(remaining, 0.5))
+            preempted = _holders.pop(key, None)
+            if preempted is not None:
+                _parked[key] = preempted
+            lease["since"] = time.time()
+            _holders[key] = lease
+        finally:
+            _waiters[key].remove(ticket)
+            if not _waiters[key]:
+                del _waiters[key]
+            _cond.notify_all()
+    if preempted is not None and preempted["on_preempt"]:
+        try:
+            preempted["on_preempt"]()
+        except Exception:
+            pass
+    return lease
+
+
+def acquire_monitor(port: str, owner: str, on_preempt, on_resume) -> tuple:
+    """
+    Preemptible lease for the serial monitor. on_preempt() must close the port before returning; on_resume() reopens it.
+    Returns (lease, active): active is False when a job holds the device, in which case the monitor starts paused
+    and on_resume is called once the job releases it.
+    """
+    lease = _new_lease(port, owner, "monitor", on_preempt=on_preempt, on_resume=on_resume)
+    key = lease["key"]
+    with _cond:
+        if key in _holders or _waiters.get(key):
+            _parked[key] = lease
+            return lease, False
+        _holders[key] = lease
+        return lease, True
+
+
+def release(lease) -> None:
+    """Release a lease (job or monitor). When the last job lets go, a paused monitor is resumed."""
+    if not lease:
+        return
+    key = lease["key"]
+    resume = None
+    with _cond:
+        if _holders.get(key) is lease:
+            del _holders[key]
+            parked = _parked.get(key)
+            if parked is not None and not _waiters.get(key):
+                del _parked[key]
+                parked["since"] = time.time()
+                _holders[key] = parked
+                resume = parked
+        elif _parked.get(key) is lease:
+            del _parked[key]
+        _cond.notify_all()
+    if resume is not None and resume["on_resume"]:
+        try:
+            resume["on_resume"]()
+        except Exception:
+            pass
+
+
+@contextmanager
+def leased(port: str, owner: str, cancel: threading.Event | None = None):
+    """Context manager around acquire/release; yields the lease (None if cancelled while waiting)."""
+    lease = acquire(port, owner, cancel=cancel)
+    try:
+        yield lease
+    finally:
+        release(lease)
+
+
+def list_leases():
+    """Current holders, queued waiters and paused monitors per device, for the API."""
+    now = time.time()
+    with _cond:
+        keys = set(_holders) | set(_parked) | set(_waiters)
+        out = []
+        for key in sorted(keys):
+            holder = _holders.get(key)
+            parked = _parked.get(key)
+            port = (holder or parked or {}).get("port")
+            out.append({
+                "key": key,
+                "port": current_port(key) or port,
+                "holder": holder["owner"] if holder else None,
+                "holder_kind": holder["kind"] if holder else None,
+                "held_s": round(now - holder["since"], 1) if holder else None,
+                "waiting": len(_waiters.get(key) or ()),
+                "paused_monitor": parked["owner"] if parked else None,
+            })
+    return out
+
+
+def lease_holder(port: str):
+    """Owner and kind of the lease currently holding port's device ({ owner, kind }), or None when it is free."""
+    key = lease_key(port)
+    with _cond:
+        holder = _holders.get(key)
+        return {"owner": holder["owner"], "kind": holder["kind"]} if holder else None
+
+
+def port_holders(port: str) -> list:
+    """PIDs that have port open: /proc scan on Linux, lsof elsewhere; [] if neither works."""
+    real = os.path.realpath(port)
+    pids = []
+    if os.path.isdir("/proc/self/fd"):
+        for pid in os.listdir("/proc"):
+            if not pid.isdigit():
+                continue
+            fd_dir = f"/proc/{pid}/fd"
+            try:
+                for fd in os.listdir(fd_dir):
+                    if os.readlink(os.path.join(fd_dir, fd)) == real:
+                        pids.append(int(pid))
+                        break
+            except OSError:
+                continue
+        return pids
+    try:
+        out = subprocess.run(["lsof", "-t", real], capture_output=True, text=True, timeout=3)
+        return [int(x) for x in out.stdout.split() if x.isdigit()]
+    except (OSError, subprocess.TimeoutExpired):
+        return []
+
+
+def _cmdline(pid: int) -> str:
+    try:
+        with open(f"/proc/{pid}/cmdline", "rb") as f:
+            return f.read().replace(b"\0", b" ").decode("utf-8", errors="replace")
+    except OSError:
+        try:
+            out = subprocess.run(["ps", "-o", "command=", "-p", str(pid)], capture_output=True, text=True, timeout=3)
+            return out.stdout
+        except (OSError, subprocess.TimeoutExpired):
+            return ""
+
+
+def wait_port_ready(port: str, timeout: float | None = None, cancel: threading.Event | None = None) -> bool:
+    """Poll until port exists and no process holds it open. Returns False on timeout / cancel."""
+    deadline = time.monotonic() + (PORT_READY_TIMEOUT if timeout is None else timeout)
+    while True:
+        if os.path.exists(port) and not port_holders(port):
+            return True
+        if time.monotonic() >= deadline or (cancel is not None and cancel.is_set()):
+            return False
+        time.sleep(_POLL_S)
+
+
+def free_port(port: str, cancel: threading.Event | None = None) -> bool:
+    """
+    Make port usable for esptool: wait for it to be released; if an orphaned esptool (e.g. from a timed-out
+    request) still holds it, kill that process and wait again. Returns whether the port is ready.
+    """
+    if wait_port_ready(port, timeout=1.0, cancel=cancel):
+        return True
+    for pid in port_holders(port):
+        if pid != os.getpid() and "esptool" in _cmdline(pid):
+            try:
+                os.kill(pid, 9)
+            except (ProcessLookupError, PermissionError):
+                pass
+    return wait_port_ready(port, cancel=cancel)
@@ -0,0 +1,294 @@
+"""
+Artifact retention: which builds, release downloads and backups to keep, and garbage collection of the rest.
+Rules per device / firmware (config.ARTIFACT_RETENTION) keep the newest N builds per build env, release downloads,
+backups newer than X days and anything flashed recently; everything else expires. A total byte budget
+(ARTIFACT_BUDGET_BYTES) then evicts kept items too, least recently flashed first, but never a build env's newest
+build, a device's newest backup, or a protected release / hand-copied file. Identical .bin files are hardlinked.
+Nothing is deleted unless run_gc(dry_run=False) is called; the dry run is the same report.
+"""
+import filecmp
+import os
+import shutil
+import threading
+from datetime import datetime, timedelta
+
+import artifact_index
+import backup_store
+from config import ARTIFACT_BUDGET_BYTES, ARTIFACT_RETENTION, REPO_ROOT
+
+_gc_lock = threading.Lock()
+
+
+def policy_for(device: str | None = None, firmware: str | None = None) -> dict:
+    """Effective rules: "default", overridden by "<device>", then by "<device>/<firmware>"."""
+    rules = dict(ARTIFACT_RETENTION.get("default") or {})
+    if device:
+        rules.update(ARTIFACT_RETENTION.get(device) or {})
+        if firmware:
+            rules.update(ARTIFACT_RETENTION.get(f"{device}/{firmware}") or {})
+    return rules
+
+
+def _file_key(st) -> tuple:
+    return ("file", st.st_dev, st.st_ino)
+
+
+def _collect_units(rows: list, usage: dict, refs: dict):
+    """
+    Group index rows into removable units: a build directory (with its bootloader / partitions files), a single
+    release or hand-copied .bin, or a backup (manifest + the chunks it references). Each unit lists the storage keys it
+    holds; usage maps key -> bytes and refs key -> how many holders (hard links, manifests) share it.
+    """
+    units = {}
+    for r in rows:
+        abs_path = os.path.join(REPO_ROOT, r["path"])
+        is_build_dir = r["kind"] == "artifact" and r["source"] == "build" and r["version"]
+        root = os.path.dirname(abs_path) if is_build_dir else abs_path
+        u = units.get(root)
+        if u is None:
+            u = units[root] = {
+                "path": os.path.relpath(root, REPO_ROOT), "abs_path": root,
+                "type": "build" if is_build_dir else r["kind"] if r["kind"] == "backup" else r["source"],
+                "source": r["source"], "device": r["device"], "firmware": r["firmware"], "build_env": r["build_env"],
+                "version": r["version"], "created_at": r["created_at"], "last_flashed_at": r["last_flashed_at"],
+                "rows": [], "keys": [],
+            }
+        u["rows"].append(r["path"])
+        u["created_at"] = max(u["created_at"] or "", r["created_at"] or "") or None
+        u["last_flashed_at"] = max(u["last_flashed_at"] or "", r["last_flashed_at"] or "") or None
+    for u in units.values():
+        if u["type"] == "build":
+            files = [os.path.join(d, f) for d, _, names in os.walk(u["abs_path"]) for f in names]
+        else:
+            files = [u["abs_path"]]
+        for path in files:
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            key = _file_key(st)
+            usage.setdefault(key, st.st_size)
+            refs.setdefault(key, st.st_nlink)  # links outside artifacts/ keep the inode alive too
+            u["keys"].append(key)
+        if backup_store.is_manifest(u["abs_path"]):
+            for digest, size in backup_store.chunk_usage(u["abs_path"]).items():
+                key = ("chunk", digest)
+                usage.setdefault(key, size)
+                refs[key] = refs.get(key, 0) + 1
+                u["keys"].append(key)
+    return list(units.values())
+
+
+def _hardlink_candidates(rows: list) -> list:
+    """[(duplicate_path, target_path)]: .bin files with the same SHA-256 and size on one filesystem, not yet linked."""
+    groups = {}
+    for r in rows:
+        if r["sha256"] and r["path"].endswith(".bin"):
+            groups.setdefault((r["sha256"], r["size"]), []).append(os.path.join(REPO_ROOT, r["path"]))
+    out = []
+    for paths in groups.values():
+        if len(paths) < 2:
+            continue
+        by_dev = {}
+        for p in paths:
+            try:
+                st = os.stat(p)
+            except OSError:
+                continue
+            by_dev.setdefault(st.st_dev, []).append((st.st_mtime, p, st.st_ino))
+        for same_dev in by_dev.values():
+            same_dev.sort()
+            _, target, target_ino = same_dev[0]  # the oldest copy stays
+            out.extend((p, target) for _, p, ino in same_dev[1:] if ino != target_ino)
+    return out
+
+
+def _release(unit: dict, usage: dict, refs: dict) -> int:
+    """Drop unit's holds on storage; returns the bytes that become free."""
+    freed = 0
+    for key in unit["keys"]:
+        refs[key] -= 1
+        if refs[key] == 0:
+            freed += usage[key]
+    return freed
+
+
+def _evaluate(units: list, now: datetime):
+    """Apply the keep rules. Sets unit["action"] (keep / expire), ["reason"] and ["pinned"] (never evicted for budget)."""
+    groups = {}
+    for u in units:
+        if u["type"] == "build":
+            groups.setdefault(("build", u["device"], u["firmware"], u["build_env"]), []).append(u)
+        elif u["type"] == "backup":
+            groups.setdefault(("backup", u["device"]), []).append(u)
+    rank = {}
+    for members in groups.values():
+        members.sort(key=lambda u: (u["created_at"] or "", u["path"]), reverse=True)
+        for i, u in enumerate(members):
+            rank[id(u)] = i
+    for u in units:
+        rules = policy_for(u["device"], u["firmware"])
+        flashed_days = rules.get("keep_flashed_days")
+        recently_flashed = bool(
+            flashed_days and u["last_flashed_at"]
+            and u["last_flashed_at"] >= (now - timedelta(days=flashed_days)).isoformat(timespec="seconds")
+        )
+        u["pinned"] = False
+        if u["type"] == "build":
+            keep_n = int(rules.get("keep_builds") or 0)
+            u["pinned"] = rank[id(u)] == 0
+            if rank[id(u)] < max(1, keep_n):
+                u["action"], u["reason"] = "keep", f"newest {max(1, keep_n)} build(s) for env {u['build_env'] or '-'}"
+            elif recently_flashed:
+                u["action"], u["reason"] = "keep", f"flashed within {flashed_days} days"
+            else:
+                u["action"], u["reason"] = "expire", f"older than the newest {keep_n} build(s) for env {u['build_env'] or '-'}"
+        elif u["type"] == "backup":
+            days = rules.get("keep_backups_days")
+            u["pinned"] = rank[id(u)] == 0
+            if u["pinned"]:
+                u["action"], u["reason"] = "keep", "newest backup for this device"
+            elif not days or (u["created_at"] or "") >= (now - timedelta(days=days)).isoformat(timespec="seconds"):
+                u["action"], u["reason"] = "keep", f"newer than {days} days" if days else "backups kept (no age limit)"
+            elif recently_flashed:
+                u["action"], u["reason"] = "keep", f"restored within {flashed_days} days"
+            else:
+                u["action"], u["reason"] = "expire", f"backup older than {days} days"
+        elif u["type"] == "ota" and rules.get("keep_releases", True):
+            u["pinned"] = True
+            u["action"], u["reason"] = "keep", "release download"
+        elif u["type"] == "manual" and rules.get("keep_manual", True):
+            u["pinned"] = True
+            u["action"], u["reason"] = "keep", "copied in by hand"
+        elif recently_flashed:
+            u["action"], u["reason"] = "keep", f"flashed within {flashed_days} days"
+        else:
+            u["action"], u["reason"] = "expire", "not covered by a keep rule"
+
+
+def _lru_key(u: dict):
+    """Least recently flashed first: never-flashed items by age, then by last flash."""
+    return (u["last_flashed_at"] is not None, u["last_flashed_at"] or "", u["created_at"] or "")
+
+
+def _plan(budget_bytes: int, hardlink: bool, include_kept: bool):
+    """(report, units_to_remove) — see plan()."""
+    artifact_index.reconcile(force=True)
+    rows = artifact_index.list_artifacts()
+    usage, refs = {}, {}
+    units = _collect_units(rows, usage, refs)
+    usage_before = sum(usage.values())
+    links = _hardlink_candidates(rows) if hardlink else []
+    link_saved = 0
+    for dup, target in links:
+        try:
+            dkey, tkey = _file_key(os.stat(dup)), _file_key(os.stat(target))
+        except OSError:
+            continue
+        holder = next((u for u in units if dkey in u["keys"]), None)
+        if holder is None or tkey not in refs:
+            continue
+        holder["keys"][holder["keys"].index(dkey)] = tkey
+        refs[dkey] -= 1
+        refs[tkey] += 1
+        if refs[dkey] == 0:
+            link_saved += usage[dkey]
+    _evaluate(units, datetime.now())
+    freed = 0
+    removals = []
+    for u in sorted((u for u in units if u["action"] == "expire"), key=_lru_key):
+        u["freed_bytes"] = _release(u, usage, refs)
+        freed += u["freed_bytes"]
+        removals.append(u)
+    budget = ARTIFACT_BUDGET_BYTES if budget_bytes is None else int(budget_bytes)
+    remaining = usage_before - link_saved - freed
+    if budget:
+        for u in sorted((u for u in units if u["action"] == "keep" and not u["pinned"]), key=_lru_key):
+            if remaining <= budget:
+                break
+            u["action"], u["reason"] = "evict", f"over budget ({u['reason']})"
+            u["freed_bytes"] = _release(u, usage, refs)
+            freed += u["freed_bytes"]
+            remaining -= u["freed_bytes"]
+            removals.append(u)
+
+    def _public(u):
+        return {k: v for k, v in u.items() if k not in ("abs_path", "keys", "rows", "pinned")}
+
+    report = {
+        "usage_bytes": usage_before,
+        "hardlink_saved_bytes": link_saved,
+        "freed_bytes": freed,
+        "usage_after_bytes": remaining,
+        "budget_bytes": budget or None,
+        "over_budget": bool(budget and remaining > budget),
+        "hardlinks": [{"path": os.path.relpath(d, REPO_ROOT), "target": os.path.relpath(t, REPO_ROOT)} for d, t in links],
+        "remove": [_public(u) for u in removals],
+        "kept": sum(1 for u in units if u["action"] == "keep"),
+    }
+    if include_kept:
+        report["keep"] = [_public(u) for u in units if u["action"] == "keep"]
+    return report, removals
+
+
+def plan(budget_bytes: int | None = None, hardlink: bool = True, include_kept: bool = False) -> dict:
+    """
+    Retention report (nothing is changed): which units the rules expire, which the byte budget evicts (least recently
+    flashed first), which duplicate files would be hardlinked, and disk usage before / after.
+    budget_bytes: overrides ARTIFACT_BUDGET_BYTES (0 = no budget).
+    """
+    return _plan(budget_bytes, hardlink, include_kept)[0]
+
+
+def _link(dup: str, target: str) -> bool:
+    """Replace dup with a hard link to target after a byte-for-byte compare."""
+    if not filecmp.cmp(dup, target, shallow=False):
+        return False
+    tmp = dup + ".gc-link"
+    os.link(target, tmp)
+    os.replace(tmp, dup)
+    return True
+
+
+def run_gc(dry_run: bool = True, budget_bytes: int | None = None, hardlink: bool = True, include_kept: bool = False):
+    """
+    Plan retention and, unless dry_run, apply it: hardlink duplicates, delete expired / evicted builds, release
+    downloads and backups, then drop unreferenced backup chunks. Returns (report, error). The report has "dry_run"
+    and, after a real run, "errors" for anything that could not be removed.
+    """
+    if not _gc_lock.acquire(blocking=False):
+        return None, "Garbage collection already running"
+    try:
+        report, units = _plan(budget_bytes, hardlink, include_kept)
+        report["dry_run"] = dry_run
+        if dry_run:
+            return report, None
+        errors = []
+        for item in report["hardlinks"]:
+            try:
+                if not _link(os.path.join(REPO_ROOT, item["path"]), os.path.join(REPO_ROOT, item["target"])):
+                    errors.append(f"{item['path']}: contents differ from {item['target']}; not linked")
+            except OSError as e:
+                errors.append(f"{item['path']}: {e}")
+        removed_backups = False
+        for u in units:
+            try:
+                if u["type"] == "build":
+                    shutil.rmtree(u["abs_path"])
+                else:
+                    os.remove(u["abs_path"])
+                    removed_backups = removed_backups or u["type"] == "backup"
+            except OSError as e:
+                errors.append(f"{u['path']}: {e}")
+                continue
+            for rel in u["rows"]:
+                artifact_index.forget(rel)
+        if removed_backups:
+            report["chunks_removed"], report["chunk_bytes_freed"] = backup_store.gc_chunks()
+        artifact_index.reconcile(force=True)
+        report["errors"] = errors
+        return report, None
+    except OSError as e:
+        return None, str(e)
+    finally:
+        _gc_lock.release()
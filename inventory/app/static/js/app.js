@@ -1250,6 +1250,7 @@
     let deviceId = document.getElementById("flash-device")?.value?.trim();
     const backupType = document.getElementById("flash-backup-type")?.value || "full";
     const backupName = document.getElementById("flash-backup-name")?.value?.trim() || null;
+    const partitionNames = document.getElementById("flash-backup-partitions")?.value?.trim() || "";
     const dialog = document.getElementById("backup-progress-dialog");
     const msgEl = document.getElementById("backup-progress-message");
     if (!port) {
@@ -1261,6 +1262,10 @@
       setFlashStatus("backup-status", "Select a device (or click Refresh & detect devices).", true);
       return;
     }
+    if (backupType === "partitions" && !partitionNames) {
+      setFlashStatus("backup-status", "Enter partition names (click Read table to list them).", true);
+      return;
+    }
     if (isFlashDeviceUf2(deviceId)) {
       const suggested = getDeviceForPort(port);
       if (suggested) {
@@ -1279,68 +1284,80 @@
     }
     const isFull = backupType === "full";
     if (msgEl) {
-      const typeLabel = isFull ? "Full flash — this takes ~20-25 min for 16 MB" : backupType === "app" ? "App partition" : "NVS";
+      const typeLabel = isFull ? "Full flash — this takes ~20-25 min for 16 MB" : backupType === "app" ? "App partition" : backupType === "nvs" ? "NVS" : "partitions " + partitionNames;
       msgEl.textContent = "Reading " + typeLabel + ". Please wait…";
     }
     if (dialog) dialog.hidden = false;
     setFlashStatus("backup-status", "Reading flash…", false);
     const progressBar = dialog?.querySelector(".backup-progress-bar");
-    let progressTimer = null;
-    if (isFull && progressBar) {
+    if (progressBar) {
       progressBar.style.width = "0%";
       progressBar.style.transition = "width 0.5s";
-      progressTimer = setInterval(() => {
-        fetch("/api/flash/backup/progress").then(r => r.json()).then(d => {
-          if (d.pct != null) progressBar.style.width = d.pct + "%";
-          if (d.status === "reading" && d.chunk != null && d.total_chunks && msgEl) {
-            msgEl.textContent = "Reading chunk " + d.chunk + " / " + d.total_chunks + " (" + d.pct + "%)…";
-          } else if (d.status === "assembling" && msgEl) {
-            msgEl.textContent = "Assembling backup file…";
-          }
-        }).catch(() => {});
-      }, 3000);
     }
-    function stopProgress() { if (progressTimer) { clearInterval(progressTimer); progressTimer = null; } }
-    const body = { port, device_id: deviceId, backup_type: backupType };
+    function fail(err) {
+      closeBackupDialog();
+      const msg = err && err.message ? err.message : String(err);
+      setFlashStatus("backup-status", msg.length > 280 ? "Error: " + msg.slice(0, 277) + "…" : "Error: " + msg, true);
+    }
+    function showProgress(job) {
+      const p = job.progress || {};
+      if (progressBar && p.pct != null) progressBar.style.width = p.pct + "%";
+      if (!msgEl) return;
+      if (job.status === "waiting_port") {
+        msgEl.textContent = "Waiting for another operation on this port to finish…";
+      } else if (p.status === "assembling") {
+        msgEl.textContent = "Assembling backup file…";
+      } else if (p.pct != null) {
+        const rate = p.bytes_per_sec ? " — " + (p.bytes_per_sec / 1024).toFixed(1) + " KB/s" : "";
+        const chunk = p.chunk != null && p.total_chunks ? "chunk " + p.chunk + " / " + p.total_chunks + ", " : "";
+        const size = p.chunk_size ? ", " + Math.round(p.chunk_size / 1024) + " KB chunks" + (p.errors ? ", " + p.errors + " retried" : "") : "";
+        msgEl.textContent = "Reading flash (" + chunk + Math.round(p.pct) + "%" + rate + size + ")…";
+      }
+    }
+    function finish(job) {
+      closeBackupDialog();
+      if (job.status !== "done") {
+        fail(new Error(job.status === "cancelled" ? "Cancelled" : job.error || "Backup failed"));
+        return;
+      }
+      const a = document.createElement("a");
+      a.href = "/api/flash/backup/download?path=" + encodeURIComponent(job.result.path);
+      a.click();
+      setFlashStatus("backup-status", "Download started. Backup saved in artifacts/backups.", false);
+      loadFlashArtifacts();
+    }
+    const body = { port, device_id: deviceId, backup_type: backupType, async: true };
     if (backupName) body.name = backupName;
+    if (backupType === "partitions") body.partitions = partitionNames;
     fetch("/api/flash/backup", {
       method: "POST",
       headers: { "Content-Type": "application/json" },
       body: JSON.stringify(body),
     })
-      .then((r) => {
-        if (!r.ok) {
-          return r.text().then((text) => {
-            let errMsg = r.statusText;
-            try {
-              const j = JSON.parse(text);
-              if (j && typeof j.error === "string") errMsg = j.error;
-            } catch (_) {}
-            throw new Error(errMsg);
-          });
-        }
-        return r.blob();
-      })
-      .then((blob) => {
-        stopProgress();
-        closeBackupDialog();
-        const name = backupName && /^[\w\-_.]+\.bin$/i.test(backupName)
-          ? (backupName.toLowerCase().endsWith(".bin") ? backupName : backupName + ".bin")
-          : "backup-" + deviceId + "-" + backupType + "-" + new Date().toISOString().slice(0, 19).replace(/[:-]/g, "") + ".bin";
-        const a = document.createElement("a");
-        a.href = URL.createObjectURL(blob);
-        a.download = name;
-        a.click();
-        URL.revokeObjectURL(a.href);
-        setFlashStatus("backup-status", "Download started." + (backupName ? " File saved in artifacts/backups." : ""), false);
-        if (backupName) loadFlashArtifacts();
+      .then((r) => r.json().then((j) => {
+        if (!r.ok || !j.job_id) throw new Error((j && j.error) || r.statusText);
+        return j.job_id;
+      }))
+      .then((jobId) => {
+        const es = new EventSource("/api/flash/jobs/" + encodeURIComponent(jobId) + "/events");
+        es.onmessage = (e) => {
+          const job = JSON.parse(e.data);
+          showProgress(job);
+          if (job.status === "done" || job.status === "error" || job.status === "cancelled") {
+            es.close();
+            finish(job);
+          }
+        };
+        es.onerror = () => {
+          // Stream dropped (proxy timeout etc.): fall back to a single status fetch.
+          es.close();
+          fetch("/api/flash/jobs/" + encodeURIComponent(jobId)).then((r) => r.json()).then((job) => {
+            if (job.status === "done" || job.status === "error" || job.status === "cancelled") finish(job);
+            else setFlashStatus("backup-status", "Backup still running (job " + jobId + "); see /api/flash/jobs.", false);
+          }).catch(fail);
+        };
       })
-      .catch((err) => {
-        stopProgress();
-        closeBackupDialog();
-        const msg = err && err.message ? err.message : String(err);
-        setFlashStatus("backup-status", msg.length > 280 ? "Error: " + msg.slice(0, 277) + "…" : "Error: " + msg, true);
-      });
+      .catch(fail);
   }
 
   let restoreUploadFile = null;
@@ -1396,6 +1413,7 @@
       setFlashStatus("restore-status", "Select a file or upload one.", true);
       return;
     }
+    if (document.getElementById("flash-restore-skip-unchanged")?.checked) fd.set("skip_unchanged", "1");
     setFlashStatus("restore-status", "Restoring…", false);
     fetch("/api/flash/restore", { method: "POST", body: fd })
       .then((r) => r.json())
@@ -1445,6 +1463,7 @@
       setFlashStatus("flash-status", "Select a file or upload one.", true);
       return;
     }
+    if (document.getElementById("flash-flash-skip-unchanged")?.checked) fd.set("skip_unchanged", "1");
     setFlashStatus("flash-status", "Flashing…", false);
     fetch("/api/flash/flash", { method: "POST", body: fd })
       .then((r) => r.json())
@@ -1483,9 +1502,34 @@
       .catch((err) => setFlashStatus(statusId, "Error: " + err.message, true));
   }
 
+  function loadPartitionTable() {
+    const port = document.getElementById("flash-port")?.value?.trim();
+    const deviceId = document.getElementById("flash-device")?.value?.trim() || getDeviceForPort(port);
+    if (!port || !deviceId) {
+      setFlashStatus("backup-status", "Select a port and device.", true);
+      return;
+    }
+    setFlashStatus("backup-status", "Reading partition table…", false);
+    fetch("/api/flash/partitions?port=" + encodeURIComponent(port) + "&device_id=" + encodeURIComponent(deviceId))
+      .then((r) => r.json().then((j) => {
+        if (!r.ok) throw new Error((j && j.error) || r.statusText);
+        return j.partitions || [];
+      }))
+      .then((parts) => {
+        const list = parts.map((p) => p.name + " (" + p.subtype + ", 0x" + p.offset.toString(16) + ", " + Math.round(p.size / 1024) + " KB)");
+        setFlashStatus("backup-status", "Partitions: " + list.join("; "), false);
+        const input = document.getElementById("flash-backup-partitions");
+        if (input && !input.value) input.placeholder = parts.map((p) => p.name).join(", ");
+        const typeSel = document.getElementById("flash-backup-type");
+        if (typeSel) typeSel.value = "partitions";
+      })
+      .catch((err) => setFlashStatus("backup-status", "Error: " + err.message, true));
+  }
+
   function onFlashSectionClick(e) {
     const id = e.target && e.target.id ? e.target.id : (e.target.closest && e.target.closest("[id]") ? e.target.closest("[id]").id : "");
     if (id === "btn-flash-backup") { e.preventDefault(); doBackup(); return; }
+    if (id === "btn-flash-partitions") { e.preventDefault(); loadPartitionTable(); return; }
     if (id === "btn-flash-restore") { e.preventDefault(); doRestore(); return; }
     if (id === "btn-flash-flash") { e.preventDefault(); doFlash(); return; }
     if (id === "btn-flash-delete-restore") { e.preventDefault(); deleteSelectedFlashFile(document.getElementById("flash-restore-file"), "restore-status"); return; }
@@ -1529,7 +1573,7 @@
       setFlashStatus("build-status", "Select port and device above for Flash after build.", true);
       return;
     }
-    if (statusEl) statusEl.textContent = "Building…";
+    if (statusEl) statusEl.textContent = "Queued…";
     const body = {
       device_id: deviceId,
       firmware_id: firmwareId,
@@ -1539,29 +1583,96 @@
       verbose,
       timeout,
       flash_after: flashAfter,
+      async: true,
     };
     if (flashAfter) {
       body.port = port;
       body.flash_device_id = flashDeviceId;
     }
+    const logEl = document.getElementById("flash-build-log");
+    const cancelBtn = document.getElementById("btn-flash-build-cancel");
+    if (logEl) { logEl.textContent = ""; logEl.hidden = false; }
+    const appendLog = (lines) => {
+      if (!logEl || !lines || !lines.length) return;
+      const atBottom = logEl.scrollTop + logEl.clientHeight >= logEl.scrollHeight - 4;
+      logEl.textContent += lines.join("\n") + "\n";
+      if (atBottom) logEl.scrollTop = logEl.scrollHeight;
+    };
+    const finishFlash = (path, flashJobId) => {
+      setFlashStatus("build-status", "Built: " + path + ". Flashing (job " + flashJobId + ")…", false);
+      const es = new EventSource("/api/flash/jobs/" + encodeURIComponent(flashJobId) + "/events");
+      es.onmessage = (e) => {
+        const job = JSON.parse(e.data);
+        if (job.status === "done") setFlashStatus("build-status", "Built and flashed: " + path, false);
+        else if (job.status === "error" || job.status === "cancelled") setFlashStatus("build-status", "Built: " + path + ". Flash failed: " + (job.error || job.status), true);
+        else return;
+        es.close();
+      };
+      es.onerror = () => es.close();
+    };
+    const finish = (build) => {
+      if (cancelBtn) cancelBtn.hidden = true;
+      if (build.status === "done") {
+        const saved = build.result && build.result.runner_saved_s;
+        const ccache = build.result && build.result.ccache;
+        const regressions = (build.result && build.result.footprint && build.result.footprint.regressions) || [];
+        const path = ((build.result && build.result.path) || "") + (build.result && build.result.cached ? " (cached)" : "")
+          + (build.result && build.result.worker ? " (built on " + build.result.worker + ")" : "")
+          + (saved ? " (warm container, ~" + saved + "s saved)" : "")
+          + (ccache && ccache.hit_rate != null ? " (ccache " + Math.round(ccache.hit_rate * 100) + "% hits)" : "")
+          + (regressions.length ? " (footprint regression: " + regressions.map((r) => r.what + (r.delta ? " +" + r.delta + " B" : "") + (r.pct != null ? " " + r.pct + "%" : "")).join(", ") + ")" : "");
+        if (build.result && build.result.flash_job_id) finishFlash(path, build.result.flash_job_id);
+        else if (build.result && build.result.flash_error) setFlashStatus("build-status", "Built: " + path + ". Flash failed: " + build.result.flash_error, true);
+        else setFlashStatus("build-status", "Built: " + path, false);
+        loadFlashArtifacts();
+      } else {
+        setFlashStatus("build-status", build.status === "cancelled" ? "Build cancelled" : (build.error || "Build failed"), true);
+      }
+    };
     fetch("/api/flash/build", {
       method: "POST",
       headers: { "Content-Type": "application/json" },
       body: JSON.stringify(body),
     })
-      .then((r) => r.json())
-      .then((data) => {
-        if (data.success) {
-          let msg = "Built: " + (data.path || "");
-          if (data.flashed) msg = "Built and flashed: " + (data.path || "");
-          else if (data.flash_error) msg = "Built: " + (data.path || "") + ". Flash failed: " + data.flash_error;
-          setFlashStatus("build-status", msg, !!data.flash_error);
-          loadFlashArtifacts();
-        } else {
-          setFlashStatus("build-status", data.error || "Build failed", true);
+      .then((r) => r.json().then((j) => {
+        if (!r.ok || !j.build_id) throw new Error((j && j.error) || r.statusText);
+        return j.build_id;
+      }))
+      .then((buildId) => {
+        if (cancelBtn) {
+          cancelBtn.hidden = false;
+          cancelBtn.onclick = () => fetch("/api/flash/builds/" + encodeURIComponent(buildId) + "/cancel", { method: "POST" });
         }
+        let seen = 0;
+        const follow = () => {
+          const es = new EventSource("/api/flash/builds/" + encodeURIComponent(buildId) + "/events?after=" + seen);
+          es.onmessage = (e) => {
+            const build = JSON.parse(e.data);
+            appendLog(build.log);
+            seen = build.lines;
+            if (build.status === "waiting_tree") setFlashStatus("build-status", "Waiting for another build of this source tree…", false);
+            else if (build.status === "waiting_worker") setFlashStatus("build-status", "Waiting for a build worker…", false);
+            else if (build.status === "running") setFlashStatus("build-status", "Building… (" + build.lines + " lines)", false);
+            if (build.status === "done" || build.status === "error" || build.status === "cancelled") {
+              es.close();
+              finish(build);
+            }
+          };
+          es.onerror = () => {
+            // Stream dropped (proxy timeout etc.): reconnect from the last line seen unless the build is over.
+            es.close();
+            fetch("/api/flash/builds/" + encodeURIComponent(buildId) + "?log_lines=0").then((r) => r.json()).then((build) => {
+              if (build.status === "done" || build.status === "error" || build.status === "cancelled") finish(build);
+              else setTimeout(follow, 1000);
+            }).catch((err) => setFlashStatus("build-status", "Error: " + err.message, true));
+          };
+        };
+        follow();
       })
-      .catch((err) => setFlashStatus("build-status", "Error: " + err.message, true));
+      .catch((err) => {
+        if (cancelBtn) cancelBtn.hidden = true;
+        setFlashStatus("build-status", "Error: " + err.message, true);
+      });
   });
 
   document.getElementById("btn-flash-download")?.addEventListener("click", () => {
@@ -0,0 +1,276 @@
+"""
+Flash telemetry: every esptool run (read/write/verify/erase) and every backup / restore / flash / tune operation is
+recorded in SQLite (artifacts/telemetry.db) with device MAC, chip, port, bytes, duration, effective bytes/sec,
+retries and outcome. Restores and flashes are also written to flash_history (same shape as
+scripts/schema/cyberdeck_schema.sql). stats() returns percentiles per device, port or operation so slow paths and
+flaky ports / cables show up in the data. Recording never raises: a telemetry failure must not fail a flash.
+"""
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+from config import TELEMETRY_DB_PATH
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS flash_operations (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  kind TEXT NOT NULL,  -- backup, restore, flash, tune, partitions
+  device_id TEXT,
+  chip TEXT,
+  mac TEXT,
+  port TEXT,
+  usb_identity TEXT,  -- VID:PID:serial (follows the board across port renumbering)
+  bytes INTEGER NOT NULL DEFAULT 0,
+  duration_s REAL NOT NULL,
+  bytes_per_sec REAL,
+  esptool_runs INTEGER NOT NULL DEFAULT 0,
+  retries INTEGER NOT NULL DEFAULT 0,
+  outcome TEXT NOT NULL,  -- ok, error, cancelled
+  error TEXT,
+  created_at TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS esptool_runs (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  operation_id INTEGER REFERENCES flash_operations(id),  -- NULL for runs outside an operation
+  command TEXT NOT NULL,  -- read-flash, write-flash, verify-flash, erase-flash, ...
+  chip TEXT,
+  port TEXT,
+  baud INTEGER,
+  bytes INTEGER NOT NULL DEFAULT 0,
+  duration_s REAL NOT NULL,
+  bytes_per_sec REAL,
+  outcome TEXT NOT NULL,  -- ok, error, cancelled, timeout, busy, gone
+  error TEXT,
+  created_at TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS flash_history (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  user_id TEXT,
+  device_id TEXT NOT NULL,
+  firmware_id TEXT,
+  flash_method TEXT NOT NULL,
+  port TEXT,
+  success INTEGER NOT NULL,
+  message TEXT,
+  created_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_flash_operations_created ON flash_operations(created_at);
+CREATE INDEX IF NOT EXISTS idx_esptool_runs_operation ON esptool_runs(operation_id);
+CREATE INDEX IF NOT EXISTS idx_esptool_runs_created ON esptool_runs(created_at);
+CREATE INDEX IF NOT EXISTS idx_flash_history_device ON flash_history(device_id);
+CREATE INDEX IF NOT EXISTS idx_flash_history_created ON flash_history(created_at);
+"""
+
+GROUP_COLUMNS = {
+    "device": "device_id",
+    "mac": "mac",
+    "chip": "chip",
+    "port": "port",
+    "usb": "usb_identity",
+    "operation": "kind",
+}
+_ERROR_MAX = 400
+
+_db_lock = threading.Lock()
+_initialized = False
+_local = threading.local()  # .op: the operation being recorded on this thread
+
+
+def _connect():
+    global _initialized
+    os.makedirs(os.path.dirname(TELEMETRY_DB_PATH), exist_ok=True)
+    conn = sqlite3.connect(TELEMETRY_DB_PATH, timeout=10)
+    conn.row_factory = sqlite3.Row
+    if not _initialized:
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(_SCHEMA)
+        _initialized = True
+    return conn
+
+
+def _now() -> str:
+    return datetime.now().isoformat(timespec="seconds")
+
+
+def _write(sql: str, params: tuple):
+    """Run one INSERT / UPDATE; returns lastrowid, or None when the database is unavailable."""
+    try:
+        with _db_lock:
+            conn = _connect()
+            try:
+                with conn:
+                    return conn.execute(sql, params).lastrowid
+            finally:
+                conn.close()
+    except (sqlite3.Error, OSError):
+        return None
+
+
+def _rate(nbytes: int, duration: float):
+    return round(nbytes / duration, 1) if nbytes and duration > 0 else None
+
+
+@contextmanager
+def operation(kind: str, device_id: str | None = None, port: str | None = None, chip: str | None = None, mac: str | None = None,
+              usb_identity: str | None = None):
+    """
+    Record one backup / restore / flash / tune operation. esptool runs and retries on this thread are attributed
+    to it. Yields the op dict: set op["outcome"] ("ok", "error", "cancelled"), op["error"] and op["port"] (if the
+    device moved) before leaving the block; an exception records outcome "error".
+    """
+    op = {
+        "kind": kind, "device_id": device_id, "port": port, "chip": chip, "mac": mac, "usb_identity": usb_identity,
+        "bytes": 0, "runs": 0, "retries": 0, "outcome": None, "error": None,
+    }
+    op["id"] = _write(
+        "INSERT INTO flash_operations (kind, device_id, chip, mac, port, usb_identity, duration_s, outcome, created_at)"
+        " VALUES (?,?,?,?,?,?,?,?,?)",
+        (kind, device_id, chip, mac, port, usb_identity, 0, "running", _now()),
+    )
+    parent = getattr(_local, "op", None)
+    _local.op = op
+    started = time.monotonic()
+    try:
+        yield op
+    except BaseException as e:
+        op["outcome"], op["error"] = "error", op["error"] or str(e)
+        raise
+    finally:
+        _local.op = parent
+        duration = time.monotonic() - started
+        outcome = op["outcome"] or "ok"
+        error = (op["error"] or "")[:_ERROR_MAX] or None
+        if op["id"] is not None:
+            _write(
+                "UPDATE flash_operations SET chip = ?, mac = ?, port = ?, bytes = ?, duration_s = ?, bytes_per_sec = ?,"
+                " esptool_runs = ?, retries = ?, outcome = ?, error = ? WHERE id = ?",
+                (op["chip"], op["mac"], op["port"], op["bytes"], round(duration, 3), _rate(op["bytes"], duration),
+                 op["runs"], op["retries"], outcome, error, op["id"]),
+            )
+        if kind in ("restore", "flash") and device_id and outcome != "cancelled":
+            _write(
+                "INSERT INTO flash_history (device_id, flash_method, port, success, message, created_at)"
+                " VALUES (?,?,?,?,?,?)",
+                (device_id, "usb_direct", op["port"], 1 if outcome == "ok" else 0, error, _now()),
+            )
+
+
+def note_retry(count: int = 1) -> None:
+    """Count a retry (chunk re-read, baud fallback, job re-dispatch) against the current operation."""
+    op = getattr(_local, "op", None)
+    if op is not None:
+        op["retries"] += count
+
+
+def record_run(args, outcome: str, output: str, duration: float, total_bytes: int = 0) -> None:
+    """
+    Record one esptool invocation (args as passed to esptool). outcome: ok, error, cancelled, timeout, busy, gone.
+    Bytes count only when the run succeeded.
+    """
+    args = list(args)
+
+    def _arg(flag):
+        return args[args.index(flag) + 1] if flag in args and args.index(flag) + 1 < len(args) else None
+
+    command = next((a for a in args if not a.startswith("-") and a not in (_arg("--chip"), _arg("--port"), _arg("--baud"))), "?")
+    ok = outcome == "ok"
+    nbytes = int(total_bytes or 0) if ok else 0
+    baud = _arg("--baud")
+    op = getattr(_local, "op", None)
+    _write(
+        "INSERT INTO esptool_runs (operation_id, command, chip, port, baud, bytes, duration_s, bytes_per_sec, outcome,"
+        " error, created_at) VALUES (?,?,?,?,?,?,?,?,?,?,?)",
+        (op["id"] if op else None, command, _arg("--chip"), _arg("--port"),
+         int(baud) if baud and baud.isdigit() else None, nbytes, round(duration, 3), _rate(nbytes, duration),
+         outcome, None if ok else (output or "")[-_ERROR_MAX:], _now()),
+    )
+    if op is not None:
+        op["runs"] += 1
+        op["bytes"] += nbytes
+
+
+def _percentile(sorted_values: list, pct: float):
+    """Nearest-rank-interpolated percentile of an ascending list (None if empty)."""
+    if not sorted_values:
+        return None
+    k = (len(sorted_values) - 1) * pct / 100
+    lo = int(k)
+    hi = min(lo + 1, len(sorted_values) - 1)
+    return round(sorted_values[lo] + (sorted_values[hi] - sorted_values[lo]) * (k - lo), 3)
+
+
+def _summary(rows: list) -> dict:
+    durations = sorted(r["duration_s"] for r in rows)
+    rates = sorted(r["bytes_per_sec"] for r in rows if r["bytes_per_sec"])
+    ok = sum(1 for r in rows if r["outcome"] == "ok")
+    failed = sum(1 for r in rows if r["outcome"] not in ("ok", "cancelled"))
+    return {
+        "count": len(rows),
+        "ok": ok,
+        "failed": failed,
+        "failure_rate": round(failed / len(rows), 3) if rows else None,
+        "retries": sum(r["retries"] for r in rows),
+        "retries_per_op": round(sum(r["retries"] for r in rows) / len(rows), 2) if rows else None,
+        "duration_s": {p: _percentile(durations, p) for p in (50, 90, 99)},
+        # Low percentiles are the slow tail for throughput.
+        "bytes_per_sec": {p: _percentile(rates, p) for p in (10, 50, 90)},
+        "bytes_total": sum(r["bytes"] for r in rows),
+    }
+
+
+def stats(group_by: str = "operation", kind: str | None = None, since_days: float | None = None):
+    """
+    Percentiles of duration and bytes/sec, failure rate and retries per group (device, mac, chip, port, usb, operation),
+    worst first (failure rate, then slowest p90). Optional kind filter (backup, restore, flash, tune) and time window.
+    Returns (groups_or_None, error).
+    """
+    column = GROUP_COLUMNS.get(group_by)
+    if column is None:
+        return None, f"Unknown group_by: {group_by} (use {', '.join(GROUP_COLUMNS)})"
+    where, params = [], []
+    if kind:
+        where.append("kind = ?")
+        params.append(kind)
+    if since_days:
+        where.append("created_at >= ?")
+        params.append((datetime.now() - timedelta(days=float(since_days))).isoformat(timespec="seconds"))
+    where.append("outcome != 'running'")
+    sql = "SELECT * FROM flash_operations WHERE " + " AND ".join(where)
+    try:
+        with _db_lock:
+            conn = _connect()
+            try:
+                rows = conn.execute(sql, params).fetchall()
+            finally:
+                conn.close()
+    except (sqlite3.Error, OSError) as e:
+        return None, str(e)
+    groups = {}
+    for r in rows:
+        groups.setdefault(r[column], []).append(r)
+    out = [{"group": key, **_summary(items)} for key, items in groups.items()]
+    out.sort(key=lambda g: (-(g["failure_rate"] or 0), -(g["duration_s"][90] or 0)))
+    return out, None
+
+
+def recent_operations(limit: int = 50, with_runs: bool = False):
+    """Latest operations, newest first; with_runs adds each operation's esptool runs."""
+    try:
+        with _db_lock:
+            conn = _connect()
+            try:
+                ops = [dict(r) for r in conn.execute(
+                    "SELECT * FROM flash_operations ORDER BY id DESC LIMIT ?", (int(limit),))]
+                if with_runs:
+                    for op in ops:
+                        op["runs"] = [dict(r) for r in conn.execute(
+                            "SELECT command, baud, bytes, duration_s, bytes_per_sec, outcome, error FROM esptool_runs"
+                            " WHERE operation_id = ? ORDER BY id", (op["id"],))]
+            finally:
+                conn.close()
+    except (sqlite3.Error, OSError):
+        return []
+    return ops
@@ -0,0 +1,182 @@
+"""
+USB hotplug watcher: a background thread keeps a live map of USB serial devices (identity -> current port, chip, MAC)
+so flash jobs and the serial monitor follow a board when its port is renumbered, e.g. an ESP32-S3 re-enumerating as a
+new /dev/ttyACM* or cu.usbmodem* after a reset into the bootloader.
+Rescans the port list (pyserial reads /sys/class/tty on Linux, IOKit on macOS) every USB_WATCH_INTERVAL seconds;
+when pyudev is installed, tty add/remove events trigger an immediate rescan.
+"""
+import threading
+import time
+
+from config import USB_WATCH_INTERVAL
+from flash_ops import cached_detection, invalidate_detection, list_serial_ports, port_identity
+
+try:
+    import pyudev
+except ImportError:
+    pyudev = None
+
+_DISCONNECTED_KEEP_S = 600  # forget unplugged devices after 10 minutes
+
+_cond = threading.Condition()
+_devices = {}  # identity -> { identity, port, location, vid, pid, serial_number, description, connected, ... }
+_port_to_identity = {}
+_thread = None
+_mode = None
+
+
+def _scan() -> None:
+    """Rescan the port list and update the device map; wakes wait_for_device callers."""
+    try:
+        ports = list_serial_ports()
+    except Exception:
+        return
+    present = {}
+    for p in ports:
+        if p.get("port"):
+            present.setdefault(port_identity(p), p)
+    now = time.time()
+    with _cond:
+        for ident, p in present.items():
+            dev = _devices.get(ident)
+            if dev is None:
+                dev = _devices[ident] = {"identity": ident, "first_seen": now, "generation": 0}
+            elif not dev["connected"]:
+                dev["generation"] += 1  # re-enumerated (reset into / out of the bootloader, or replugged)
+                if not p.get("serial_number"):
+                    # No serial number: the identity is just the USB path, so whatever is plugged in now may be another board.
+                    invalidate_detection(ident)
+            if dev.get("port") and dev["port"] != p["port"]:
+                dev["previous_port"] = dev["port"]
+                if dev["connected"]:
+                    dev["generation"] += 1  # renumbered between two scans
+            dev.update(
+                port=p["port"],
+                description=p.get("description"),
+                location=p.get("location"),
+                vid=p.get("vid"),
+                pid=p.get("pid"),
+                serial_number=p.get("serial_number"),
+                connected=True,
+                last_seen=now,
+            )
+        for ident, dev in list(_devices.items()):
+            if ident in present:
+                continue
+            if dev["connected"]:
+                dev["connected"] = False
+                dev["disconnected_at"] = now
+            elif now - dev.get("disconnected_at", now) > _DISCONNECTED_KEEP_S:
+                del _devices[ident]
+        _port_to_identity.clear()
+        _port_to_identity.update({p["port"]: ident for ident, p in present.items()})
+        _cond.notify_all()
+
+
+def _watch_loop() -> None:
+    global _mode
+    monitor = None
+    if pyudev is not None:
+        try:
+            monitor = pyudev.Monitor.from_netlink(pyudev.Context())
+            monitor.filter_by("tty")
+            monitor.start()
+        except Exception:
+            monitor = None
+    _mode = "udev" if monitor is not None else "poll"
+    while True:
+        if monitor is not None:
+            try:
+                if monitor.poll(timeout=USB_WATCH_INTERVAL) is not None:
+                    time.sleep(0.2)  # let the rest of the add/remove burst settle before rescanning
+            except Exception:
+                monitor = None
+                _mode = "poll"
+        else:
+            time.sleep(USB_WATCH_INTERVAL)
+        _scan()
+
+
+def start_usb_watch() -> None:
+    """Start the watcher thread (idempotent). The first scan runs synchronously so the map is populated on return."""
+    global _thread
+    with _cond:
+        if _thread is not None:
+            return
+        _thread = threading.Thread(target=_watch_loop, name="usb-watch", daemon=True)
+    _scan()
+    _thread.start()
+
+
+def list_usb_devices():
+    """Known USB serial devices (connected first), each with current port, chip and MAC when detected."""
+    start_usb_watch()
+    with _cond:
+        devices = [dict(d) for d in _devices.values()]
+    for d in devices:
+        d.update(cached_detection(d["identity"]) or {"chip": None, "mac": None})
+    return sorted(devices, key=lambda d: (not d["connected"], d.get("port") or ""))
+
+
+def watch_mode():
+    """'udev', 'poll', or None when the watcher has not started."""
+    return _mode
+
+
+def identity_for_port(port: str):
+    """USB identity of the device currently on port, or None (unknown port or no USB metadata)."""
+    if not port:
+        return None
+    start_usb_watch()
+    with _cond:
+        return _port_to_identity.get(port)
+
+
+def device_for_port(port: str):
+    """Copy of the watcher's entry (vid, pid, serial_number, location, ...) for the device currently on port, or None."""
+    if not port:
+        return None
+    start_usb_watch()
+    with _cond:
+        dev = _devices.get(_port_to_identity.get(port))
+        return dict(dev) if dev else None
+
+
+def current_port(identity: str):
+    """Port the device with this identity is on right now, or None if it is not connected."""
+    if not identity:
+        return None
+    start_usb_watch()
+    with _cond:
+        dev = _devices.get(identity)
+        return dev["port"] if dev and dev["connected"] else None
+
+
+def device_generation(identity: str):
+    """Counter bumped whenever the device re-enumerates or changes port; None if unknown."""
+    if not identity:
+        return None
+    start_usb_watch()
+    with _cond:
+        dev = _devices.get(identity)
+        return dev["generation"] if dev else None
+
+
+def wait_for_device(identity: str, timeout: float = 10.0, cancel: threading.Event | None = None, after_generation: int | None = None):
+    """
+    Block until the device is connected; with after_generation, until it has re-enumerated since that generation
+    (i.e. it dropped off the bus and came back, possibly on a new port). Returns its port, or None on timeout / cancel.
+    """
+    if not identity:
+        return None
+    start_usb_watch()
+    deadline = time.monotonic() + timeout
+    with _cond:
+        while True:
+            dev = _devices.get(identity)
+            if dev and dev["connected"] and (after_generation is None or dev["generation"] > after_generation):
+                return dev["port"]
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or (cancel is not None and cancel.is_set()):
+                return None
+            _cond.wait(min(remaining, 0.5))
@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+"""
+Flash pipeline benchmark against emulated boards (scripts/esp_emulator.py): no hardware needed.
+Runs the inventory app's real job path (flash_jobs -> flash_ops -> esptool subprocess) and checks every result
+against the emulator's flash image. Scenarios: chip detect, full backup (adaptive chunked read), partition-aware
+app backup, backup over a flaky link (short reads + corrupted blocks: retries), flash, re-flash with
+skip_unchanged, restore, and a parallel fleet flash. Reports seconds, bytes/sec and retries (from flash telemetry)
+per scenario; exits 1 if any result does not match.
+Needs esptool and pyserial (pip install esptool pyserial flask pyyaml). Uses a throwaway REPO_ROOT, never the real artifacts/.
+
+  python scripts/bench_flash.py
+  python scripts/bench_flash.py --flash-size 8MB --link-bps 0 --fleet 8 --json bench.json
+"""
+from __future__ import annotations
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import shutil
+import struct
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+SCRIPTS_DIR = Path(__file__).resolve().parent
+APP_DIR = SCRIPTS_DIR.parent / "inventory" / "app"
+sys.path.insert(0, str(SCRIPTS_DIR))
+
+from esp_emulator import EspEmulator, parse_size
+
+BENCH_DEVICE = "bench_emulator"
+APP_OFFSET = 0x10000
+
+
+def _partition_table(flash_size: int) -> bytes:
+    """nvs, otadata, two OTA app slots and spiffs (the Arduino default layout, scaled to flash_size)."""
+    app_size = (flash_size - 0x20000) // 3 & ~0xFFFF
+    rows = [
+        ("nvs", 1, 0x02, 0x9000, 0x5000),
+        ("otadata", 1, 0x00, 0xE000, 0x2000),
+        ("app0", 0, 0x10, APP_OFFSET, app_size),
+        ("app1", 0, 0x11, APP_OFFSET + app_size, app_size),
+        ("spiffs", 1, 0x82, APP_OFFSET + 2 * app_size, flash_size - APP_OFFSET - 2 * app_size),
+    ]
+    table = b"".join(
+        struct.pack("<2sBBII16sI", b"\xaa\x50", t, st, off, size, name.encode().ljust(16, b"\0"), 0)
+        for name, t, st, off, size in rows
+    )
+    return table + b"\xff" * (0xC00 - len(table))
+
+
+def _app_image(size: int) -> bytes:
+    """A structurally valid app image (header, 3 segments, checksum block, appended SHA-256) of about size bytes."""
+    seg_len = (size // 3) & ~3
+    header = bytes([0xE9, 3, 2, 0x20]) + struct.pack("<I", 0x40380000) + bytes(15) + b"\x01"
+    body = b"".join(struct.pack("<II", 0x3C000000 + i * 0x100000, seg_len) + os.urandom(seg_len) for i in range(3))
+    image = header + body
+    image += bytes(16 - len(image) % 16)
+    return image + os.urandom(32)
+
+
+def _synthetic_flash(flash_size: int) -> tuple:
+    """(image, app_length): bootloader-ish noise, partition table, NVS data, a 40%-full app0, erased elsewhere."""
+    flash = bytearray(b"\xff" * flash_size)
+    flash[0x1000:0x6000] = os.urandom(0x5000)
+    flash[0x8000:0x8C00] = _partition_table(flash_size)
+    flash[0x9000:0xB000] = os.urandom(0x2000)
+    app = _app_image(int((flash_size - 0x20000) // 3 * 0.4))
+    flash[APP_OFFSET:APP_OFFSET + len(app)] = app
+    return bytes(flash), len(app)
+
+
+class Bench:
+    def __init__(self, args):
+        self.args = args
+        self.results = []
+        self.emulators = []
+
+    def emulator(self, image=None, **kw) -> EspEmulator:
+        opts = dict(chip=self.args.chip, flash_size=self.args.flash_size, link_bps=self.args.link_bps,
+                    latency=self.args.latency, seed=len(self.emulators))
+        opts.update(kw)
+        emu = EspEmulator(flash=image, **opts)
+        emu.start()
+        self.emulators.append(emu)
+        return emu
+
+    def stop(self):
+        for emu in self.emulators:
+            emu.stop()
+
+    def record(self, name, seconds, nbytes=0, ok=True, retries=0, detail=""):
+        row = {
+            "scenario": name, "ok": bool(ok), "seconds": round(seconds, 2), "bytes": nbytes,
+            "bytes_per_sec": round(nbytes / seconds) if nbytes and seconds > 0 else None,
+            "retries": retries, "detail": detail,
+        }
+        self.results.append(row)
+        rate = f"{row['bytes_per_sec'] / 1024:8.1f} KB/s" if row["bytes_per_sec"] else " " * 13
+        print(f"  {'ok  ' if ok else 'FAIL'} {name:<28} {seconds:7.2f}s {rate} retries={retries:<3} {detail}", flush=True)
+
+    def job(self, kind, port, params=None):
+        """Run one flash job to completion. Returns (snapshot, seconds, telemetry operation row)."""
+        from flash_jobs import submit_job, wait_job
+        from telemetry import recent_operations
+        started = time.monotonic()
+        snap = wait_job(submit_job(kind, port, BENCH_DEVICE, params), timeout=self.args.timeout)
+        seconds = time.monotonic() - started
+        ops = recent_operations(limit=1)
+        return snap, seconds, (ops[0] if ops else {})
+
+
+def run(args) -> int:
+    flash_size = parse_size(args.flash_size)
+    import config
+    config.FLASH_DEVICES[BENCH_DEVICE] = {
+        "chip": args.chip, "flash_size": f"{flash_size >> 20}MB", "description": "Emulated board (bench_flash.py)",
+    }
+    import backup_store
+    import flash_ops
+    from fleet_ops import get_fleet, start_fleet_flash
+
+    bench = Bench(args)
+    image, app_len = _synthetic_flash(flash_size)
+    work = Path(config.REPO_ROOT)
+    print(f"Flash benchmark: {args.chip}, {flash_size >> 20} MB flash, link "
+          f"{'unthrottled' if args.link_bps == 0 else f'{args.link_bps} B/s' if args.link_bps else 'baud/10'}, "
+          f"latency {args.latency * 1000:.0f} ms, fleet {args.fleet}", flush=True)
+    try:
+        emu = bench.emulator(image)
+
+        started = time.monotonic()
+        with contextlib.redirect_stdout(io.StringIO()):  # in-process esptool prints its connect log
+            chip, err = flash_ops.detect_chip_on_port(emu.port)
+        bench.record("detect", time.monotonic() - started, ok=chip == args.chip, detail=err or chip or "")
+
+        snap, secs, op = bench.job("backup", emu.port, {"backup_type": "full", "name": "bench_full"})
+        full_manifest = (snap.get("result") or {}).get("abs_path") if snap else None
+        ok = False
+        if full_manifest:
+            with backup_store.materialized(full_manifest) as path:
+                ok = Path(path).read_bytes() == bytes(emu.flash)
+        bench.record("backup full", secs, flash_size, ok, op.get("retries", 0), (snap or {}).get("error") or "")
+
+        snap, secs, op = bench.job("backup", emu.port, {"backup_type": "app", "name": "bench_app"})
+        result = (snap or {}).get("result") or {}
+        app_read = -(-app_len // 0x1000) * 0x1000  # the image, rounded up to a flash sector
+        bench.record("backup app (partition-aware)", secs, result.get("size") or 0,
+                     snap and snap["status"] == "done" and result.get("size") == app_read, op.get("retries", 0),
+                     (snap or {}).get("error") or f"{app_read} of {flash_size} bytes")
+
+        flaky = bench.emulator(image, max_read=args.flaky_max_read, error_rate=args.flaky_error_rate)
+        snap, secs, op = bench.job("backup", flaky.port, {"backup_type": "full", "name": "bench_flaky"})
+        ok = False
+        if snap and snap["status"] == "done":
+            with backup_store.materialized(snap["result"]["abs_path"]) as path:
+                ok = Path(path).read_bytes() == bytes(flaky.flash)
+        bench.record("backup full (flaky link)", secs, flash_size, ok, op.get("retries", 0),
+                     (snap or {}).get("error") or f"{flaky.stats['errors_injected']} errors injected")
+
+        firmware = os.urandom(args.image_size // 2) + b"\xff" * (args.image_size - args.image_size // 2)
+        bin_path = work / "bench_firmware.bin"
+        bin_path.write_bytes(firmware)
+        for name, skip in (("flash", False), ("re-flash (skip_unchanged)", True)):
+            snap, secs, op = bench.job("flash", emu.port, {"bin_path": str(bin_path), "addr": hex(APP_OFFSET), "skip_unchanged": skip})
+            ok = snap and snap["status"] == "done" and bytes(emu.flash[APP_OFFSET:APP_OFFSET + len(firmware)]) == firmware
+            bench.record(name, secs, len(firmware), ok, op.get("retries", 0), (snap or {}).get("error") or "")
+
+        if full_manifest:
+            snap, secs, op = bench.job("restore", emu.port, {"bin_path": full_manifest, "skip_unchanged": True})
+            bench.record("restore (skip_unchanged)", secs, flash_size,
+                         snap and snap["status"] == "done" and bytes(emu.flash) == image, op.get("retries", 0),
+                         (snap or {}).get("error") or "")
+
+        if args.fleet:
+            fleet = [bench.emulator(image) for _ in range(args.fleet)]
+            started = time.monotonic()
+            fleet_id = start_fleet_flash([{"port": e.port} for e in fleet], BENCH_DEVICE, str(bin_path), hex(APP_OFFSET),
+                                         max_per_hub=args.fleet)
+            while (get_fleet(fleet_id) or {}).get("status") == "running" and time.monotonic() - started < args.timeout:
+                time.sleep(0.2)
+            secs = time.monotonic() - started
+            state = get_fleet(fleet_id) or {}
+            flashed = sum(1 for e in fleet if bytes(e.flash[APP_OFFSET:APP_OFFSET + len(firmware)]) == firmware)
+            from telemetry import recent_operations
+            retries = sum(o.get("retries", 0) for o in recent_operations(limit=args.fleet))
+            bench.record(f"fleet flash x{args.fleet}", secs, len(firmware) * args.fleet,
+                         state.get("status") == "done" and flashed == args.fleet, retries,
+                         f"{flashed}/{args.fleet} verified")
+    finally:
+        bench.stop()
+
+    from telemetry import stats
+    groups, _ = stats(group_by="operation")
+    report = {
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "config": {k: v for k, v in vars(args).items() if k != "json"},
+        "python": platform.python_version(),
+        "esptool": getattr(flash_ops.esptool_lib, "__version__", None),
+        "scenarios": bench.results,
+        "telemetry": groups or [],
+    }
+    if args.json:
+        Path(args.json).write_text(json.dumps(report, indent=2))
+        print(f"Wrote {args.json}")
+    failed = [r["scenario"] for r in bench.results if not r["ok"]]
+    if failed:
+        print(f"FAILED: {', '.join(failed)}")
+    return 1 if failed else 0
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark backup / flash / restore / fleet flashing against emulated boards.")
+    parser.add_argument("--chip", default="esp32s3", choices=("esp32", "esp32s2", "esp32s3", "esp32c3"))
+    parser.add_argument("--flash-size", default="4MB")
+    parser.add_argument("--image-size", type=parse_size, default="1MB", help="Firmware image size for the flash scenarios")
+    parser.add_argument("--link-bps", type=int, default=250000, help="Bytes/sec each way per board (0 = unthrottled)")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds before each emulator response")
+    parser.add_argument("--flaky-max-read", type=parse_size, default="256KB", help="Flaky board: reads above this drop data")
+    parser.add_argument("--flaky-error-rate", type=float, default=0.002, help="Flaky board: corrupted block probability")
+    parser.add_argument("--fleet", type=int, default=4, help="Boards in the parallel fleet flash (0 = skip)")
+    parser.add_argument("--timeout", type=float, default=600, help="Per-scenario timeout in seconds")
+    parser.add_argument("--json", help="Write results (and telemetry percentiles) here")
+    args = parser.parse_args(argv)
+
+    if shutil.which("esptool") is None and shutil.which("esptool.py") is None:
+        print("esptool not found (pip install esptool pyserial)", file=sys.stderr)
+        return 2
+    work = tempfile.mkdtemp(prefix="bench_flash_")
+    # Before importing the app: throwaway artifacts/ and telemetry.db, and no DTR/RTS resets (ptys have none)
+    os.environ["REPO_ROOT"] = work
+    os.environ.setdefault("ESPTOOL_BEFORE", "no_reset")
+    os.environ.setdefault("ESPTOOL_AFTER", "no_reset")
+    sys.path.insert(0, str(APP_DIR))
+    try:
+        return run(args)
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
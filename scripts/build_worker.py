@@ -0,0 +1,472 @@
+#!/usr/bin/env python3
+"""
+Build worker for the inventory app's remote builds (inventory/app/build_workers.py): run it on any lab host with Docker
+(or a local PlatformIO) and it pulls PlatformIO builds over HTTP, builds them and uploads firmware.bin, firmware.elf and
+partitions.bin. Standard library only; needs git, and docker (--runner docker, image platformio-lab with the same
+lab-pio-packages / lab-ccache volumes as scripts/lab-exec.sh) or pio on PATH (--runner local).
+Builds arrive as a git revision: the worker keeps a bare mirror per upstream (work-dir/mirrors/) and a warm checkout
+per repo and env (work-dir/src/<repo>/<env>, .pio/ kept between builds), checks out the commit, applies the build's
+patches and runs pio run. Its heartbeat reports slots, load, toolchain and the commit of each warm checkout, so the
+app sends a build to the worker that already has the tree.
+Several workers can run on one machine (distinct --id and --work-dir) to try it out.
+
+  python scripts/build_worker.py --server http://lab-host:5050 --slots 2
+  python scripts/build_worker.py --server http://127.0.0.1:5050 --id w2 --work-dir /tmp/w2 --runner local
+Env: BUILD_WORKER_TOKEN (the app's token, sent as X-Build-Worker-Token; the app accepts no worker without one).
+"""
+from __future__ import annotations
+
+import argparse
+import base64
+import json
+import os
+import re
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+from pathlib import Path
+
+SCRIPTS_DIR = Path(__file__).resolve().parent
+UPLOAD_FILES = ("firmware.bin", "firmware.elf", "partitions.bin")
+HEARTBEAT_S = 5
+LOG_FLUSH_S = 1.0
+CLAIM_WAIT_S = 20
+
+# PlatformIO core version and installed platforms, in the shape of build_cache.toolchain_version (the app keys the build
+# cache on it); runs with the worker's python (local) or the image's python3 (docker)
+_TOOLCHAIN_SNIPPET = r"""
+import json, os, subprocess
+try:
+    r = subprocess.run(["pio", "--version"], capture_output=True, text=True, timeout=60)
+    core = (r.stdout or r.stderr).strip()
+except (OSError, subprocess.TimeoutExpired):
+    print("{}")
+    raise SystemExit
+core_dir = os.environ.get("PLATFORMIO_CORE_DIR") or os.path.join(os.path.expanduser("~"), ".platformio")
+platforms_dir = os.path.join(core_dir, "platforms")
+platforms = []
+for name in sorted(os.listdir(platforms_dir)) if os.path.isdir(platforms_dir) else []:
+    try:
+        with open(os.path.join(platforms_dir, name, "platform.json"), encoding="utf-8") as f:
+            platforms.append(f"{name}@{json.load(f).get('version')}")
+    except (OSError, ValueError):
+        continue
+print(json.dumps({"core": core, "platforms": platforms}))
+"""
+
+
+def _log(msg: str) -> None:
+    print(f"{time.strftime('%H:%M:%S')} {msg}", flush=True)
+
+
+def _git(args, cwd=None, timeout: int = 1800):
+    """(ok, output) of a git command; output is stderr (or stdout) on failure."""
+    try:
+        r = subprocess.run(["git"] + args, cwd=cwd, capture_output=True, text=True, timeout=timeout)
+    except subprocess.TimeoutExpired:
+        return False, f"git {args[0]} timed out"
+    except OSError as e:
+        return False, str(e)
+    return r.returncode == 0, (r.stdout if r.returncode == 0 else (r.stderr or r.stdout)).strip()
+
+
+def _slug(url: str) -> str:
+    """Directory name for a repo URL: host and path, other characters replaced."""
+    url = re.sub(r"(^[a-z+]+://([^@/]*@)?|\.git$)", "", url.strip())
+    return re.sub(r"[^\w.-]+", "_", url.replace(":", "/")).strip("_.") or "repo"
+
+
+class Worker:
+    def __init__(self, args):
+        self.server = args.server.rstrip("/")
+        self.id = args.id
+        self.slots = args.slots
+        self.work_dir = Path(args.work_dir).resolve()
+        self.runner = args.runner
+        self.image = args.image
+        self.token = args.token
+        self.stop = threading.Event()
+        self.lock = threading.Lock()
+        self.running = 0
+        self.trees = {}  # checkout dir -> {repo_url, env, commit, busy}
+        self.repo_locks = {}  # mirror dir -> lock (one fetch at a time)
+        self.toolchain = {}
+        self._load_trees()
+
+    # --- HTTP -------------------------------------------------------------------------------------------------------
+
+    def _request(self, path: str, body: bytes, content_type: str, timeout: float):
+        """(status, parsed JSON or None) of a POST to the app; status 0 when the app is unreachable."""
+        headers = {"Content-Type": content_type}
+        if self.token:
+            headers["X-Build-Worker-Token"] = self.token
+        req = urllib.request.Request(self.server + path, data=body, headers=headers, method="POST")
+        try:
+            with urllib.request.urlopen(req, timeout=timeout) as r:
+                raw = r.read()
+                return r.status, (json.loads(raw) if raw else None)
+        except urllib.error.HTTPError as e:
+            try:
+                return e.code, json.loads(e.read() or b"null")
+            except ValueError:
+                return e.code, None
+        except (OSError, ValueError) as e:
+            return 0, {"error": str(e)}
+
+    def _post(self, path: str, data: dict, timeout: float = 30):
+        return self._request(path, json.dumps(data).encode(), "application/json", timeout)
+
+    def _upload(self, build_id: str, fields: dict, files: dict):
+        """Multipart POST of the build result: form fields and {name: path} files."""
+        boundary = uuid.uuid4().hex
+        parts = []
+        for name, value in fields.items():
+            parts.append(
+                f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode()
+            )
+        for name, path in files.items():
+            parts.append(
+                f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{name}"\r\n'
+                f"Content-Type: application/octet-stream\r\n\r\n".encode() + Path(path).read_bytes() + b"\r\n"
+            )
+        parts.append(f"--{boundary}--\r\n".encode())
+        return self._request(
+            f"/api/flash/build-workers/jobs/{build_id}/result", b"".join(parts),
+            f"multipart/form-data; boundary={boundary}", timeout=300,
+        )
+
+    # --- heartbeat --------------------------------------------------------------------------------------------------
+
+    def _targets(self):
+        with self.lock:
+            return [
+                {"repo_url": t["repo_url"], "env": t["env"], "commit": t["commit"]}
+                for t in self.trees.values() if t.get("commit")
+            ]
+
+    def heartbeat(self) -> bool:
+        with self.lock:
+            running = self.running
+        status, data = self._post("/api/flash/build-workers/heartbeat", {
+            "worker_id": self.id, "host": socket.gethostname(), "slots": self.slots, "running": running,
+            "load": os.getloadavg()[0] if hasattr(os, "getloadavg") else 0, "cpus": os.cpu_count() or 1,
+            "runner": self.runner, "toolchain": self.toolchain, "targets": self._targets(),
+        }, timeout=10)
+        if status != 200:
+            _log(f"Heartbeat failed ({status}): {(data or {}).get('error')}")
+        return status == 200
+
+    def _heartbeat_loop(self):
+        while not self.stop.wait(HEARTBEAT_S):
+            self.heartbeat()
+
+    def _refresh_toolchain(self):
+        if self.runner == "docker":
+            cmd = ["docker", "run", "--rm", "-v", "lab-pio-packages:/root/.platformio", self.image,
+                   "python3", "-c", _TOOLCHAIN_SNIPPET]
+        else:
+            cmd = [sys.executable, "-c", _TOOLCHAIN_SNIPPET]
+        try:
+            r = subprocess.run(cmd, capture_output=True, text=True, timeout=120)
+            toolchain = json.loads(r.stdout.strip().splitlines()[-1]) if r.returncode == 0 and r.stdout.strip() else {}
+        except (OSError, subprocess.TimeoutExpired, ValueError):
+            toolchain = {}
+        with self.lock:
+            self.toolchain = toolchain if isinstance(toolchain, dict) else {}
+
+    # --- source trees -----------------------------------------------------------------------------------------------
+
+    def _load_trees(self):
+        """Warm checkouts from earlier runs (their <dir>.json state files)."""
+        for state in self.work_dir.glob("src/*/*.json"):
+            try:
+                t = json.loads(state.read_text())
+            except (OSError, ValueError):
+                continue
+            if state.with_suffix("").is_dir():
+                self.trees[str(state.with_suffix(""))] = {**t, "busy": False}
+
+    def _save_tree(self, tree_dir: str):
+        with self.lock:
+            t = {k: v for k, v in self.trees[tree_dir].items() if k != "busy"}
+        Path(tree_dir + ".json").write_text(json.dumps(t))
+
+    def _acquire_tree(self, repo_url: str, env_name: str, commit: str) -> str:
+        """A free checkout for repo and env, preferring one already at commit (a new one when all are busy)."""
+        base = self.work_dir / "src" / _slug(repo_url) / re.sub(r"[^\w.-]", "_", env_name)
+        with self.lock:
+            candidates = [str(base)] + [f"{base}-{i}" for i in range(2, self.slots + 2)]
+            free = [d for d in candidates if not self.trees.get(d, {}).get("busy")]
+            tree_dir = next((d for d in free if self.trees.get(d, {}).get("commit") == commit), free[0])
+            self.trees[tree_dir] = {**self.trees.get(tree_dir, {}), "repo_url": repo_url, "env": env_name, "busy": True}
+            return tree_dir
+
+    def _release_tree(self, tree_dir: str, commit):
+        with self.lock:
+            self.trees[tree_dir].update(busy=False, commit=commit)
+        self._save_tree(tree_dir)
+
+    def _mirror(self, repo_url: str, commit: str, out):
+        """Bare mirror of repo_url holding commit (cloned, or fetched when the commit is new). Returns (ok, path_or_error)."""
+        mirror = self.work_dir / "mirrors" / (_slug(repo_url) + ".git")
+        with self.lock:
+            lock = self.repo_locks.setdefault(str(mirror), threading.Lock())
+        with lock:
+            if not (mirror / "HEAD").is_file():
+                out(f"Cloning mirror of {repo_url}")
+                tmp = mirror.with_name(mirror.name + ".tmp")
+                shutil.rmtree(tmp, ignore_errors=True)
+                tmp.parent.mkdir(parents=True, exist_ok=True)
+                ok, err = _git(["clone", "--mirror", "--quiet", repo_url, str(tmp)])
+                if not ok:
+                    shutil.rmtree(tmp, ignore_errors=True)
+                    return False, f"git clone --mirror failed: {err[:300]}"
+                # Checkouts borrow objects from here: never prune them away
+                _git(["config", "gc.pruneExpire", "never"], str(tmp))
+                tmp.rename(mirror)
+            if _git(["cat-file", "-e", f"{commit}^{{commit}}"], str(mirror), timeout=30)[0]:
+                return True, str(mirror)
+            out(f"Fetching {repo_url}")
+            ok, err = _git(["fetch", "--prune", "--quiet", "origin"], str(mirror))
+            if not _git(["cat-file", "-e", f"{commit}^{{commit}}"], str(mirror), timeout=30)[0]:
+                # A commit outside the mirrored refs (pinned by a tag that moved, or a PR ref)
+                ok, err = _git(["fetch", "--quiet", "origin", commit], str(mirror))
+                if not ok:
+                    return False, f"commit {commit[:12]} not found upstream: {err[:300]}"
+            return True, str(mirror)
+
+    def _checkout(self, spec: dict, tree_dir: str, out):
+        """Check tree_dir out at the spec's commit with its patches applied. Returns (ok, build_dir_or_error)."""
+        ok, mirror = self._mirror(spec["repo_url"], spec["commit"], out)
+        if not ok:
+            return False, mirror
+        tree = Path(tree_dir)
+        if not (tree / ".git").exists():
+            shutil.rmtree(tree, ignore_errors=True)
+            tree.parent.mkdir(parents=True, exist_ok=True)
+            ok, err = _git(["clone", "--shared", "--no-checkout", "--quiet", mirror, tree_dir])
+            if not ok:
+                return False, f"git clone failed: {err[:300]}"
+            # Relative submodule URLs resolve against origin: point it at upstream (objects still come from the mirror)
+            _git(["remote", "set-url", "origin", spec["repo_url"]], tree_dir)
+        out(f"Checking out {spec['commit'][:12]} in {tree_dir}")
+        ok, err = _git(["checkout", "--force", "--quiet", "--detach", spec["commit"]], tree_dir)
+        if not ok:
+            return False, f"git checkout failed: {err[:300]}"
+        _git(["clean", "-fdq"], tree_dir)  # files added by earlier patches; ignored files (.pio/) stay
+        _git(["submodule", "sync", "--recursive", "--quiet"], tree_dir)
+        ok, err = _git(["submodule", "update", "--init", "--recursive", "--force", "--quiet"], tree_dir)
+        if not ok:
+            return False, f"git submodule update failed: {err[:300]}"
+        build_dir = tree / spec.get("subdir", ".")
+        for patch in spec.get("patches") or []:
+            try:
+                r = subprocess.run(
+                    ["git", "apply", "-p1", "--verbose"], cwd=build_dir, input=base64.b64decode(patch["data"]),
+                    capture_output=True, timeout=60,
+                )
+            except (OSError, subprocess.TimeoutExpired) as e:
+                return False, f"Patch {patch['name']} failed: {e}"
+            if r.returncode != 0:
+                return False, f"Patch {patch['name']} failed: {r.stderr.decode(errors='replace')[:300]}"
+            out(f"Applied patch {patch['name']}")
+        return True, str(build_dir)
+
+    # --- builds -----------------------------------------------------------------------------------------------------
+
+    def _command(self, spec: dict, tree_dir: str, build_dir: str, args, name: str):
+        """(argv, env) running pio with args in build_dir, in a throwaway container or on the host."""
+        if self.runner == "docker":
+            subdir = os.path.relpath(build_dir, tree_dir)
+            return [
+                "docker", "run", "--rm", "--name", name,
+                "-v", f"{tree_dir}:/workspace", "-v", f"{SCRIPTS_DIR}:/lab-scripts:ro",
+                "-v", "lab-pio-packages:/root/.platformio", "-v", "lab-ccache:/ccache",
+                # Every checkout is /workspace in the container, so they all share ccache entries
+                "-e", "CCACHE_DIR=/ccache", "-e", "CCACHE_BASEDIR=/workspace", "-e", "CCACHE_NOHASHDIR=1",
+                "-e", "PLATFORMIO_EXTRA_SCRIPTS=pre:/lab-scripts/pio_ccache.py",
+                "-w", "/workspace/" + subdir.replace(os.sep, "/"), self.image, "pio",
+            ] + args, None
+        env = dict(os.environ)
+        if shutil.which("ccache"):
+            env.update(CCACHE_BASEDIR=tree_dir, CCACHE_NOHASHDIR="1")
+            env["PLATFORMIO_EXTRA_SCRIPTS"] = f"pre:{SCRIPTS_DIR / 'pio_ccache.py'}"
+        return ["pio"] + args, env
+
+    def _run_pio(self, spec: dict, tree_dir: str, build_dir: str, args, out, cancelled, deadline: float):
+        """Run pio, streaming its output; kills it on cancel or timeout. Returns (ok, error)."""
+        name = f"build-worker-{spec['build_id']}"
+        cmd, env = self._command(spec, tree_dir, build_dir, args, name)
+        out("$ " + " ".join(["pio"] + args))
+        try:
+            proc = subprocess.Popen(
+                cmd, cwd=build_dir, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True,
+                errors="replace", start_new_session=True,
+            )
+        except OSError as e:
+            return False, str(e)
+        reader = threading.Thread(target=lambda: [out(line) for line in proc.stdout], daemon=True)
+        reader.start()
+        stopped = None
+        while proc.poll() is None:
+            if cancelled():
+                stopped = "Build cancelled"
+            elif time.time() > deadline:
+                stopped = "Build timed out"
+            if stopped:
+                if self.runner == "docker":
+                    subprocess.run(["docker", "rm", "-f", name], capture_output=True, timeout=60)
+                try:
+                    os.killpg(proc.pid, signal.SIGKILL)
+                except OSError:
+                    pass
+                break
+            time.sleep(0.2)
+        proc.wait()
+        reader.join(timeout=10)
+        if stopped:
+            return False, stopped
+        return proc.returncode == 0, (None if proc.returncode == 0 else f"pio run exited with code {proc.returncode}")
+
+    def build(self, spec: dict) -> None:
+        build_id = spec["build_id"]
+        started = time.time()
+        pending, state = [], {"cancel": False}
+        pending_lock = threading.Lock()
+
+        def out(line):
+            with pending_lock:
+                pending.append(line.rstrip("\n"))
+
+        def flush():
+            with pending_lock:
+                lines = pending[:]
+                pending.clear()
+            status, data = self._post(
+                f"/api/flash/build-workers/jobs/{build_id}/log", {"worker_id": self.id, "lines": lines}, timeout=30,
+            )
+            if status == 409 or (status == 200 and (data or {}).get("cancel")):
+                state["cancel"] = True
+
+        stop_flush = threading.Event()
+
+        def flush_loop():
+            while not stop_flush.wait(LOG_FLUSH_S):
+                flush()
+
+        flusher = threading.Thread(target=flush_loop, daemon=True)
+        flusher.start()
+        _log(f"Build {build_id}: {spec['device_id']}/{spec['firmware_id']} env {spec['env_name']} @ {spec['commit'][:12]}")
+        tree_dir = self._acquire_tree(spec["repo_url"], spec["env_name"], spec["commit"])
+        commit = None
+        ok, error, files = False, None, {}
+        try:
+            out(f"Worker {self.id} ({socket.gethostname()}, {self.runner})")
+            ok, build_dir = self._checkout(spec, tree_dir, out)
+            if not ok:
+                error = build_dir
+                return
+            commit = None if spec.get("patches") else spec["commit"]
+            deadline = started + float(spec.get("timeout") or 300)
+            cancelled = lambda: state["cancel"] or self.stop.is_set()
+            if spec.get("clean"):
+                self._run_pio(spec, tree_dir, build_dir, ["run", "-e", spec["env_name"], "-t", "clean"], out, cancelled, deadline)
+            args = ["run", "-e", spec["env_name"]]
+            if spec.get("jobs"):
+                args += ["-j", str(spec["jobs"])]
+            if spec.get("verbose"):
+                args.append("-v")
+            ok, error = self._run_pio(spec, tree_dir, build_dir, args, out, cancelled, deadline)
+            out_dir = Path(build_dir) / ".pio" / "build" / spec["env_name"]
+            files = {name: str(out_dir / name) for name in UPLOAD_FILES if (out_dir / name).is_file()} if ok else {}
+        finally:
+            stop_flush.set()
+            flusher.join(timeout=35)
+            self._refresh_toolchain()
+            flush()
+            # A patched build leaves the tree off its commit: don't advertise it as warm for that commit
+            self._release_tree(tree_dir, commit)
+            # A worker shutting down uploads nothing: the app sees it gone and builds elsewhere
+            if not state["cancel"] and not self.stop.is_set():
+                status, data = self._upload(build_id, {
+                    "worker_id": self.id, "ok": "1" if ok else "0", "error": error or "",
+                    "meta": json.dumps({"toolchain": self.toolchain, "duration_s": round(time.time() - started, 3)}),
+                }, files)
+                if status != 200:
+                    _log(f"Build {build_id}: upload failed ({status}): {(data or {}).get('error')}")
+            _log(f"Build {build_id}: {'ok' if ok else error} in {time.time() - started:.1f}s")
+
+    def _slot_loop(self):
+        while not self.stop.is_set():
+            asked = time.time()
+            status, spec = self._post(
+                "/api/flash/build-workers/claim", {"worker_id": self.id, "wait": CLAIM_WAIT_S}, timeout=CLAIM_WAIT_S + 30,
+            )
+            if status == 200 and isinstance(spec, dict):
+                with self.lock:
+                    self.running += 1
+                try:
+                    self.build(spec)
+                except Exception as e:  # keep the slot alive; the app notices the missing result
+                    _log(f"Build {spec.get('build_id')} failed: {e}")
+                finally:
+                    with self.lock:
+                        self.running -= 1
+                self.heartbeat()
+                continue
+            if status not in (200, 204):
+                _log(f"Claim failed ({status}): {(spec or {}).get('error')}")
+                self.stop.wait(HEARTBEAT_S)
+            elif time.time() - asked < 1:
+                self.stop.wait(1)  # not registered yet (or app restarted): let the heartbeat catch up
+
+    def serve(self) -> int:
+        self.work_dir.mkdir(parents=True, exist_ok=True)
+        self._refresh_toolchain()
+        if not self.toolchain:
+            _log(f"Warning: no PlatformIO toolchain found ({self.runner} runner)")
+        _log(f"Worker {self.id}: {self.slots} slot(s), {self.runner} runner, work dir {self.work_dir}, server {self.server}")
+        self.heartbeat()
+        signal.signal(signal.SIGTERM, lambda *_: self.stop.set())
+        threads = [threading.Thread(target=self._heartbeat_loop, daemon=True)]
+        threads += [threading.Thread(target=self._slot_loop, daemon=True) for _ in range(self.slots)]
+        for t in threads:
+            t.start()
+        try:
+            while not self.stop.wait(1):
+                pass
+        except KeyboardInterrupt:
+            self.stop.set()
+        _log("Stopping (running builds are killed)")
+        deadline = time.time() + 60
+        while time.time() < deadline:
+            with self.lock:
+                if not self.running:
+                    break
+            time.sleep(0.2)
+        return 0
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Pull PlatformIO builds from the inventory app and build them on this host.")
+    parser.add_argument("--server", default=os.environ.get("BUILD_WORKER_SERVER", "http://127.0.0.1:5050"), help="Inventory app URL")
+    parser.add_argument("--id", default=f"{socket.gethostname()}-{os.getpid()}", help="Worker id (unique per worker process)")
+    parser.add_argument("--slots", type=int, default=1, help="Builds run at once")
+    parser.add_argument("--work-dir", default=os.path.expanduser("~/.cache/lab-build-worker"), help="Mirrors and warm checkouts")
+    parser.add_argument("--runner", choices=("docker", "local"), default="docker")
+    parser.add_argument("--image", default=os.environ.get("LAB_IMAGE_PLATFORMIO", "platformio-lab"), help="Docker image (docker runner)")
+    parser.add_argument("--token", default=os.environ.get("BUILD_WORKER_TOKEN", ""), help="App's BUILD_WORKER_TOKEN")
+    args = parser.parse_args(argv)
+    args.slots = max(1, args.slots)
+    return Worker(args).serve()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
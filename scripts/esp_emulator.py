@@ -0,0 +1,497 @@
+#!/usr/bin/env python3
+"""
+Software stand-in for an ESP32-family board on a serial port, for testing and benchmarking the flash pipeline
+(inventory/app/flash_ops.py) without hardware. Each emulator owns a pseudo-terminal; esptool opens the pty slave
+like a USB serial port and talks the ROM loader / flasher stub protocol to an in-memory flash image.
+
+Emulated: SLIP framing; ROM loader (sync, read/write register, mem_begin/data/end to "upload" the stub, which answers
+OHAI and switches to 2-byte status); flasher stub (flash_begin/data/end, compressed flash_defl_*, SPI flash MD5,
+read_flash with block acks and final digest, erase_flash/erase_region, change_baudrate, spi_attach/set_params);
+SPI RDID through the SPI peripheral registers; chip magic, security info (chip ID) and MAC efuses for esp32,
+esp32s2, esp32s3 and esp32c3. Closing the port resets the emulated chip back to the ROM loader.
+
+Link model: bytes/sec in each direction (default: negotiated baud / 10, as on a real UART), a fixed latency
+before each response, and injected errors: error_rate corrupts read_flash blocks (digest mismatch) and
+compressed write packets (bad checksum); max_read makes read_flash requests larger than N bytes drop data
+mid-transfer, like the ESP32-S3 USB-Serial/JTAG on long reads.
+
+No reset lines on a pty: run esptool with --before no_reset --after no_reset (flash_ops: ESPTOOL_BEFORE /
+ESPTOOL_AFTER environment variables). Linux and macOS; stdlib only.
+
+  python scripts/esp_emulator.py --chip esp32s3 --flash-size 4MB --link-bps 200000 --link /tmp/ttyESP0
+"""
+from __future__ import annotations
+
+import argparse
+import hashlib
+import os
+import random
+import select
+import struct
+import sys
+import threading
+import time
+import tty
+import zlib
+
+SLIP_END = 0xC0
+SLIP_ESC = 0xDB
+
+# Commands (esptool loader.py names)
+FLASH_BEGIN = 0x02
+FLASH_DATA = 0x03
+FLASH_END = 0x04
+MEM_BEGIN = 0x05
+MEM_END = 0x06
+MEM_DATA = 0x07
+SYNC = 0x08
+WRITE_REG = 0x09
+READ_REG = 0x0A
+SPI_SET_PARAMS = 0x0B
+SPI_ATTACH = 0x0D
+CHANGE_BAUDRATE = 0x0F
+FLASH_DEFL_BEGIN = 0x10
+FLASH_DEFL_DATA = 0x11
+FLASH_DEFL_END = 0x12
+SPI_FLASH_MD5 = 0x13
+GET_SECURITY_INFO = 0x14
+ERASE_FLASH = 0xD0
+ERASE_REGION = 0xD1
+READ_FLASH = 0xD2
+RUN_USER_CODE = 0xD3
+
+ROM_INVALID_RECV_MSG = 0x05
+STUB_BAD_DATA_CHECKSUM = 0xC1
+STUB_BAD_DATA_LEN = 0xC0
+STUB_CMD_NOT_IMPLEMENTED = 0xFF
+CHECKSUM_SEED = 0xEF
+ROM_BAUD = 115200
+SPI_CMD_USR = 1 << 18
+SPIFLASH_RDID = 0x9F
+CHIP_DETECT_MAGIC_REG = 0x40001000
+
+CHIPS = {
+    "esp32": {
+        "magic": 0x00F01D83, "chip_id": None, "spi_base": 0x3FF42000, "usr2": 0x24, "w0": 0x80,
+        "mac": ("esp32", 0x3FF5A000), "regs": {0x3FF40014: 347},  # UART_CLKDIV: 40 MHz crystal at 115200
+    },
+    "esp32s2": {"magic": 0x000007C6, "chip_id": 2, "spi_base": 0x3F402000, "usr2": 0x20, "w0": 0x58, "mac": ("efuse", 0x3F41A044)},
+    "esp32s3": {"magic": 0x00000009, "chip_id": 9, "spi_base": 0x60002000, "usr2": 0x20, "w0": 0x58, "mac": ("efuse", 0x60007044)},
+    "esp32c3": {"magic": 0x1B31506F, "chip_id": 5, "spi_base": 0x60002000, "usr2": 0x20, "w0": 0x58, "mac": ("efuse", 0x60008844)},
+}
+_FLASH_ID_BY_SIZE = {1 << 20: 0x14, 2 << 20: 0x15, 4 << 20: 0x16, 8 << 20: 0x17, 16 << 20: 0x18, 32 << 20: 0x19}
+
+
+def parse_size(text) -> int:
+    """'4MB' / '512KB' / '0x400000' / 4194304 -> bytes."""
+    if isinstance(text, int):
+        return text
+    t = str(text).strip().upper()
+    for suffix, mult in (("MB", 1 << 20), ("KB", 1 << 10)):
+        if t.endswith(suffix):
+            return int(float(t[: -len(suffix)]) * mult)
+    return int(t, 0)
+
+
+def slip_encode(data: bytes) -> bytes:
+    return bytes([SLIP_END]) + data.replace(b"\xdb", b"\xdb\xdd").replace(b"\xc0", b"\xdb\xdc") + bytes([SLIP_END])
+
+
+class EspEmulator:
+    """
+    One emulated board. flash: initial image (bytes; padded with 0xFF to flash_size) or None for erased flash.
+    link_bps: bytes/sec each way (None = negotiated baud / 10; 0 = unthrottled). latency: seconds before each
+    response. error_rate: probability of corrupting a read block / write packet. max_read: read_flash requests
+    above this many bytes drop data mid-transfer. link_path: optional symlink to the pty (stable port name).
+    """
+
+    def __init__(self, chip: str = "esp32s3", flash_size="4MB", flash: bytes | None = None,
+                 mac: str | None = None, link_bps: int | None = None, latency: float = 0.0,
+                 error_rate: float = 0.0, max_read: int | None = None, seed: int | None = None,
+                 link_path: str | None = None):
+        if chip not in CHIPS:
+            raise ValueError(f"Unsupported chip {chip} (have: {', '.join(CHIPS)})")
+        self.chip = chip
+        self.spec = CHIPS[chip]
+        size = parse_size(flash_size)
+        self.flash = bytearray(flash or b"")[:size]
+        self.flash.extend(b"\xff" * (size - len(self.flash)))
+        rnd = random.Random(seed)
+        self.mac = bytes.fromhex(mac.replace(":", "")) if mac else bytes([0x24, 0x58, 0x7C] + [rnd.randrange(256) for _ in range(3)])
+        self.link_bps = link_bps
+        self.latency = latency
+        self.error_rate = error_rate
+        self.max_read = max_read
+        self.link_path = link_path
+        self._rnd = rnd
+        self._master = None
+        self._port = None
+        self._thread = None
+        self._stop = threading.Event()
+        self.stats = {"connections": 0, "commands": 0, "bytes_read": 0, "bytes_written": 0, "errors_injected": 0}
+        self._reset()
+
+    # -- lifecycle -----------------------------------------------------------------------------------------------
+
+    @property
+    def port(self) -> str:
+        return self.link_path or self._port
+
+    def start(self) -> str:
+        """Create the pty and start serving. Returns the port path to hand to esptool."""
+        master, slave = os.openpty()
+        tty.setraw(slave)
+        self._port = os.ttyname(slave)
+        os.close(slave)  # nothing holds the port open until a client does (port_leases sees it as free)
+        self._master = master
+        if self.link_path:
+            try:
+                os.remove(self.link_path)
+            except OSError:
+                pass
+            os.symlink(self._port, self.link_path)
+        self._thread = threading.Thread(target=self._serve, name=f"esp-emulator-{self.chip}", daemon=True)
+        self._thread.start()
+        return self.port
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout=2)
+        if self._master is not None:
+            os.close(self._master)
+            self._master = None
+        if self.link_path:
+            try:
+                os.remove(self.link_path)
+            except OSError:
+                pass
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _reset(self) -> None:
+        """Chip reset: back to the ROM loader at the ROM baud rate."""
+        self.stub = False
+        self.baud = ROM_BAUD
+        self.regs = dict(self.spec.get("regs") or {})
+        self.regs[CHIP_DETECT_MAGIC_REG] = self.spec["magic"]
+        kind, addr = self.spec["mac"]
+        if kind == "esp32":
+            self.regs[addr + 4] = struct.unpack(">I", self.mac[2:6])[0]
+            self.regs[addr + 8] = struct.unpack(">H", self.mac[0:2])[0]
+        else:
+            self.regs[addr] = struct.unpack(">I", self.mac[2:6])[0]
+            self.regs[addr + 4] = struct.unpack(">H", self.mac[0:2])[0]
+        self._write = None
+        self._read = None
+        self._rx = bytearray()
+        self._in_frame = False
+        self._escape = False
+
+    # -- link ----------------------------------------------------------------------------------------------------
+
+    def _bps(self):
+        return self.baud / 10 if self.link_bps is None else self.link_bps
+
+    def _throttle(self, nbytes: int) -> None:
+        bps = self._bps()
+        if bps:
+            time.sleep(nbytes / bps)
+
+    def _send_frame(self, data: bytes) -> None:
+        frame = slip_encode(data)
+        self._throttle(len(frame))
+        try:
+            os.write(self._master, frame)
+        except OSError:
+            pass
+
+    def _respond(self, op: int, val: int = 0, data: bytes = b"", error: int = 0) -> None:
+        if self.latency:
+            time.sleep(self.latency)
+        status = bytes([1 if error else 0, error]) + (b"" if self.stub else b"\x00\x00")
+        body = data + status
+        self._send_frame(struct.pack("<BBHI", 1, op, len(body), val) + body)
+
+    def _serve(self) -> None:
+        connected = False
+        while not self._stop.is_set():
+            try:
+                ready, _, _ = select.select([self._master], [], [], 0.1)
+                if not ready:
+                    continue
+                chunk = os.read(self._master, 65536)
+            except OSError:
+                # EIO: no process has the port open (closed after an esptool run) -> the chip resets
+                if connected:
+                    connected = False
+                    self._reset()
+                time.sleep(0.02)
+                continue
+            if not chunk:
+                continue
+            if not connected:
+                connected = True
+                self.stats["connections"] += 1
+            self._throttle(len(chunk))
+            for frame in self._deframe(chunk):
+                try:
+                    self._handle(frame)
+                except Exception as e:  # malformed packet: answer like a confused ROM, never die
+                    print(f"esp_emulator: {e}", file=sys.stderr)
+
+    def _deframe(self, chunk: bytes):
+        for b in chunk:
+            if b == SLIP_END:
+                if self._in_frame and self._rx:
+                    yield bytes(self._rx)
+                self._rx.clear()
+                self._in_frame = True
+                self._escape = False
+            elif not self._in_frame:
+                continue  # noise between frames
+            elif self._escape:
+                self._rx.append({0xDC: SLIP_END, 0xDD: SLIP_ESC}.get(b, b))
+                self._escape = False
+            elif b == SLIP_ESC:
+                self._escape = True
+            else:
+                self._rx.append(b)
+
+    # -- protocol ------------------------------------------------------------------------------------------------
+
+    def _handle(self, frame: bytes) -> None:
+        if self._read is not None and len(frame) == 4:
+            self._read_ack(struct.unpack("<I", frame)[0])
+            return
+        self._read = None
+        if len(frame) < 8 or frame[0] != 0:
+            return
+        _, op, size, checksum = struct.unpack("<BBHI", frame[:8])
+        data = frame[8:8 + size]
+        self.stats["commands"] += 1
+        handler = {
+            SYNC: self._sync,
+            READ_REG: self._read_reg,
+            WRITE_REG: self._write_reg,
+            GET_SECURITY_INFO: self._security_info,
+            MEM_BEGIN: self._ok,
+            MEM_DATA: self._ok,
+            MEM_END: self._mem_end,
+            SPI_ATTACH: self._ok,
+            SPI_SET_PARAMS: self._ok,
+            CHANGE_BAUDRATE: self._change_baud,
+            FLASH_BEGIN: self._flash_begin,
+            FLASH_DATA: self._flash_data,
+            FLASH_END: self._flash_end,
+            FLASH_DEFL_BEGIN: self._flash_begin,
+            FLASH_DEFL_DATA: self._flash_data,
+            FLASH_DEFL_END: self._flash_end,
+            SPI_FLASH_MD5: self._md5,
+        }.get(op)
+        if self.stub and handler is None:
+            handler = {ERASE_FLASH: self._erase_flash, ERASE_REGION: self._erase_region, READ_FLASH: self._read_flash,
+                       RUN_USER_CODE: self._run_user_code}.get(op)
+        if handler is None:
+            self._respond(op, error=STUB_CMD_NOT_IMPLEMENTED if self.stub else ROM_INVALID_RECV_MSG)
+            return
+        handler(op, data, checksum)
+
+    def _ok(self, op, data, checksum):
+        self._respond(op)
+
+    def _sync(self, op, data, checksum):
+        for _ in range(8):  # the ROM answers every SYNC eight times; esptool reads them all
+            self._respond(op, val=0 if self.stub else 0x20120707)
+
+    def _read_reg(self, op, data, checksum):
+        (addr,) = struct.unpack("<I", data[:4])
+        self._respond(op, val=self.regs.get(addr, 0))
+
+    def _write_reg(self, op, data, checksum):
+        for pos in range(0, len(data) - 15, 16):
+            addr, value, mask, _ = struct.unpack("<IIII", data[pos:pos + 16])
+            self.regs[addr] = (self.regs.get(addr, 0) & ~mask) | (value & mask)
+            self._spi_peripheral(addr)
+        self._respond(op)
+
+    def _spi_peripheral(self, addr: int) -> None:
+        """SPI0/1 user command: esptool sets USR2 (command) and CMD.USR, then polls CMD and reads W0."""
+        base = self.spec["spi_base"]
+        if addr != base or not self.regs[addr] & SPI_CMD_USR:
+            return
+        command = self.regs.get(base + self.spec["usr2"], 0) & 0xFF
+        if command == SPIFLASH_RDID:
+            size_id = _FLASH_ID_BY_SIZE.get(len(self.flash), 0x16)
+            self.regs[base + self.spec["w0"]] = (size_id << 16) | (0x40 << 8) | 0xEF  # Winbond W25Q
+        else:
+            self.regs[base + self.spec["w0"]] = 0  # status registers: idle, no protection
+        self.regs[addr] &= ~SPI_CMD_USR
+
+    def _security_info(self, op, data, checksum):
+        chip_id = self.spec["chip_id"]
+        if chip_id is None:
+            self._respond(op, error=ROM_INVALID_RECV_MSG if not self.stub else STUB_CMD_NOT_IMPLEMENTED)
+        elif chip_id == 2:  # ESP32-S2: no chip ID / ECO fields
+            self._respond(op, data=struct.pack("<IBBBBBBBB", 0, 0, *([0] * 7)))
+        else:
+            self._respond(op, data=struct.pack("<IBBBBBBBBII", 0, 0, *([0] * 7), chip_id, 0))
+
+    def _mem_end(self, op, data, checksum):
+        _, entry = struct.unpack("<II", data[:8])
+        self._respond(op)
+        if entry and not self.stub:
+            self.stub = True  # the uploaded flasher stub starts and greets the host
+            self._send_frame(b"OHAI")
+
+    def _change_baud(self, op, data, checksum):
+        (new_baud,) = struct.unpack("<I", data[:4])
+        self._respond(op)
+        self.baud = new_baud
+
+    def _flash_begin(self, op, data, checksum):
+        erase_size, _, _, offset = struct.unpack("<IIII", data[:16])
+        if offset + erase_size > len(self.flash):
+            self._respond(op, error=STUB_BAD_DATA_LEN)
+            return
+        if erase_size:
+            end = min(len(self.flash), -(-(offset + erase_size) // 0x1000) * 0x1000)
+            self.flash[offset:end] = b"\xff" * (end - offset)
+        self._write = {
+            "offset": offset,
+            "pos": 0,
+            "inflate": zlib.decompressobj() if op == FLASH_DEFL_BEGIN else None,
+        }
+        self._respond(op)
+
+    def _flash_data(self, op, data, checksum):
+        if self._write is None:
+            self._respond(op, error=STUB_BAD_DATA_LEN)
+            return
+        size = struct.unpack("<I", data[:4])[0]
+        payload = data[16:16 + size]
+        calc = CHECKSUM_SEED
+        for b in payload:
+            calc ^= b
+        if calc != checksum & 0xFF or (self.error_rate and self._rnd.random() < self.error_rate):
+            if calc == checksum & 0xFF:
+                self.stats["errors_injected"] += 1
+            self._respond(op, error=STUB_BAD_DATA_CHECKSUM)
+            return
+        chunk = self._write["inflate"].decompress(payload) if self._write["inflate"] else payload
+        start = self._write["offset"] + self._write["pos"]
+        self.flash[start:start + len(chunk)] = chunk
+        self._write["pos"] += len(chunk)
+        self.stats["bytes_written"] += len(chunk)
+        self._respond(op)
+
+    def _flash_end(self, op, data, checksum):
+        self._write = None
+        self._respond(op)
+        if data[:4] == b"\x00\x00\x00\x00" and not self.stub:
+            self._reset()  # ROM flash_end(reboot=True): the chip runs the app
+
+    def _md5(self, op, data, checksum):
+        addr, size = struct.unpack("<II", data[:8])
+        digest = hashlib.md5(bytes(self.flash[addr:addr + size]))
+        self._respond(op, data=digest.digest() if self.stub else digest.hexdigest().encode())
+
+    def _erase_flash(self, op, data, checksum):
+        self.flash[:] = b"\xff" * len(self.flash)
+        self._respond(op)
+
+    def _erase_region(self, op, data, checksum):
+        offset, size = struct.unpack("<II", data[:8])
+        self.flash[offset:offset + size] = b"\xff" * size
+        self._respond(op)
+
+    def _run_user_code(self, op, data, checksum):
+        self._reset()
+
+    def _read_flash(self, op, data, checksum):
+        offset, length, block, in_flight = struct.unpack("<IIII", data[:16])
+        if offset + length > len(self.flash) or not block:
+            self._respond(op, error=STUB_BAD_DATA_LEN)
+            return
+        self._respond(op)
+        self._read = {
+            "offset": offset, "length": length, "block": block, "window": max(1, in_flight) * block,
+            "sent": 0, "acked": 0, "md5": hashlib.md5(),
+            "drop_at": self.max_read if self.max_read and length > self.max_read else None,
+        }
+        self._read_pump()
+
+    def _read_pump(self) -> None:
+        r = self._read
+        while r["sent"] < r["length"] and r["sent"] - r["acked"] < r["window"]:
+            start = r["offset"] + r["sent"]
+            data = bytes(self.flash[start:start + min(r["block"], r["length"] - r["sent"])])
+            r["md5"].update(data)
+            r["sent"] += len(data)
+            if r["drop_at"] is not None and r["sent"] > r["drop_at"]:
+                self.stats["errors_injected"] += 1
+                self._send_frame(data[: len(data) // 2])  # short block: the host sees corrupt / missing data
+                self._read = None
+                return
+            if self.error_rate and self._rnd.random() < self.error_rate:
+                self.stats["errors_injected"] += 1
+                data = bytes([data[0] ^ 0xFF]) + data[1:]  # bit errors on the wire: the final digest won't match
+            self._send_frame(data)
+            self.stats["bytes_read"] += len(data)
+
+    def _read_ack(self, acked: int) -> None:
+        r = self._read
+        r["acked"] = acked
+        if acked >= r["length"]:
+            self._read = None
+            self._send_frame(r["md5"].digest())
+        else:
+            self._read_pump()
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Emulated ESP32 board on a pty (esptool ROM/stub protocol).")
+    parser.add_argument("--chip", default="esp32s3", choices=sorted(CHIPS))
+    parser.add_argument("--flash-size", default="4MB")
+    parser.add_argument("--image", help="Initial flash contents (raw .bin at 0x0)")
+    parser.add_argument("--save", help="Write the flash image here on exit")
+    parser.add_argument("--link-bps", type=int, default=None, help="Bytes/sec each way (default: baud/10; 0 = unthrottled)")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds before each response")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Probability of corrupting a read block / write packet")
+    parser.add_argument("--max-read", type=parse_size, default=None, help="read_flash requests above this drop data")
+    parser.add_argument("--mac", help="aa:bb:cc:dd:ee:ff (default: random Espressif OUI)")
+    parser.add_argument("--link", help="Symlink to create for the port (e.g. /tmp/ttyESP0)")
+    parser.add_argument("--seed", type=int)
+    args = parser.parse_args(argv)
+
+    image = None
+    if args.image:
+        with open(args.image, "rb") as f:
+            image = f.read()
+    emu = EspEmulator(args.chip, args.flash_size, image, mac=args.mac, link_bps=args.link_bps, latency=args.latency,
+                      error_rate=args.error_rate, max_read=args.max_read, seed=args.seed, link_path=args.link)
+    port = emu.start()
+    print(port, flush=True)
+    print(f"Emulating {args.chip} ({len(emu.flash) // 1024} KB flash, MAC {emu.mac.hex(':')}); "
+          "use esptool --before no_reset --after no_reset. Ctrl-C to stop.", file=sys.stderr)
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        emu.stop()
+        if args.save:
+            with open(args.save, "wb") as f:
+                f.write(emu.flash)
+        print(f"Stats: {emu.stats}", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -4,6 +4,8 @@
 # Example: ./scripts/lab-build.sh t_beam_1w meshcore T_Beam_1W_SX1262_repeater
 # Example: ./scripts/lab-build.sh lumari_watch lumari_watch
 # Build in container, flash from host. See CONTEXT.md and docker/README.md.
+# Builds run in warm per-toolchain containers via scripts/lab-exec.sh (LAB_WARM=0: fresh docker run per build).
+# LAB_BUILD_WORK_DIR: build this project directory inside the repo instead (e.g. a build worktree at another ref).
 set -e
 ROOT="$(cd "$(dirname "$0")/.." && pwd)"
 cd "$ROOT"
@@ -18,6 +20,13 @@ WORK_DIR="$ROOT/devices/$DEVICE_ID/firmware/$FIRMWARE_ID"
 if [ ! -f "$WORK_DIR/platformio.ini" ] && [ -f "$WORK_DIR/firmware/platformio.ini" ]; then
   WORK_DIR="$WORK_DIR/firmware"
 fi
+if [ -n "${LAB_BUILD_WORK_DIR:-}" ]; then
+  WORK_DIR="$(cd "$LAB_BUILD_WORK_DIR" && pwd)"
+  case "$WORK_DIR" in
+    "$ROOT"/*) ;;
+    *) echo "lab-build: LAB_BUILD_WORK_DIR must be inside the repo ($ROOT)" >&2; exit 1 ;;
+  esac
+fi
 
 # Detect toolchain: PlatformIO vs ESP-IDF (L6)
 TOOLCHAIN=""
@@ -46,12 +55,7 @@ if [ "$TOOLCHAIN" = "idf" ]; then
   esac
   echo "lab-build: device=$DEVICE_ID firmware=$FIRMWARE_ID (ESP-IDF target=$IDF_TARGET) -> $ARTIFACT_DIR"
   echo "Running in container (esp-idf-lab)..."
-  docker run --rm \
-    -v "$ROOT:/workspace" \
-    -w "/workspace/$WORK_REL" \
-    -e HOME=/tmp \
-    -e IDF_GIT_SAFE_DIR="/workspace" \
-    esp-idf-lab \
+  "$ROOT/scripts/lab-exec.sh" idf "$WORK_REL" -- \
     bash -c "idf.py set-target $IDF_TARGET && idf.py build"
   # Copy IDF build outputs: bootloader.bin, partitions.bin, main app .bin
   BUILD_OUT="$WORK_DIR/build"
@@ -97,17 +101,10 @@ if [ "$FIRMWARE_ID" = "meshcore" ]; then
   # Build then explicit merge in same container (framework packages needed for boot_app0).
   # Merge can fail if esptool not on PATH; copy boot_app0 out so host can merge.
   ARTIFACT_REL="artifacts/$DEVICE_ID/$FIRMWARE_ID/$VERSION"
-  docker run --rm \
-    -v "$ROOT:/workspace" \
-    -w "/workspace/$WORK_REL" \
-    -e "ARTIFACT_REL=$ARTIFACT_REL" \
-    platformio-lab \
+  "$ROOT/scripts/lab-exec.sh" platformio "$WORK_REL" -e "ARTIFACT_REL=$ARTIFACT_REL" -- \
     bash -c "pio run -e '$ENV_NAME'; ( chmod +x merge_tbeam1w_explicit.sh 2>/dev/null; ./merge_tbeam1w_explicit.sh '$ENV_NAME' ) || true; mkdir -p \"/workspace/\$ARTIFACT_REL\" && for b in /root/.platformio/packages/framework-arduinoespressif32 \$HOME/.platformio/packages/framework-arduinoespressif32; do [ -f \"\$b/tools/partitions/boot_app0.bin\" ] && cp \"\$b/tools/partitions/boot_app0.bin\" \"/workspace/\$ARTIFACT_REL/boot_app0.bin\" && echo 'Copied boot_app0 to artifact dir' && break; done"
 else
-  docker run --rm \
-    -v "$ROOT:/workspace" \
-    -w "/workspace/$WORK_REL" \
-    platformio-lab \
+  "$ROOT/scripts/lab-exec.sh" platformio "$WORK_REL" -- \
     pio run -e "$ENV_NAME"
 fi
 
@@ -140,7 +137,7 @@ if [ -n "$FIRM_BIN" ] && [ -f "$FIRM_BIN" ]; then
     echo "  Merging on host (bootloader + partitions + boot_app0 + app) -> firmware.factory.bin..."
     BOOT_APP0="$ARTIFACT_DIR/boot_app0.bin"
     if [ ! -f "$BOOT_APP0" ]; then
-      docker run --rm -v "$ROOT:/workspace" -w "/workspace/$WORK_REL" platformio-lab \
+      "$ROOT/scripts/lab-exec.sh" platformio "$WORK_REL" -- \
         sh -c 'for b in /root/.platformio/packages/framework-arduinoespressif32 "$HOME/.platformio/packages/framework-arduinoespressif32"; do [ -f "$b/tools/partitions/boot_app0.bin" ] && cat "$b/tools/partitions/boot_app0.bin" && exit 0; done; exit 1' > "$BOOT_APP0" 2>/dev/null || true
       [ ! -s "$BOOT_APP0" ] && rm -f "$BOOT_APP0"
     fi
@@ -0,0 +1,175 @@
+#!/usr/bin/env bash
+# Run a command in a warm build container via docker exec instead of a fresh docker run --rm per build.
+# One long-lived container per toolchain (lab-build-platformio from platformio-lab, lab-build-idf from esp-idf-lab)
+# with the repo at /workspace and named volumes for PlatformIO packages and the shared compiler cache (lab-ccache,
+# used by both toolchains: idf.py via IDF_CCACHE_ENABLE, pio via scripts/pio_ccache.py), so container startup,
+# toolchain environment setup and package resolution are paid once, not per build.
+# The container is recycled when its image changes, after LAB_MAX_BUILDS builds, when it fails a health check, or when
+# its mounts or environment differ from what this script would create. Builds run in parallel: inspecting, recycling
+# and creating the container happen under a host lock (.lab-exec/<container>.lock), and a container with builds still
+# running in it (markers in /tmp/.lab-active) is recycled once they finish: after an image change or LAB_MAX_BUILDS
+# the next idle invocation replaces it, after a mounts / environment change this one waits for them.
+# Killing docker exec does not stop the process it started, so each build runs as its own session in the container and
+# SIGTERM / SIGINT to this script (a cancelled or timed-out build) terminates that session there (SIGKILL after 10 s).
+# Usage: lab-exec.sh <platformio|idf> <workdir relative to repo> [-e VAR=value ...] -- <command...>
+# Env: LAB_WARM=0 (docker run --rm per build, as before), LAB_MAX_BUILDS (default 50),
+#      LAB_HOST_ROOT (repo path as the docker daemon sees it, when running inside the inventory container),
+#      LAB_IMAGE_PLATFORMIO / LAB_IMAGE_IDF (image names), BUILD_CCACHE_MAX_SIZE (ccache size limit, default 5G),
+#      CCACHE_STATSLOG (per-build ccache stats log; a path inside the repo is mapped into the container).
+# Status lines go to stderr, prefixed "lab-exec:"; a warm run reports "saved_s=<seconds>" (the measured cold start it skipped).
+set -e
+ROOT="$(cd "$(dirname "$0")/.." && pwd)"
+HOST_ROOT="${LAB_HOST_ROOT:-$ROOT}"
+MAX_BUILDS="${LAB_MAX_BUILDS:-50}"
+
+TOOLCHAIN="$1"
+WORK_REL="$2"
+shift 2 || { echo "Usage: lab-exec.sh <platformio|idf> <workdir> [-e VAR=value ...] -- <command...>" >&2; exit 2; }
+# Per-build environment, applied after the container's captured toolchain environment
+ENV_PAIRS=("CCACHE_MAXSIZE=${BUILD_CCACHE_MAX_SIZE:-5G}")
+case "${CCACHE_STATSLOG:-}" in
+  "$ROOT"/*) ENV_PAIRS+=("CCACHE_STATSLOG=/workspace/${CCACHE_STATSLOG#$ROOT/}") ;;
+esac
+while [ $# -gt 0 ] && [ "$1" != "--" ]; do
+  case "$1" in
+    -e) ENV_PAIRS+=("$2"); shift 2 ;;
+    *) echo "lab-exec: unexpected argument $1" >&2; exit 2 ;;
+  esac
+done
+[ "${1:-}" = "--" ] && shift
+[ $# -gt 0 ] || { echo "lab-exec: no command" >&2; exit 2; }
+
+case "$TOOLCHAIN" in
+  platformio)
+    IMAGE="${LAB_IMAGE_PLATFORMIO:-platformio-lab}"
+    VOLUMES=(-v lab-pio-packages:/root/.platformio -v lab-ccache:/ccache)
+    TC_ENV=(-e PLATFORMIO_EXTRA_SCRIPTS=pre:/workspace/scripts/pio_ccache.py)
+    SETUP_ENV='true'
+    ;;
+  idf)
+    IMAGE="${LAB_IMAGE_IDF:-esp-idf-lab}"
+    VOLUMES=(-v lab-ccache:/ccache)
+    TC_ENV=(-e HOME=/tmp -e IDF_GIT_SAFE_DIR=/workspace -e IDF_CCACHE_ENABLE=1)
+    # docker exec skips the image entrypoint that sources export.sh; source it once and replay the result per build
+    SETUP_ENV='. "$IDF_PATH/export.sh" >/dev/null 2>&1'
+    ;;
+  *) echo "lab-exec: unknown toolchain $TOOLCHAIN (platformio or idf)" >&2; exit 2 ;;
+esac
+# Sources under /workspace hash by relative path, so worktrees and the shared checkout hit the same cache entries
+TC_ENV+=(-e CCACHE_DIR=/ccache -e CCACHE_BASEDIR=/workspace -e CCACHE_NOHASHDIR=1)
+ENV_ARGS=()
+for pair in "${ENV_PAIRS[@]}"; do ENV_ARGS+=(-e "$pair"); done
+# Mounts and environment the container is created with; a container created differently is recycled
+CONFIG="$(echo "$HOST_ROOT ${VOLUMES[*]} ${TC_ENV[*]}" | cksum | cut -d' ' -f1)"
+
+if [ "${LAB_WARM:-1}" = "0" ]; then
+  exec docker run --rm -v "$HOST_ROOT:/workspace" -w "/workspace/$WORK_REL" "${VOLUMES[@]}" "${TC_ENV[@]}" "${ENV_ARGS[@]}" \
+    "$IMAGE" bash -c "$SETUP_ENV; exec \"\$@\"" bash "$@"
+fi
+
+NAME="lab-build-$TOOLCHAIN"
+LOCK_DIR="${LAB_LOCK_DIR:-$ROOT/.lab-exec}"
+mkdir -p "$LOCK_DIR"
+if command -v flock >/dev/null 2>&1; then
+  exec 9>"$LOCK_DIR/$NAME.lock"
+  flock 9
+  unlock() { exec 9>&-; }
+else
+  # No flock (macOS): mkdir is atomic; a lock left by a killed invocation expires after 10 minutes
+  until mkdir "$LOCK_DIR/$NAME.lockdir" 2>/dev/null; do
+    [ -n "$(find "$LOCK_DIR/$NAME.lockdir" -maxdepth 0 -mmin +10 2>/dev/null)" ] && rmdir "$LOCK_DIR/$NAME.lockdir" 2>/dev/null
+    sleep 0.2
+  done
+  trap 'rmdir "$LOCK_DIR/$NAME.lockdir" 2>/dev/null' EXIT
+  unlock() { rmdir "$LOCK_DIR/$NAME.lockdir" 2>/dev/null; trap - EXIT; }
+fi
+# Builds running in the container: one marker per build holding its in-container PID (empty while it starts);
+# markers of dead builds are dropped
+active_builds() {
+  docker exec "$NAME" sh -c 'n=0; for f in /tmp/.lab-active/*; do [ -e "$f" ] || continue; p=$(cat "$f")
+    if [ -z "$p" ]; then if [ -n "$(find "$f" -mmin -2)" ]; then n=$((n + 1)); else rm -f "$f"; fi
+    elif kill -0 "$p" 2>/dev/null; then n=$((n + 1)); else rm -f "$f"; fi; done; echo $n' 2>/dev/null || echo 0
+}
+
+IMAGE_ID="$(docker image inspect -f '{{.Id}}' "$IMAGE" 2>/dev/null)" || {
+  echo "lab-exec: image $IMAGE not found (see docker/README.md)" >&2
+  exit 1
+}
+
+if docker container inspect "$NAME" >/dev/null 2>&1; then
+  REASON=""
+  if [ "$(docker container inspect -f '{{.Image}}' "$NAME")" != "$IMAGE_ID" ]; then
+    REASON="image $IMAGE changed"
+  elif [ "$(docker container inspect -f '{{index .Config.Labels "cyber-lab.config"}}' "$NAME")" != "$CONFIG" ]; then
+    REASON="mounts or environment changed"
+  elif [ "$(docker container inspect -f '{{.State.Running}}' "$NAME")" != "true" ]; then
+    REASON="not running"
+  elif ! timeout 15 docker exec "$NAME" test -f /tmp/.lab-env; then
+    REASON="health check failed"
+  else
+    BUILDS="$(docker exec "$NAME" cat /tmp/.lab-builds 2>/dev/null || echo 0)"
+    [ "$BUILDS" -ge "$MAX_BUILDS" ] && REASON="$BUILDS builds"
+  fi
+  if [ -n "$REASON" ]; then
+    ACTIVE=0
+    case "$REASON" in
+      "not running"|"health check failed") ;;  # nothing usable runs in it
+      *) ACTIVE="$(active_builds)" ;;
+    esac
+    if [ "$ACTIVE" -gt 0 ] && [ "$REASON" != "mounts or environment changed" ]; then
+      echo "lab-exec: $NAME due for recycling ($REASON), deferred: $ACTIVE build(s) running in it" >&2
+    else
+      while [ "$ACTIVE" -gt 0 ]; do
+        echo "lab-exec: $NAME must be recycled ($REASON); waiting for $ACTIVE running build(s)" >&2
+        sleep 5
+        ACTIVE="$(active_builds)"
+      done
+      echo "lab-exec: recycling $NAME ($REASON)" >&2
+      docker rm -f "$NAME" >/dev/null
+    fi
+  fi
+fi
+
+if ! docker container inspect "$NAME" >/dev/null 2>&1; then
+  T0="$(date +%s.%N)"
+  docker run -d --name "$NAME" \
+    --label "cyber-lab.build-runner=$TOOLCHAIN" --label "cyber-lab.config=$CONFIG" --label "cyber-lab.image=$IMAGE" \
+    -v "$HOST_ROOT:/workspace" "${VOLUMES[@]}" "${TC_ENV[@]}" \
+    "$IMAGE" sleep infinity >/dev/null
+  docker exec "$NAME" bash -c "$SETUP_ENV; export -p > /tmp/.lab-env; echo 0 > /tmp/.lab-builds"
+  COLD="$(awk -v a="$T0" -v b="$(date +%s.%N)" 'BEGIN { printf "%.1f", b - a }')"
+  docker exec "$NAME" sh -c "echo $COLD > /tmp/.lab-cold-start-s"
+  echo "lab-exec: started $NAME from $IMAGE (cold start ${COLD}s; later builds reuse it)" >&2
+  WARM=0
+else
+  WARM=1
+fi
+
+# Count the build and register it as running while still holding the lock, so no one recycles the container under it
+TOKEN="$$-$(date +%s)-$RANDOM"
+BUILDS="$(docker exec "$NAME" sh -c 'mkdir -p /tmp/.lab-active; : > "/tmp/.lab-active/$1"
+  n=$(( $(cat /tmp/.lab-builds 2>/dev/null || echo 0) + 1 )); echo $n > /tmp/.lab-builds; echo $n' sh "$TOKEN")"
+unlock
+if [ "$WARM" = "1" ]; then
+  echo "lab-exec: warm $NAME (build $BUILDS/$MAX_BUILDS), saved_s=$(docker exec "$NAME" cat /tmp/.lab-cold-start-s)" >&2
+fi
+# The build is a session leader in the container (setsid): its marker PID is also its process group
+docker exec -w "/workspace/$WORK_REL" "$NAME" setsid -w bash -c \
+  'echo $$ > "/tmp/.lab-active/$0"; trap "rm -f \"/tmp/.lab-active/$0\"" EXIT; . /tmp/.lab-env; env "$@"' \
+  "$TOKEN" "${ENV_PAIRS[@]}" "$@" &
+CLIENT=$!
+stop_build() {
+  trap '' INT TERM
+  echo "lab-exec: stopping build $TOKEN in $NAME" >&2
+  docker exec "$NAME" sh -c 'i=0; while [ -e "/tmp/.lab-active/$1" ] && [ ! -s "/tmp/.lab-active/$1" ] && [ $i -lt 25 ]; do
+      sleep 0.2; i=$((i + 1)); done  # still starting: wait for its PID
+    p=$(cat "/tmp/.lab-active/$1" 2>/dev/null); [ -n "$p" ] || exit 0
+    kill -TERM "-$p" 2>/dev/null; i=0
+    while kill -0 "-$p" 2>/dev/null && [ $i -lt 50 ]; do sleep 0.2; i=$((i + 1)); done
+    kill -KILL "-$p" 2>/dev/null; rm -f "/tmp/.lab-active/$1"' sh "$TOKEN"
+  kill "$CLIENT" 2>/dev/null
+  wait "$CLIENT" 2>/dev/null || true
+  exit 143
+}
+trap stop_build INT TERM
+wait "$CLIENT"
@@ -0,0 +1,16 @@
+"""
+PlatformIO pre: extra script: compile C/C++ through ccache when it is installed.
+Passed in PLATFORMIO_EXTRA_SCRIPTS by the inventory app's builds and scripts/lab-exec.sh, so firmware repos need
+no changes. Cache location, size limit and per-build stats log come from the CCACHE_* environment.
+Prefixes the compile command lines (not $CC), so the platform setting CC later and every cloned library
+environment still go through ccache.
+"""
+import shutil
+
+Import("env")  # noqa: F821 - provided by SCons
+
+if shutil.which("ccache"):
+    for var in ("CCCOM", "CXXCOM", "SHCCCOM", "SHCXXCOM"):
+        cmd = env.get(var)  # noqa: F821
+        if isinstance(cmd, str) and not cmd.startswith("ccache "):
+            env.Replace(**{var: "ccache " + cmd})  # noqa: F821
@@ -0,0 +1,17 @@
+"""
+PlatformIO pre: extra script: time every C/C++/assembly compile for per-translation-unit build statistics.
+Passed in PLATFORMIO_EXTRA_SCRIPTS by the inventory app's builds (build_stats.pio_env) together with
+BUILD_UNIT_LOG and BUILD_UNIT_WRAPPER (scripts/time_unit.py); each compile command runs under the wrapper,
+which appends its duration to the log. Listed after pio_ccache.py so the timing wraps ccache (a hit is a fast compile).
+"""
+import os
+
+Import("env")  # noqa: F821 - provided by SCons
+
+wrapper = os.environ.get("BUILD_UNIT_WRAPPER")
+if os.environ.get("BUILD_UNIT_LOG") and wrapper:
+    python = os.environ.get("BUILD_UNIT_PYTHON") or env.subst("$PYTHONEXE")  # noqa: F821
+    for var in ("CCCOM", "CXXCOM", "SHCCCOM", "SHCXXCOM", "ASPPCOM"):
+        cmd = env.get(var)  # noqa: F821
+        if isinstance(cmd, str) and "time_unit.py" not in cmd:
+            env.Replace(**{var: f'"{python}" "{wrapper}" $TARGET -- {cmd}'})  # noqa: F821
@@ -74,6 +74,41 @@ CREATE TABLE IF NOT EXISTS flash_history (
   created_at TEXT NOT NULL
 );
 
+-- Flash telemetry (inventory app telemetry.py, artifacts/telemetry.db): one row per backup/restore/flash operation
+CREATE TABLE IF NOT EXISTS flash_operations (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  kind TEXT NOT NULL,  -- backup, restore, flash, tune, partitions
+  device_id TEXT,
+  chip TEXT,
+  mac TEXT,
+  port TEXT,
+  usb_identity TEXT,  -- VID:PID:serial
+  bytes INTEGER NOT NULL DEFAULT 0,
+  duration_s REAL NOT NULL,
+  bytes_per_sec REAL,
+  esptool_runs INTEGER NOT NULL DEFAULT 0,
+  retries INTEGER NOT NULL DEFAULT 0,
+  outcome TEXT NOT NULL,  -- running, ok, error, cancelled
+  error TEXT,
+  created_at TEXT NOT NULL
+);
+
+-- Flash telemetry: one row per esptool invocation
+CREATE TABLE IF NOT EXISTS esptool_runs (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  operation_id INTEGER REFERENCES flash_operations(id),
+  command TEXT NOT NULL,  -- read-flash, write-flash, verify-flash, erase-flash
+  chip TEXT,
+  port TEXT,
+  baud INTEGER,
+  bytes INTEGER NOT NULL DEFAULT 0,
+  duration_s REAL NOT NULL,
+  bytes_per_sec REAL,
+  outcome TEXT NOT NULL,  -- ok, error, cancelled, timeout, busy, gone
+  error TEXT,
+  created_at TEXT NOT NULL
+);
+
 -- Map builds (region, zoom, tile count, output path)
 CREATE TABLE IF NOT EXISTS map_builds (
   id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -122,6 +157,7 @@ CREATE TABLE IF NOT EXISTS hardware_snapshots (
 CREATE INDEX IF NOT EXISTS idx_flash_history_device ON flash_history(device_id);
 CREATE INDEX IF NOT EXISTS idx_flash_history_user ON flash_history(user_id);
 CREATE INDEX IF NOT EXISTS idx_flash_history_created ON flash_history(created_at);
+CREATE INDEX IF NOT EXISTS idx_esptool_runs_operation ON esptool_runs(operation_id);
 CREATE INDEX IF NOT EXISTS idx_hardware_snapshots_device ON hardware_snapshots(device_id);
 CREATE INDEX IF NOT EXISTS idx_hardware_snapshots_user ON hardware_snapshots(user_id);
 CREATE INDEX IF NOT EXISTS idx_forks_device ON forks(device_id);
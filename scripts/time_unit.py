@@ -0,0 +1,30 @@
+"""
+Compile-command wrapper for per-translation-unit build timing (see scripts/pio_unit_times.py).
+Usage: time_unit.py <target> -- <command...>. Runs the command and appends "<seconds>\t<target>" to $BUILD_UNIT_LOG;
+the command's exit status is passed through.
+"""
+import os
+import subprocess
+import sys
+import time
+
+
+def main() -> int:
+    if len(sys.argv) < 4 or sys.argv[2] != "--":
+        print("Usage: time_unit.py <target> -- <command...>", file=sys.stderr)
+        return 2
+    target, cmd = sys.argv[1], sys.argv[3:]
+    started = time.monotonic()
+    rc = subprocess.call(cmd)
+    log = os.environ.get("BUILD_UNIT_LOG")
+    if log and rc == 0:
+        try:
+            with open(log, "a", encoding="utf-8") as f:  # one short append per unit: safe with parallel compiles
+                f.write(f"{time.monotonic() - started:.3f}\t{target}\n")
+        except OSError:
+            pass
+    return rc
+
+
+if __name__ == "__main__":
+    sys.exit(main())